@@ -36,7 +36,10 @@ CONNECTIVITY_UNKNOWN = None
 DEFAULT_TILE_STORAGE_TYPE = "files"
 TILE_STORAGE_FILES = "files"
 TILE_STORAGE_SQLITE = "sqlite"
-TILE_STORAGE_TYPES = [TILE_STORAGE_FILES, TILE_STORAGE_SQLITE]
+TILE_STORAGE_PACK = "pack"
+TILE_STORAGE_TYPES = [TILE_STORAGE_FILES, TILE_STORAGE_SQLITE, TILE_STORAGE_PACK]
+# read only MBTiles tile packs, can't be used as the primary tile storage type
+TILE_STORAGE_MBTILES = "mbtiles"
 
 # GTK GUI
 PANGO_ON = '<span color="green">ON</span>'
@@ -63,6 +66,10 @@ THREAD_GPSD_CONSUMER = "modRanaGPSDConsumer"
 THREAD_TILE_DOWNLOAD_MANAGER = "modRanaTileDownloadManager"
 THREAD_TILE_DOWNLOAD_WORKER = "modRanaTileDownloadWorker"
 THREAD_TILE_STORAGE_LOADER = "modRanaTileStorageLoader"
+THREAD_TILE_STORAGE_QUOTA_MANAGER = "modRanaTileStorageQuotaManager"
+THREAD_TILE_STORAGE_COMPACTION = "modRanaTileStorageCompaction"
+THREAD_TILE_STORAGE_SWEEPER = "modRanaTileStorageSweeper"
+THREAD_TILE_STORAGE_INTEGRITY_CHECK = "modRanaTileStorageIntegrityCheck"
 # resource checking
 THREAD_CONNECTIVITY_CHECK = "modRanaConnectivityCheck"
 THREAD_LOCATION_CHECK = "modRanaCurrentPositionCheck"
@@ -102,8 +109,10 @@ DEFAULT_AUTOMATIC_TILE_DOWNLOAD_QUEUE_SIZE = 100
 #   requested again, which is often needed by the GTK GUI
 #   and should also help the Qt 5 GUI
 DEFAULT_MEMORY_TILE_CACHE_SIZE = 150
-# how many tiles to remove from cache when it gets full
-DEFAULT_MEMORY_TILE_CACHE_TRIM_SIZE = 30
+# in-memory tile cache memory budget
+# * least recently used tiles are evicted from the cache
+#   once the tiles in it use more memory than this
+DEFAULT_MEMORY_TILE_CACHE_BUDGET = 32 # MiB
 
 # sqlite tile database commit interval
 # * lower interval - lower amount of tiles in flight and this
@@ -111,6 +120,26 @@ DEFAULT_MEMORY_TILE_CACHE_TRIM_SIZE = 30
 # * longer interval - more tiles in flight, more memory usage but
 #   IO happens less often in longer hopefully more efficient bursts
 DEFAULT_SQLITE_TILE_DATABASE_COMMIT_INTERVAL = 5 # seconds
+# how often to check if tile storage quotas are exceeded
+DEFAULT_TILE_STORAGE_QUOTA_CHECK_INTERVAL = 10 * 60 # seconds
+# once a tile storage quota is exceeded tiles are evicted until
+# only this fraction of the quota is used
+TILE_STORAGE_QUOTA_EVICTION_TARGET = 0.9
+# what to do with stored tiles older than the layer timeout
+# * keep - keep them, they are just not used (the default)
+# * delete - delete them to reclaim space
+# * revalidate - download them again
+TILE_STORAGE_EXPIRED_KEEP = "keep"
+TILE_STORAGE_EXPIRED_DELETE = "delete"
+TILE_STORAGE_EXPIRED_REVALIDATE = "revalidate"
+DEFAULT_TILE_STORAGE_EXPIRED_TILES = TILE_STORAGE_EXPIRED_KEEP
+# how often to look for stored tiles older than the layer timeout
+DEFAULT_TILE_STORAGE_SWEEP_INTERVAL = 60 * 60 # seconds
+# at most this many expired tiles are queued for download per layer and sweep,
+# so that revalidation does not crowd out tiles requested for display
+TILE_STORAGE_REVALIDATION_LIMIT = 50
+# tag used for download requests of expired tiles, nobody is waiting for these tiles
+TILE_STORAGE_REVALIDATION_TAG = "revalidation"
 
 # device types
 DEVICE_TYPE_DESKTOP = 1
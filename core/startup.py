@@ -40,12 +40,14 @@ SEARCH_PROVIDER_ERROR = 5
 LOCAL_SEARCH_CURRENT_POSITION_UNKNOWN_ERROR = 6
 CURRENT_POSITION_UNKNOWN_ERROR = 7
 COORDINATE_PARSING_ERROR = 8
+TILE_MIGRATION_ERROR = 9
 
 USE_LAST_KNOWN_POSITION_KEYWORD = "LAST_KNOWN_POSITION"
 
 POI_SUBCOMMAND = "poi"
+TILES_SUBCOMMAND = "tiles"
 
-SUBCOMMAND_LIST = [POI_SUBCOMMAND]
+SUBCOMMAND_LIST = [POI_SUBCOMMAND, TILES_SUBCOMMAND]
 
 SUBCOMMANDS = set(SUBCOMMAND_LIST)
 
@@ -56,6 +58,7 @@ class Startup(object):
         self.originalStderr = None
         self._subcommand_present = len(sys.argv) >= 2 and sys.argv[1] in SUBCOMMANDS
         self._poi_subcommand_present = False
+        self._tiles_subcommand_present = False
         current_subcommands = ",".join(SUBCOMMAND_LIST)
         parser = argparse.ArgumentParser(description="A flexible GPS navigation system.",
                                          epilog="You can also use the following subcommands: [%s] \
@@ -209,6 +212,23 @@ class Startup(object):
                                          help='POI category name or index (default: 11/Other), EXAMPLE: "Landmark" or "10"')
                 # list-categories
                 poi_subcommands.add_parser("list-categories", help='list POI database categories')
+            elif subcommand == TILES_SUBCOMMAND:
+                # tiles subcommand
+                self._tiles_subcommand_present = True
+                subcommands = parser.add_subparsers()
+                tiles = subcommands.add_parser("tiles", help="Tile storage handling")
+                tiles.required = False
+                tiles_subcommands = tiles.add_subparsers(dest="tiles_subcommand")
+                # migrate
+                tiles_migrate = tiles_subcommands.add_parser("migrate",
+                                                             help='migrate tiles stored as files to SQLite tile storage')
+                tiles_migrate.add_argument(type=str, dest="tiles_layer_folders", nargs="*",
+                                           help='names of layer folders to migrate (all layers with tiles stored '
+                                                'as files by default), EXAMPLE: "OpenStreetMap I"')
+                tiles_migrate.add_argument("--threads", type=int, dest="tiles_thread_count", default=None,
+                                           help='number of threads reading tile files, EXAMPLE: "8"')
+                tiles_migrate.add_argument("--delete-source", dest="tiles_delete_source", action="store_true",
+                                           help='delete tile files once they have been migrated')
 
         self.args, _unknownArgs = parser.parse_known_args()
 
@@ -235,6 +255,8 @@ class Startup(object):
             self._disableStdout()
         elif self._poi_subcommand_present:
             self._disableStdout()
+        elif self._tiles_subcommand_present:
+            self._disableStdout()
 
     def handle_non_gui_tasks(self):
         """Handle CLI arguments that can be handled before the general modRana startup,
@@ -258,6 +280,9 @@ class Startup(object):
                 self._addPOI()
             elif self.args.poi_subcommand == "list-categories":
                 self._listCategories()
+        elif self._tiles_subcommand_present:
+            if self.args.tiles_subcommand == "migrate":
+                self._migrate_tiles()
 
     def handlePostFirstTimeTasks(self):
         """
@@ -482,6 +507,48 @@ class Startup(object):
             print("%d, %s, %s" % (index, name, description))
         self._exit(0)
 
+    def _migrate_tiles(self):
+        """Migrate tiles stored as files to SQLite tile storage"""
+        self._disableStdout()
+        import os
+        from core.tile_storage.files_store import FileBasedTileStore
+        from core.tile_storage.sqlite_store import SqliteTileStore
+        from core.tile_storage import migration
+
+        map_folder_path = self.modrana.paths.map_folder_path
+        layer_folders = self.args.tiles_layer_folders or sorted(os.listdir(map_folder_path))
+        layer_paths = [os.path.join(map_folder_path, folder) for folder in layer_folders]
+        layer_paths = [path for path in layer_paths if FileBasedTileStore.is_store(path)]
+        if not layer_paths:
+            self._enableStdout()
+            print("no tiles stored as files found in %s" % map_folder_path)
+            self._exit(0)
+
+        thread_count = self.args.tiles_thread_count or migration.MIGRATION_THREAD_COUNT
+        exit_code = 0
+        for layer_path in layer_paths:
+            start = time.time()
+            store = SqliteTileStore(layer_path,
+                                    deduplicate=bool(self.modrana.get('sqliteTileStorageDeduplicate', False)))
+            files_migration = migration.FilesToSqliteMigration(layer_path, store,
+                                                               thread_count=thread_count,
+                                                               delete_source=self.args.tiles_delete_source)
+            try:
+                finished = files_migration.run()
+            finally:
+                store.close()
+            self._enableStdout()
+            print("%s: %d tiles migrated, %d invalid tiles skipped in %1.2f s" % (
+                os.path.basename(layer_path), files_migration.migrated_tile_count,
+                files_migration.invalid_tile_count, time.time() - start))
+            if not finished:
+                print("%s: some tile folders could not be migrated, run the migration again to retry"
+                      % os.path.basename(layer_path))
+                exit_code = TILE_MIGRATION_ERROR
+            self._disableStdout()
+        self._enableStdout()
+        self._exit(exit_code)
+
     def _returnStaticMapUrl(self, results, online):
         """return static map url for early search methods & exit"""
         if results:
@@ -33,6 +33,145 @@ class BaseTileStore(object):
     def tile_is_stored(self, lzxy):
         pass
 
+    def get_tiles(self, lzxys):
+        """Get data and timestamps for multiple tiles at once
+
+        Stores that can fetch many tiles more efficiently than one by one
+        should override this method.
+
+        :param list lzxys: list of lzxy tuples
+        :returns: dictionary with (tile data, timestamp) tuples or None
+                  (for tiles that are not in the store) under lzxy keys
+        :rtype: dict
+        """
+        return {lzxy: self.get_tile(lzxy) for lzxy in lzxys}
+
+    def tiles_are_stored(self, lzxys):
+        """Report if multiple tiles are stored at once
+
+        Stores that can check many tiles more efficiently than one by one
+        should override this method.
+
+        :param list lzxys: list of lzxy tuples
+        :returns: dictionary with the same values tile_is_stored() would return
+                  under lzxy keys
+        :rtype: dict
+        """
+        return {lzxy: self.tile_is_stored(lzxy) for lzxy in lzxys}
+
+    def get_tile_coordinates(self, z):
+        """List coordinates of all tiles stored on the given zoom level
+
+        Used to build tile presence indexes, stores that can't list their
+        tiles reasonably fast should keep the default implementation.
+
+        :param int z: zoom level
+        :returns: list of (x, y) tuples or None if the store can't list its tiles
+        :rtype: list or None
+        """
+        return None
+
+    def get_modification_signature(self, z):
+        """Return a value that changes whenever tiles on the given zoom level are modified
+
+        Used to check if a persisted tile presence index is still valid,
+        so the value needs to be JSON serializable.
+
+        :param int z: zoom level
+        :returns: modification signature or None if not supported by the store
+        """
+        return None
+
+    def stats(self):
+        """Return storage statistics that are cheap to get
+
+        Stores that can cheaply report how much space their tiles use
+        should return it under the "size" key (in bytes).
+
+        :returns: dictionary with store specific statistics
+        :rtype: dict
+        """
+        return {}
+
+    def get_zoom_stats(self):
+        """Return statistics of tiles stored on each zoom level
+
+        This is meant to be cheap, so stores that would need to go over
+        all the stored tiles keep the default implementation.
+
+        :returns: dictionary with tile count, tile data size in bytes (under the "tile_count"
+                  and "size" keys), min/max x & y coordinates (min_x, max_x, min_y, max_y) and
+                  oldest/newest tile timestamp (oldest_timestamp, newest_timestamp) under zoom
+                  level keys or None if not available
+        :rtype: dict or None
+        """
+        return None
+
+    def get_used_size(self):
+        """Return how much space the stored tiles use
+
+        This might be slow for some stores, so it should not be called
+        from time critical code.
+
+        :returns: size in bytes or None if the store does not know
+        :rtype: int or None
+        """
+        return None
+
+    def evict_tiles(self, size_in_bytes, batch_size=None, should_continue=None):
+        """Delete least recently used tiles until the given amount of tile data has been deleted
+
+        Read only stores and stores that don't support eviction keep the default implementation.
+
+        :param int size_in_bytes: how much tile data to delete
+        :param int batch_size: how many tiles to delete at once (None for store default)
+        :param should_continue: optional callable, eviction stops once it returns False
+        :returns: size of deleted tile data in bytes
+        :rtype: int
+        """
+        return 0
+
+    def get_expired_tiles(self, timestamp, limit=None):
+        """Return coordinates of tiles last modified before the given timestamp, oldest first
+
+        :param int timestamp: unix epoch timestamp
+        :param int limit: maximum number of tiles to return, None for no limit
+        :returns: list of (z, x, y) tuples
+        :rtype: list
+        """
+        return []
+
+    def delete_expired_tiles(self, timestamp, batch_size=None, should_continue=None):
+        """Delete all tiles last modified before the given timestamp
+
+        Read only stores keep the default implementation.
+
+        :param int timestamp: unix epoch timestamp
+        :param int batch_size: how many tiles to delete at once (None for store default)
+        :param should_continue: optional callable, deleting stops once it returns False
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        return 0
+
+    def check_integrity(self, repair=False, thread_count=None, should_continue=None, progress_callback=None):
+        """Check stored tiles for damaged tile data & store inconsistencies
+
+        Damaged tile data (not an image or a truncated one) is moved to the quarantine
+        folder of the store when repairing, so that it can be inspected later on.
+
+        Stores that can't be checked keep the default implementation.
+
+        :param bool repair: repair or quarantine the damaged tiles & inconsistencies found
+        :param int thread_count: number of checking threads (None for the default)
+        :param should_continue: optional callable, the check stops once it returns False
+        :param progress_callback: optional callable called with a status message
+                                  and progress (from 0.0 to 1.0)
+        :returns: integrity report (see utils.get_integrity_report()) or None if not supported
+        :rtype: dict or None
+        """
+        return None
+
     def delete_tile(self, lzxy):
         pass
 
@@ -1 +1,7 @@
+MEBI_BYTE = 2**20
 GIBI_BYTE = 2**30
+
+# data of damaged tiles found by integrity checks is moved to this folder in the store folder
+QUARANTINE_FOLDER_NAME = "quarantine"
+# default number of threads used for tile store integrity checks
+INTEGRITY_CHECK_THREAD_COUNT = 4
@@ -1,15 +1,88 @@
 import os
-import glob
+import sys
 import shutil
 import re
+import time
+import heapq
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, Condition, Thread
 
 from .base import BaseTileStore
+from .constants import INTEGRITY_CHECK_THREAD_COUNT
 from . import utils
 
 import logging
 log = logging.getLogger("tile_storage.files_store")
 
 PARTIAL_TILE_FILE_SUFFIX = ".part"
+# Tile access times are recorded as file access times, rounded to this resolution, so that
+# a tile file is only touched once in a while and not every time the tile is displayed.
+# File access times are set explicitly as many filesystems are mounted with noatime or relatime.
+FILES_ACCESS_TIME_RESOLUTION = 60 * 60  # in seconds
+# recorded tile accesses are written once this many of them are waiting
+FILES_ACCESS_BATCH_SIZE = 500
+# how many tile files to delete before checking if eviction should continue
+FILES_EVICTION_BATCH_SIZE = 500
+# The size of all tile files is counted by walking the store once and then kept up to date as the store
+# changes tile files, so that quota checks don't need to walk the store. It is counted again after
+# this long, so that tile files changed by other programs are eventually accounted for.
+FILES_USED_SIZE_RECOUNT_INTERVAL = 24 * 60 * 60  # in seconds
+# partial tile files older than this are leftovers of interrupted downloads
+FILES_STALE_PARTIAL_FILE_AGE = 60 * 60  # in seconds
+# Fuzzy tile matching lists the x level folder to find tiles with other than the expected extension.
+# Listings of this many recently used folders are cached and reused until the folder modification
+# time changes or the store itself modifies the folder.
+FILES_FOLDER_LISTING_CACHE_SIZE = 256
+# Folders modified less than this long ago are not cached, as filesystems with coarse
+# modification time resolution (FAT has 2 seconds) could miss a change made right after the listing.
+FILES_FOLDER_MTIME_RESOLUTION = 2  # in seconds
+# Recent fuzzy matching misses are remembered, so that looking for a tile that is not stored
+# (which happens on every redraw until the tile is downloaded) is just a dictionary lookup.
+# Misses are forgotten once the store writes the tile or after a timeout,
+# so that tiles added by other programs are found eventually.
+FILES_NEGATIVE_CACHE_SIZE = 1024
+FILES_NEGATIVE_CACHE_TIMEOUT = 30  # in seconds
+# In durable mode tile files are synced to permanent storage before being renamed in place,
+# so that a power cut can't leave a torn tile behind. The syncs are coalesced (group commit):
+# tiles waiting to be synced are synced together once this many of them are waiting
+# or once the oldest of them has been waiting for the sync interval.
+FILES_SYNC_BATCH_SIZE = 100
+FILES_SYNC_INTERVAL = 0.5  # in seconds
+
+def _load_syncfs():
+    """Return the Linux syncfs() function or None if it is not available
+
+    syncfs() writes all data of a filesystem to permanent storage with a single call,
+    which is much cheaper than an fsync() of every tile file on slow storage such as SD cards.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        syncfs = ctypes.CDLL(None, use_errno=True).syncfs
+    except (ImportError, OSError, AttributeError):
+        return None
+    syncfs.argtypes = [ctypes.c_int]
+    syncfs.restype = ctypes.c_int
+    return syncfs
+
+_syncfs = _load_syncfs()
+
+def _fsync_path(path):
+    """Write a file or folder to permanent storage
+
+    Folders can't be opened on some platforms (Windows), which is ignored.
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
 
 def _get_toplevel_tile_folder_list(path):
     """Return a list of toplevel tile folders
@@ -40,13 +113,54 @@ class FileBasedTileStore(BaseTileStore):
             is_files_store = bool(_get_toplevel_tile_folder_list(path))
         return is_files_store
 
-    def __init__(self, store_path, prevent_media_indexing = False):
+    def __init__(self, store_path, prevent_media_indexing = False, durable=False,
+                 sync_batch_size=FILES_SYNC_BATCH_SIZE, sync_interval=FILES_SYNC_INTERVAL):
         BaseTileStore.__init__(self, store_path, prevent_media_indexing=prevent_media_indexing)
 
         # make sure the folder for the file based tile store exists and is in a correct state,
         # such as that it contains a file that disables media indexing on platforms where this is needed
         utils.check_folder(self.store_path, prevent_media_indexing=prevent_media_indexing)
 
+        # tile file path -> access time rounded down to FILES_ACCESS_TIME_RESOLUTION
+        self._pending_accesses = {}
+        self._pending_accesses_lock = Lock()
+
+        # (z, x) -> (folder modification time, {y: [tile file names]})
+        self._folder_listings = OrderedDict()
+        # (z, x, y) -> time of the miss
+        self._missing_tiles = OrderedDict()
+        # total size of the tile files, None if not counted yet
+        self._used_size = None
+        self._used_size_counted_at = None
+        self._used_size_lock = Lock()
+        # incremented on every change made by the store, so that lookups
+        # running concurrently with a change don't cache outdated results
+        self._lookup_cache_generation = 0
+        self._lookup_cache_lock = Lock()
+
+        # in durable mode tiles are renamed in place by the syncer thread
+        # once their partial files have been synced
+        self._durable = durable
+        self._sync_batch_size = sync_batch_size
+        self._sync_interval = sync_interval
+        # tile file path -> (partial tile file path, (z, x, y))
+        self._sync_queue = OrderedDict()
+        self._sync_queue_since = None
+        # tiles currently being synced by the syncer thread
+        self._sync_batch = {}
+        self._sync_condition = Condition()
+        self._sync_flush_waiters = 0
+        self._syncer_shutdown = False
+        # partial files of tiles waiting to be synced need unique names, so that
+        # a tile can be stored again while its previous version is being synced
+        self._partial_file_counter = itertools.count()
+        self._syncer_thread = None
+        if durable:
+            self._syncer_thread = Thread(target=self._syncer,
+                                         name="FileBasedTileStoreSyncer:%s" % self.store_path)
+            self._syncer_thread.daemon = True
+            self._syncer_thread.start()
+
     def __str__(self):
         return "file based store @ %s" % self.store_path
 
@@ -55,9 +169,13 @@ class FileBasedTileStore(BaseTileStore):
 
     def store_tile_data(self, lzxy, tile_data):
         """Store the given tile to a file"""
+        self._invalidate_lookup_cache(lzxy[1], lzxy[2], lzxy[3])
         # get the folder path
         file_path = self._get_tile_file_path(lzxy)
-        partial_file_path = file_path + PARTIAL_TILE_FILE_SUFFIX
+        if self._durable:
+            partial_file_path = "%s.%d%s" % (file_path, next(self._partial_file_counter), PARTIAL_TILE_FILE_SUFFIX)
+        else:
+            partial_file_path = file_path + PARTIAL_TILE_FILE_SUFFIX
         (folder_path, tail) = os.path.split(file_path)
         if not os.path.exists(folder_path): # does it exist ?
             try:
@@ -75,8 +193,15 @@ class FileBasedTileStore(BaseTileStore):
         try:
             with open(partial_file_path, 'wb') as f:
                 f.write(tile_data)
-            os.rename(partial_file_path, file_path)
-            # TODO: fsync the file (optionally ?)?
+            if self._durable:
+                self._queue_for_sync(file_path, partial_file_path, lzxy[1:])
+            else:
+                replaced_size = self._get_tracked_file_size(file_path)
+                os.rename(partial_file_path, file_path)
+                self._update_used_size(len(tile_data) - replaced_size)
+                # a lookup running while the tile was being written might have
+                # recorded it as missing, so invalidate again once it is in place
+                self._invalidate_lookup_cache(lzxy[1], lzxy[2], lzxy[3])
         except:
             log.exception("saving tile to file %s failed", file_path)
             try:
@@ -101,7 +226,10 @@ class FileBasedTileStore(BaseTileStore):
         :returns: (tile data, timestamp) or None if tile is not found in the database
         :rtype: a (bytes, int) tuple or None
         """
-        if fuzzy_matching:
+        file_path = self._get_unsynced_tile_file_path(lzxy)
+        if file_path is not None and os.path.isfile(file_path):
+            pass
+        elif fuzzy_matching:
             file_path = self._fuzzy_find_tile(lzxy)
         else:
             file_path = self._get_tile_file_path(lzxy)
@@ -110,7 +238,9 @@ class FileBasedTileStore(BaseTileStore):
             try:
                 tile_mtime = os.path.getmtime(file_path)
                 with open(file_path, "rb") as f:
-                    return f.read(), tile_mtime
+                    tile_data = f.read()
+                self._record_access(file_path)
+                return tile_data, tile_mtime
             except:
                 log.exception("tile file reading failed for: %s", file_path)
                 return  None
@@ -129,7 +259,10 @@ class FileBasedTileStore(BaseTileStore):
         :returns: True if tile is present in the store, else False
         :rtype: bool
         """
-        if fuzzy_matching:
+        file_path = self._get_unsynced_tile_file_path(lzxy)
+        if file_path is not None and os.path.isfile(file_path):
+            pass
+        elif fuzzy_matching:
             file_path = self._fuzzy_find_tile(lzxy)
         else:
             file_path = self._get_tile_file_path(lzxy)
@@ -138,6 +271,489 @@ class FileBasedTileStore(BaseTileStore):
         else:
             return False
 
+    def get_tile_coordinates(self, z):
+        """List coordinates of all tiles stored on the given zoom level
+
+        Files with any extension are listed, same as with fuzzy matching.
+
+        :param int z: zoom level
+        :returns: list of (x, y) tuples
+        :rtype: list
+        """
+        coordinates = []
+        z_path = os.path.join(self.store_path, str(z))
+        if not os.path.isdir(z_path):
+            return coordinates
+        for x_entry in os.scandir(z_path):
+            if not x_entry.name.isdigit() or not x_entry.is_dir():
+                continue
+            x = int(x_entry.name)
+            for y_entry in os.scandir(x_entry.path):
+                if y_entry.name.endswith(PARTIAL_TILE_FILE_SUFFIX):
+                    continue
+                y_name = y_entry.name.split(".", 1)[0]
+                if y_name.isdigit():
+                    coordinates.append((x, int(y_name)))
+        return coordinates
+
+    def get_modification_signature(self, z):
+        """Return modification times of the zoom level folder and all its x level folders
+
+        Adding or removing a tile file changes the modification time of the x level folder.
+        """
+        z_path = os.path.join(self.store_path, str(z))
+        if not os.path.isdir(z_path):
+            return []
+        signature = [os.stat(z_path).st_mtime_ns]
+        for x_entry in sorted(os.scandir(z_path), key=lambda entry: entry.name):
+            if x_entry.is_dir():
+                signature.append((x_entry.name, x_entry.stat().st_mtime_ns))
+        return signature
+
+    def _record_access(self, file_path):
+        """Record that a tile file has been accessed
+
+        The accesses are written in batches once enough of them are waiting.
+        """
+        access_time = int(time.time()) // FILES_ACCESS_TIME_RESOLUTION * FILES_ACCESS_TIME_RESOLUTION
+        with self._pending_accesses_lock:
+            self._pending_accesses[file_path] = access_time
+            if len(self._pending_accesses) < FILES_ACCESS_BATCH_SIZE:
+                return
+            pending_accesses = self._pending_accesses
+            self._pending_accesses = {}
+        self._write_accesses(pending_accesses)
+
+    def _write_accesses(self, accesses):
+        """Set access times of tile files, keeping their modification times unchanged
+
+        :param dict accesses: access times under tile file path keys
+        """
+        for file_path, access_time in accesses.items():
+            try:
+                file_stat = os.stat(file_path)
+                if file_stat.st_atime < access_time:
+                    os.utime(file_path, ns=(access_time * 10**9, file_stat.st_mtime_ns))
+            except FileNotFoundError:
+                # the tile has been deleted in the meantime
+                pass
+            except OSError:
+                log.exception("setting access time failed for %s", file_path)
+
+    def _iter_tile_files(self):
+        """Iterate over all tile files in the store
+
+        :returns: iterator of (access time, size, path, modification time) tuples
+        :rtype: iterator
+        """
+        for z_folder in _get_toplevel_tile_folder_list(self.store_path):
+            z_path = os.path.join(self.store_path, z_folder)
+            for x_entry in os.scandir(z_path):
+                if not x_entry.is_dir():
+                    continue
+                for y_entry in os.scandir(x_entry.path):
+                    if y_entry.name.endswith(PARTIAL_TILE_FILE_SUFFIX) or not y_entry.is_file():
+                        continue
+                    try:
+                        file_stat = y_entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    yield file_stat.st_atime, file_stat.st_size, y_entry.path, file_stat.st_mtime
+
+    def _get_tracked_file_size(self, file_path):
+        """Return size of a tile file for keeping the used size up to date
+
+        :returns: file size in bytes, 0 if there is no such file or if the used size is not counted yet
+        :rtype: int
+        """
+        if self._used_size is None:
+            return 0
+        try:
+            return os.path.getsize(file_path)
+        except OSError:
+            return 0
+
+    def _update_used_size(self, size_change):
+        with self._used_size_lock:
+            if self._used_size is not None:
+                self._used_size += size_change
+
+    def get_used_size(self):
+        """Return total size of all tile files
+
+        NOTE: the first call (and a call once in a while after that) needs to walk over
+              all the tile files, so it can be slow
+        """
+        self.flush()
+        with self._used_size_lock:
+            if self._used_size is not None and \
+                    time.monotonic() - self._used_size_counted_at < FILES_USED_SIZE_RECOUNT_INTERVAL:
+                return self._used_size
+        # tile files changed while they are being counted might be counted wrong,
+        # which is fixed by the next recount
+        used_size = sum(size for _atime, size, _path, _mtime in self._iter_tile_files())
+        with self._used_size_lock:
+            self._used_size = used_size
+            self._used_size_counted_at = time.monotonic()
+        return used_size
+
+    def evict_tiles(self, size_in_bytes, batch_size=FILES_EVICTION_BATCH_SIZE, should_continue=None):
+        """Delete least recently used tile files until the given amount of tile data has been deleted
+
+        NOTE: this needs to walk over all the tile files, so it can be slow
+        """
+        # make sure recently used tiles are not evicted
+        self.flush()
+        evicted_bytes = 0
+        if size_in_bytes <= 0:
+            return evicted_bytes
+        # only the least recently used tile files needed to evict the requested amount of data
+        # are kept in a heap with the most recently used of them on top, so that the whole
+        # store does not need to be listed & sorted
+        heap = []
+        heap_size = 0
+        for atime, size, file_path, _mtime in self._iter_tile_files():
+            heapq.heappush(heap, (-atime, size, file_path))
+            heap_size += size
+            while heap_size - heap[0][1] >= size_in_bytes:
+                heap_size -= heapq.heappop(heap)[1]
+        tile_files = sorted((-negative_atime, size, file_path) for negative_atime, size, file_path in heap)
+        for batch_start in range(0, len(tile_files), batch_size):
+            if evicted_bytes >= size_in_bytes:
+                break
+            if should_continue is not None and not should_continue():
+                break
+            for _atime, size, file_path in tile_files[batch_start:batch_start + batch_size]:
+                if evicted_bytes >= size_in_bytes:
+                    break
+                if self._remove_tile_file(file_path, size):
+                    evicted_bytes += size
+        log.debug("%d bytes of least recently used tiles evicted from %s", evicted_bytes, self)
+        return evicted_bytes
+
+    def _remove_tile_file(self, file_path, size=None):
+        """Remove a tile file together with any folders left empty
+
+        :param str file_path: path to the tile file
+        :param int size: size of the tile file if known
+        :returns: True if the file has been removed, else False
+        :rtype: bool
+        """
+        if size is None:
+            size = self._get_tracked_file_size(file_path)
+        try:
+            os.remove(file_path)
+            self._update_used_size(-size)
+            x_path, _file_name = os.path.split(file_path)
+            z_path, x_folder = os.path.split(x_path)
+            z_folder = os.path.basename(z_path)
+            if z_folder.isdigit() and x_folder.isdigit():
+                self._invalidate_lookup_cache(int(z_folder), int(x_folder))
+            self._delete_empty_folders(z_folder, x_folder)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError:
+            log.exception("removing tile file %s failed", file_path)
+            return False
+
+    def _list_expired_tile_files(self, timestamp):
+        """List tile files last modified before the given timestamp, oldest first
+
+        The file modification time is the tile timestamp for this store.
+
+        :returns: list of (modification time, path) tuples
+        :rtype: list
+        """
+        return sorted((mtime, file_path) for _atime, _size, file_path, mtime in self._iter_tile_files()
+                      if mtime < timestamp)
+
+    def get_expired_tiles(self, timestamp, limit=None):
+        """Return coordinates of tiles last modified before the given timestamp, oldest first
+
+        NOTE: this needs to walk over all the tile files, so it can be slow
+        """
+        expired_tiles = []
+        for _mtime, file_path in self._list_expired_tile_files(timestamp)[:limit]:
+            x_path, file_name = os.path.split(file_path)
+            z_path, x_folder = os.path.split(x_path)
+            y_name = file_name.split(".", 1)[0]
+            if y_name.isdigit() and x_folder.isdigit():
+                expired_tiles.append((int(os.path.basename(z_path)), int(x_folder), int(y_name)))
+        return expired_tiles
+
+    def delete_expired_tiles(self, timestamp, batch_size=FILES_EVICTION_BATCH_SIZE, should_continue=None):
+        """Delete all tile files last modified before the given timestamp
+
+        NOTE: this needs to walk over all the tile files, so it can be slow
+        """
+        deleted_count = 0
+        expired_files = self._list_expired_tile_files(timestamp)
+        for batch_start in range(0, len(expired_files), batch_size):
+            if should_continue is not None and not should_continue():
+                break
+            for _mtime, file_path in expired_files[batch_start:batch_start + batch_size]:
+                if self._remove_tile_file(file_path):
+                    deleted_count += 1
+        log.debug("%d expired tiles deleted from %s", deleted_count, self)
+        return deleted_count
+
+    def check_integrity(self, repair=False, thread_count=INTEGRITY_CHECK_THREAD_COUNT,
+                        should_continue=None, progress_callback=None):
+        """Check all tile files are complete images & look for leftover partial tile files
+
+        The x level folders are checked in a pool of threads. When repairing, damaged tile files
+        are moved to the quarantine folder and leftover partial tile files are deleted.
+
+        :returns: integrity report, see utils.get_integrity_report()
+        :rtype: dict
+        """
+        report = utils.get_integrity_report()
+        folders = []
+        for z_folder in _get_toplevel_tile_folder_list(self.store_path):
+            for x_entry in os.scandir(os.path.join(self.store_path, z_folder)):
+                if x_entry.name.isdigit() and x_entry.is_dir():
+                    folders.append((z_folder, x_entry.name))
+        stale_before = time.time() - FILES_STALE_PARTIAL_FILE_AGE
+        with ThreadPoolExecutor(max_workers=max(1, thread_count)) as executor:
+            futures = [executor.submit(self._check_tile_folder, z, x, stale_before) for z, x in folders]
+            for index, future in enumerate(futures):
+                if should_continue is not None and not should_continue():
+                    for remaining_future in futures[index:]:
+                        remaining_future.cancel()
+                    return report
+                checked_tile_count, invalid_files, partial_files = future.result()
+                report["checked_tiles"] += checked_tile_count
+                report["invalid_tiles"] += len(invalid_files)
+                report["orphaned_tiles"] += len(partial_files)
+                if repair and (invalid_files or partial_files):
+                    z, x = folders[index]
+                    self._repair_tile_folder(z, x, invalid_files, partial_files, report)
+                if progress_callback is not None:
+                    progress_callback("checking tiles", (index + 1) / len(futures))
+        if report["invalid_tiles"] or report["orphaned_tiles"]:
+            log.warning("%s: %d damaged tiles & %d leftover partial tile files found",
+                        self, report["invalid_tiles"], report["orphaned_tiles"])
+        return report
+
+    def _check_tile_folder(self, z, x, stale_before):
+        """Check tile files in the given x level folder
+
+        :returns: number of checked tiles, list of names of damaged tile files
+                  & list of names of leftover partial tile files
+        :rtype: tuple
+        """
+        checked_tile_count = 0
+        invalid_files = []
+        partial_files = []
+        for entry in os.scandir(os.path.join(self.store_path, z, x)):
+            try:
+                if not entry.is_file():
+                    continue
+                if entry.name.endswith(PARTIAL_TILE_FILE_SUFFIX):
+                    if entry.stat().st_mtime < stale_before:
+                        partial_files.append(entry.name)
+                    continue
+                if not entry.name.partition(".")[0].isdigit():
+                    continue
+                with open(entry.path, "rb") as f:
+                    tile_data = f.read()
+            except FileNotFoundError:
+                # the tile has been deleted in the meantime
+                continue
+            checked_tile_count += 1
+            if not utils.is_complete_image(tile_data):
+                invalid_files.append(entry.name)
+        return checked_tile_count, invalid_files, partial_files
+
+    def _repair_tile_folder(self, z, x, invalid_files, partial_files, report):
+        """Quarantine damaged tile files & delete leftover partial tile files in an x level folder"""
+        folder_path = os.path.join(self.store_path, z, x)
+        self._invalidate_lookup_cache(int(z), int(x))
+        for file_name in invalid_files:
+            y, _dot, extension = file_name.partition(".")
+            try:
+                os.replace(os.path.join(folder_path, file_name),
+                           utils.get_quarantine_path(self.store_path, int(z), int(x), int(y), extension))
+                report["quarantined_tiles"] += 1
+                report["repaired_tiles"] += 1
+            except OSError:
+                log.exception("quarantining tile file %s failed", os.path.join(folder_path, file_name))
+        for file_name in partial_files:
+            try:
+                os.remove(os.path.join(folder_path, file_name))
+                report["repaired_tiles"] += 1
+            except OSError:
+                log.exception("removing partial tile file %s failed", os.path.join(folder_path, file_name))
+        self._delete_empty_folders(z, x)
+        # count the used size again, without the quarantined tiles
+        with self._used_size_lock:
+            self._used_size = None
+
+    def _get_unsynced_tile_file_path(self, lzxy):
+        """Return path to the partial file of a tile waiting to be synced
+
+        :returns: partial tile file path or None if the tile is not waiting to be synced
+        :rtype: str or None
+        """
+        if not self._durable:
+            return None
+        file_path = self._get_tile_file_path(lzxy)
+        with self._sync_condition:
+            unsynced_tile = self._sync_queue.get(file_path) or self._sync_batch.get(file_path)
+        return unsynced_tile[0] if unsynced_tile else None
+
+    def _queue_for_sync(self, file_path, partial_file_path, zxy):
+        """Add a written partial tile file to the sync queue"""
+        with self._sync_condition:
+            replaced_tile = self._sync_queue.pop(file_path, None)
+            self._sync_queue[file_path] = partial_file_path, zxy
+            if self._sync_queue_since is None:
+                self._sync_queue_since = time.monotonic()
+            self._sync_condition.notify_all()
+        if replaced_tile is not None:
+            # the previous version of the tile has not been synced yet, so it can be just dropped
+            self._remove_partial_file(replaced_tile[0])
+
+    def _remove_unsynced_tile(self, file_path):
+        """Remove a tile waiting to be synced from the sync queue
+
+        The partial file of a tile that is just being synced is removed as well, so that
+        the syncer thread does not rename it in place. If the syncer has renamed it
+        already, the tile file is in place and can be deleted as usual.
+
+        :returns: True if the tile was waiting to be synced, else False
+        :rtype: bool
+        """
+        with self._sync_condition:
+            unsynced_tile = self._sync_queue.pop(file_path, None) or self._sync_batch.get(file_path)
+        if unsynced_tile is None:
+            return False
+        self._remove_partial_file(unsynced_tile[0])
+        return True
+
+    def _remove_partial_file(self, partial_file_path):
+        try:
+            os.remove(partial_file_path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            log.exception("removing partial tile file %s failed", partial_file_path)
+
+    def _sync_pending(self):
+        """Report if the syncer thread should sync the queued tiles
+
+        NOTE: needs to be called with the sync condition held
+        """
+        if not self._sync_queue:
+            return False
+        return (self._syncer_shutdown or
+                self._sync_flush_waiters > 0 or
+                len(self._sync_queue) >= self._sync_batch_size or
+                time.monotonic() - self._sync_queue_since >= self._sync_interval)
+
+    def _syncer(self):
+        """Sync queued tiles in batches & rename them in place
+
+        This method is run by the syncer thread in durable mode.
+        """
+        while True:
+            with self._sync_condition:
+                while not self._sync_pending():
+                    if self._syncer_shutdown:
+                        return
+                    timeout = None
+                    if self._sync_queue:
+                        timeout = max(0, self._sync_queue_since + self._sync_interval - time.monotonic())
+                    self._sync_condition.wait(timeout)
+                batch = self._sync_queue
+                self._sync_batch = batch
+                self._sync_queue = OrderedDict()
+                self._sync_queue_since = None
+            try:
+                self._sync_tiles(batch)
+            except Exception:
+                log.exception("syncing a batch of %d tiles to %s failed", len(batch), self)
+            finally:
+                with self._sync_condition:
+                    self._sync_batch = {}
+                    # wake up any flush() callers
+                    self._sync_condition.notify_all()
+
+    def _sync_filesystem(self, paths):
+        """Write the given files to permanent storage
+
+        With syncfs() a single call covers all of them, else every file is synced separately.
+        """
+        if _syncfs is not None:
+            fd = os.open(self.store_path, os.O_RDONLY)
+            try:
+                if _syncfs(fd) == 0:
+                    return
+            finally:
+                os.close(fd)
+        for path in paths:
+            _fsync_path(path)
+
+    def _sync_tiles(self, batch):
+        """Sync partial tile files, rename them in place & sync the renames
+
+        :param dict batch: tile file path -> (partial tile file path, (z, x, y)) dictionary
+        """
+        partial_file_paths = [partial_file_path for partial_file_path, _zxy in batch.values()]
+        # the tile data needs to be on permanent storage before the rename,
+        # else the renamed tile file could be empty or torn after a power cut
+        self._sync_filesystem(partial_file_paths)
+        folder_paths = set()
+        for file_path, (partial_file_path, zxy) in batch.items():
+            size_change = self._get_tracked_file_size(partial_file_path) - self._get_tracked_file_size(file_path)
+            try:
+                os.replace(partial_file_path, file_path)
+            except FileNotFoundError:
+                # the tile has been deleted in the meantime
+                continue
+            except OSError:
+                log.exception("renaming synced tile file %s failed", file_path)
+                self._remove_partial_file(partial_file_path)
+                continue
+            self._update_used_size(size_change)
+            x_path = os.path.dirname(file_path)
+            # newly created folders need to be synced as well
+            folder_paths.update((x_path, os.path.dirname(x_path)))
+            self._invalidate_lookup_cache(*zxy)
+        self._sync_filesystem(sorted(folder_paths))
+
+    def _stop_syncer(self):
+        """Sync all queued tiles and stop the syncer thread (if any)"""
+        syncer_thread = self._syncer_thread
+        if syncer_thread is not None:
+            with self._sync_condition:
+                self._syncer_shutdown = True
+                self._sync_condition.notify_all()
+            syncer_thread.join()
+            self._syncer_thread = None
+
+    def flush(self):
+        """Write recorded tile accesses and sync tiles waiting to be synced"""
+        with self._pending_accesses_lock:
+            pending_accesses = self._pending_accesses
+            self._pending_accesses = {}
+        self._write_accesses(pending_accesses)
+        if self._syncer_thread is None:
+            return
+        with self._sync_condition:
+            self._sync_flush_waiters += 1
+            self._sync_condition.notify_all()
+            try:
+                while self._sync_queue or self._sync_batch:
+                    self._sync_condition.wait()
+            finally:
+                self._sync_flush_waiters -= 1
+
+    def close(self):
+        self._stop_syncer()
+        self.flush()
+
     def _delete_empty_folders(self, z, x):
         # x-level folder
         x_path = os.path.join(self.store_path, z, x)
@@ -151,7 +767,7 @@ class FileBasedTileStore(BaseTileStore):
                     pass
                 # z-level folder
                 z_path = os.path.join(self.store_path, z)
-                if os.listdir(z_path):
+                if not os.listdir(z_path):
                     try:
                         os.rmdir(z_path)
                     except OSError:
@@ -164,13 +780,18 @@ class FileBasedTileStore(BaseTileStore):
     def delete_tile(self, lzxy):
         # TODO: delete empty folders ?
         tile_path = self._get_tile_file_path(lzxy)
+        self._invalidate_lookup_cache(lzxy[1], lzxy[2])
+        # make sure the tile does not reappear once synced
+        was_unsynced = self._durable and self._remove_unsynced_tile(tile_path)
         try:
             if os.path.isfile(tile_path):
+                size = self._get_tracked_file_size(tile_path)
                 os.remove(tile_path)
+                self._update_used_size(-size)
                 # remove any empty folders that might have been
                 # left after the deleted tile file
-                self._delete_empty_folders(lzxy[1], lzxy[2])
-            else:
+                self._delete_empty_folders(str(lzxy[1]), str(lzxy[2]))
+            elif not was_unsynced:
                 log.error("can't delete file - path is not a file: %s", tile_path)
         except:
             log.exception("removing of tile at %s failed", tile_path)
@@ -184,6 +805,14 @@ class FileBasedTileStore(BaseTileStore):
         is used to store both tiles and sqlite tile storage database and we would
         also remove any databases if we just removed the toplevel folder.
         """
+        # don't let the syncer rename tiles into the folders being removed
+        self.flush()
+        with self._lookup_cache_lock:
+            self._lookup_cache_generation += 1
+            self._folder_listings.clear()
+            self._missing_tiles.clear()
+        with self._used_size_lock:
+            self._used_size = None
         try:
             for folder in _get_toplevel_tile_folder_list(self.store_path):
                 folder_path = os.path.join(self.store_path, folder)
@@ -206,42 +835,115 @@ class FileBasedTileStore(BaseTileStore):
             "%d.%s" % (lzxy[3], lzxy[0].type)
         )
 
+    def _invalidate_lookup_cache(self, z, x, y=None):
+        """Forget the cached listing of an x level folder (and a recorded miss of a tile in it)
+
+        :param int z: zoom level
+        :param int x: x coordinate
+        :param int y: y coordinate of a tile that has been added or None
+        """
+        with self._lookup_cache_lock:
+            self._lookup_cache_generation += 1
+            self._folder_listings.pop((z, x), None)
+            if y is not None:
+                self._missing_tiles.pop((z, x, y), None)
+
+    def _is_known_missing(self, z, x, y):
+        """Report if a fuzzy matching miss has been recently recorded for the tile"""
+        with self._lookup_cache_lock:
+            miss_time = self._missing_tiles.get((z, x, y))
+            if miss_time is None:
+                return False
+            if time.time() - miss_time > FILES_NEGATIVE_CACHE_TIMEOUT:
+                del self._missing_tiles[(z, x, y)]
+                return False
+            return True
+
+    def _record_miss(self, z, x, y, generation):
+        """Record a fuzzy matching miss, unless the store has been modified since the lookup started"""
+        with self._lookup_cache_lock:
+            if generation != self._lookup_cache_generation:
+                return
+            self._missing_tiles[(z, x, y)] = time.time()
+            self._missing_tiles.move_to_end((z, x, y))
+            if len(self._missing_tiles) > FILES_NEGATIVE_CACHE_SIZE:
+                self._missing_tiles.popitem(last=False)
+
+    def _get_folder_listing(self, z, x, generation):
+        """Return names of tile files in an x level folder, grouped by the y coordinate
+
+        :returns: dictionary with y coordinate keys and lists of file names as values
+        :rtype: dict
+        """
+        folder_path = os.path.join(self.store_path, str(z), str(x))
+        try:
+            folder_mtime = os.stat(folder_path).st_mtime_ns
+        except FileNotFoundError:
+            return {}
+        with self._lookup_cache_lock:
+            cached_listing = self._folder_listings.get((z, x))
+            if cached_listing is not None and cached_listing[0] == folder_mtime:
+                self._folder_listings.move_to_end((z, x))
+                return cached_listing[1]
+        listing = {}
+        try:
+            for entry in os.scandir(folder_path):
+                if entry.name.endswith(PARTIAL_TILE_FILE_SUFFIX):
+                    continue
+                y_name = entry.name.split(".", 1)[0]
+                if y_name.isdigit():
+                    listing.setdefault(int(y_name), []).append(entry.name)
+        except FileNotFoundError:
+            return {}
+        if time.time() - folder_mtime / 10**9 > FILES_FOLDER_MTIME_RESOLUTION:
+            with self._lookup_cache_lock:
+                if generation == self._lookup_cache_generation:
+                    self._folder_listings[(z, x)] = folder_mtime, listing
+                    self._folder_listings.move_to_end((z, x))
+                    if len(self._folder_listings) > FILES_FOLDER_LISTING_CACHE_SIZE:
+                        self._folder_listings.popitem(last=False)
+        return listing
+
     def _fuzzy_find_tile(self, lzxy):
         """Try to find a tile image file for the given coordinates
 
         :returns: path to a suitable tile or None if no can be found
         :rtype: str or None
         """
+        _layer, z, x, y = lzxy
+        if self._is_known_missing(z, x, y):
+            return None
+        generation = self._lookup_cache_generation
         # first check if the primary tile path exists
         tile_path = self._get_tile_file_path(lzxy)
         # check if the primary file path exists and also if it actually
         # is an image file
-        if os.path.exists(tile_path):
-            try:
-                with open(tile_path, "rb") as f:
-                    if utils.is_an_image(f.read(32)):
-                        return tile_path
-                    else:
-                        log.warning("%s is not an image", tile_path)
-            except Exception:
-                log.exception("checking if primary tile file is an image failed for %s", lzxy)
-
-        # look also for other supported image formats
-        alternative_tile_path = None
-        # TODO: might be good to investigate the performance impact,
-        #       just to be sure :P
-
-        # replace the extension with a * so that the path can be used
-        # as wildcard in glob
-        wildcard_tile_path = "%s.*" % os.path.splitext(tile_path)[0]
-        # iterate over potential paths returned by the glob iterator
-        for path in glob.iglob(wildcard_tile_path):
-            # go over the paths and check if they point to an image files
-            with open(path, "rb") as f:
+        try:
+            with open(tile_path, "rb") as f:
                 if utils.is_an_image(f.read(32)):
-                    # once an image file is found, break & returns its path
-                    alternative_tile_path = path
-                    break
+                    return tile_path
                 else:
                     log.warning("%s is not an image", tile_path)
-        return alternative_tile_path
\ No newline at end of file
+        except FileNotFoundError:
+            pass
+        except Exception:
+            log.exception("checking if primary tile file is an image failed for %s", lzxy)
+
+        # look also for other supported image formats in the (cached) folder listing
+        primary_file_name = os.path.basename(tile_path)
+        for file_name in self._get_folder_listing(z, x, generation).get(y, []):
+            if file_name == primary_file_name:
+                continue
+            path = os.path.join(os.path.dirname(tile_path), file_name)
+            try:
+                with open(path, "rb") as f:
+                    if utils.is_an_image(f.read(32)):
+                        # once an image file is found, return its path
+                        return path
+                    else:
+                        log.warning("%s is not an image", path)
+            except FileNotFoundError:
+                # the listing is outdated
+                continue
+        self._record_miss(z, x, y, generation)
+        return None
@@ -0,0 +1,397 @@
+# A read only tile store for MBTiles offline tile packs
+#
+# MBTiles is a widely used format for distributing tiles in a single SQLite database:
+# https://github.com/mapbox/mbtiles-spec
+#
+# The database has a tiles table (or a view with the same columns):
+#
+# tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)
+#
+# and a metadata table with name/value pairs describing the tile pack.
+#
+# Tile rows are numbered according to the TMS scheme, eq. from the south,
+# so the y coordinate needs to be flipped to get the XYZ tile coordinates
+# used by modRana (and the other way around).
+#
+# All MBTiles files (*.mbtiles) in the store folder are mounted by the store, sorted by name.
+# Tile packs are assumed to never change while mounted and are opened with the immutable
+# flag, so SQLite does not do any locking or change detection when reading from them.
+# As the packs don't have per-tile timestamps, modification time of the pack file is used instead.
+#
+# Tiles can be exported from a SQLite tile store to a MBTiles file and imported back
+# with INSERT ... SELECT statements over attached databases.
+#
+# A delta export only contains tiles modified since a given timestamp, found with the timestamp
+# index of the lookup database, so its cost depends on the number of changed tiles and not on the
+# size of the store. Delta packs have an extra unix_epoch_timestamp column in the tiles table
+# (MBTiles readers select columns by name so they are not affected) and record the timestamps
+# in the metadata table, so that the newest timestamp can be used as a start of the next delta.
+# When a delta pack is imported tiles are replaced only by newer tiles (last writer wins).
+# Tile deletions are not part of delta packs.
+import os
+import glob
+import sqlite3
+from threading import RLock, local
+from urllib.request import pathname2url
+
+import logging
+log = logging.getLogger("tile_storage.mbtiles_store")
+
+from .base import BaseTileStore
+from .sqlite_store import get_chunks, quote_sqlite_string, SQLITE_BULK_QUERY_SIZE
+
+MBTILES_EXTENSION = ".mbtiles"
+MBTILES_DEFAULT_FORMAT = "png"
+
+# selects tiles from a MBTiles database attached as "source" in the
+# format expected by SqliteTileStore.import_tiles()
+MBTILES_IMPORT_QUERY = "select zoom_level as z, tile_column as x, (1 << zoom_level) - 1 - tile_row as y, " \
+                       "tile_data as tile, %s as extension, %d as unix_epoch_timestamp from source.tiles"
+# the same for delta packs, which have per-tile timestamps
+MBTILES_DELTA_IMPORT_QUERY = "select zoom_level as z, tile_column as x, (1 << zoom_level) - 1 - tile_row as y, " \
+                             "tile_data as tile, %s as extension, unix_epoch_timestamp from source.tiles"
+# delta pack metadata keys
+DELTA_MODIFIED_SINCE_KEY = "modrana_modified_since"
+DELTA_NEWEST_TIMESTAMP_KEY = "modrana_newest_timestamp"
+
+def flip_y(z, y):
+    """Convert between XYZ and TMS tile row numbering
+
+    The conversion is symmetric, so the same function is used for both directions.
+    """
+    return (1 << z) - 1 - y
+
+def connect_to_pack(path):
+    """Open a MBTiles file read only & without any locking
+
+    :param str path: path to the MBTiles file
+    :returns: Sqlite database connection
+    """
+    uri = "file:%s?immutable=1" % pathname2url(path)
+    return sqlite3.connect(uri, uri=True, check_same_thread=False)
+
+def get_pack_metadata(connection):
+    """Return metadata of a MBTiles file as a dictionary"""
+    try:
+        return dict(connection.execute("select name, value from metadata").fetchall())
+    except sqlite3.OperationalError:
+        # the metadata table is missing
+        return {}
+
+
+class TilePack(object):
+    """A single MBTiles file mounted by the MBTiles tile store"""
+
+    def __init__(self, path):
+        self.path = path
+        self.timestamp = int(os.path.getmtime(path))
+        self.size = os.path.getsize(path)
+        self.name = os.path.basename(path)
+
+
+class MBTilesTileStore(BaseTileStore):
+
+    @staticmethod
+    def is_store(path):
+        """We consider the path to be a MBTiles tile store if it is a folder
+           containing at least one MBTiles file.
+
+        :param str path: path to test
+        :returns: True if the path leads to a MBTiles tile store, else False
+        :rtype: bool
+        """
+        if os.path.isdir(path):
+            return bool(glob.glob(os.path.join(path, "*%s" % MBTILES_EXTENSION)))
+        else:
+            return False
+
+    def __init__(self, store_path, prevent_media_indexing=False):
+        BaseTileStore.__init__(self, store_path, prevent_media_indexing=prevent_media_indexing)
+        # the store is read only, so we don't need to check or create the store folder
+        pack_paths = sorted(glob.glob(os.path.join(self.store_path, "*%s" % MBTILES_EXTENSION)))
+        self._packs = [TilePack(path) for path in pack_paths]
+        # Reading from immutable databases does not need any locking,
+        # so every thread gets its own set of connections, opened lazily
+        # on first access. All connections are also tracked so that
+        # they can be closed once the store is closed.
+        self._thread_local = local()
+        self._connections = []
+        self._connections_lock = RLock()
+
+    def __str__(self):
+        return "MBTiles store @ %s" % self.store_path
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def pack_paths(self):
+        """Paths to MBTiles files mounted by this store"""
+        return [pack.path for pack in self._packs]
+
+    def _get_pack_connections(self):
+        """Return a list of (pack, connection) tuples for the current thread"""
+        pack_connections = getattr(self._thread_local, "pack_connections", None)
+        if pack_connections is None:
+            pack_connections = []
+            with self._connections_lock:
+                for pack in self._packs:
+                    connection = connect_to_pack(pack.path)
+                    self._connections.append(connection)
+                    pack_connections.append((pack, connection))
+            self._thread_local.pack_connections = pack_connections
+        return pack_connections
+
+    def store_tile_data(self, lzxy, tile_data):
+        log.error("can't store tile %s - %s is read only", lzxy, self)
+
+    def get_tile(self, lzxy):
+        """Get tile data and timestamp corresponding to the given coordinate tuple
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+                           (layer is actually not used and can be None)
+        :returns: (tile data, timestamp) or None if tile is not found in any of the packs
+        :rtype: a (bytes, int) tuple or None
+        """
+        _layer, z, x, y = lzxy
+        query = "select tile_data from tiles where zoom_level=? and tile_column=? and tile_row=?"
+        for pack, connection in self._get_pack_connections():
+            result = connection.execute(query, (z, x, flip_y(z, y))).fetchone()
+            if result:
+                return result[0], pack.timestamp
+        return None
+
+    def tile_is_stored(self, lzxy):
+        """Report if a tile specified by the lzxy tuple is stored in any of the packs
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :returns: (True, timestamp) if the tile is stored, else False
+        """
+        _layer, z, x, y = lzxy
+        query = "select 1 from tiles where zoom_level=? and tile_column=? and tile_row=?"
+        for pack, connection in self._get_pack_connections():
+            if connection.execute(query, (z, x, flip_y(z, y))).fetchone():
+                return True, pack.timestamp
+        return False
+
+    def _query_tiles(self, lzxys, columns):
+        """Query multiple tiles in all packs
+
+        :param list lzxys: list of lzxy tuples
+        :param str columns: columns to select in addition to the tile coordinates
+        :returns: (found tiles, not found lzxys) tuple, found tiles is a list of
+                  (lzxy, timestamp, row) tuples
+        """
+        found = []
+        remaining = {}
+        for lzxy in lzxys:
+            _layer, z, x, y = lzxy
+            remaining[(z, x, flip_y(z, y))] = lzxy
+        for pack, connection in self._get_pack_connections():
+            if not remaining:
+                break
+            for chunk in get_chunks(list(remaining.keys()), SQLITE_BULK_QUERY_SIZE):
+                query = "select zoom_level, tile_column, tile_row, %s from tiles " \
+                        "where (zoom_level, tile_column, tile_row) in (values %s)" \
+                        % (columns, ", ".join(["(?, ?, ?)"] * len(chunk)))
+                parameters = [coordinate for zxy in chunk for coordinate in zxy]
+                for row in connection.execute(query, parameters):
+                    lzxy = remaining.pop((row[0], row[1], row[2]), None)
+                    if lzxy is not None:
+                        found.append((lzxy, pack.timestamp, row))
+        return found, remaining.values()
+
+    def get_tiles(self, lzxys):
+        """Get data and timestamps for multiple tiles with a single query per pack
+
+        :param list lzxys: list of lzxy tuples
+        :returns: dictionary with (tile data, timestamp) tuples or None under lzxy keys
+        :rtype: dict
+        """
+        found, not_found = self._query_tiles(lzxys, "tile_data")
+        results = dict.fromkeys(not_found)
+        for lzxy, timestamp, row in found:
+            results[lzxy] = row[3], timestamp
+        return results
+
+    def tiles_are_stored(self, lzxys):
+        """Report if multiple tiles are stored with a single query per pack
+
+        :param list lzxys: list of lzxy tuples
+        :returns: dictionary with (True, timestamp) or False under lzxy keys
+        :rtype: dict
+        """
+        found, not_found = self._query_tiles(lzxys, "1")
+        results = dict.fromkeys(not_found, False)
+        for lzxy, timestamp, _row in found:
+            results[lzxy] = True, timestamp
+        return results
+
+    def get_tile_coordinates(self, z):
+        """List coordinates of all tiles on the given zoom level in all packs"""
+        coordinates = []
+        query = "select tile_column, tile_row from tiles where zoom_level=?"
+        for _pack, connection in self._get_pack_connections():
+            coordinates.extend((x, flip_y(z, tile_row)) for x, tile_row in connection.execute(query, (z,)))
+        return coordinates
+
+    def get_modification_signature(self, z):
+        """Return names, sizes and modification times of the mounted packs"""
+        signature = []
+        for pack in self._packs:
+            pack_stat = os.stat(pack.path)
+            signature.append((pack.name, pack_stat.st_size, pack_stat.st_mtime_ns))
+        return signature
+
+    def stats(self):
+        """Return total size and sizes of the mounted packs by name"""
+        pack_sizes = {pack.name: pack.size for pack in self._packs}
+        return {"size": sum(pack_sizes.values()), "pack_sizes": pack_sizes}
+
+    def delete_tile(self, lzxy):
+        log.error("can't delete tile %s - %s is read only", lzxy, self)
+
+    def clear(self):
+        """Tile packs are provided by the user and are never removed"""
+        log.warning("not clearing %s - MBTiles stores are read only", self)
+
+    def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._thread_local = local()
+
+
+def export_to_mbtiles(sqlite_store, mbtiles_path, name=None, tile_format=None, modified_since=None):
+    """Export all tiles from a SQLite tile store to a new MBTiles file
+
+    The tiles are copied from one storage database at a time with a single INSERT ... SELECT
+    statement over the lookup and storage databases attached to the MBTiles database,
+    so that tile data never passes through Python.
+
+    If modified_since is set, a delta pack with only tiles modified at or after the given
+    timestamp is created. Tiles with the same timestamp are exported again by the next delta
+    export starting at the newest exported timestamp, which is harmless as importing
+    a delta pack does not replace tiles with the same timestamp.
+
+    :param sqlite_store: a SqliteTileStore instance
+    :param str mbtiles_path: path to the MBTiles file to create
+    :param str name: tile pack name for the metadata, the store folder name is used by default
+    :param str tile_format: tile format for the metadata, the most common
+                            tile extension in the store is used by default
+    :param int modified_since: create a delta pack with tiles modified since this Unix timestamp
+    :returns: number of exported tiles
+    :rtype: int
+    """
+    if os.path.exists(mbtiles_path):
+        raise FileExistsError("MBTiles file %s already exists" % mbtiles_path)
+    # make sure all tiles are in the databases
+    sqlite_store.flush()
+    connection = sqlite3.connect(mbtiles_path)
+    try:
+        cursor = connection.cursor()
+        cursor.execute("create table metadata (name text, value text)")
+        lookup_uri = "file:%s?mode=ro" % pathname2url(sqlite_store.lookup_db_path)
+        cursor.execute("attach database ? as lookup", (lookup_uri,))
+        if modified_since is None:
+            cursor.execute("create table tiles (zoom_level integer, tile_column integer, "
+                           "tile_row integer, tile_data blob)")
+            store_names = sorted(sqlite_store.store_names)
+        else:
+            cursor.execute("create table tiles (zoom_level integer, tile_column integer, "
+                           "tile_row integer, tile_data blob, unix_epoch_timestamp integer)")
+            # only storage databases with modified tiles need to be attached
+            store_names = sorted(row[0] for row in cursor.execute(
+                "select distinct store_filename from lookup.tiles where unix_epoch_timestamp>=?",
+                (modified_since,)
+            ))
+        for store_name in store_names:
+            store_uri = "file:%s?mode=ro" % pathname2url(os.path.join(sqlite_store.store_path, store_name))
+            cursor.execute("attach database ? as store", (store_uri,))
+            # only export tiles the lookup database points to, skipping any leftovers
+            if modified_since is None:
+                cursor.execute(
+                    "insert or replace into main.tiles (zoom_level, tile_column, tile_row, tile_data) "
+                    "select s.z, s.x, (1 << s.z) - 1 - s.y, coalesce(s.tile, b.tile) from store.tiles as s "
+                    "left join store.blobs as b on b.id=s.blob_id "
+                    "join lookup.tiles as l on l.z=s.z and l.x=s.x and l.y=s.y "
+                    "where l.store_filename=%s" % quote_sqlite_string(store_name)
+                )
+            else:
+                # the cross join makes the modified tiles found with the timestamp
+                # index drive the query instead of scanning the whole storage database
+                cursor.execute(
+                    "insert or replace into main.tiles "
+                    "(zoom_level, tile_column, tile_row, tile_data, unix_epoch_timestamp) "
+                    "select s.z, s.x, (1 << s.z) - 1 - s.y, coalesce(s.tile, b.tile), l.unix_epoch_timestamp "
+                    "from lookup.tiles as l cross join store.tiles as s "
+                    "on s.z=l.z and s.x=l.x and s.y=l.y and s.extension=l.extension "
+                    "left join store.blobs as b on b.id=s.blob_id "
+                    "where l.unix_epoch_timestamp>=%d and l.store_filename=%s"
+                    % (modified_since, quote_sqlite_string(store_name))
+                )
+            connection.commit()
+            cursor.execute("detach database store")
+        # creating the index once all tiles are inserted is faster than updating it for every tile
+        cursor.execute("create unique index tile_index on tiles (zoom_level, tile_column, tile_row)")
+        tile_count, min_zoom, max_zoom = cursor.execute(
+            "select count(*), min(zoom_level), max(zoom_level) from main.tiles"
+        ).fetchone()
+        if tile_format is None:
+            result = cursor.execute("select extension from lookup.tiles group by extension "
+                                    "order by count(*) desc limit 1").fetchone()
+            tile_format = result[0] if result else MBTILES_DEFAULT_FORMAT
+        metadata = {
+            "name": name or os.path.basename(os.path.normpath(sqlite_store.store_path)),
+            "format": tile_format,
+            "type": "baselayer",
+            "version": "1.0"
+        }
+        if tile_count:
+            metadata["minzoom"] = str(min_zoom)
+            metadata["maxzoom"] = str(max_zoom)
+        if modified_since is not None:
+            newest_timestamp = cursor.execute("select max(unix_epoch_timestamp) from main.tiles").fetchone()[0]
+            metadata[DELTA_MODIFIED_SINCE_KEY] = str(modified_since)
+            # an empty delta pack does not move the next delta forward
+            metadata[DELTA_NEWEST_TIMESTAMP_KEY] = str(modified_since if newest_timestamp is None
+                                                       else newest_timestamp)
+        cursor.executemany("insert into metadata (name, value) values (?, ?)", metadata.items())
+        connection.commit()
+        cursor.execute("detach database lookup")
+    except Exception:
+        connection.close()
+        # don't leave a partial tile pack around
+        os.remove(mbtiles_path)
+        raise
+    else:
+        connection.close()
+    log.info("%d tiles exported from %s to %s", tile_count, sqlite_store, mbtiles_path)
+    return tile_count
+
+def import_from_mbtiles(mbtiles_path, sqlite_store, extension=None):
+    """Import all tiles from a MBTiles file to a SQLite tile store
+
+    Tiles from a delta pack replace already stored tiles only if they are newer,
+    tiles from a regular MBTiles file always replace them.
+
+    :param str mbtiles_path: path to the MBTiles file
+    :param sqlite_store: a SqliteTileStore instance
+    :param str extension: extension of the imported tiles, the format from
+                          the MBTiles metadata is used by default
+    :returns: number of imported tiles
+    :rtype: int
+    """
+    connection = connect_to_pack(mbtiles_path)
+    try:
+        metadata = get_pack_metadata(connection)
+    finally:
+        connection.close()
+    if extension is None:
+        extension = metadata.get("format", MBTILES_DEFAULT_FORMAT)
+    if DELTA_MODIFIED_SINCE_KEY in metadata:
+        return sqlite_store.import_tiles(mbtiles_path, MBTILES_DELTA_IMPORT_QUERY % quote_sqlite_string(extension),
+                                         newer_only=True)
+    timestamp = int(os.path.getmtime(mbtiles_path))
+    return sqlite_store.import_tiles(mbtiles_path, MBTILES_IMPORT_QUERY % (quote_sqlite_string(extension), timestamp))
@@ -0,0 +1,227 @@
+"""Migration of tiles stored as files to a SQLite tile store
+
+The z/x/y tile tree of a file based tile store is walked by a couple of reader threads,
+each listing & reading a single x level folder at a time with os.scandir(). Tiles that are
+not images are skipped. The tiles that have been read are written to the SQLite tile store
+by the migrating thread in large transactions, as SQLite has just a single writer anyway.
+
+Once all tiles from an x level folder are committed, the folder is recorded as migrated
+in a state file in the source folder, so that an interrupted migration can be resumed
+without reading the migrated folders again. The state file is removed once the migration
+is finished. Migrated tile files can be optionally deleted.
+"""
+import os
+import queue
+from threading import Thread, Event
+
+import logging
+log = logging.getLogger("tile_storage.migration")
+
+from .files_store import PARTIAL_TILE_FILE_SUFFIX
+from . import utils
+
+# default number of threads reading tile files
+MIGRATION_THREAD_COUNT = 4
+# tiles are written to the SQLite tile store in transactions of about this many tiles
+MIGRATION_TRANSACTION_SIZE = 2000
+# name of the file recording x level folders that have already been migrated
+MIGRATION_STATE_FILE_NAME = "files_migration.state"
+# how long to wait before checking if a reader thread should stop
+MIGRATION_READER_TIMEOUT = 0.5  # in seconds
+
+def _list_numeric_folders(path):
+    """Return a sorted list of numbers of folders with numeric names in the given folder"""
+    return sorted(int(entry.name) for entry in os.scandir(path) if entry.name.isdigit() and entry.is_dir())
+
+
+class FilesToSqliteMigration(object):
+    """Migrate tiles stored as files to a SQLite tile store
+
+    :param str source_path: path to a file based tile store
+    :param target_store: SqliteTileStore instance to migrate the tiles to
+    :param int thread_count: number of threads reading tile files
+    :param int transaction_size: about how many tiles to write in a single transaction
+    :param bool delete_source: delete tile files once they have been migrated
+    """
+
+    def __init__(self, source_path, target_store, thread_count=MIGRATION_THREAD_COUNT,
+                 transaction_size=MIGRATION_TRANSACTION_SIZE, delete_source=False):
+        self.source_path = source_path
+        self.target_store = target_store
+        self.thread_count = max(1, thread_count)
+        self.transaction_size = transaction_size
+        self.delete_source = delete_source
+        self.migrated_tile_count = 0
+        self.invalid_tile_count = 0
+        self._state_file_path = os.path.join(source_path, MIGRATION_STATE_FILE_NAME)
+
+    def __str__(self):
+        return "files to sqlite migration @ %s" % self.source_path
+
+    def _load_migrated_folders(self):
+        """Return a set of (z, x) tuples of x level folders migrated by a previous interrupted run"""
+        migrated_folders = set()
+        if not os.path.isfile(self._state_file_path):
+            return migrated_folders
+        with open(self._state_file_path, "r") as f:
+            for line in f:
+                z, _slash, x = line.strip().partition("/")
+                # the last line might be incomplete if the previous run crashed
+                if z.isdigit() and x.isdigit():
+                    migrated_folders.add((int(z), int(x)))
+        return migrated_folders
+
+    def _list_folders(self):
+        """Return a list of (z, x) tuples of all x level folders"""
+        folders = []
+        for z in _list_numeric_folders(self.source_path):
+            for x in _list_numeric_folders(os.path.join(self.source_path, str(z))):
+                folders.append((z, x))
+        return folders
+
+    def _read_folder(self, z, x):
+        """Read all tiles from an x level folder
+
+        :returns: list of (z, x, y, extension, tile_data, timestamp) tuples,
+                  list of paths of the tile files & number of skipped invalid tiles
+        :rtype: tuple
+        """
+        tiles = []
+        tile_paths = []
+        invalid_tile_count = 0
+        for entry in os.scandir(os.path.join(self.source_path, str(z), str(x))):
+            if entry.name.endswith(PARTIAL_TILE_FILE_SUFFIX):
+                continue
+            y, _dot, extension = entry.name.partition(".")
+            if not y.isdigit() or not entry.is_file():
+                continue
+            with open(entry.path, "rb") as f:
+                tile_data = f.read()
+            if not utils.is_an_image(tile_data):
+                log.warning("skipping %s, it is probably not an image", entry.path)
+                invalid_tile_count += 1
+                continue
+            # the file based tile store uses file modification time as the tile timestamp
+            tiles.append((z, x, int(y), extension, tile_data, int(entry.stat().st_mtime)))
+            tile_paths.append(entry.path)
+        return tiles, tile_paths, invalid_tile_count
+
+    def _reader(self, folder_queue, result_queue, stop_event):
+        """Read x level folders from the folder queue & put the results to the result queue"""
+        while not stop_event.is_set():
+            try:
+                z, x = folder_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                result = (z, x) + self._read_folder(z, x)
+            except Exception:
+                log.exception("reading tile folder %d/%d of %s failed", z, x, self)
+                result = (z, x, None, None, 0)
+            while not stop_event.is_set():
+                try:
+                    result_queue.put(result, timeout=MIGRATION_READER_TIMEOUT)
+                    break
+                except queue.Full:
+                    continue
+
+    def _commit(self, tiles, folders, state_file):
+        """Write the tiles to the target store & record the folders as migrated
+
+        :param list tiles: tiles to write
+        :param list folders: list of (z, x, tile paths) tuples of folders the tiles are from
+        :param state_file: opened migration state file
+        """
+        self.target_store.store_tiles(tiles)
+        self.migrated_tile_count += len(tiles)
+        # the folders are recorded only once their tiles are committed, if the record is lost
+        # the folders are just migrated again, replacing the already migrated tiles
+        for z, x, _tile_paths in folders:
+            state_file.write("%d/%d\n" % (z, x))
+        state_file.flush()
+        if self.delete_source:
+            for z, x, tile_paths in folders:
+                for tile_path in tile_paths:
+                    os.remove(tile_path)
+                try:
+                    # the folder might still contain invalid tiles and other files
+                    os.rmdir(os.path.join(self.source_path, str(z), str(x)))
+                except OSError:
+                    pass
+
+    def run(self, should_continue=None, progress_callback=None):
+        """Run the migration, resuming a previous interrupted run (if any)
+
+        :param should_continue: a callable, the migration is interrupted once it returns False
+        :param progress_callback: called with migrated and total x level folder count
+        :returns: True if all folders have been migrated, else False
+        :rtype: bool
+        """
+        migrated_folders = self._load_migrated_folders()
+        folders = self._list_folders()
+        pending_folders = [folder for folder in folders if folder not in migrated_folders]
+        migrated_folder_count = len(folders) - len(pending_folders)
+        if migrated_folders:
+            log.info("resuming %s, %d of %d tile folders have already been migrated",
+                     self, migrated_folder_count, len(folders))
+
+        folder_queue = queue.Queue()
+        for folder in pending_folders:
+            folder_queue.put(folder)
+        # limit how many read tiles can wait to be written
+        result_queue = queue.Queue(maxsize=self.thread_count * 2)
+        stop_event = Event()
+        readers = []
+        for index in range(min(self.thread_count, len(pending_folders))):
+            reader = Thread(target=self._reader, args=(folder_queue, result_queue, stop_event),
+                            name="modRanaTileMigrationReader%d" % index)
+            reader.daemon = True
+            reader.start()
+            readers.append(reader)
+
+        finished = True
+        tiles = []
+        tile_folders = []
+        try:
+            with open(self._state_file_path, "a") as state_file:
+                for _index in range(len(pending_folders)):
+                    if should_continue is not None and not should_continue():
+                        log.info("%s has been interrupted", self)
+                        finished = False
+                        break
+                    z, x, folder_tiles, tile_paths, invalid_tile_count = result_queue.get()
+                    self.invalid_tile_count += invalid_tile_count
+                    if folder_tiles is None:
+                        # the folder could not be read, so it is not recorded as migrated
+                        finished = False
+                        continue
+                    tiles.extend(folder_tiles)
+                    tile_folders.append((z, x, tile_paths))
+                    if len(tiles) >= self.transaction_size:
+                        self._commit(tiles, tile_folders, state_file)
+                        migrated_folder_count += len(tile_folders)
+                        tiles = []
+                        tile_folders = []
+                        if progress_callback is not None:
+                            progress_callback(migrated_folder_count, len(folders))
+                if tile_folders:
+                    self._commit(tiles, tile_folders, state_file)
+                    migrated_folder_count += len(tile_folders)
+                    if progress_callback is not None:
+                        progress_callback(migrated_folder_count, len(folders))
+        finally:
+            stop_event.set()
+            for reader in readers:
+                reader.join()
+
+        if finished:
+            os.remove(self._state_file_path)
+            if self.delete_source:
+                for z in _list_numeric_folders(self.source_path):
+                    try:
+                        os.rmdir(os.path.join(self.source_path, str(z)))
+                    except OSError:
+                        pass
+        log.info("%s: %d tiles migrated, %d invalid tiles skipped",
+                 self, self.migrated_tile_count, self.invalid_tile_count)
+        return finished
@@ -0,0 +1,503 @@
+"""A tile store that appends tiles to large pack files
+
+This has a number of benefits, especially on flash storage:
+* there is just a couple of files no matter how many tiles are stored,
+  so no inode & directory lookup per tile as with the files store
+* tiles are only ever appended, so writes (batch download) are near-sequential
+  and there is no B-tree & journal overhead per write as with the SQLite store
+* tile data is read from memory mapped pack files, so reads are served
+  from the page cache without any seeking or read calls
+
+How does it work ?
+Tiles are appended to pack files, starting with tiles.pack.0. Once a pack file reaches
+MAX_PACK_FILE_SIZE a new one is started (tiles.pack.1, tiles.pack.2, etc.). Every record
+is a fixed size header followed by the tile data:
+
+magic (4 bytes), z (uint8), x (uint32), y (uint32), timestamp (int64), data length (uint32), data crc32 (uint32)
+
+Deleting a tile appends a record with no data.
+
+The index (tiles.packindex) is a sorted array of fixed size entries:
+
+key (uint64, z << 58 | x << 29 | y), pack number (uint16), data offset (uint32), data length (uint32), timestamp (int64)
+
+preceded by a header saying up to which pack file and offset the index covers the pack files.
+The index is memory mapped & binary searched, so it does not need to be loaded to memory.
+Tiles stored or deleted since the index has been written are kept in a small in-memory journal,
+which is merged to a new index once it gets too big, on flush() and on close(). After a crash
+the records not covered by the index are replayed from the pack files to the journal, so the pack
+files themselves serve as the journal. A record torn by the crash (incomplete or with a wrong
+checksum) can only be at the end of a pack file and is truncated. If the index is missing
+or damaged it is rebuilt from the pack files.
+
+NOTE: space used by replaced or deleted tiles is not reclaimed
+"""
+import os
+import glob
+import mmap
+import struct
+import time
+import zlib
+from threading import RLock
+
+import logging
+log = logging.getLogger("tile_storage.pack_store")
+
+from .base import BaseTileStore
+from .constants import GIBI_BYTE, MEBI_BYTE
+from . import utils
+
+# pack files can be only this big to avoid maximum file size limitations on FAT32
+# (and data offsets need to fit to 32 bits)
+MAX_PACK_FILE_SIZE = 1  # in Gibi Bytes
+# size of the write buffer of the pack file tiles are appended to
+PACK_WRITE_BUFFER_SIZE = 1  # in Mebi Bytes
+# the in-memory journal is merged to the index once it has this many entries
+PACK_JOURNAL_SIZE = 10000
+PACK_FILE_PREFIX = "tiles.pack."
+PACK_INDEX_NAME = "tiles.packindex"
+PACK_FORMAT_VERSION = 1
+
+RECORD_MAGIC = b"MRTL"
+RECORD_HEADER = struct.Struct("<4sBIIqII")
+INDEX_MAGIC = b"MRTPINDX"
+INDEX_HEADER = struct.Struct("<8sIQHQ")
+INDEX_ENTRY = struct.Struct("<QHIIq")
+INDEX_KEY = struct.Struct("<Q")
+
+_COORDINATE_MASK = 2**29 - 1
+
+def get_tile_key(z, x, y):
+    """Return an integer key for the given tile, keys sort by z, x & y"""
+    return (z << 58) | (x << 29) | y
+
+def split_tile_key(key):
+    """Return z, x & y coordinates for the given tile key"""
+    return key >> 58, (key >> 29) & _COORDINATE_MASK, key & _COORDINATE_MASK
+
+
+class PackIndex(object):
+    """A read only memory mapped sorted tile index
+
+    :param str path: path to the index file, an empty index is used if None or if the file does not exist
+    :raises ValueError: if the index file is damaged
+    """
+
+    def __init__(self, path=None):
+        self.entry_count = 0
+        # (pack number, offset) up to which the index covers the pack files
+        self.covered = (0, 0)
+        self._mmap = None
+        if path is None or not os.path.isfile(path):
+            return
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size < INDEX_HEADER.size:
+                raise ValueError("index file %s is truncated" % path)
+            index_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, entry_count, pack_number, offset = INDEX_HEADER.unpack_from(index_map, 0)
+        if magic != INDEX_MAGIC or version != PACK_FORMAT_VERSION:
+            raise ValueError("%s is not a supported tile pack index" % path)
+        if len(index_map) != INDEX_HEADER.size + entry_count * INDEX_ENTRY.size:
+            raise ValueError("index file %s has unexpected size" % path)
+        self.entry_count = entry_count
+        self.covered = (pack_number, offset)
+        self._mmap = index_map
+
+    def _key_at(self, position):
+        return INDEX_KEY.unpack_from(self._mmap, INDEX_HEADER.size + position * INDEX_ENTRY.size)[0]
+
+    def _lower_bound(self, key):
+        """Return position of the first entry with key not lower than the given key"""
+        low, high = 0, self.entry_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get(self, key):
+        """Return the index entry for the given tile key
+
+        :returns: (pack number, offset, length, timestamp) or None if the tile is not in the index
+        :rtype: tuple or None
+        """
+        position = self._lower_bound(key)
+        if position < self.entry_count and self._key_at(position) == key:
+            return INDEX_ENTRY.unpack_from(self._mmap, INDEX_HEADER.size + position * INDEX_ENTRY.size)[1:]
+        return None
+
+    def entries(self, start_key=0, end_key=None):
+        """Iterate over index entries with keys from start key (inclusive) to end key (exclusive)
+
+        :returns: iterator of (key, pack number, offset, length, timestamp) tuples
+        """
+        if not self.entry_count:
+            return
+        position = self._lower_bound(start_key) if start_key else 0
+        for entry in INDEX_ENTRY.iter_unpack(self._mmap[INDEX_HEADER.size + position * INDEX_ENTRY.size:]):
+            if end_key is not None and entry[0] >= end_key:
+                break
+            yield entry
+
+
+class PackFileTileStore(BaseTileStore):
+
+    @staticmethod
+    def is_store(path):
+        """We consider the path to be a pack file tile store if it is a folder containing a pack file
+
+        :param str path: path to test
+        :returns: True if the path leads to a pack file tile store, else False
+        :rtype: bool
+        """
+        return os.path.isdir(path) and bool(glob.glob(os.path.join(path, PACK_FILE_PREFIX + "*")))
+
+    def __init__(self, store_path, prevent_media_indexing=False):
+        BaseTileStore.__init__(self, store_path, prevent_media_indexing=prevent_media_indexing)
+        # make sure the folder containing the pack files exists
+        utils.check_folder(self.store_path, prevent_media_indexing=prevent_media_indexing)
+        # Writes & the journal are protected by the lock, while the index is immutable
+        # and replaced as a whole, so it can be searched without holding the lock.
+        self._lock = RLock()
+        self._index_path = os.path.join(self.store_path, PACK_INDEX_NAME)
+        # tile key -> (pack number, offset, length, timestamp) or None for deleted tiles
+        self._journal = {}
+        # pack number -> read only memory map of the pack file
+        self._pack_maps = {}
+        self._write_file = None
+        self._open()
+
+    def __str__(self):
+        return "pack file store @ %s" % self.store_path
+
+    def __repr__(self):
+        return str(self)
+
+    def _get_pack_path(self, pack_number):
+        return os.path.join(self.store_path, "%s%d" % (PACK_FILE_PREFIX, pack_number))
+
+    def _list_pack_numbers(self):
+        """Return a sorted list of numbers of existing pack files"""
+        pack_numbers = []
+        for pack_path in glob.glob(os.path.join(self.store_path, PACK_FILE_PREFIX + "*")):
+            number = pack_path.split(PACK_FILE_PREFIX)[-1]
+            if number.isdigit():
+                pack_numbers.append(int(number))
+        return sorted(pack_numbers)
+
+    def _open(self):
+        """Load the index and replay any records it does not cover"""
+        try:
+            self._index = PackIndex(self._index_path)
+        except (ValueError, OSError):
+            log.exception("tile pack index of %s is damaged, rebuilding it", self)
+            self._index = PackIndex()
+        pack_numbers = self._list_pack_numbers()
+        covered_pack_number, covered_offset = self._index.covered
+        for pack_number in pack_numbers:
+            if pack_number > covered_pack_number:
+                self._replay_pack(pack_number, 0)
+            elif pack_number == covered_pack_number:
+                self._replay_pack(pack_number, covered_offset)
+        if self._journal:
+            log.info("%d tile records replayed to the journal of %s", len(self._journal), self)
+        self._write_pack_number = pack_numbers[-1] if pack_numbers else 0
+        pack_path = self._get_pack_path(self._write_pack_number)
+        self._write_offset = os.path.getsize(pack_path) if os.path.exists(pack_path) else 0
+        self._flushed_offset = self._write_offset
+
+    def _replay_pack(self, pack_number, offset):
+        """Add records from the given pack file starting at the given offset to the journal
+
+        A torn record (incomplete or with a wrong checksum) is truncated.
+        """
+        pack_path = self._get_pack_path(pack_number)
+        with open(pack_path, "r+b") as f:
+            pack_size = os.fstat(f.fileno()).st_size
+            f.seek(offset)
+            while offset < pack_size:
+                header = f.read(RECORD_HEADER.size)
+                torn = len(header) < RECORD_HEADER.size
+                if not torn:
+                    magic, z, x, y, timestamp, length, checksum = RECORD_HEADER.unpack(header)
+                    tile_data = f.read(length)
+                    torn = magic != RECORD_MAGIC or len(tile_data) < length or zlib.crc32(tile_data) != checksum
+                if torn:
+                    log.warning("truncating torn tile record at %d in %s", offset, pack_path)
+                    f.truncate(offset)
+                    break
+                key = get_tile_key(z, x, y)
+                if length:
+                    self._journal[key] = (pack_number, offset + RECORD_HEADER.size, length, timestamp)
+                else:  # deleted tile
+                    self._journal[key] = None
+                offset += RECORD_HEADER.size + length
+
+    def _append_record(self, z, x, y, timestamp, tile_data):
+        """Append a tile record to the current pack file
+
+        NOTE: needs to be called with the lock held
+
+        :returns: (pack number, data offset) tuple
+        """
+        record_size = RECORD_HEADER.size + len(tile_data)
+        if self._write_offset and self._write_offset + record_size > MAX_PACK_FILE_SIZE * GIBI_BYTE:
+            # the current pack file is full, start a new one
+            self._close_write_file()
+            self._write_pack_number += 1
+            self._write_offset = 0
+            self._flushed_offset = 0
+        if self._write_file is None:
+            self._write_file = open(self._get_pack_path(self._write_pack_number), "ab",
+                                    buffering=PACK_WRITE_BUFFER_SIZE * MEBI_BYTE)
+        self._write_file.write(RECORD_HEADER.pack(RECORD_MAGIC, z, x, y, timestamp,
+                                                  len(tile_data), zlib.crc32(tile_data)))
+        self._write_file.write(tile_data)
+        data_offset = self._write_offset + RECORD_HEADER.size
+        self._write_offset += record_size
+        return self._write_pack_number, data_offset
+
+    def _flush_write_file(self, sync=False):
+        """Write buffered records to the current pack file
+
+        NOTE: needs to be called with the lock held
+        """
+        if self._write_file is not None:
+            self._write_file.flush()
+            if sync:
+                os.fsync(self._write_file.fileno())
+            self._flushed_offset = self._write_offset
+
+    def _close_write_file(self):
+        """NOTE: needs to be called with the lock held"""
+        if self._write_file is not None:
+            self._flush_write_file(sync=True)
+            self._write_file.close()
+            self._write_file = None
+
+    def store_tile_data(self, lzxy, tile_data):
+        _layer, z, x, y = lzxy
+        timestamp = int(time.time())
+        with self._lock:
+            pack_number, offset = self._append_record(z, x, y, timestamp, tile_data)
+            self._journal[get_tile_key(z, x, y)] = (pack_number, offset, len(tile_data), timestamp)
+            if len(self._journal) >= PACK_JOURNAL_SIZE:
+                self._write_index()
+
+    def _get_entry(self, z, x, y):
+        """Return (pack number, offset, length, timestamp) for the given tile or None if it is not stored"""
+        key = get_tile_key(z, x, y)
+        with self._lock:
+            if key in self._journal:
+                return self._journal[key]
+            index = self._index
+        return index.get(key)
+
+    def _read_tile_data(self, pack_number, offset, length):
+        """Read tile data from a memory mapped pack file"""
+        end = offset + length
+        with self._lock:
+            if pack_number == self._write_pack_number and end > self._flushed_offset:
+                # the tile is still in the write buffer
+                self._flush_write_file()
+            pack_map = self._pack_maps.get(pack_number)
+            if pack_map is None or len(pack_map) < end:
+                # the pack file has grown since it has been mapped, map it again
+                # - the old map is unmapped once no reader is using it
+                with open(self._get_pack_path(pack_number), "rb") as f:
+                    pack_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._pack_maps[pack_number] = pack_map
+        return pack_map[offset:end]
+
+    def get_tile(self, lzxy):
+        """Get tile data and timestamp corresponding to the given coordinate tuple
+
+        :returns: (tile data, timestamp) or None if tile is not found in the store
+        :rtype: a (bytes, int) tuple or None
+        """
+        _layer, z, x, y = lzxy
+        entry = self._get_entry(z, x, y)
+        if entry is None:
+            return None
+        pack_number, offset, length, timestamp = entry
+        tile_data = self._read_tile_data(pack_number, offset, length)
+        if not utils.is_an_image(tile_data):
+            log.warning("%s,%s,%s in %s is probably not an image", x, y, z, self)
+        return tile_data, timestamp
+
+    def tile_is_stored(self, lzxy):
+        _layer, z, x, y = lzxy
+        entry = self._get_entry(z, x, y)
+        if entry is None:
+            return False
+        return True, entry[3]
+
+    def delete_tile(self, lzxy):
+        _layer, z, x, y = lzxy
+        with self._lock:
+            if self._get_entry(z, x, y) is None:
+                return
+            self._append_record(z, x, y, int(time.time()), b"")
+            self._journal[get_tile_key(z, x, y)] = None
+
+    def _entries(self, start_key=0, end_key=None):
+        """Iterate over entries of all stored tiles, both from the index and the journal
+
+        :returns: iterator of (key, pack number, offset, length, timestamp) tuples sorted by key
+        """
+        with self._lock:
+            journal_items = sorted(item for item in self._journal.items()
+                                   if item[0] >= start_key and (end_key is None or item[0] < end_key))
+            index = self._index
+        journal_position = 0
+        for entry in index.entries(start_key, end_key):
+            key = entry[0]
+            while journal_position < len(journal_items) and journal_items[journal_position][0] <= key:
+                journal_key, journal_entry = journal_items[journal_position]
+                journal_position += 1
+                if journal_entry is not None:
+                    yield (journal_key,) + journal_entry
+                if journal_key == key:
+                    # the tile has been replaced or deleted since the index has been written
+                    break
+            else:
+                yield entry
+        for journal_key, journal_entry in journal_items[journal_position:]:
+            if journal_entry is not None:
+                yield (journal_key,) + journal_entry
+
+    def _write_index(self):
+        """Merge the journal to a new index file
+
+        NOTE: needs to be called with the lock held
+        """
+        # the records covered by the index need to be on disk before the index is
+        self._flush_write_file(sync=True)
+        covered = (self._write_pack_number, self._write_offset)
+        temporary_index_path = self._index_path + ".part"
+        entry_count = 0
+        with open(temporary_index_path, "wb") as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, PACK_FORMAT_VERSION, 0, *covered))
+            for entry in self._entries():
+                f.write(INDEX_ENTRY.pack(*entry))
+                entry_count += 1
+            f.seek(0)
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, PACK_FORMAT_VERSION, entry_count, *covered))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_index_path, self._index_path)
+        self._index = PackIndex(self._index_path)
+        self._journal = {}
+
+    def get_tile_coordinates(self, z):
+        """List coordinates of all tiles stored on the given zoom level
+
+        :param int z: zoom level
+        :returns: list of (x, y) tuples
+        :rtype: list
+        """
+        return [split_tile_key(entry[0])[1:]
+                for entry in self._entries(get_tile_key(z, 0, 0), get_tile_key(z + 1, 0, 0))]
+
+    def get_modification_signature(self, z):
+        """Return the current pack file number and size
+
+        Storing or deleting any tile appends to the current pack file,
+        so the signature covers all zoom levels.
+        """
+        with self._lock:
+            return [self._write_pack_number, self._write_offset]
+
+    def get_expired_tiles(self, timestamp, limit=None):
+        """Return coordinates of tiles stored before the given timestamp, oldest first
+
+        NOTE: this needs to go over the whole index
+        """
+        expired_entries = sorted((entry[4], entry[0]) for entry in self._entries() if entry[4] < timestamp)
+        return [split_tile_key(key) for _timestamp, key in expired_entries[:limit]]
+
+    def delete_expired_tiles(self, timestamp, batch_size=PACK_JOURNAL_SIZE, should_continue=None):
+        """Delete all tiles stored before the given timestamp
+
+        NOTE: this needs to go over the whole index
+        """
+        expired_keys = [entry[0] for entry in self._entries() if entry[4] < timestamp]
+        deleted_count = 0
+        for batch_start in range(0, len(expired_keys), batch_size):
+            if should_continue is not None and not should_continue():
+                break
+            with self._lock:
+                deletion_timestamp = int(time.time())
+                for key in expired_keys[batch_start:batch_start + batch_size]:
+                    z, x, y = split_tile_key(key)
+                    self._append_record(z, x, y, deletion_timestamp, b"")
+                    self._journal[key] = None
+                    deleted_count += 1
+                if len(self._journal) >= PACK_JOURNAL_SIZE:
+                    self._write_index()
+        log.debug("%d expired tiles deleted from %s", deleted_count, self)
+        return deleted_count
+
+    def stats(self):
+        """Return storage statistics
+
+        :returns: dictionary with total size in bytes (including replaced & deleted tiles)
+                  under the "size" key and pack file sizes by name under the "pack_sizes" key
+        :rtype: dict
+        """
+        with self._lock:
+            pack_sizes = {}
+            for pack_number in self._list_pack_numbers():
+                pack_sizes[os.path.basename(self._get_pack_path(pack_number))] = \
+                    os.path.getsize(self._get_pack_path(pack_number))
+            if self._write_pack_number in pack_sizes or self._write_offset:
+                # include tiles still in the write buffer
+                pack_sizes[os.path.basename(self._get_pack_path(self._write_pack_number))] = self._write_offset
+        index_size = os.path.getsize(self._index_path) if os.path.exists(self._index_path) else 0
+        return {
+            "size": index_size + sum(pack_sizes.values()),
+            "pack_sizes": pack_sizes
+        }
+
+    def get_used_size(self):
+        """Return size of the pack files & index (including replaced & deleted tiles)"""
+        return self.stats()["size"]
+
+    def flush(self):
+        """Write buffered tiles to the pack file and merge the journal to the index"""
+        with self._lock:
+            if self._journal:
+                self._write_index()
+            else:
+                self._flush_write_file(sync=True)
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._close_write_file()
+            # the maps are unmapped once no reader is using them
+            self._pack_maps = {}
+            self._index = PackIndex()
+
+    def clear(self):
+        """Delete all pack files and the index"""
+        with self._lock:
+            if self._write_file is not None:
+                self._write_file.close()
+                self._write_file = None
+            self._pack_maps = {}
+            self._index = PackIndex()
+            self._journal = {}
+            try:
+                for pack_number in self._list_pack_numbers():
+                    os.remove(self._get_pack_path(pack_number))
+                for path in (self._index_path, self._index_path + ".part"):
+                    if os.path.exists(path):
+                        os.remove(path)
+            except OSError:
+                log.exception("clearing of pack file tile store at path %s failed", self.store_path)
+            self._write_pack_number = 0
+            self._write_offset = 0
+            self._flushed_offset = 0
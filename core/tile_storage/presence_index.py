@@ -0,0 +1,313 @@
+"""In memory tile presence index
+
+The presence index keeps a compact summary of which tiles are stored in a set
+of tile stores (usually all stores of a single map layer). This makes it possible
+to answer "is this tile stored ?" without touching storage if the tile is not
+stored, which is the most common answer for example when batch downloading.
+
+For every zoom level a scalable Bloom filter of the x/y coordinates is used:
+- there are no false negatives, so if the index says a tile is not stored,
+  it really is not stored
+- there can be false positives (about 1 % by default), so if the index says a tile
+  might be stored, the stores need to be checked
+- tiles can't be removed from a Bloom filter, so deleted tiles just stay in it
+  as false positives until the index is rebuilt
+
+The index for a zoom level is built lazily in a background thread the first time
+the zoom level is queried, by listing tile coordinates from the stores. Until the
+index is built all tiles are reported as possibly stored. Optionally the index can
+be persisted to a file next to the store and loaded on next start, as long as the
+stores have not been modified in the meantime.
+"""
+import os
+import math
+import json
+import threading
+
+import logging
+log = logging.getLogger("tile_storage.presence_index")
+
+# target false positive rate of the Bloom filters
+DEFAULT_FALSE_POSITIVE_RATE = 0.01
+# minimum capacity of a Bloom filter
+MINIMUM_CAPACITY = 1024
+# file name prefix of persisted zoom level indexes
+PRESENCE_INDEX_FILE_PREFIX = "tile_presence_index."
+
+PRESENCE_INDEX_FORMAT_VERSION = 1
+
+_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+_HASH_MASK = 2**64 - 1
+
+class BloomFilter(object):
+    """A simple fixed capacity Bloom filter for integer keys"""
+
+    def __init__(self, capacity, false_positive_rate=DEFAULT_FALSE_POSITIVE_RATE, bits=None, hash_count=None):
+        self.capacity = capacity
+        if bits is None:
+            bit_count = int(-capacity * math.log(false_positive_rate) / (math.log(2) ** 2))
+            bits = bytearray((bit_count + 7) // 8)
+        self._bits = bits
+        self._bit_count = len(bits) * 8
+        if hash_count is None:
+            hash_count = max(1, int(round(self._bit_count / capacity * math.log(2))))
+        self.hash_count = hash_count
+        self.count = 0
+
+    @property
+    def bits(self):
+        return self._bits
+
+    def _positions(self, key):
+        # double hashing over a 64 bit multiplicative hash of the key
+        key_hash = (key * _HASH_MULTIPLIER) & _HASH_MASK
+        h1 = key_hash & 0xffffffff
+        h2 = (key_hash >> 32) | 1
+        bit_count = self._bit_count
+        return [(h1 + i * h2) % bit_count for i in range(self.hash_count)]
+
+    def add(self, key):
+        bits = self._bits
+        for position in self._positions(key):
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self._bits
+        for position in self._positions(key):
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def is_full(self):
+        return self.count >= self.capacity
+
+
+class ScalableBloomFilter(object):
+    """A Bloom filter that adds a new, twice as big Bloom filter once the last one is full"""
+
+    def __init__(self, initial_capacity=MINIMUM_CAPACITY, filters=None):
+        if filters is None:
+            filters = [BloomFilter(max(initial_capacity, MINIMUM_CAPACITY))]
+        self._filters = filters
+
+    @property
+    def filters(self):
+        return self._filters
+
+    def add(self, key):
+        last_filter = self._filters[-1]
+        if last_filter.is_full:
+            last_filter = BloomFilter(last_filter.capacity * 2)
+            self._filters.append(last_filter)
+        last_filter.add(key)
+
+    def __contains__(self, key):
+        for bloom_filter in self._filters:
+            if key in bloom_filter:
+                return True
+        return False
+
+
+def _get_tile_key(z, x, y):
+    """Return an integer key unique for the given tile on a zoom level"""
+    return (x << z) | y
+
+
+class TilePresenceIndex(object):
+    """Presence index for all tiles stored in a set of tile stores
+
+    :param stores_getter: a callable returning an iterable of the current tile stores
+    :param str persistence_folder: folder to persist the index to, None disables persistence
+    """
+
+    def __init__(self, stores_getter, persistence_folder=None):
+        self._stores_getter = stores_getter
+        self._persistence_folder = persistence_folder
+        self._lock = threading.RLock()
+        # z -> ScalableBloomFilter for ready & building indexes
+        self._filters = {}
+        # zoom levels that are ready to be used
+        self._ready = set()
+        # zoom levels that can't be indexed
+        self._unsupported = set()
+        # incremented on invalidation so that results of builds
+        # started before the invalidation are discarded
+        self._generation = 0
+
+    def might_be_stored(self, z, x, y):
+        """Report if the given tile might be stored
+
+        :returns: False if the tile is definitely not stored, else True
+        :rtype: bool
+        """
+        with self._lock:
+            if z in self._ready:
+                return _get_tile_key(z, x, y) in self._filters[z]
+            elif z not in self._filters and z not in self._unsupported:
+                self._start_building(z)
+        # the index is not ready, so we don't know
+        return True
+
+    def add(self, z, x, y):
+        """Record that a tile has been stored
+
+        NOTE: this should be called after the tile has been stored,
+              so that the tile is not missed by an index that is being built
+        """
+        with self._lock:
+            bloom_filter = self._filters.get(z)
+            if bloom_filter is not None:
+                bloom_filter.add(_get_tile_key(z, x, y))
+
+    def remove(self, z, x, y):
+        """Record that a tile has been removed
+
+        Tiles can't be removed from a Bloom filter so this does nothing and the tile
+        will be reported as possibly stored until the index is rebuilt.
+        """
+        pass
+
+    def invalidate(self):
+        """Drop all zoom level indexes, they will be rebuilt once needed again
+
+        This should be called when tiles are added to the stores by other means
+        than through the code maintaining this index.
+        """
+        with self._lock:
+            self._filters = {}
+            self._ready = set()
+            self._unsupported = set()
+            self._generation += 1
+
+    def _start_building(self, z):
+        """Start building the index for the given zoom level in a background thread
+
+        NOTE: needs to be called with the index lock held
+        """
+        # register the filter right away so that tiles stored while
+        # the index is being built are added to it
+        self._filters[z] = ScalableBloomFilter()
+        thread = threading.Thread(target=self._build, args=(z, self._generation),
+                                  name="TilePresenceIndexBuilder:%d" % z)
+        thread.daemon = True
+        thread.start()
+
+    def _build(self, z, generation):
+        """Build the index for the given zoom level (if possible from a persisted file)"""
+        try:
+            stores = list(self._stores_getter())
+            bloom_filter = self._load(z, stores)
+            if bloom_filter is None:
+                coordinate_lists = []
+                for store in stores:
+                    coordinates = store.get_tile_coordinates(z)
+                    if coordinates is None:
+                        log.debug("%s can't list tile coordinates, zoom level %d won't be indexed", store, z)
+                        with self._lock:
+                            if generation == self._generation:
+                                self._filters.pop(z, None)
+                                self._unsupported.add(z)
+                        return
+                    coordinate_lists.append(coordinates)
+                # leave enough space for the tiles to be stored later
+                tile_count = sum(len(coordinates) for coordinates in coordinate_lists)
+                bloom_filter = ScalableBloomFilter(initial_capacity=tile_count * 2)
+                for coordinates in coordinate_lists:
+                    for x, y in coordinates:
+                        bloom_filter.add(_get_tile_key(z, x, y))
+            with self._lock:
+                if generation == self._generation:
+                    # keep tiles that have been stored while the index was being built
+                    # (new tiles will be added to the last, big enough, filter)
+                    registered_filter = self._filters.get(z)
+                    if registered_filter is not None:
+                        bloom_filter.filters[0:0] = registered_filter.filters
+                    self._filters[z] = bloom_filter
+                    self._ready.add(z)
+            log.debug("presence index for zoom level %d is ready", z)
+        except Exception:
+            log.exception("building presence index for zoom level %d failed", z)
+            with self._lock:
+                if generation == self._generation:
+                    self._filters.pop(z, None)
+                    self._unsupported.add(z)
+
+    @staticmethod
+    def _get_signatures(z, stores):
+        """Return store modification signatures for the given zoom level
+
+        :returns: list of signatures or None if some of the stores does not provide one
+        """
+        signatures = []
+        for store in stores:
+            signature = store.get_modification_signature(z)
+            if signature is None:
+                return None
+            signatures.append(signature)
+        # normalize the signatures (tuples to lists) so that they can be compared to persisted ones
+        return json.loads(json.dumps(signatures))
+
+    def _get_index_file_path(self, z):
+        return os.path.join(self._persistence_folder, "%s%d" % (PRESENCE_INDEX_FILE_PREFIX, z))
+
+    def _load(self, z, stores):
+        """Load a persisted index for the given zoom level if it is still valid
+
+        :returns: a ScalableBloomFilter instance or None
+        """
+        if self._persistence_folder is None:
+            return None
+        index_file_path = self._get_index_file_path(z)
+        if not os.path.isfile(index_file_path):
+            return None
+        try:
+            with open(index_file_path, "rb") as f:
+                header = json.loads(f.readline().decode("utf-8"))
+                if header.get("version") != PRESENCE_INDEX_FORMAT_VERSION:
+                    return None
+                if header.get("signatures") != self._get_signatures(z, stores):
+                    log.debug("persisted presence index for zoom level %d is outdated", z)
+                    return None
+                filters = []
+                for capacity, byte_count, hash_count, count in header["filters"]:
+                    bloom_filter = BloomFilter(capacity, bits=bytearray(f.read(byte_count)), hash_count=hash_count)
+                    bloom_filter.count = count
+                    filters.append(bloom_filter)
+            log.debug("persisted presence index for zoom level %d loaded", z)
+            return ScalableBloomFilter(filters=filters)
+        except Exception:
+            log.exception("loading persisted presence index from %s failed", index_file_path)
+            return None
+
+    def save(self):
+        """Persist all ready zoom level indexes
+
+        NOTE: the stores should be flushed before this is called
+        """
+        if self._persistence_folder is None or not os.path.isdir(self._persistence_folder):
+            return
+        stores = list(self._stores_getter())
+        with self._lock:
+            ready = [(z, self._filters[z]) for z in self._ready]
+        for z, scalable_filter in ready:
+            signatures = self._get_signatures(z, stores)
+            if signatures is None:
+                continue
+            index_file_path = self._get_index_file_path(z)
+            try:
+                with self._lock:
+                    header = {
+                        "version": PRESENCE_INDEX_FORMAT_VERSION,
+                        "signatures": signatures,
+                        "filters": [(f.capacity, len(f.bits), f.hash_count, f.count) for f in scalable_filter.filters]
+                    }
+                    data = b"".join(bytes(f.bits) for f in scalable_filter.filters)
+                temporary_file_path = index_file_path + ".part"
+                with open(temporary_file_path, "wb") as f:
+                    f.write(json.dumps(header).encode("utf-8") + b"\n")
+                    f.write(data)
+                os.rename(temporary_file_path, index_file_path)
+            except Exception:
+                log.exception("persisting presence index to %s failed", index_file_path)
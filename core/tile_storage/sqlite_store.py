@@ -23,41 +23,116 @@
 #
 # The storage database looks schema like this:
 #
-# table tiles (z integer, x integer, y integer, store_filename string, extension varchar(10), unix_epoch_timestamp integer, primary key (z, x, y, extension))
+# table tiles (z integer, x integer, y integer, store_filename string, extension varchar(10), unix_epoch_timestamp integer, last_access integer, size integer, primary key (z, x, y, extension))
+# table zoom_stats (z integer primary key, tile_count integer, size integer, min_x integer, max_x integer, min_y integer, max_y integer, oldest_timestamp integer, newest_timestamp integer)
 #
 # The storage databases schema look like this:
 #
-# table tiles (z integer, x integer, y integer, tile blob, extension varchar(10), unix_epoch_timestamp integer, primary key (z, x, y, extension))
+# table tiles (z integer, x integer, y integer, tile blob, extension varchar(10), unix_epoch_timestamp integer, blob_id integer, primary key (z, x, y, extension))
+# table blobs (id integer primary key, hash blob unique, tile blob, refcount integer)
 #
 # The only difference in the structure is that the lookup databases only stores the name of the store
 # for given coordinates and the store database stores the actual blob.
+# The lookup database also records when was the tile last accessed (with SQLITE_ACCESS_TIME_RESOLUTION)
+# so that least recently used tiles can be evicted if the store gets too big. The last_access column
+# is added to lookup databases created before it existed once they are opened.
+# The tile timestamp is indexed in the lookup database, so that tiles older than the layer timeout
+# can be found without scanning all tiles (the index is also added to older lookup databases).
+# The lookup database also has per zoom level statistics (tile count, tile data size, coordinate
+# bounds & oldest/newest tile timestamp) in the zoom_stats table. The statistics are maintained by
+# triggers on the tiles table, so they are always updated in the same transaction as the tiles.
+# Bounds & the oldest timestamp are not narrowed when tiles are deleted or replaced, they are
+# recomputed from scratch once the store is compacted. The size column & zoom_stats table are added
+# to lookup databases created before they existed once opened.
 # Both also have a table called version which has an integer column called v.
 # There is a single 1 inserted, which indicates the current version of the table.
 #
+# With deduplication enabled, tile data is not stored in the tiles table of the storage database.
+# Instead it is stored just once per storage database in the blobs table under a hash of the data
+# and tiles point to it by blob_id. Many tiles are byte identical (sea, empty land, blank overlays),
+# so this can save a lot of space. The blobs also have a reference count and are deleted once no
+# tile uses them. Both kinds of tiles can be mixed in a single storage database and the blobs
+# table & blob_id column are added to storage databases created before they existed once opened.
+#
+# The integrity check reads all tile data from the storage databases in parallel chunks and
+# checks it is an image, compares the lookup database with the storage databases for missing
+# & orphaned tiles and runs quick_check on all the database files. When repairing, damaged
+# tiles are moved to the quarantine folder, tiles with missing data are deleted and orphaned
+# tiles are added back to the lookup database if it has no other version of the tile.
+#
 # When looking for a tile in the database, the lookup database is checked first and if the coordinates
 # are found the corresponding storage database is queried for the actual data.
+#
+# Storage databases use incremental auto vacuum, so that free pages left after deleted or replaced
+# tiles can be released in small steps by compact() while the store is in use. Compaction also
+# migrates tiles out of sparsely used storage databases & deletes storage databases left empty.
 import os
 import sqlite3
 import glob
 import time
-from threading import RLock
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, closing
+from queue import LifoQueue, Empty
+from threading import RLock, Lock, Condition, Thread, BoundedSemaphore
+from urllib.request import pathname2url
 
 import logging
 log = logging.getLogger("tile_storage.sqlite_store")
 
 from .base import BaseTileStore
-from .constants import GIBI_BYTE
+from .constants import GIBI_BYTE, MEBI_BYTE, INTEGRITY_CHECK_THREAD_COUNT
 from . import utils
 
 # the storage database files can be only this big to avoid
 # maximum file size limitations on FAT32 and possibly elsewhere
 MAX_STORAGE_DB_FILE_SIZE = 3.7  # in Gibi Bytes
+# sizes of storage databases are tracked in memory and are only
+# re-checked on disk once this much data has been written to them
+STORAGE_DB_SIZE_CHECK_INTERVAL = 16  # in Mebi Bytes
+# maximum number of tiles waiting in the write-behind queue
 SQLITE_QUEUE_SIZE = 50
+# maximum time a tile can wait in the write-behind queue before being written
+SQLITE_COMMIT_INTERVAL = 5  # in seconds
+# maximum number of read-only connection sets used by readers in WAL mode
+SQLITE_READ_CONNECTION_POOL_SIZE = 4
+# how many tiles to look up with a single query when working with multiple tiles
+# (each tile needs 3 query parameters & the default maximum is 999 parameters in older SQLite versions)
+SQLITE_BULK_QUERY_SIZE = 300
+# tile access times are only recorded with this resolution, so that a tile
+# is not updated in the lookup database every time it is displayed
+SQLITE_ACCESS_TIME_RESOLUTION = 60 * 60  # in seconds
+# recorded tile accesses are written to the lookup database together with the next
+# tile write or once this many of them are waiting
+SQLITE_ACCESS_BATCH_SIZE = 1000
+# how many tiles to delete in a single transaction when evicting tiles
+SQLITE_EVICTION_BATCH_SIZE = 500
+# size of the tile data hash used for deduplication
+TILE_HASH_SIZE = 20  # in bytes
+# storage databases with less than this fraction of the maximum storage
+# database size used by tiles are consolidated during compaction
+SQLITE_SPARSE_STORE_FRACTION = 0.5
+# how many tiles to migrate in a single transaction during compaction
+SQLITE_MIGRATION_BATCH_SIZE = 200
+# how much free space to release in a single incremental vacuum step
+SQLITE_VACUUM_STEP_SIZE = 4  # in Mebi Bytes
+# storage databases created before incremental vacuum was used need a full VACUUM,
+# which is only done during compaction if at least this fraction of the database is free
+SQLITE_VACUUM_CONVERSION_FREE_FRACTION = 0.25
+SQLITE_AUTO_VACUUM_INCREMENTAL = 2
+# background maintenance pauses for a while once more than SQLITE_HEAVY_READ_TILE_COUNT
+# tiles are read within SQLITE_READ_ACTIVITY_WINDOW (eq. the map is being moved around)
+SQLITE_READ_ACTIVITY_WINDOW = 1  # in seconds
+SQLITE_HEAVY_READ_TILE_COUNT = 30
+SQLITE_MAINTENANCE_READ_PAUSE = 2  # in seconds
+# how many storage database rows to check in a single integrity check task
+SQLITE_INTEGRITY_CHECK_CHUNK_SIZE = 2000
 SQLITE_TILE_STORAGE_FORMAT_VERSION = 1
 LOOKUP_DB_NAME = "lookup.sqlite"
 STORE_DB_NAME_PREFIX = "store.sqlite."
 
-def connect_to_db(path_to_database):
+def connect_to_db(path_to_database, read_only=False):
     """Setting check_same_thread to False fixes a Sqlite exception
     that happens when a thread tries to access a database read connection
     that was created in a different thread. All write connections are "owned"
@@ -75,9 +150,284 @@ def connect_to_db(path_to_database):
     solutions could be used.
 
     :param str path_to_database: path to the database
+    :param bool read_only: open the database in read only mode
     :returns: Sqlite database connection
     """
-    return sqlite3.connect(path_to_database, check_same_thread=False)
+    if read_only:
+        uri = "file:%s?mode=ro" % pathname2url(path_to_database)
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
+    else:
+        return sqlite3.connect(path_to_database, check_same_thread=False)
+
+# Tile data size is stored in the lookup database, so that the zoom level statistics
+# triggers don't need to look to the storage databases.
+# NOTE: the triggers use just plain insert & update statements,
+#       so that they work also with old SQLite versions without upsert
+ZOOM_STATS_SCHEMA = [
+    "create table zoom_stats (z integer primary key, tile_count integer, size integer, "
+    "min_x integer, max_x integer, min_y integer, max_y integer, oldest_timestamp integer, newest_timestamp integer)",
+    "create trigger zoom_stats_insert after insert on tiles begin "
+    "insert or ignore into zoom_stats values (new.z, 0, 0, new.x, new.x, new.y, new.y, "
+    "new.unix_epoch_timestamp, new.unix_epoch_timestamp); "
+    "update zoom_stats set tile_count=tile_count+1, size=size+coalesce(new.size, 0), "
+    "min_x=min(min_x, new.x), max_x=max(max_x, new.x), min_y=min(min_y, new.y), max_y=max(max_y, new.y), "
+    "oldest_timestamp=min(oldest_timestamp, new.unix_epoch_timestamp), "
+    "newest_timestamp=max(newest_timestamp, new.unix_epoch_timestamp) where z=new.z; "
+    "end",
+    "create trigger zoom_stats_update after update of size, unix_epoch_timestamp on tiles begin "
+    "update zoom_stats set size=size-coalesce(old.size, 0)+coalesce(new.size, 0), "
+    "newest_timestamp=max(newest_timestamp, new.unix_epoch_timestamp) where z=new.z; "
+    "end",
+    "create trigger zoom_stats_delete after delete on tiles begin "
+    "update zoom_stats set tile_count=tile_count-1, size=size-coalesce(old.size, 0) where z=old.z; "
+    "delete from zoom_stats where z=old.z and tile_count<=0; "
+    "end"
+]
+ZOOM_STATS_COLUMNS = ["tile_count", "size", "min_x", "max_x", "min_y", "max_y",
+                      "oldest_timestamp", "newest_timestamp"]
+
+def get_zxy_in_condition(tile_count):
+    """Return a condition matching rows with any of the given number of z, x, y coordinates
+
+    :param int tile_count: number of z, x, y coordinate triplets
+    :returns: condition string
+    :rtype: str
+    """
+    return "(z, x, y) in (values %s)" % ", ".join(["(?, ?, ?)"] * tile_count)
+
+def get_zxy_in_query(query_prefix, tile_count):
+    """Return a query selecting rows matching any of the given number of z, x, y coordinates
+
+    :param str query_prefix: query up to the where clause
+    :param int tile_count: number of z, x, y coordinate triplets
+    :returns: query string
+    :rtype: str
+    """
+    return "%s where %s" % (query_prefix, get_zxy_in_condition(tile_count))
+
+def get_store_tiles_query(schema="main"):
+    """Return a query selecting z, x, y, tile data and timestamp from a storage database
+
+    The tile data is either stored in the tiles table or in the blobs table for deduplicated tiles.
+
+    :param str schema: schema name of the storage database
+    :returns: query string without the where clause
+    :rtype: str
+    """
+    return "select s.z, s.x, s.y, coalesce(s.tile, b.tile), s.unix_epoch_timestamp " \
+           "from {schema}.tiles as s left join {schema}.blobs as b on b.id=s.blob_id".format(schema=schema)
+
+def delete_store_tiles(cursor, condition, parameters=(), schema="main"):
+    """Delete tiles matching the given condition from a storage database
+
+    Reference counts of deduplicated tile data are decreased and
+    tile data no longer used by any tile is deleted.
+
+    :param cursor: cursor of a storage database connection
+    :param str condition: condition selecting the tiles to delete
+    :param parameters: condition parameters
+    :param str schema: schema name of the storage database
+    :returns: size of the deleted tile data in bytes
+    :rtype: int
+    """
+    freed_bytes = int(cursor.execute("select total(length(tile)) from %s.tiles where %s"
+                                     % (schema, condition), parameters).fetchone()[0])
+    blob_references = cursor.execute("select blob_id, count(*) from %s.tiles where blob_id is not null and (%s) "
+                                     "group by blob_id" % (schema, condition), parameters).fetchall()
+    if blob_references:
+        cursor.executemany("update %s.blobs set refcount=refcount-? where id=?" % schema,
+                           [(count, blob_id) for blob_id, count in blob_references])
+        for blob_id, _count in blob_references:
+            result = cursor.execute("select length(tile) from %s.blobs where id=? and refcount<=0" % schema,
+                                    (blob_id,)).fetchone()
+            if result:
+                freed_bytes += result[0]
+                cursor.execute("delete from %s.blobs where id=?" % schema, (blob_id,))
+    cursor.execute("delete from %s.tiles where %s" % (schema, condition), parameters)
+    return freed_bytes
+
+def get_chunks(items, chunk_size):
+    """Split a list to chunks of the given size
+
+    :param list items: list to split
+    :param int chunk_size: maximum size of a chunk
+    :returns: a generator yielding lists
+    """
+    for index in range(0, len(items), chunk_size):
+        yield items[index:index + chunk_size]
+
+def quote_sqlite_string(string):
+    """Quote a string so that it can be used as a SQLite string literal"""
+    return "'%s'" % string.replace("'", "''")
+
+class ReadConnections(object):
+    """A set of connections used for reading from the lookup and storage databases of a SQLite tile store
+
+    By default read only connections are opened to the lookup database and to the storage databases,
+    connections to storage databases are opened lazily once a tile stored in them is requested.
+
+    With attach_stores set all the storage databases are attached to the lookup database connection
+    instead, so that tile data can be fetched with a single query. Storage databases added to the store
+    later are attached once they are first needed.
+
+    Alternatively, already existing connections can be wrapped, for example the read-write connections
+    used by the store itself.
+    """
+
+    def __init__(self, tile_store, attach_stores=False, lookup_connection=None, store_connections=None):
+        self._tile_store = tile_store
+        self._owns_connections = lookup_connection is None
+        if lookup_connection is None:
+            lookup_connection = connect_to_db(tile_store.lookup_db_path, read_only=True)
+        self.lookup_connection = lookup_connection
+        if store_connections is None:
+            store_connections = {}
+        self._store_connections = store_connections
+        self._attached = attach_stores
+        # store name -> schema name of the attached storage database
+        self._attached_stores = OrderedDict()
+        self._attached_tile_query = None
+        self._attached_tiles_query = None
+        if attach_stores:
+            self.lookup_connection.execute(
+                "create temp table if not exists requested_tiles (z integer, x integer, y integer)"
+            )
+
+    @property
+    def attached(self):
+        """Report if storage databases are attached to the lookup database connection"""
+        if self._attached:
+            self._attach_new_stores()
+        return self._attached
+
+    def get_store_connection(self, store_name):
+        """Return a read only connection to the given storage database
+
+        :param str store_name: name of the storage database
+        :returns: database connection or None if the given storage database does not exist
+        """
+        connection = self._store_connections.get(store_name)
+        if connection is None and self._owns_connections and store_name in self._tile_store.store_names:
+            store_path = os.path.join(self._tile_store.store_path, store_name)
+            connection = connect_to_db(store_path, read_only=True)
+            self._store_connections[store_name] = connection
+        return connection
+
+    def _attach_new_stores(self):
+        """Attach storage databases that are not yet attached"""
+        new_store_names = [name for name in self._tile_store.store_names if name not in self._attached_stores]
+        if not new_store_names:
+            return
+        try:
+            for store_name in sorted(new_store_names):
+                schema_name = "store_%d" % len(self._attached_stores)
+                store_path = os.path.join(self._tile_store.store_path, store_name)
+                uri = "file:%s?mode=ro" % pathname2url(store_path)
+                self.lookup_connection.execute("attach database ? as %s" % schema_name, (uri,))
+                self._attached_stores[store_name] = schema_name
+        except sqlite3.OperationalError:
+            # most probably too many storage databases for the maximum number
+            # of attached databases, fall back to using separate connections
+            log.exception("attaching storage databases of %s failed, using separate connections",
+                          self._tile_store)
+            self._attached = False
+            return
+        # Every storage database has its own branch in the query that fetches the tile only if
+        # the lookup database says the tile is stored in the given storage database.
+        tile_branches = []
+        tiles_branches = []
+        for store_name, schema_name in self._attached_stores.items():
+            tile_branches.append(
+                "select coalesce(s.tile, b.tile), s.unix_epoch_timestamp from main.tiles as l "
+                "join {schema}.tiles as s on s.z=l.z and s.x=l.x and s.y=l.y "
+                "left join {schema}.blobs as b on b.id=s.blob_id "
+                "where l.z=:z and l.x=:x and l.y=:y and l.store_filename={store}".format(
+                    schema=schema_name, store=quote_sqlite_string(store_name))
+            )
+            tiles_branches.append(
+                "select s.z, s.x, s.y, coalesce(s.tile, b.tile), s.unix_epoch_timestamp from temp.requested_tiles as r "
+                "join main.tiles as l on l.z=r.z and l.x=r.x and l.y=r.y "
+                "join {schema}.tiles as s on s.z=l.z and s.x=l.x and s.y=l.y "
+                "left join {schema}.blobs as b on b.id=s.blob_id "
+                "where l.store_filename={store}".format(schema=schema_name, store=quote_sqlite_string(store_name))
+            )
+        self._attached_tile_query = " union all ".join(tile_branches)
+        self._attached_tiles_query = " union all ".join(tiles_branches)
+
+    def get_attached_tile(self, z, x, y):
+        """Get tile data & timestamp with a single query over attached databases
+
+        :returns: (tile data, timestamp) or None if tile is not found
+        :rtype: a (bytes, int) tuple or None
+        """
+        return self.lookup_connection.execute(self._attached_tile_query, {"z": z, "x": x, "y": y}).fetchone()
+
+    def get_attached_tiles(self, zxys):
+        """Get data & timestamps for multiple tiles with a single query over attached databases
+
+        :param list zxys: list of z, x, y tuples
+        :returns: list of (z, x, y, tile data, timestamp) tuples for tiles that have been found
+        :rtype: list
+        """
+        cursor = self.lookup_connection.cursor()
+        cursor.execute("delete from temp.requested_tiles")
+        cursor.executemany("insert into temp.requested_tiles (z, x, y) values (?, ?, ?)", zxys)
+        results = cursor.execute(self._attached_tiles_query).fetchall()
+        cursor.execute("delete from temp.requested_tiles")
+        self.lookup_connection.commit()
+        return results
+
+    def close(self):
+        if self._owns_connections:
+            self.lookup_connection.close()
+            for connection in self._store_connections.values():
+                connection.close()
+        self._store_connections = {}
+
+class ReadActivity(object):
+    """Tracks how many tiles are read from a store
+
+    Background maintenance (like compaction) uses this to pause while tiles
+    are read heavily, so that it does not slow down map display.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._window_start = time.monotonic()
+        self._window_tile_count = 0
+        self._last_heavy_read = None
+
+    def add(self, tile_count):
+        """Record that the given number of tiles has been read"""
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window_start >= SQLITE_READ_ACTIVITY_WINDOW:
+                self._window_start = now
+                self._window_tile_count = 0
+            self._window_tile_count += tile_count
+            if self._window_tile_count > SQLITE_HEAVY_READ_TILE_COUNT:
+                self._last_heavy_read = now
+
+    @property
+    def is_heavy(self):
+        """Report if tiles have been read heavily recently"""
+        with self._lock:
+            if self._last_heavy_read is None:
+                return False
+            return time.monotonic() - self._last_heavy_read < SQLITE_MAINTENANCE_READ_PAUSE
+
+    def wait_until_calm(self, should_continue=None):
+        """Wait while tiles are being read heavily
+
+        :param should_continue: optional callable, waiting stops once it returns False
+        :returns: False if the caller should stop, else True
+        :rtype: bool
+        """
+        while self.is_heavy:
+            if should_continue is not None and not should_continue():
+                return False
+            time.sleep(SQLITE_READ_ACTIVITY_WINDOW)
+        return should_continue is None or should_continue()
 
 class SqliteTileStore(BaseTileStore):
 
@@ -101,7 +451,10 @@ class SqliteTileStore(BaseTileStore):
                 is_store = True
         return is_store
 
-    def __init__(self, store_path, prevent_media_indexing = False):
+    def __init__(self, store_path, prevent_media_indexing = False, write_behind=False,
+                 queue_size=SQLITE_QUEUE_SIZE, commit_interval=SQLITE_COMMIT_INTERVAL,
+                 wal_mode=False, read_connection_pool_size=SQLITE_READ_CONNECTION_POOL_SIZE,
+                 attach_stores=False, deduplicate=False):
         BaseTileStore.__init__(self, store_path, prevent_media_indexing=prevent_media_indexing)
 
         # SQLite tends to blow up with the infamous "sqlite3.OperationalError: database is locked"
@@ -121,6 +474,34 @@ class SqliteTileStore(BaseTileStore):
         # storage database free space checking and the related adding of new stores
         self._storage_db_management_lock = RLock()
 
+        # In WAL mode the databases use write-ahead logging, which makes it possible
+        # for readers to run in parallel with a writer without "database is locked" errors.
+        # The connections created at startup are then only used for writing (still serialized
+        # by the database lock) and readers use read only connections from a small pool instead.
+        # The pool is LIFO, so a thread doing repeated reads will mostly get the same connections.
+        self._wal_mode = wal_mode
+        self._read_connection_pool = None
+        self._read_connection_pool_semaphore = None
+        if wal_mode:
+            self._read_connection_pool = LifoQueue()
+            self._read_connection_pool_semaphore = BoundedSemaphore(read_connection_pool_size)
+        # With attached stores all storage databases are attached to the connection used
+        # for reading from the lookup database, so that tile data can be fetched with a
+        # single query. Without WAL a single such read only connection is shared by all
+        # readers, serialized by the database lock.
+        self._attach_stores = attach_stores
+        self._shared_read_connections = None
+        # with deduplication identical tile data is stored only once per storage database
+        self._deduplicate = deduplicate
+        # tile reads are tracked so that compaction can pause while tiles are read heavily
+        self._read_activity = ReadActivity()
+        # storage databases tiles are being migrated out of during compaction,
+        # no new tiles should be stored to them
+        self._draining_stores = set()
+        # pooled read connections created before a storage database
+        # has been deleted are closed instead of being reused
+        self._read_connections_generation = 0
+
         # make sure the folder containing the sqlite tile databases exists
         utils.check_folder(self.store_path, prevent_media_indexing=prevent_media_indexing)
 
@@ -130,10 +511,25 @@ class SqliteTileStore(BaseTileStore):
         #  should hopefully never happen)
         self._lookup_db_path = os.path.join(self.store_path, LOOKUP_DB_NAME)
         self._lookup_db_connection = self._get_lookup_db_connection()
+        # Approximate sizes of the storage databases are tracked in memory, so that
+        # we don't need to check file size on disk every time a tile is stored.
+        # The sizes are seeded from disk when a storage database is opened or created,
+        # increased by tile data size for every stored tile & re-checked on disk once
+        # enough data has been written to the storage database since the last check.
+        self._storage_db_sizes = {}
+        self._storage_db_unchecked_bytes = {}
+        # free space (unused pages) in the storage databases, which is reused by new tiles
+        self._storage_db_free_bytes = {}
+        # tile accesses waiting to be written to the lookup database,
+        # (z, x, y) -> access time rounded down to SQLITE_ACCESS_TIME_RESOLUTION
+        self._pending_accesses = {}
+        self._pending_accesses_lock = Lock()
         # there is always one or more storage databases that hold the actual tile data
         # - once a storage database hits the max file size limit (actually se to 3.7 GB just in case)
         #   a new storage database file is added
         self._storage_databases = self._get_storage_db_connections()
+        # tile sizes are needed from the storage databases for the zoom level statistics
+        self._add_zoom_stats()
 
         # these two variables point to a storage database that currently has enough free space
         # for storing of new tiles, once the storage database hits the max file size limit,
@@ -147,12 +543,113 @@ class SqliteTileStore(BaseTileStore):
         self._new_tiles_store_name = store_name
         self._new_tiles_store_connection = store_connection
 
+        # In write-behind mode tiles are not written to the database right away,
+        # but are put to a bounded in-memory queue instead. The queue is then
+        # periodically written to the databases by a single writer thread,
+        # using just one transaction per database file for the whole batch.
+        # - the queue is flushed once it is full, once the oldest tile in it
+        #   is older than the commit interval or when flush() or close() is called
+        # - tiles waiting in the queue (or being written) are checked first when
+        #   reading so that they are visible as soon as store_tile_data() returns
+        self._queue_size = queue_size
+        self._commit_interval = commit_interval
+        # (z, x, y) -> (z, x, y, extension, tile_data, timestamp)
+        self._write_queue = OrderedDict()
+        self._write_queue_since = None
+        # tiles currently being written by the writer thread
+        self._write_batch = {}
+        self._write_queue_condition = Condition()
+        self._flush_waiters = 0
+        self._writer_shutdown = False
+        self._writer_thread = None
+        if write_behind:
+            self._writer_thread = Thread(target=self._writer,
+                                         name="SqliteTileStoreWriter:%s" % self.store_path)
+            self._writer_thread.daemon = True
+            self._writer_thread.start()
+
     def __str__(self):
         return "sqlite store @ %s" % self.store_path
 
     def __repr__(self):
         return str(self)
 
+    @property
+    def lookup_db_path(self):
+        return self._lookup_db_path
+
+    @property
+    def store_names(self):
+        """Names of storage databases currently in use by this store"""
+        return list(self._storage_databases.keys())
+
+    def _connect_to_db(self, path_to_database, incremental_vacuum=False):
+        """Return a read-write connection to the given database, enable WAL if requested
+
+        :param bool incremental_vacuum: enable incremental auto vacuum, which only
+                                        has an effect if the database is being created
+        """
+        connection = connect_to_db(path_to_database)
+        if incremental_vacuum:
+            # needs to be set before WAL is enabled as that writes the database header
+            connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        if self._wal_mode:
+            connection.execute("PRAGMA journal_mode=WAL")
+            # with WAL synchronous=NORMAL is still safe from database corruption
+            # and only the last few transactions might be lost on power loss
+            connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    @contextmanager
+    def _read_connections(self):
+        """Provide database connections for reading
+
+        Without WAL the read-write connections (or the shared connection with attached
+        storage databases) are used and all access to them is serialized by the database lock.
+        In WAL mode a read only connection set is taken from the pool (or created if the pool
+        is empty) and returned to the pool once the reader is done.
+
+        :returns: a ReadConnections instance
+        """
+        if self._read_connection_pool is None:
+            with self._db_lock:
+                if self._attach_stores:
+                    if self._shared_read_connections is None:
+                        self._shared_read_connections = ReadConnections(self, attach_stores=True)
+                    yield self._shared_read_connections
+                else:
+                    yield ReadConnections(self,
+                                          lookup_connection=self._lookup_db_connection,
+                                          store_connections=self._storage_databases)
+        else:
+            with self._read_connection_pool_semaphore:
+                generation = self._read_connections_generation
+                try:
+                    read_connections = self._read_connection_pool.get_nowait()
+                except Empty:
+                    read_connections = ReadConnections(self, attach_stores=self._attach_stores)
+                try:
+                    yield read_connections
+                finally:
+                    if generation == self._read_connections_generation:
+                        self._read_connection_pool.put(read_connections)
+                    else:
+                        # a storage database has been deleted in the meantime
+                        read_connections.close()
+
+    def _close_read_connections(self):
+        """Close all read only connections"""
+        if self._read_connection_pool is not None:
+            while True:
+                try:
+                    self._read_connection_pool.get_nowait().close()
+                except Empty:
+                    break
+        with self._db_lock:
+            if self._shared_read_connections is not None:
+                self._shared_read_connections.close()
+                self._shared_read_connections = None
+
     def _get_lookup_db_connection(self):
         """Initialize the lookup database
            If the database already exist just connect to it, otherwise create it and
@@ -160,19 +657,112 @@ class SqliteTileStore(BaseTileStore):
         """
         log.debug("initializing lookup db: %s" % self._lookup_db_path)
         if os.path.exists(self._lookup_db_path): #does the lookup db exist ?
-            connection = connect_to_db(self._lookup_db_path) # connect to the lookup db
+            connection = self._connect_to_db(self._lookup_db_path) # connect to the lookup db
+            self._add_last_access_column(connection)
+            self._add_timestamp_index(connection)
         else:  # create new lookup database
             with self._db_lock:
-                connection = connect_to_db(self._lookup_db_path)
+                connection = self._connect_to_db(self._lookup_db_path)
                 cursor = connection.cursor()
                 log.info("sqlite tiles: creating lookup table")
                 cursor.execute(
-                    "create table tiles (z integer, x integer, y integer, store_filename string, extension varchar(10), unix_epoch_timestamp integer, primary key (z, x, y, extension))")
+                    "create table tiles (z integer, x integer, y integer, store_filename string, extension varchar(10), unix_epoch_timestamp integer, last_access integer, size integer, primary key (z, x, y, extension))")
+                cursor.execute("create index tiles_last_access on tiles (last_access)")
+                cursor.execute("create index tiles_timestamp on tiles (unix_epoch_timestamp)")
+                for statement in ZOOM_STATS_SCHEMA:
+                    cursor.execute(statement)
                 cursor.execute("create table version (v integer)")
                 cursor.execute("insert into version values (?)", (SQLITE_TILE_STORAGE_FORMAT_VERSION,))
                 connection.commit()
         return connection
 
+    def _add_last_access_column(self, connection):
+        """Add the last access column to a lookup database created before it existed
+
+        Tiles are considered to be last accessed when they have been stored.
+        """
+        columns = [row[1] for row in connection.execute("pragma table_info(tiles)")]
+        if "last_access" not in columns:
+            log.info("sqlite tiles: adding last access column to %s", self._lookup_db_path)
+            with self._db_lock:
+                cursor = connection.cursor()
+                cursor.execute("alter table tiles add column last_access integer")
+                cursor.execute("update tiles set last_access=unix_epoch_timestamp")
+                cursor.execute("create index tiles_last_access on tiles (last_access)")
+                connection.commit()
+
+    def _add_timestamp_index(self, connection):
+        """Add the tile timestamp index to a lookup database created before it existed"""
+        index_exists = connection.execute(
+            "select count(*) from sqlite_master where type='index' and name='tiles_timestamp'"
+        ).fetchone()[0]
+        if not index_exists:
+            log.info("sqlite tiles: adding timestamp index to %s", self._lookup_db_path)
+            with self._db_lock:
+                connection.execute("create index tiles_timestamp on tiles (unix_epoch_timestamp)")
+                connection.commit()
+
+    def _add_zoom_stats(self):
+        """Add the size column & zoom level statistics to a lookup database created before they existed
+
+        Sizes of already stored tiles are looked up in the storage databases.
+        """
+        connection = self._lookup_db_connection
+        with self._db_lock:
+            cursor = connection.cursor()
+            columns = [row[1] for row in cursor.execute("pragma table_info(tiles)")]
+            if "size" not in columns:
+                log.info("sqlite tiles: adding size column to %s", self._lookup_db_path)
+                cursor.execute("alter table tiles add column size integer")
+                connection.commit()
+                for store_name in self.store_names:
+                    # databases can't be attached inside a transaction
+                    cursor.execute("attach database ? as size_source", (os.path.join(self.store_path, store_name),))
+                    try:
+                        cursor.execute("update tiles set size=(select length(coalesce(s.tile, b.tile)) "
+                                       "from size_source.tiles as s left join size_source.blobs as b on b.id=s.blob_id "
+                                       "where s.z=tiles.z and s.x=tiles.x and s.y=tiles.y) where store_filename=?",
+                                       (store_name,))
+                        connection.commit()
+                    finally:
+                        cursor.execute("detach database size_source")
+            table_exists = cursor.execute(
+                "select count(*) from sqlite_master where type='table' and name='zoom_stats'"
+            ).fetchone()[0]
+            if not table_exists:
+                log.info("sqlite tiles: adding zoom level statistics to %s", self._lookup_db_path)
+                for statement in ZOOM_STATS_SCHEMA:
+                    cursor.execute(statement)
+                self._rebuild_zoom_stats(cursor)
+                connection.commit()
+
+    def _rebuild_zoom_stats(self, lookup_cursor):
+        """Compute the zoom level statistics from scratch
+
+        NOTE: needs to be called with the database lock held
+        """
+        lookup_cursor.execute("delete from zoom_stats")
+        lookup_cursor.execute("insert into zoom_stats select z, count(*), coalesce(sum(size), 0), min(x), max(x), min(y), max(y), "
+                              "min(unix_epoch_timestamp), max(unix_epoch_timestamp) from tiles group by z")
+
+    def get_zoom_stats(self):
+        """Return statistics of tiles stored on each zoom level
+
+        The statistics are maintained as tiles are stored & deleted, so this is cheap.
+        Coordinate bounds & the oldest timestamp might be wider than necessary
+        after tiles have been deleted or replaced, until the store is compacted.
+        Tiles waiting in the write-behind queue are not included.
+
+        :returns: dictionary with tile count, tile data size in bytes, min/max x & y coordinates
+                  and oldest/newest tile timestamp under zoom level keys
+        :rtype: dict
+        """
+        with self._read_connections() as read_connections:
+            rows = read_connections.lookup_connection.execute(
+                "select z, %s from zoom_stats" % ", ".join(ZOOM_STATS_COLUMNS)
+            ).fetchall()
+        return {row[0]: dict(zip(ZOOM_STATS_COLUMNS, row[1:])) for row in rows}
+
     def _get_storage_db_connections(self):
         """Connect to all existing storage databases and return a dictionary of the resulting connections
            - if no storage databases exist, create the first (store.sqlite.0) storage database
@@ -182,7 +772,9 @@ class SqliteTileStore(BaseTileStore):
         if existing_stores:
             for store_path in existing_stores:
                 store_name = os.path.basename(store_path)
-                connections[store_name] = connect_to_db(store_path)
+                connections[store_name] = self._connect_to_db(store_path)
+                self._add_blobs_table(connections[store_name])
+                self._check_storage_db_size(store_name, connections[store_name])
         else:  # no stores yet, create the first one
             store_name, store_connection = self._add_store()
             connections = {store_name : store_connection}
@@ -195,7 +787,7 @@ class SqliteTileStore(BaseTileStore):
         new_highest_number = 0
         storeList = self._list_store_files()
         if storeList:
-            number_candidate_list = map(lambda x: x.split('store.sqlite.')[1], storeList)
+            number_candidate_list = [x.split(STORE_DB_NAME_PREFIX)[-1] for x in storeList]
             integer_list = []
             for number_candidate in number_candidate_list:
                 try:
@@ -205,11 +797,12 @@ class SqliteTileStore(BaseTileStore):
                     # eq. something that fails to parse to an integer
                     pass
             if integer_list:
-                highest_number = sorted(number_candidate_list)[-1]
-                new_highest_number = highest_number + 1
+                new_highest_number = max(integer_list) + 1
 
         store_name = "store.sqlite.%d" % new_highest_number
-        return store_name, self._create_new_store(os.path.join(self.store_path, store_name))
+        store_connection = self._create_new_store(os.path.join(self.store_path, store_name))
+        self._check_storage_db_size(store_name, store_connection)
+        return store_name, store_connection
 
     def _create_new_store(self, path):
         """Create a new store database at the given file path
@@ -217,23 +810,43 @@ class SqliteTileStore(BaseTileStore):
         :param str path: path to the file path where the database should be created
         """
         log.debug("creating a new storage database in %s" % path)
-        connection = connect_to_db(path)
+        connection = self._connect_to_db(path, incremental_vacuum=True)
         cursor = connection.cursor()
         cursor.execute(
-            "create table tiles (z integer, x integer, y integer, tile blob, extension varchar(10), unix_epoch_timestamp integer, primary key (z, x, y, extension))")
+            "create table tiles (z integer, x integer, y integer, tile blob, extension varchar(10), unix_epoch_timestamp integer, blob_id integer, primary key (z, x, y, extension))")
+        cursor.execute("create table blobs (id integer primary key, hash blob unique, tile blob, refcount integer)")
         cursor.execute("create table version (v integer)")
         cursor.execute("insert into version values (?)", (SQLITE_TILE_STORAGE_FORMAT_VERSION,))
         connection.commit()
         return connection
 
+    def _add_blobs_table(self, connection):
+        """Add the blobs table & blob_id column to a storage database created before they existed"""
+        columns = [row[1] for row in connection.execute("pragma table_info(tiles)")]
+        if "blob_id" not in columns:
+            log.info("sqlite tiles: adding blobs table to storage database in %s", self.store_path)
+            with self._db_lock:
+                cursor = connection.cursor()
+                cursor.execute("alter table tiles add column blob_id integer")
+                cursor.execute("create table blobs (id integer primary key, hash blob unique, tile blob, refcount integer)")
+                connection.commit()
+
     def _get_name_connection_to_available_store(self, data_size):
         """Return a path to a store that can be used to store a tile specified by its size"""
         with self._storage_db_management_lock:
             # first check if the last-known-good storage database has enough space to satisfy the request
-            if self._will_it_fit_in(self._new_tiles_store_name, data_size):
+            if (self._new_tiles_store_name not in self._draining_stores and
+                    self._will_it_fit_in(self._new_tiles_store_name, data_size)):
                 return self._new_tiles_store_name, self._new_tiles_store_connection
             else:  # try if the request will fit to some other store we are already connected to
-                for store_name, store_connection in self._storage_databases.items():
+                # - fullest storage databases are filled first, so that
+                #   tiles are not spread over many sparse storage databases
+                store_names = sorted(self._storage_databases.keys(),
+                                     key=lambda name: self._storage_db_sizes.get(name, 0), reverse=True)
+                for store_name in store_names:
+                    if store_name in self._draining_stores:
+                        continue
+                    store_connection = self._storage_databases[store_name]
                     if self._will_it_fit_in(store_name, data_size):
                         # this store can handle the given storage request, so set it as able to
                         # handle further tile storage requests
@@ -245,6 +858,9 @@ class SqliteTileStore(BaseTileStore):
                 # if we got there it means we have not found space for the request in any existing
                 # storage database file, so we need to create a new one
                 new_store_name, new_store_connection = self._add_store()
+                # register the new store so that tiles can be read from it
+                # (this also makes readers attach it if they use attached stores)
+                self._storage_databases[new_store_name] = new_store_connection
                 # again cache the connection to the store
                 self._new_tiles_store_name = new_store_name
                 self._new_tiles_store_connection = new_store_connection
@@ -272,76 +888,325 @@ class SqliteTileStore(BaseTileStore):
         :rtype: bool
         """
         maximum_size_in_bytes = MAX_STORAGE_DB_FILE_SIZE * GIBI_BYTE
-        storage_database_path = os.path.join(self.store_path, storage_database_name)
-        store_size_in_bytes = os.path.getsize(storage_database_path)
+        store_size_in_bytes = self._storage_db_sizes.get(storage_database_name)
+        if store_size_in_bytes is None:
+            store_size_in_bytes = self._check_storage_db_size(storage_database_name)
         if (store_size_in_bytes + size_in_bytes) <= maximum_size_in_bytes:
             return True  # the database will (probably) still smaller than the limit
         else:
             return False  # the database will be larger
 
+    def _check_storage_db_size(self, storage_database_name, connection=None):
+        """Update the tracked size & free space of the given storage database from disk
+
+        :param str storage_database_name: name of the storage database
+        :param connection: connection to the storage database, if not yet
+                           registered in the storage databases dictionary
+        :returns: storage database size in bytes
+        :rtype: int
+        """
+        storage_database_path = os.path.join(self.store_path, storage_database_name)
+        with self._db_lock, self._storage_db_management_lock:
+            size_in_bytes = os.path.getsize(storage_database_path)
+            if connection is None:
+                connection = self._storage_databases.get(storage_database_name)
+            free_bytes = 0
+            if connection is not None:
+                page_size = connection.execute("pragma page_size").fetchone()[0]
+                free_bytes = connection.execute("pragma freelist_count").fetchone()[0] * page_size
+            self._storage_db_sizes[storage_database_name] = size_in_bytes
+            self._storage_db_free_bytes[storage_database_name] = free_bytes
+            self._storage_db_unchecked_bytes[storage_database_name] = 0
+        return size_in_bytes
+
+    def _add_to_storage_db_size(self, storage_database_name, size_in_bytes):
+        """Account for data written to the given storage database
+
+        :param str storage_database_name: name of the storage database
+        :param int size_in_bytes: size of the written data
+        """
+        with self._storage_db_management_lock:
+            unchecked_bytes = self._storage_db_unchecked_bytes.get(storage_database_name, 0) + size_in_bytes
+            if unchecked_bytes >= STORAGE_DB_SIZE_CHECK_INTERVAL * MEBI_BYTE:
+                self._check_storage_db_size(storage_database_name)
+            else:
+                self._storage_db_unchecked_bytes[storage_database_name] = unchecked_bytes
+                # new tiles are first stored to free space left after deleted tiles
+                # and only then the database file grows
+                free_bytes = self._storage_db_free_bytes.get(storage_database_name, 0)
+                reused_bytes = min(free_bytes, size_in_bytes)
+                self._storage_db_free_bytes[storage_database_name] = free_bytes - reused_bytes
+                self._storage_db_sizes[storage_database_name] = \
+                    self._storage_db_sizes.get(storage_database_name, 0) + size_in_bytes - reused_bytes
+
+    def stats(self):
+        """Return storage statistics
+
+        Storage database sizes are approximate (tracked in memory), so this is cheap to call.
+
+        :returns: dictionary with total size in bytes under the "size" key,
+                  lookup database size under the "lookup_size" key,
+                  storage database sizes by name under the "store_sizes" key,
+                  free space in storage databases under the "free_size" key
+                  and size without the free space under the "used_size" key
+        :rtype: dict
+        """
+        with self._storage_db_management_lock:
+            store_sizes = dict(self._storage_db_sizes)
+            free_size = sum(self._storage_db_free_bytes.values())
+        lookup_size = os.path.getsize(self._lookup_db_path) if self._lookup_db_path else 0
+        size = lookup_size + sum(store_sizes.values())
+        return {
+            "size": size,
+            "lookup_size": lookup_size,
+            "store_sizes": store_sizes,
+            "free_size": free_size,
+            "used_size": size - free_size
+        }
+
+    def get_used_size(self):
+        """Return approximate size of the stored tiles (without free space in the databases)
+
+        With deduplication enabled this is the size of the tile data before deduplication,
+        the same size eviction counts with, as evicting a tile that shares its data
+        with other tiles does not free any space.
+        """
+        if self._deduplicate:
+            return sum(zoom_stats["size"] for zoom_stats in self.get_zoom_stats().values())
+        return self.stats()["used_size"]
+
     def store_tile_data(self, lzxy, tile_data):
+        """Store tile data for the given coordinates
+
+        In write-behind mode the tile is just added to the write queue
+        and is written to the database later by the writer thread.
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :param bytes tile_data: tile data to store
+        """
+        layer, z, x, y = lzxy
+        tile = (z, x, y, layer.type, tile_data, int(time.time()))
+        if self._writer_thread is not None:
+            self._enqueue_tile(tile)
+        else:
+            self._write_tiles([tile])
+
+    def store_tiles(self, tiles):
+        """Store a batch of tiles in a single transaction
+
+        Tiles waiting in the write-behind queue are written first,
+        so that they can't replace the given tiles later on.
+
+        :param tiles: list of (z, x, y, extension, tile_data, timestamp) tuples
+        """
+        if self._writer_thread is not None:
+            self.flush()
+        self._write_tiles(tiles)
+
+    def _enqueue_tile(self, tile):
+        """Add a tile to the write-behind queue, block if the queue is full
+
+        :param tuple tile: (z, x, y, extension, tile_data, timestamp) tuple
+        """
+        zxy = tile[:3]
+        with self._write_queue_condition:
+            while len(self._write_queue) >= self._queue_size and zxy not in self._write_queue:
+                # wake up the writer & wait for it to take the full queue
+                self._write_queue_condition.notify_all()
+                self._write_queue_condition.wait()
+            if not self._write_queue:
+                self._write_queue_since = time.monotonic()
+            # a newer version of the tile replaces any not yet written older one
+            self._write_queue.pop(zxy, None)
+            self._write_queue[zxy] = tile
+            if len(self._write_queue) >= self._queue_size:
+                self._write_queue_condition.notify_all()
+
+    def _get_queued_tile(self, z, x, y):
+        """Return a tile waiting to be written (if any)
+
+        :returns: (z, x, y, extension, tile_data, timestamp) tuple or None
+        :rtype: tuple or None
+        """
+        if self._writer_thread is None:
+            return None
+        with self._write_queue_condition:
+            tile = self._write_queue.get((z, x, y))
+            if tile is None:
+                tile = self._write_batch.get((z, x, y))
+            return tile
+
+    def _write_pending(self):
+        """Report if the writer thread should write the queue to the database
+
+        NOTE: needs to be called with the write queue condition held
+        """
+        if not self._write_queue:
+            return False
+        return (self._writer_shutdown or
+                self._flush_waiters > 0 or
+                len(self._write_queue) >= self._queue_size or
+                time.monotonic() - self._write_queue_since >= self._commit_interval)
+
+    def _writer(self):
+        """Write tiles from the write-behind queue to the database in batches
+
+        This method is run by the writer thread, which is the only thread
+        writing to the database in write-behind mode.
+        """
+        while True:
+            with self._write_queue_condition:
+                while not self._write_pending():
+                    if self._writer_shutdown:
+                        # the queue is empty & we are shutting down
+                        return
+                    timeout = None
+                    if self._write_queue:
+                        timeout = max(0, self._write_queue_since + self._commit_interval - time.monotonic())
+                    self._write_queue_condition.wait(timeout)
+                batch = self._write_queue
+                self._write_batch = batch
+                self._write_queue = OrderedDict()
+                self._write_queue_since = None
+                # wake up any producers waiting for space in the queue
+                self._write_queue_condition.notify_all()
+            try:
+                self._write_tiles(batch.values())
+            except Exception:
+                log.exception("writing a batch of %d tiles to %s failed", len(batch), self)
+            finally:
+                with self._write_queue_condition:
+                    self._write_batch = {}
+                    # wake up any flush() callers
+                    self._write_queue_condition.notify_all()
+
+    def _stop_writer(self):
+        """Write all queued tiles and stop the writer thread (if any)"""
+        writer_thread = self._writer_thread
+        if writer_thread is not None:
+            with self._write_queue_condition:
+                self._writer_shutdown = True
+                self._write_queue_condition.notify_all()
+            writer_thread.join()
+            self._writer_thread = None
+
+    def _write_tiles(self, tiles):
+        """Write the given tiles to the database
+
+        All the tiles are written in a single transaction per database file,
+        storage databases are committed before the lookup database so that
+        the lookup database never points to tile data that has not been committed.
+
+        :param tiles: iterable of (z, x, y, extension, tile_data, timestamp) tuples
+        """
         with self._db_lock:
-            layer, z, x, y = lzxy
-            extension = layer.type
             lookup_connection = self._lookup_db_connection
             lookup_cursor = lookup_connection.cursor()
-            data_size = len(tile_data)
-            integer_timestamp = int(time.time())
-            tile_exists = lookup_cursor.execute(
-                "select store_filename from tiles where z=? and x=? and y=?",
-                (z, x, y)).fetchone()
-            if tile_exists:  # tile is already in the database, update it
-                # check if the new tile will fit to the storage database where the tile currently is
-                # (we count as we would add the tile to the database, not replace it du to
-                # database file size uncertainties caused by metadata updates, etc.)
-                store_name = tile_exists[0]
-                if self._will_it_fit_in(store_name, data_size):
-                    # update the tile data and its timestamp in place
-                    store_connection = self._storage_databases[store_name]
-                    store_cursor = store_connection.cursor()
-                    # update the storage database
-                    su_query = "insert or replace into tiles (z, x, y, tile, extension, unix_epoch_timestamp) values (?, ?, ?, ?, ?, ?)"
-                    # use "insert or replace" in case that the storage database is missing the tile for some reason
-                    # - this should never happen as long as the database is properly managed, but better be safe than sorry
-                    store_cursor.execute(su_query, [z, x, y, sqlite3.Binary(tile_data), extension, integer_timestamp])
+            used_store_connections = []
+            try:
+                for tile in tiles:
+                    for store_connection in self._write_tile(lookup_cursor, tile):
+                        if store_connection not in used_store_connections:
+                            used_store_connections.append(store_connection)
+                # also write any recorded tile accesses, as we are going to commit anyway
+                self._write_pending_accesses(lookup_cursor)
+                for store_connection in used_store_connections:
                     store_connection.commit()
-                    # update the extension and timestamp in the lookup database
-                    lu_query = "update tiles set extension=?, unix_epoch_timestamp=? where z=? and x=? and y=?"
-                    lookup_cursor.execute(lu_query, [extension, integer_timestamp, z, x, y])
-                    lookup_connection.commit()
-                else:
-                    # remove the tile from the current storage database file
-                    old_store_connection = self._storage_databases[store_name]
-                    old_store_cursor = old_store_connection.cursor()
-                    old_store_cursor.execute("delete from tiles where z=? and x=? and y=?", (z, x, y))
-                    old_store_connection.commit()
-                    # find a suitable storage database file
-                    new_store_name, new_store_connection = self._get_name_connection_to_available_store(data_size)
-                    # store the tile to it
-                    store_query = "insert or replace into tiles (z, x, y, tile, extension, unix_epoch_timestamp) values (?, ?, ?, ?, ?, ?)"
-                    # we use "insert or replace" in case there already is an unexpected leftover tile in the store for the coordinates
-                    # - this should never happen as long as the database is properly managed, but better be safe than sorry
-                    store_cursor = new_store_connection.cursor()
-                    store_cursor.execute(store_query, [z, x, y, sqlite3.Binary(tile_data), extension, integer_timestamp])
-                    new_store_connection.commit()
-                    # update the store path, extension and timestamp in the lookup database
-                    lu_query = "update tiles set store_filename=?, extension=?, unix_epoch_timestamp=? where where z=? and x=? and y=?"
-                    lookup_cursor.execute(lu_query, [new_store_name, extension, integer_timestamp, z, x, y])
-                    lookup_connection.commit()
-
-            else:   # tile is not yet in the database, so just store it
-                # get a store that can store this tile
-                store_name, store_connection = self._get_name_connection_to_available_store(data_size)
-                # write in the lookup db
-                lookup_query = "insert into tiles (z, x, y, store_filename, extension, unix_epoch_timestamp) values (?, ?, ?, ?, ?, ?)"
-                lookup_cursor = lookup_connection.cursor()
-                lookup_cursor.execute(lookup_query, [z, x, y, store_name, extension, integer_timestamp])
                 lookup_connection.commit()
-                # write in the store
-                store_query = "insert into tiles (z, x, y, tile, extension, unix_epoch_timestamp) values (?, ?, ?, ?, ?, ?)"
+            except Exception:
+                lookup_connection.rollback()
+                for store_connection in self._storage_databases.values():
+                    store_connection.rollback()
+                raise
+
+    def _write_tile(self, lookup_cursor, tile):
+        """Write a single tile to the database without committing
+
+        :param lookup_cursor: lookup database cursor
+        :param tuple tile: (z, x, y, extension, tile_data, timestamp) tuple
+        :returns: list of storage database connections that have been modified
+        :rtype: list
+        """
+        z, x, y, extension, tile_data, integer_timestamp = tile
+        data_size = len(tile_data)
+        tile_exists = lookup_cursor.execute(
+            "select store_filename from tiles where z=? and x=? and y=?",
+            (z, x, y)).fetchone()
+        if tile_exists:  # tile is already in the database, update it
+            # check if the new tile will fit to the storage database where the tile currently is
+            # (we count as we would add the tile to the database, not replace it du to
+            # database file size uncertainties caused by metadata updates, etc.)
+            store_name = tile_exists[0]
+            if self._will_it_fit_in(store_name, data_size):
+                # update the tile data and its timestamp in place
+                store_connection = self._storage_databases[store_name]
                 store_cursor = store_connection.cursor()
-                store_cursor.execute(store_query, [z, x, y, sqlite3.Binary(tile_data), extension, integer_timestamp])
-                store_connection.commit()
+                # update the storage database, the old version of the tile needs to be deleted
+                # first so that reference count of its data is updated if it is deduplicated
+                delete_store_tiles(store_cursor, "z=? and x=? and y=?", (z, x, y))
+                stored_size = self._insert_store_tile(store_cursor, z, x, y, extension, tile_data, integer_timestamp)
+                self._add_to_storage_db_size(store_name, stored_size)
+                # update the extension and timestamp in the lookup database
+                lu_query = "update tiles set extension=?, unix_epoch_timestamp=?, last_access=?, size=? where z=? and x=? and y=?"
+                lookup_cursor.execute(lu_query, [extension, integer_timestamp, integer_timestamp, data_size, z, x, y])
+                return [store_connection]
+            else:
+                # remove the tile from the current storage database file
+                old_store_connection = self._storage_databases[store_name]
+                old_store_cursor = old_store_connection.cursor()
+                delete_store_tiles(old_store_cursor, "z=? and x=? and y=?", (z, x, y))
+                # find a suitable storage database file
+                new_store_name, new_store_connection = self._get_name_connection_to_available_store(data_size)
+                # store the tile to it
+                store_cursor = new_store_connection.cursor()
+                stored_size = self._insert_store_tile(store_cursor, z, x, y, extension, tile_data, integer_timestamp)
+                self._add_to_storage_db_size(new_store_name, stored_size)
+                # update the store path, extension and timestamp in the lookup database
+                lu_query = "update tiles set store_filename=?, extension=?, unix_epoch_timestamp=?, last_access=?, size=? where z=? and x=? and y=?"
+                lookup_cursor.execute(lu_query, [new_store_name, extension, integer_timestamp, integer_timestamp, data_size, z, x, y])
+                return [old_store_connection, new_store_connection]
+        else:   # tile is not yet in the database, so just store it
+            # get a store that can store this tile
+            store_name, store_connection = self._get_name_connection_to_available_store(data_size)
+            # write in the lookup db
+            lookup_query = "insert into tiles (z, x, y, store_filename, extension, unix_epoch_timestamp, last_access, size) values (?, ?, ?, ?, ?, ?, ?, ?)"
+            lookup_cursor.execute(lookup_query, [z, x, y, store_name, extension, integer_timestamp, integer_timestamp, data_size])
+            # write in the store
+            store_cursor = store_connection.cursor()
+            stored_size = self._insert_store_tile(store_cursor, z, x, y, extension, tile_data, integer_timestamp)
+            self._add_to_storage_db_size(store_name, stored_size)
+            return [store_connection]
+
+    def _insert_store_tile(self, store_cursor, z, x, y, extension, tile_data, integer_timestamp):
+        """Insert a tile to a storage database, deduplicate the tile data if enabled
+
+        We use "insert or replace" in case there already is an unexpected leftover tile in the store
+        for the coordinates - this should never happen as long as the database is properly managed,
+        but better be safe than sorry.
+
+        :param store_cursor: storage database cursor
+        :returns: size of the tile data that has been added to the storage database in bytes
+        :rtype: int
+        """
+        if self._deduplicate:
+            tile_hash = hashlib.blake2b(tile_data, digest_size=TILE_HASH_SIZE).digest()
+            result = store_cursor.execute("select id from blobs where hash=?", (tile_hash,)).fetchone()
+            if result:  # the same tile data is already stored
+                blob_id = result[0]
+                store_cursor.execute("update blobs set refcount=refcount+1 where id=?", (blob_id,))
+                stored_size = 0
+            else:
+                store_cursor.execute("insert into blobs (hash, tile, refcount) values (?, ?, 1)",
+                                     (tile_hash, sqlite3.Binary(tile_data)))
+                blob_id = store_cursor.lastrowid
+                stored_size = len(tile_data)
+            store_query = "insert or replace into tiles (z, x, y, tile, blob_id, extension, unix_epoch_timestamp) values (?, ?, ?, null, ?, ?, ?)"
+            store_cursor.execute(store_query, [z, x, y, blob_id, extension, integer_timestamp])
+        else:
+            store_query = "insert or replace into tiles (z, x, y, tile, blob_id, extension, unix_epoch_timestamp) values (?, ?, ?, ?, null, ?, ?)"
+            store_cursor.execute(store_query, [z, x, y, sqlite3.Binary(tile_data), extension, integer_timestamp])
+            stored_size = len(tile_data)
+        return stored_size
 
     def get_tile(self, lzxy):
         """Get tile data and timestamp corresponding to the given coordinate tuple from the database.
@@ -353,16 +1218,37 @@ class SqliteTileStore(BaseTileStore):
         :rtype: a (bytes, int) tuple or None
         """
         _layer, z, x, y = lzxy
-        with self._db_lock:
-            lookup_connection = self._lookup_db_connection
-            lookup_cursor = lookup_connection.cursor()
+        queued_tile = self._get_queued_tile(z, x, y)
+        if queued_tile:
+            return queued_tile[4], queued_tile[5]
+        self._read_activity.add(1)
+        result = self._read_tile(z, x, y)
+        if result:
+            self._record_accesses([(z, x, y)])
+        return result
+
+    def _read_tile(self, z, x, y):
+        """Read tile data and timestamp from the database
+
+        :returns: (tile data, timestamp) or None if tile is not found in the database
+        :rtype: a (bytes, int) tuple or None
+        """
+        with self._read_connections() as read_connections:
+            if read_connections.attached:
+                # storage databases are attached to the lookup database connection,
+                # so we can get the tile with a single query
+                result = read_connections.get_attached_tile(z, x, y)
+                if result and not utils.is_an_image(result[0]):
+                    log.warning("%s,%s,%s in %s is probably not an image", x, y, z, self.store_path)
+                return result
+            lookup_cursor = read_connections.lookup_connection.cursor()
             lookup_result = lookup_cursor.execute(
                 "select store_filename, unix_epoch_timestamp from tiles where z=? and x=? and y=?",
                 (z, x, y)).fetchone()
             if lookup_result:  # the tile was found in the lookup db
                 # now search for in the specified store
                 store_name = lookup_result[0]
-                store_connection = self._storage_databases.get(store_name)
+                store_connection = read_connections.get_store_connection(store_name)
                 if store_connection is None:
                     log.warning("store %s/%s is mentioned in lookup db for %s/%s/%s but does not exist",
                                 self.store_path, store_name, z, x, y)
@@ -372,7 +1258,8 @@ class SqliteTileStore(BaseTileStore):
                 # x, y & z combination and thus there can be only one result for a select
                 # over x, y & z
                 result = store_cursor.execute(
-                    "select tile, unix_epoch_timestamp from tiles where z=? and x=? and y=?",
+                    "select coalesce(s.tile, b.tile), s.unix_epoch_timestamp from tiles as s "
+                    "left join blobs as b on b.id=s.blob_id where s.z=? and s.x=? and s.y=?",
                     (z, x, y)).fetchone()
                 if result:
                     if not utils.is_an_image(result[0]):
@@ -383,23 +1270,167 @@ class SqliteTileStore(BaseTileStore):
             else:  # the tile was not found in the lookup database
                 return None
 
+    def _lookup_tiles(self, lookup_connection, zxys):
+        """Look up multiple tiles in the lookup database
+
+        :param lookup_connection: lookup database connection
+        :param list zxys: list of z, x, y tuples
+        :returns: list of (z, x, y, store_filename, timestamp) tuples for tiles found
+        :rtype: list
+        """
+        results = []
+        lookup_cursor = lookup_connection.cursor()
+        for chunk in get_chunks(zxys, SQLITE_BULK_QUERY_SIZE):
+            query = get_zxy_in_query("select z, x, y, store_filename, unix_epoch_timestamp from tiles", len(chunk))
+            parameters = [coordinate for zxy in chunk for coordinate in zxy]
+            results.extend(lookup_cursor.execute(query, parameters).fetchall())
+        return results
+
+    def get_tiles(self, lzxys):
+        """Get data and timestamps for multiple tiles
+
+        All the tiles are looked up with a single lookup database query (per SQLITE_BULK_QUERY_SIZE tiles)
+        and a single query per storage database holding some of the tiles.
+
+        :param list lzxys: list of lzxy tuples
+        :returns: dictionary with (tile data, timestamp) tuples or None
+                  (for tiles that are not in the store) under lzxy keys
+        :rtype: dict
+        """
+        results = {}
+        zxy_to_lzxy = {}
+        for lzxy in lzxys:
+            _layer, z, x, y = lzxy
+            results[lzxy] = None
+            queued_tile = self._get_queued_tile(z, x, y)
+            if queued_tile:
+                results[lzxy] = queued_tile[4], queued_tile[5]
+            else:
+                zxy_to_lzxy[(z, x, y)] = lzxy
+        if not zxy_to_lzxy:
+            return results
+
+        self._read_activity.add(len(zxy_to_lzxy))
+        found_zxys = []
+        with self._read_connections() as read_connections:
+            if read_connections.attached:
+                for chunk in get_chunks(list(zxy_to_lzxy.keys()), SQLITE_BULK_QUERY_SIZE):
+                    for z, x, y, tile_data, timestamp in read_connections.get_attached_tiles(chunk):
+                        if not utils.is_an_image(tile_data):
+                            log.warning("%s,%s,%s in %s is probably not an image", x, y, z, self.store_path)
+                        results[zxy_to_lzxy[(z, x, y)]] = tile_data, timestamp
+                        found_zxys.append((z, x, y))
+                self._record_accesses(found_zxys)
+                return results
+            # group the tiles by storage database
+            store_tiles = {}
+            lookup_connection = read_connections.lookup_connection
+            for z, x, y, store_name, _timestamp in self._lookup_tiles(lookup_connection, list(zxy_to_lzxy.keys())):
+                store_tiles.setdefault(store_name, []).append((z, x, y))
+            for store_name, zxys in store_tiles.items():
+                store_connection = read_connections.get_store_connection(store_name)
+                if store_connection is None:
+                    log.warning("store %s/%s is mentioned in lookup db for %d tiles but does not exist",
+                                self.store_path, store_name, len(zxys))
+                    continue
+                store_cursor = store_connection.cursor()
+                for chunk in get_chunks(zxys, SQLITE_BULK_QUERY_SIZE):
+                    query = get_zxy_in_query(get_store_tiles_query(), len(chunk))
+                    parameters = [coordinate for zxy in chunk for coordinate in zxy]
+                    for z, x, y, tile_data, timestamp in store_cursor.execute(query, parameters):
+                        if not utils.is_an_image(tile_data):
+                            log.warning("%s,%s,%s in %s/%s is probably not an image", x, y, z, self.store_path, store_name)
+                        results[zxy_to_lzxy[(z, x, y)]] = tile_data, timestamp
+                        found_zxys.append((z, x, y))
+        self._record_accesses(found_zxys)
+        return results
+
+    def tiles_are_stored(self, lzxys):
+        """Report if multiple tiles are stored in the database
+
+        The same limitations as for tile_is_stored() apply.
+
+        :param list lzxys: list of lzxy tuples
+        :returns: dictionary with (True, timestamp) for stored tiles and False for tiles
+                  that are not stored under lzxy keys
+        :rtype: dict
+        """
+        results = {}
+        zxy_to_lzxy = {}
+        for lzxy in lzxys:
+            _layer, z, x, y = lzxy
+            results[lzxy] = False
+            queued_tile = self._get_queued_tile(z, x, y)
+            if queued_tile:
+                results[lzxy] = True, queued_tile[5]
+            else:
+                zxy_to_lzxy[(z, x, y)] = lzxy
+        if not zxy_to_lzxy:
+            return results
+
+        with self._read_connections() as read_connections:
+            lookup_connection = read_connections.lookup_connection
+            for z, x, y, _store_name, timestamp in self._lookup_tiles(lookup_connection, list(zxy_to_lzxy.keys())):
+                results[zxy_to_lzxy[(z, x, y)]] = True, timestamp
+        return results
+
+    def get_tile_coordinates(self, z):
+        """List coordinates of all tiles stored on the given zoom level
+
+        Tiles waiting in the write-behind queue are included.
+
+        :param int z: zoom level
+        :returns: list of (x, y) tuples
+        :rtype: list
+        """
+        with self._read_connections() as read_connections:
+            lookup_cursor = read_connections.lookup_connection.cursor()
+            coordinates = lookup_cursor.execute("select x, y from tiles where z=?", (z,)).fetchall()
+        if self._writer_thread is not None:
+            with self._write_queue_condition:
+                for tile_z, x, y in list(self._write_queue.keys()) + list(self._write_batch.keys()):
+                    if tile_z == z:
+                        coordinates.append((x, y))
+        return coordinates
+
+    def get_modification_signature(self, z):
+        """Return size and modification time of the lookup database (and its WAL file)
+
+        Every tile change modifies the lookup database, so the signature covers all zoom levels.
+        """
+        signature = []
+        for path in (self._lookup_db_path, self._lookup_db_path + "-wal"):
+            if os.path.exists(path):
+                path_stat = os.stat(path)
+                signature.append((path_stat.st_size, path_stat.st_mtime_ns))
+        return signature
+
     def delete_tile(self, lzxy):
         """Try to delete tile corresponding to the lzxy coordinate tuple from the database
 
         :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
                            (layer is actually not used and can be None)
         """
+        _layer, z, x, y = lzxy
+        if self._writer_thread is not None:
+            # drop any not yet written version of the tile
+            with self._write_queue_condition:
+                self._write_queue.pop((z, x, y), None)
+                # if the tile is just being written, wait for the write to finish
+                # so that the tile is not resurrected right after we delete it
+                while (z, x, y) in self._write_batch:
+                    self._write_queue_condition.wait()
         with self._db_lock:
-            _layer, z, x, y = lzxy
             lookup_connection = self._lookup_db_connection
             lookup_cursor = lookup_connection.cursor()
-            store_name = lookup_cursor.execute(
+            lookup_result = lookup_cursor.execute(
                 "select store_filename from tiles where z=? and x=? and y=?", (z, x, y)
-            ).fetchone()[0]
-            if store_name:
+            ).fetchone()
+            if lookup_result:
+                store_name = lookup_result[0]
                 store_connection = self._storage_databases[store_name]
                 store_cursor = store_connection.cursor()
-                store_cursor.execute("delete from tiles where z=? and x=? and y=?", (z, x, y))
+                delete_store_tiles(store_cursor, "z=? and x=? and y=?", (z, x, y))
                 store_connection.commit()
             lookup_cursor.execute("delete from tiles where z=? and x=? and y=?", (z, x, y))
             lookup_connection.commit()
@@ -417,24 +1448,860 @@ class SqliteTileStore(BaseTileStore):
         :rtype: bool
         """
         _layer, z, x, y = lzxy
-        lookup_connection = self._lookup_db_connection
-        lookup_cursor = lookup_connection.cursor()
-        query = "select store_filename, unix_epoch_timestamp from tiles where z=? and x=? and y=?"
-        lookupResult = lookup_cursor.execute(query, (z, x, y)).fetchone()
+        queued_tile = self._get_queued_tile(z, x, y)
+        if queued_tile:
+            return True, queued_tile[5]
+        with self._read_connections() as read_connections:
+            lookup_cursor = read_connections.lookup_connection.cursor()
+            query = "select store_filename, unix_epoch_timestamp from tiles where z=? and x=? and y=?"
+            lookupResult = lookup_cursor.execute(query, (z, x, y)).fetchone()
         if lookupResult:
             return True, lookupResult[1]  # the tile is in the database
         else:
             return False # the tile is not in the database
 
+    def _record_accesses(self, zxys):
+        """Record that the given tiles have been accessed
+
+        The accesses are kept in memory and written to the lookup database
+        together with the next tile write. If too many accesses are waiting,
+        they are written right away, unless the database is busy.
+
+        :param list zxys: list of z, x, y tuples
+        """
+        if not zxys:
+            return
+        access_time = int(time.time()) // SQLITE_ACCESS_TIME_RESOLUTION * SQLITE_ACCESS_TIME_RESOLUTION
+        with self._pending_accesses_lock:
+            for zxy in zxys:
+                self._pending_accesses[zxy] = access_time
+            pending_access_count = len(self._pending_accesses)
+        if pending_access_count >= SQLITE_ACCESS_BATCH_SIZE:
+            # don't make a reader wait for a writer just to record accesses
+            if self._db_lock.acquire(blocking=False):
+                try:
+                    if self._lookup_db_connection is not None:
+                        self._write_pending_accesses(self._lookup_db_connection.cursor())
+                        self._lookup_db_connection.commit()
+                finally:
+                    self._db_lock.release()
+
+    def _write_pending_accesses(self, lookup_cursor):
+        """Write recorded tile accesses to the lookup database without committing
+
+        NOTE: needs to be called with the database lock held
+        """
+        with self._pending_accesses_lock:
+            pending_accesses = self._pending_accesses
+            self._pending_accesses = {}
+        if pending_accesses:
+            lookup_cursor.executemany(
+                "update tiles set last_access=? where z=? and x=? and y=? and last_access<?",
+                ((access_time, z, x, y, access_time) for (z, x, y), access_time in pending_accesses.items())
+            )
+
+    def evict_tiles(self, size_in_bytes, batch_size=SQLITE_EVICTION_BATCH_SIZE, should_continue=None):
+        """Delete least recently used tiles until the given amount of tile data has been deleted
+
+        The tiles are deleted in batches, each batch in a single transaction per database
+        file, with the database lock released between batches so that reading and storing
+        of tiles is not blocked for long. Tiles are deleted from the lookup database first,
+        so that it never points to tiles that don't exist.
+
+        NOTE: whole batches are always evicted, so a bit more data than requested might be deleted
+        NOTE: the database files don't shrink once tiles are deleted, the free space is
+              reused for new tiles instead
+        NOTE: evicted tiles count with their size before deduplication, as otherwise tiles sharing
+              their data with many other tiles (sea, blank tiles) would be evicted until
+              almost nothing is left, without freeing much space
+
+        :param int size_in_bytes: how much tile data to delete
+        :param int batch_size: how many tiles to delete in a single transaction
+        :param should_continue: optional callable, eviction stops once it returns False
+        :returns: size of deleted tile data in bytes
+        :rtype: int
+        """
+        evicted_bytes = 0
+        while evicted_bytes < size_in_bytes:
+            if should_continue is not None and not should_continue():
+                break
+            with self._db_lock:
+                lookup_connection = self._lookup_db_connection
+                lookup_cursor = lookup_connection.cursor()
+                # make sure recently used tiles are not evicted
+                self._write_pending_accesses(lookup_cursor)
+                lookup_connection.commit()
+                batch = lookup_cursor.execute(
+                    "select z, x, y, store_filename, size from tiles order by last_access limit ?", (batch_size,)
+                ).fetchall()
+                if not batch:
+                    break
+                deleted_bytes = self._delete_tiles([row[:4] for row in batch])
+                evicted_bytes += max(sum(row[4] or 0 for row in batch), deleted_bytes)
+        log.debug("%d bytes of least recently used tiles evicted from %s", evicted_bytes, self)
+        return evicted_bytes
+
+    def _delete_tiles(self, tiles):
+        """Delete the given tiles, with a single transaction per database file
+
+        Tiles are deleted from the lookup database first, so that it never points to tiles that don't exist.
+
+        NOTE: needs to be called with the database lock held
+
+        :param list tiles: list of (z, x, y, store_filename) tuples
+        :returns: size of deleted tile data in bytes
+        :rtype: int
+        """
+        lookup_connection = self._lookup_db_connection
+        lookup_cursor = lookup_connection.cursor()
+        deleted_bytes = 0
+        store_tiles = {}
+        for z, x, y, store_name in tiles:
+            store_tiles.setdefault(store_name, []).append((z, x, y))
+        try:
+            for chunk in get_chunks([row[:3] for row in tiles], SQLITE_BULK_QUERY_SIZE):
+                parameters = [coordinate for zxy in chunk for coordinate in zxy]
+                lookup_cursor.execute(get_zxy_in_query("delete from tiles", len(chunk)), parameters)
+            lookup_connection.commit()
+        except Exception:
+            lookup_connection.rollback()
+            raise
+        for store_name, zxys in store_tiles.items():
+            store_connection = self._storage_databases.get(store_name)
+            if store_connection is None:
+                continue
+            store_cursor = store_connection.cursor()
+            try:
+                for chunk in get_chunks(zxys, SQLITE_BULK_QUERY_SIZE):
+                    parameters = [coordinate for zxy in chunk for coordinate in zxy]
+                    deleted_bytes += delete_store_tiles(store_cursor, get_zxy_in_condition(len(chunk)), parameters)
+                store_connection.commit()
+            except Exception:
+                store_connection.rollback()
+                raise
+            self._check_storage_db_size(store_name)
+        return deleted_bytes
+
+    def get_expired_tiles(self, timestamp, limit=None):
+        """Return coordinates of tiles last modified before the given timestamp, oldest first
+
+        The tile timestamp is indexed, so this does not need to scan all tiles.
+
+        :param int timestamp: unix epoch timestamp
+        :param int limit: maximum number of tiles to return, None for no limit
+        :returns: list of (z, x, y) tuples
+        :rtype: list
+        """
+        if limit is None:
+            limit = -1  # no limit
+        with self._read_connections() as read_connections:
+            return read_connections.lookup_connection.execute(
+                "select z, x, y from tiles where unix_epoch_timestamp<? order by unix_epoch_timestamp limit ?",
+                (timestamp, limit)
+            ).fetchall()
+
+    def delete_expired_tiles(self, timestamp, batch_size=SQLITE_EVICTION_BATCH_SIZE, should_continue=None):
+        """Delete all tiles last modified before the given timestamp
+
+        The tiles are deleted in batches, with the database lock released between batches.
+
+        :param int timestamp: unix epoch timestamp
+        :param int batch_size: how many tiles to delete in a single transaction
+        :param should_continue: optional callable, deleting stops once it returns False
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        deleted_count = 0
+        while should_continue is None or should_continue():
+            with self._db_lock:
+                batch = self._lookup_db_connection.execute(
+                    "select z, x, y, store_filename from tiles where unix_epoch_timestamp<? limit ?",
+                    (timestamp, batch_size)
+                ).fetchall()
+                if not batch:
+                    break
+                self._delete_tiles(batch)
+                deleted_count += len(batch)
+        log.debug("%d expired tiles deleted from %s", deleted_count, self)
+        return deleted_count
+
+    def compact(self, should_continue=None, progress_callback=None):
+        """Release free space in the storage databases and consolidate sparsely used ones
+
+        This is meant to be run in a background thread while the store is in use:
+        - tiles are migrated out of sparsely used storage databases to the fullest storage
+          databases that have space for them, in batches, and the emptied storage databases
+          are deleted
+        - free pages left after deleted or replaced tiles are released from the storage
+          databases with incremental vacuum, so that the database files shrink
+
+        The database lock is only held for a single batch or vacuum step at a time and the work
+        is paused while tiles are being read heavily, so that map display is not slowed down.
+        Storage databases created before incremental vacuum was used are converted with a full
+        VACUUM, but only if enough of them is free space, as that can take a while.
+
+        :param should_continue: optional callable, compaction stops once it returns False
+        :param progress_callback: optional callable called with a status message
+                                  and progress (from 0.0 to 1.0)
+        :returns: by how many bytes the storage databases have shrunk
+        :rtype: int
+        """
+        self.flush()
+        for store_name in self.store_names:
+            if self._wal_mode:
+                # move recently written tiles from the WAL file to the database file first,
+                # so that database file sizes & free space are up to date
+                with self._db_lock:
+                    self._storage_databases[store_name].execute("pragma wal_checkpoint(TRUNCATE)").fetchall()
+            self._check_storage_db_size(store_name)
+        with self._storage_db_management_lock:
+            size_before = sum(self._storage_db_sizes.values())
+            free_size = sum(self._storage_db_free_bytes.values())
+        sparse_store_names, used_sizes = self._get_sparse_store_names()
+        total_work = max(1, free_size + sum(used_sizes[name] for name in sparse_store_names))
+        work_done = 0
+
+        def report(message, done_bytes=0):
+            nonlocal work_done
+            work_done += done_bytes
+            if progress_callback is not None:
+                progress_callback(message, min(1.0, work_done / total_work))
+
+        for store_name in sparse_store_names:
+            if should_continue is not None and not should_continue():
+                break
+            message = "migrating tiles from %s" % store_name
+            report(message)
+            self._drain_store(store_name, should_continue,
+                              lambda done_bytes, message=message: report(message, done_bytes))
+        for store_name in self.store_names:
+            if should_continue is not None and not should_continue():
+                break
+            message = "releasing free space in %s" % store_name
+            report(message)
+            self._vacuum_store(store_name, should_continue,
+                               lambda done_bytes, message=message: report(message, done_bytes))
+        for store_name in self.store_names:
+            self._check_storage_db_size(store_name)
+        if should_continue is None or should_continue():
+            # narrow the zoom level statistics bounds left wide by deleted & replaced tiles
+            with self._db_lock:
+                self._rebuild_zoom_stats(self._lookup_db_connection.cursor())
+                self._lookup_db_connection.commit()
+        with self._storage_db_management_lock:
+            shrunk_by = size_before - sum(self._storage_db_sizes.values())
+        report("done", total_work)
+        log.info("%s compacted, storage databases shrunk by %d bytes", self, shrunk_by)
+        return shrunk_by
+
+    def _get_sparse_store_names(self):
+        """Return names of sparsely used storage databases, least used first
+
+        The most used storage database is never considered sparse,
+        so that tiles can always be migrated to it.
+
+        :returns: list of storage database names & a dictionary with
+                  used sizes (without free space) under storage database names
+        :rtype: (list, dict) tuple
+        """
+        maximum_size_in_bytes = MAX_STORAGE_DB_FILE_SIZE * GIBI_BYTE
+        with self._storage_db_management_lock:
+            used_sizes = {name: self._storage_db_sizes.get(name, 0) - self._storage_db_free_bytes.get(name, 0)
+                          for name in self._storage_databases.keys()}
+        store_names = sorted(used_sizes.keys(), key=lambda name: used_sizes[name])
+        sparse_store_names = [name for name in store_names[:-1]
+                              if used_sizes[name] < maximum_size_in_bytes * SQLITE_SPARSE_STORE_FRACTION]
+        return sparse_store_names, used_sizes
+
+    def _get_migration_target(self, source_store_name, data_size):
+        """Return name of the fullest storage database (other than the source) the given data fits to
+
+        :returns: storage database name or None if the data does not fit anywhere
+        """
+        with self._storage_db_management_lock:
+            store_names = [name for name in self._storage_databases.keys()
+                           if name != source_store_name and name not in self._draining_stores and
+                           self._will_it_fit_in(name, data_size)]
+            if not store_names:
+                return None
+            return max(store_names, key=lambda name: self._storage_db_sizes.get(name, 0))
+
+    def _drain_store(self, store_name, should_continue, progress_callback):
+        """Migrate all tiles from the given storage database to other ones & delete it
+
+        :param str store_name: name of the storage database to drain
+        :param should_continue: optional callable, draining stops once it returns False
+        :param progress_callback: callable called with size of every migrated batch
+        :returns: True if the storage database has been drained & deleted, else False
+        :rtype: bool
+        """
+        maximum_size_in_bytes = MAX_STORAGE_DB_FILE_SIZE * GIBI_BYTE
+        with self._storage_db_management_lock:
+            store_size = self._storage_db_sizes.get(store_name, 0) - self._storage_db_free_bytes.get(store_name, 0)
+            available_size = sum(maximum_size_in_bytes - self._storage_db_sizes.get(name, 0)
+                                 for name in self._storage_databases.keys()
+                                 if name != store_name and name not in self._draining_stores)
+            if available_size < store_size:
+                log.debug("not enough space in other storage databases to drain %s/%s", self.store_path, store_name)
+                return False
+            # make sure no new tiles are stored to the storage database while it is being drained
+            self._draining_stores.add(store_name)
+        try:
+            while self._read_activity.wait_until_calm(should_continue):
+                with self._db_lock:
+                    store_connection = self._storage_databases[store_name]
+                    rows = store_connection.execute(
+                        "select s.z, s.x, s.y, s.extension, coalesce(s.tile, b.tile), s.unix_epoch_timestamp "
+                        "from tiles as s left join blobs as b on b.id=s.blob_id limit ?",
+                        (SQLITE_MIGRATION_BATCH_SIZE,)
+                    ).fetchall()
+                    if not rows:
+                        return self._remove_store(store_name)
+                    migrated_size = self._migrate_tiles(store_name, rows)
+                if migrated_size is None:
+                    log.warning("no storage database has space for tiles from %s/%s", self.store_path, store_name)
+                    return False
+                progress_callback(migrated_size)
+            return False
+        finally:
+            with self._storage_db_management_lock:
+                self._draining_stores.discard(store_name)
+
+    def _migrate_tiles(self, source_store_name, rows):
+        """Migrate the given tiles from a storage database to another one
+
+        The tiles are first stored to the target storage database, then the lookup database
+        is updated and only then are the tiles deleted from the source storage database,
+        so that the lookup database never points to tiles that don't exist.
+
+        NOTE: needs to be called with the database lock held
+
+        :param str source_store_name: name of the storage database the tiles are stored in
+        :param list rows: list of (z, x, y, extension, tile data, timestamp) tuples
+        :returns: size of the migrated tile data in bytes or None if no storage database has space for it
+        """
+        lookup_connection = self._lookup_db_connection
+        lookup_cursor = lookup_connection.cursor()
+        source_connection = self._storage_databases[source_store_name]
+        zxys = [tuple(row[:3]) for row in rows]
+        # tiles the lookup database does not point to the source storage database for are just
+        # leftovers (from an interrupted write for example) and are deleted without migrating them
+        stored_zxys = set()
+        for chunk in get_chunks(zxys, SQLITE_BULK_QUERY_SIZE):
+            parameters = [coordinate for zxy in chunk for coordinate in zxy] + [source_store_name]
+            query = get_zxy_in_query("select z, x, y from tiles", len(chunk)) + " and store_filename=?"
+            stored_zxys.update(lookup_cursor.execute(query, parameters).fetchall())
+        tiles = [row for row in rows if tuple(row[:3]) in stored_zxys and row[4] is not None]
+        data_size = sum(len(row[4]) for row in tiles)
+        target_store_name = self._get_migration_target(source_store_name, data_size)
+        if target_store_name is None:
+            return None
+        target_connection = self._storage_databases[target_store_name]
+        try:
+            target_cursor = target_connection.cursor()
+            stored_size = 0
+            for z, x, y, extension, tile_data, timestamp in tiles:
+                stored_size += self._insert_store_tile(target_cursor, z, x, y, extension, tile_data, timestamp)
+            target_connection.commit()
+            lookup_cursor.executemany("update tiles set store_filename=? where z=? and x=? and y=?",
+                                      [(target_store_name, z, x, y) for z, x, y, _e, _t, _ts in tiles])
+            lookup_connection.commit()
+            source_cursor = source_connection.cursor()
+            for chunk in get_chunks(zxys, SQLITE_BULK_QUERY_SIZE):
+                parameters = [coordinate for zxy in chunk for coordinate in zxy]
+                delete_store_tiles(source_cursor, get_zxy_in_condition(len(chunk)), parameters)
+            source_connection.commit()
+        except Exception:
+            target_connection.rollback()
+            lookup_connection.rollback()
+            source_connection.rollback()
+            raise
+        self._add_to_storage_db_size(target_store_name, stored_size)
+        self._check_storage_db_size(source_store_name)
+        return data_size
+
+    def _remove_store(self, store_name):
+        """Delete an empty storage database
+
+        NOTE: needs to be called with the database lock held
+
+        :returns: True if the storage database has been deleted, else False
+        :rtype: bool
+        """
+        connection = self._storage_databases[store_name]
+        lookup_tile_count = self._lookup_db_connection.execute(
+            "select count(*) from tiles where store_filename=?", (store_name,)
+        ).fetchone()[0]
+        if lookup_tile_count or connection.execute("select count(*) from tiles").fetchone()[0]:
+            log.warning("can't delete %s/%s as it is not empty", self.store_path, store_name)
+            return False
+        with self._storage_db_management_lock:
+            if len(self._storage_databases) < 2:
+                return False
+            del self._storage_databases[store_name]
+            for sizes in (self._storage_db_sizes, self._storage_db_unchecked_bytes, self._storage_db_free_bytes):
+                sizes.pop(store_name, None)
+            if self._new_tiles_store_name == store_name:
+                self._new_tiles_store_name = sorted(self._storage_databases.keys())[0]
+                self._new_tiles_store_connection = self._storage_databases[self._new_tiles_store_name]
+            # readers might have the storage database open
+            self._read_connections_generation += 1
+        self._close_read_connections()
+        connection.close()
+        store_path = os.path.join(self.store_path, store_name)
+        for path in (store_path, store_path + "-wal", store_path + "-shm", store_path + "-journal"):
+            if os.path.exists(path):
+                os.remove(path)
+        log.info("empty storage database %s has been deleted", store_path)
+        return True
+
+    def _vacuum_store(self, store_name, should_continue, progress_callback):
+        """Release free pages of the given storage database, so that its file shrinks
+
+        :param str store_name: name of the storage database to vacuum
+        :param should_continue: optional callable, vacuuming stops once it returns False
+        :param progress_callback: callable called with size of every released chunk of free space
+        :returns: True if all free space has been released, else False
+        :rtype: bool
+        """
+        connection = self._storage_databases.get(store_name)
+        if connection is None:
+            return False
+        page_size = connection.execute("pragma page_size").fetchone()[0]
+        if connection.execute("pragma auto_vacuum").fetchone()[0] != SQLITE_AUTO_VACUUM_INCREMENTAL:
+            with self._storage_db_management_lock:
+                free_size = self._storage_db_free_bytes.get(store_name, 0)
+                store_size = self._storage_db_sizes.get(store_name, 0)
+            if not free_size or free_size < store_size * SQLITE_VACUUM_CONVERSION_FREE_FRACTION:
+                return False
+            if not self._read_activity.wait_until_calm(should_continue):
+                return False
+            with self._db_lock:
+                log.info("converting %s/%s to incremental vacuum", self.store_path, store_name)
+                try:
+                    connection.execute("pragma auto_vacuum=incremental")
+                    connection.execute("vacuum")
+                except sqlite3.OperationalError:
+                    log.exception("vacuuming %s/%s failed", self.store_path, store_name)
+                    return False
+                self._check_storage_db_size(store_name)
+            progress_callback(free_size)
+            return True
+        step_page_count = max(1, SQLITE_VACUUM_STEP_SIZE * MEBI_BYTE // page_size)
+        while True:
+            if not self._read_activity.wait_until_calm(should_continue):
+                return False
+            with self._db_lock:
+                free_page_count = connection.execute("pragma freelist_count").fetchone()[0]
+                if not free_page_count:
+                    if self._wal_mode:
+                        # the database file is truncated on checkpoint in WAL mode
+                        connection.execute("pragma wal_checkpoint(TRUNCATE)").fetchall()
+                    self._check_storage_db_size(store_name)
+                    return True
+                connection.execute("pragma incremental_vacuum(%d)" % step_page_count).fetchall()
+                connection.commit()
+            progress_callback(min(free_page_count, step_page_count) * page_size)
+
+    def check_integrity(self, repair=False, thread_count=INTEGRITY_CHECK_THREAD_COUNT,
+                        should_continue=None, progress_callback=None):
+        """Check the store for damaged tiles & inconsistencies between the databases
+
+        The checks run on read only connections in a pool of threads:
+        - quick_check is run on all the database files
+        - data of all tiles is read in chunks and checked to be a complete image
+        - lookup database rows without tile data in the storage database
+          (or with missing deduplicated data) are reported as missing
+        - storage database rows the lookup database does not point to are reported as orphaned
+
+        When repairing, each damaged tile is checked again with the database lock held
+        (it might have been replaced in the meantime) and then:
+        - damaged tile data is moved to the quarantine folder and the tile is deleted
+        - tiles with missing data are deleted
+        - orphaned tiles are added back to the lookup database if it has no other version
+          of the tile, otherwise they are deleted
+        Damaged database files are only reported.
+
+        :returns: integrity report, see utils.get_integrity_report()
+        :rtype: dict
+        """
+        self.flush()
+        report = utils.get_integrity_report()
+        store_names = self.store_names
+
+        def report_progress(message, progress):
+            if progress_callback is not None:
+                progress_callback(message, progress)
+
+        def stopped():
+            return should_continue is not None and not should_continue()
+
+        # lists of (z, x, y, store name) tuples
+        invalid_tiles = []
+        missing_tiles = []
+        orphaned_tiles = []
+        with ThreadPoolExecutor(max_workers=max(1, thread_count)) as executor:
+            report_progress("checking database files", 0.0)
+            database_paths = [self._lookup_db_path] + [os.path.join(self.store_path, name) for name in store_names]
+            for database_path, is_ok in zip(database_paths, executor.map(self._quick_check, database_paths)):
+                if not is_ok:
+                    log.error("database file %s of %s is damaged", database_path, self)
+                    report["damaged_databases"].append(os.path.basename(database_path))
+
+            chunks = []
+            for store_name in store_names:
+                chunks.extend(self._get_integrity_check_chunks(store_name))
+            futures = [executor.submit(self._check_tile_chunk, *chunk) for chunk in chunks]
+            for index, future in enumerate(futures):
+                if stopped():
+                    for remaining_future in futures[index:]:
+                        remaining_future.cancel()
+                    return report
+                checked_tile_count, chunk_invalid_tiles, chunk_missing_tiles = future.result()
+                report["checked_tiles"] += checked_tile_count
+                invalid_tiles.extend(chunk_invalid_tiles)
+                missing_tiles.extend(chunk_missing_tiles)
+                report_progress("checking tiles", 0.1 + 0.7 * (index + 1) / len(futures))
+
+            report_progress("checking database consistency", 0.8)
+            for store_name, (store_missing_tiles, store_orphaned_tiles) in zip(
+                    store_names, executor.map(self._check_store_consistency, store_names)):
+                missing_tiles.extend(store_missing_tiles)
+                orphaned_tiles.extend(store_orphaned_tiles)
+        # lookup rows pointing to storage databases that don't exist
+        with closing(connect_to_db(self._lookup_db_path, read_only=True)) as lookup_connection:
+            missing_tiles.extend(lookup_connection.execute(
+                "select z, x, y, store_filename from tiles where store_filename not in (%s)"
+                % ", ".join(["?"] * len(store_names)), store_names
+            ).fetchall())
+
+        report["invalid_tiles"] = len(invalid_tiles)
+        report["missing_tiles"] = len(missing_tiles)
+        report["orphaned_tiles"] = len(orphaned_tiles)
+        if invalid_tiles or missing_tiles or orphaned_tiles:
+            log.warning("%s: %d damaged, %d missing & %d orphaned tiles found",
+                        self, len(invalid_tiles), len(missing_tiles), len(orphaned_tiles))
+        if repair and not stopped():
+            report_progress("repairing tiles", 0.9)
+            for batch in get_chunks(invalid_tiles + missing_tiles, SQLITE_EVICTION_BATCH_SIZE):
+                self._repair_tiles(batch, report)
+            for batch in get_chunks(orphaned_tiles, SQLITE_EVICTION_BATCH_SIZE):
+                self._repair_orphaned_tiles(batch, report)
+        report_progress("done", 1.0)
+        return report
+
+    def _quick_check(self, database_path):
+        """Run quick_check on the given database file
+
+        :returns: True if the database is fine, else False
+        :rtype: bool
+        """
+        try:
+            with closing(connect_to_db(database_path, read_only=True)) as connection:
+                return connection.execute("pragma quick_check").fetchall() == [("ok",)]
+        except sqlite3.DatabaseError:
+            log.exception("checking database file %s failed", database_path)
+            return False
+
+    def _get_integrity_check_chunks(self, store_name):
+        """Split the storage database to rowid ranges checked by a single integrity check task
+
+        :returns: list of (store name, first rowid, last rowid) tuples
+        :rtype: list
+        """
+        store_path = os.path.join(self.store_path, store_name)
+        with closing(connect_to_db(store_path, read_only=True)) as connection:
+            first_rowid, last_rowid = connection.execute("select min(rowid), max(rowid) from tiles").fetchone()
+        if first_rowid is None:
+            return []
+        return [(store_name, chunk_start, chunk_start + SQLITE_INTEGRITY_CHECK_CHUNK_SIZE - 1)
+                for chunk_start in range(first_rowid, last_rowid + 1, SQLITE_INTEGRITY_CHECK_CHUNK_SIZE)]
+
+    def _check_tile_chunk(self, store_name, first_rowid, last_rowid):
+        """Check data of tiles in the given rowid range of a storage database
+
+        :returns: number of checked tiles, list of damaged tiles & list of tiles
+                  with missing deduplicated data as (z, x, y, store name) tuples
+        :rtype: tuple
+        """
+        invalid_tiles = []
+        missing_tiles = []
+        checked_tile_count = 0
+        store_path = os.path.join(self.store_path, store_name)
+        with closing(connect_to_db(store_path, read_only=True)) as connection:
+            rows = connection.execute("%s where s.rowid between ? and ?" % get_store_tiles_query(),
+                                      (first_rowid, last_rowid))
+            for z, x, y, tile_data, _timestamp in rows:
+                checked_tile_count += 1
+                if tile_data is None:
+                    missing_tiles.append((z, x, y, store_name))
+                elif not utils.is_complete_image(tile_data):
+                    invalid_tiles.append((z, x, y, store_name))
+        return checked_tile_count, invalid_tiles, missing_tiles
+
+    def _check_store_consistency(self, store_name):
+        """Compare the lookup database with the given storage database
+
+        :returns: list of tiles the lookup database points to that are not in the storage database
+                  & list of tiles in the storage database the lookup database does not point to,
+                  both as (z, x, y, store name) tuples
+        :rtype: tuple
+        """
+        store_uri = "file:%s?mode=ro" % pathname2url(os.path.join(self.store_path, store_name))
+        with closing(connect_to_db(self._lookup_db_path, read_only=True)) as connection:
+            connection.execute("attach database ? as store", (store_uri,))
+            missing_tiles = connection.execute(
+                "select l.z, l.x, l.y, l.store_filename from main.tiles as l where l.store_filename=? and not exists "
+                "(select 1 from store.tiles as s where s.z=l.z and s.x=l.x and s.y=l.y)", (store_name,)
+            ).fetchall()
+            orphaned_tiles = connection.execute(
+                "select s.z, s.x, s.y, ? from store.tiles as s where not exists "
+                "(select 1 from main.tiles as l where l.z=s.z and l.x=s.x and l.y=s.y and l.store_filename=?)",
+                (store_name, store_name)
+            ).fetchall()
+        return missing_tiles, orphaned_tiles
+
+    def _get_stored_tile(self, store_connection, z, x, y):
+        """Return (tile data, extension, timestamp) from a storage database or None if not found"""
+        return store_connection.execute(
+            "select coalesce(s.tile, b.tile), s.extension, s.unix_epoch_timestamp from tiles as s "
+            "left join blobs as b on b.id=s.blob_id where s.z=? and s.x=? and s.y=?", (z, x, y)
+        ).fetchone()
+
+    def _quarantine_tile(self, z, x, y, extension, tile_data, report):
+        """Save damaged tile data to the quarantine folder"""
+        try:
+            with open(utils.get_quarantine_path(self.store_path, z, x, y, extension or "unknown"), "wb") as f:
+                f.write(tile_data)
+            report["quarantined_tiles"] += 1
+        except OSError:
+            log.exception("quarantining tile %d/%d/%d of %s failed", z, x, y, self)
+
+    def _repair_tiles(self, tiles, report):
+        """Delete the given damaged tiles & tiles with missing data, quarantine damaged tile data
+
+        The tiles are checked again first, as they might have been replaced since they have been found.
+
+        :param list tiles: list of (z, x, y, store name) tuples
+        :param dict report: integrity report to update
+        """
+        with self._db_lock:
+            lookup_cursor = self._lookup_db_connection.cursor()
+            damaged_tiles = []
+            for z, x, y, store_name in tiles:
+                lookup_row = lookup_cursor.execute("select store_filename from tiles where z=? and x=? and y=?",
+                                                   (z, x, y)).fetchone()
+                if lookup_row is None or lookup_row[0] != store_name:
+                    continue
+                store_connection = self._storage_databases.get(store_name)
+                stored_tile = None
+                if store_connection is not None:
+                    stored_tile = self._get_stored_tile(store_connection, z, x, y)
+                if stored_tile is not None and stored_tile[0] is not None:
+                    tile_data, extension, _timestamp = stored_tile
+                    if utils.is_complete_image(tile_data):
+                        continue
+                    self._quarantine_tile(z, x, y, extension, tile_data, report)
+                damaged_tiles.append((z, x, y, store_name))
+            if damaged_tiles:
+                self._delete_tiles(damaged_tiles)
+                report["repaired_tiles"] += len(damaged_tiles)
+
+    def _repair_orphaned_tiles(self, tiles, report):
+        """Add orphaned tiles back to the lookup database or delete them
+
+        :param list tiles: list of (z, x, y, store name) tuples
+        :param dict report: integrity report to update
+        """
+        with self._db_lock:
+            lookup_connection = self._lookup_db_connection
+            lookup_cursor = lookup_connection.cursor()
+            modified_store_names = set()
+            try:
+                for z, x, y, store_name in tiles:
+                    store_connection = self._storage_databases.get(store_name)
+                    if store_connection is None:
+                        continue
+                    stored_tile = self._get_stored_tile(store_connection, z, x, y)
+                    if stored_tile is None:
+                        continue
+                    tile_data, extension, timestamp = stored_tile
+                    lookup_row = lookup_cursor.execute("select store_filename from tiles where z=? and x=? and y=?",
+                                                       (z, x, y)).fetchone()
+                    if lookup_row is not None and lookup_row[0] == store_name:
+                        continue  # not orphaned any more
+                    tile_is_fine = tile_data is not None and utils.is_complete_image(tile_data)
+                    if lookup_row is None and tile_is_fine:
+                        lookup_cursor.execute("insert into tiles (z, x, y, store_filename, extension, "
+                                              "unix_epoch_timestamp, last_access, size) values (?, ?, ?, ?, ?, ?, ?, ?)",
+                                              (z, x, y, store_name, extension, timestamp, timestamp, len(tile_data)))
+                    else:
+                        if tile_data is not None and not tile_is_fine:
+                            self._quarantine_tile(z, x, y, extension, tile_data, report)
+                        delete_store_tiles(store_connection.cursor(), "z=? and x=? and y=?", (z, x, y))
+                        modified_store_names.add(store_name)
+                    report["repaired_tiles"] += 1
+                for store_name in modified_store_names:
+                    self._storage_databases[store_name].commit()
+                lookup_connection.commit()
+            except Exception:
+                lookup_connection.rollback()
+                for store_connection in self._storage_databases.values():
+                    store_connection.rollback()
+                raise
+            for store_name in modified_store_names:
+                self._check_storage_db_size(store_name)
+
+    def import_tiles(self, source_db_path, tiles_query, newer_only=False):
+        """Import tiles from another SQLite database
+
+        The source database is attached (read only) to the lookup database connection as "source"
+        and the tiles are copied with INSERT ... SELECT statements, so tile data never passes
+        through Python. Tiles are imported a zoom level at a time (or a part of a zoom level
+        if it would not fit to a single storage database), in a single transaction each.
+        Already stored tiles with the same coordinates are replaced.
+
+        With newer_only, stored tiles are only replaced by tiles with a newer timestamp (last writer wins)
+        and older imported tiles are skipped, so that the same tiles can be imported again without effect.
+
+        :param str source_db_path: path to the source database
+        :param str tiles_query: query selecting z, x, y, tile, extension and unix_epoch_timestamp
+                                columns from the "source" database
+        :param bool newer_only: don't replace stored tiles with tiles that are not newer
+        :returns: number of imported tiles
+        :rtype: int
+        """
+        self.flush()
+        maximum_size_in_bytes = MAX_STORAGE_DB_FILE_SIZE * GIBI_BYTE
+        range_condition = "where z=:z and x>=:x_min and x<:x_max"
+        coordinates_query = "select z, x, y from temp.import_tiles %s" % range_condition
+        import_condition = range_condition
+        if newer_only:
+            coordinates_query += " and not exists (select 1 from main.tiles as l where l.z=import_tiles.z " \
+                                 "and l.x=import_tiles.x and l.y=import_tiles.y " \
+                                 "and l.unix_epoch_timestamp>=import_tiles.unix_epoch_timestamp)"
+            # the stored tiles are deleted before the new ones are inserted,
+            # so tiles to import need to be selected by the recorded coordinates
+            import_condition += " and (z, x, y) in (select z, x, y from temp.import_coordinates)"
+        imported_tile_count = 0
+        with self._db_lock, self._storage_db_management_lock:
+            connection = self._lookup_db_connection
+            cursor = connection.cursor()
+            source_uri = "file:%s?mode=ro" % pathname2url(source_db_path)
+            cursor.execute("attach database ? as source", (source_uri,))
+            # store name -> schema name of storage databases attached for the import
+            attached_stores = {}
+            try:
+                cursor.execute("create temp view import_tiles as %s" % tiles_query)
+                cursor.execute("create temp table import_coordinates "
+                               "(z integer, x integer, y integer, primary key (z, x, y))")
+                zoom_levels = [row[0] for row in cursor.execute("select distinct z from temp.import_tiles")]
+                for z in sorted(zoom_levels):
+                    x_ranges = [(0, 2**z)]
+                    while x_ranges:
+                        x_min, x_max = x_ranges.pop()
+                        parameters = {"z": z, "x_min": x_min, "x_max": x_max}
+                        tile_count, data_size = cursor.execute(
+                            "select count(*), total(length(tile)) from temp.import_tiles %s" % range_condition,
+                            parameters
+                        ).fetchone()
+                        if not tile_count:
+                            continue
+                        if data_size > maximum_size_in_bytes and x_max - x_min > 1:
+                            # too big for a single storage database, split the range in half
+                            x_middle = (x_min + x_max) // 2
+                            x_ranges.append((x_middle, x_max))
+                            x_ranges.append((x_min, x_middle))
+                            continue
+                        cursor.execute("delete from temp.import_coordinates")
+                        cursor.execute("insert into temp.import_coordinates %s" % coordinates_query, parameters)
+                        if newer_only:
+                            tile_count = cursor.execute("select count(*) from temp.import_coordinates").fetchone()[0]
+                            if not tile_count:
+                                continue
+                        store_name, _store_connection = self._get_name_connection_to_available_store(int(data_size))
+                        # tiles being replaced might be in other storage databases
+                        store_names = {row[0] for row in cursor.execute(
+                            "select store_filename from main.tiles where (z, x, y) in "
+                            "(select z, x, y from temp.import_coordinates)")}
+                        store_names.add(store_name)
+                        # databases can't be attached inside a transaction
+                        connection.commit()
+                        for name in sorted(store_names):
+                            if name not in attached_stores and name in self._storage_databases:
+                                schema_name = "import_store_%d" % len(attached_stores)
+                                cursor.execute("attach database ? as %s" % schema_name,
+                                               (os.path.join(self.store_path, name),))
+                                attached_stores[name] = schema_name
+                        for name in store_names:
+                            if name in attached_stores:
+                                delete_store_tiles(cursor, "(z, x, y) in (select z, x, y from temp.import_coordinates)",
+                                                   schema=attached_stores[name])
+                        cursor.execute("delete from main.tiles where (z, x, y) in "
+                                       "(select z, x, y from temp.import_coordinates)")
+                        cursor.execute(
+                            "insert into %s.tiles (z, x, y, tile, extension, unix_epoch_timestamp) "
+                            "select z, x, y, tile, extension, unix_epoch_timestamp from temp.import_tiles %s"
+                            % (attached_stores[store_name], import_condition), parameters
+                        )
+                        parameters["store_name"] = store_name
+                        cursor.execute(
+                            "insert into main.tiles (z, x, y, store_filename, extension, unix_epoch_timestamp, last_access, size) "
+                            "select z, x, y, :store_name, extension, unix_epoch_timestamp, unix_epoch_timestamp, length(tile) "
+                            "from temp.import_tiles %s"
+                            % import_condition, parameters
+                        )
+                        connection.commit()
+                        self._check_storage_db_size(store_name)
+                        imported_tile_count += tile_count
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                cursor.execute("drop view if exists temp.import_tiles")
+                cursor.execute("drop table if exists temp.import_coordinates")
+                connection.commit()
+                for schema_name in list(attached_stores.values()) + ["source"]:
+                    cursor.execute("detach database %s" % schema_name)
+        log.info("%d tiles imported from %s to %s", imported_tile_count, source_db_path, self)
+        return imported_tile_count
+
+    def flush(self):
+        """Write all tiles waiting in the write-behind queue and recorded tile accesses to the database"""
+        if self._pending_accesses:
+            with self._db_lock:
+                self._write_pending_accesses(self._lookup_db_connection.cursor())
+                self._lookup_db_connection.commit()
+        if self._writer_thread is None:
+            return
+        with self._write_queue_condition:
+            self._flush_waiters += 1
+            self._write_queue_condition.notify_all()
+            try:
+                while self._write_queue or self._write_batch:
+                    self._write_queue_condition.wait()
+            finally:
+                self._flush_waiters -= 1
+
     def close(self):
-        """Close all database connections"""
+        """Write any queued tiles and close all database connections"""
+        self._stop_writer()
+        self._close_read_connections()
         with self._db_lock:
+            if self._pending_accesses:
+                self._write_pending_accesses(self._lookup_db_connection.cursor())
+                self._lookup_db_connection.commit()
             self._lookup_db_connection.close()
             for connection in self._storage_databases.values():
                 connection.close()
 
     def clear(self):
         """Delete all database files belonging to this SQLite store"""
+        # there is no point in writing queued tiles to databases that are about to be removed
+        with self._write_queue_condition:
+            self._write_queue.clear()
+        with self._pending_accesses_lock:
+            self._pending_accesses = {}
         with self._db_lock:
             # make sure the connections are closed before we remove
             # the data bases under them
@@ -448,4 +2315,7 @@ class SqliteTileStore(BaseTileStore):
                 for db_name in self._storage_databases.keys():
                     os.remove(os.path.join(self.store_path, db_name))
                 self._storage_databases = {}
+                self._storage_db_sizes = {}
+                self._storage_db_unchecked_bytes = {}
+                self._storage_db_free_bytes = {}
                 # TODO: the database should be able to handle writes after clear
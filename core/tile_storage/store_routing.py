@@ -0,0 +1,132 @@
+"""Store routing cache
+
+A map layer can have tiles in more than one tile store, for example while tiles are being
+migrated from files to SQLite or when MBTiles packs are mounted next to the tile cache.
+Without any routing information every store needs to be probed in turn for each tile
+that is not in the first store, which is a database query or a couple of syscalls per store.
+
+The routing cache remembers for each region of tiles (a square of tiles on a zoom level)
+which store last had a tile from the region, so that the store is probed first for
+neighbouring tiles. It also remembers recent misses per store and tile, so that stores
+known not to have a tile are not probed again until the miss times out. Misses are dropped
+once the tile is written to the store, so only tiles added to stores by other means than
+store_tile_data() might be missed until the timeout (or until the cache is invalidated).
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# regions are squares of 2**REGION_SHIFT x 2**REGION_SHIFT tiles
+REGION_SHIFT = 4
+# how many regions to remember the serving store for
+MAX_REGION_COUNT = 4096
+# how many store misses to remember
+MAX_MISS_COUNT = 16384
+# how long to remember a store miss
+MISS_TIMEOUT = 30  # in seconds
+
+
+class StoreRoutingCache(object):
+    """Store routing information for the tile stores of a single layer
+
+    Stores are identified by keys (store types) and lzxy tuples are used
+    for tile coordinates, as elsewhere in tile storage.
+    """
+
+    def __init__(self, miss_timeout=MISS_TIMEOUT, max_region_count=MAX_REGION_COUNT,
+                 max_miss_count=MAX_MISS_COUNT):
+        self._miss_timeout = miss_timeout
+        self._max_region_count = max_region_count
+        self._max_miss_count = max_miss_count
+        # (z, x >> REGION_SHIFT, y >> REGION_SHIFT) -> key of the store that last served the region
+        self._region_stores = OrderedDict()
+        # (store key, z, x, y) -> time of the miss
+        self._misses = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def _get_region(lzxy):
+        return lzxy[1], lzxy[2] >> REGION_SHIFT, lzxy[3] >> REGION_SHIFT
+
+    def _is_known_miss(self, key, lzxy, now):
+        """NOTE: needs to be called with the lock held"""
+        miss_key = (key, lzxy[1], lzxy[2], lzxy[3])
+        miss_time = self._misses.get(miss_key)
+        if miss_time is None:
+            return False
+        if now - miss_time > self._miss_timeout:
+            del self._misses[miss_key]
+            return False
+        return True
+
+    def route(self, lzxy, store_items):
+        """Return stores that should be probed for the tile, in order
+
+        The store that last served the tile region goes first, stores
+        that recently did not have the tile are left out.
+
+        :param tuple lzxy: tile coordinates
+        :param store_items: (store key, store) tuples in the default probing order
+        :returns: list of (store key, store) tuples
+        :rtype: list
+        """
+        now = time.monotonic()
+        with self._lock:
+            preferred_key = self._region_stores.get(self._get_region(lzxy))
+            routed_items = [item for item in store_items if not self._is_known_miss(item[0], lzxy, now)]
+        if preferred_key is not None:
+            # stable sort, so the default order is kept for the other stores
+            routed_items.sort(key=lambda item: item[0] != preferred_key)
+        return routed_items
+
+    def split_known_misses(self, key, lzxys):
+        """Split tiles to those that should be looked for in the given store and known misses
+
+        :param key: store key
+        :param list lzxys: list of lzxy tuples
+        :returns: list of tiles to look for & list of tiles known to be missing from the store
+        :rtype: tuple
+        """
+        lookup_lzxys = []
+        missing_lzxys = []
+        now = time.monotonic()
+        with self._lock:
+            for lzxy in lzxys:
+                if self._is_known_miss(key, lzxy, now):
+                    missing_lzxys.append(lzxy)
+                else:
+                    lookup_lzxys.append(lzxy)
+        return lookup_lzxys, missing_lzxys
+
+    def record_hit(self, key, lzxy):
+        """Record that a store had the tile"""
+        region = self._get_region(lzxy)
+        with self._lock:
+            self._region_stores[region] = key
+            self._region_stores.move_to_end(region)
+            if len(self._region_stores) > self._max_region_count:
+                self._region_stores.popitem(last=False)
+
+    def record_miss(self, key, lzxy):
+        """Record that a store did not have the tile"""
+        miss_key = (key, lzxy[1], lzxy[2], lzxy[3])
+        with self._lock:
+            self._misses[miss_key] = time.monotonic()
+            self._misses.move_to_end(miss_key)
+            if len(self._misses) > self._max_miss_count:
+                self._misses.popitem(last=False)
+
+    def record_write(self, key, lzxy):
+        """Record that the tile has been written to a store"""
+        with self._lock:
+            self._misses.pop((key, lzxy[1], lzxy[2], lzxy[3]), None)
+        self.record_hit(key, lzxy)
+
+    def invalidate(self):
+        """Forget all routing information
+
+        Needs to be called if tiles are added to the stores by other means than store_tile_data().
+        """
+        with self._lock:
+            self._region_stores.clear()
+            self._misses.clear()
@@ -3,6 +3,7 @@ import os
 import logging
 
 from .tile_types import ID_TO_CLASS_MAP
+from .constants import QUARANTINE_FOLDER_NAME
 
 log = logging.getLogger("tile_storage.utils")
 
@@ -26,6 +27,56 @@ def is_an_image(tile_data):
     else: # probably not an image file
         return False
 
+# the IEND chunk (no data & a constant checksum) always ends a PNG image
+PNG_END = b"\0\0\0\0IEND\xaeB`\x82"
+JPEG_END = b"\xff\xd9"
+# some JPEG encoders add padding after the end of image marker
+JPEG_END_PADDING = 32
+
+def is_complete_image(tile_data):
+    """Test if the string contains an image that has not been truncated
+
+    PNG and JPEG images are checked for their end markers, other images
+    are considered to be complete if they have a known magic number.
+    """
+    image_type = is_an_image(tile_data)
+    if image_type == "png":
+        return tile_data.endswith(PNG_END)
+    elif image_type == "jpg":
+        return JPEG_END in tile_data[-(len(JPEG_END) + JPEG_END_PADDING):]
+    else:
+        return bool(image_type)
+
+def get_integrity_report():
+    """Return an empty tile store integrity report
+
+    * checked_tiles - number of checked tiles
+    * invalid_tiles - number of tiles with damaged data (not an image or a truncated one)
+    * missing_tiles - number of tiles with missing data (stored tiles pointing to no data)
+    * orphaned_tiles - number of orphaned tile data (data no stored tile points to)
+    * damaged_databases - list of names of damaged database files
+    * repaired_tiles - number of repaired damaged, missing & orphaned tiles
+    * quarantined_tiles - number of tiles with damaged data moved to the quarantine folder
+    """
+    return {
+        "checked_tiles": 0,
+        "invalid_tiles": 0,
+        "missing_tiles": 0,
+        "orphaned_tiles": 0,
+        "damaged_databases": [],
+        "repaired_tiles": 0,
+        "quarantined_tiles": 0
+    }
+
+def get_quarantine_path(store_path, z, x, y, extension):
+    """Return path in the quarantine folder of a tile store for a damaged tile
+
+    Any missing folders are created.
+    """
+    folder_path = os.path.join(store_path, QUARANTINE_FOLDER_NAME, str(z), str(x))
+    os.makedirs(folder_path, exist_ok=True)
+    return os.path.join(folder_path, "%d.%s" % (y, extension))
+
 def get_tile_data_type(tile_data):
     return ID_TO_CLASS_MAP.get(is_an_image(tile_data), None)
 
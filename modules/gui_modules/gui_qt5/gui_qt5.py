@@ -359,9 +359,15 @@ class QMLGUI(GUIModule):
         :return: a distionary of tile states, True = available, False = will be downloaded
         :rtype: dict
         """
+        tile_id_lzxys = [(tile_id, self._tileId2lzxy(tile_id)) for tile_id in tile_ids]
+        # check all the tiles with a single bulk request
+        stored_tiles = self.modules.mapTiles.tilesInStorage([lzxy for _tile_id, lzxy in tile_id_lzxys])
         available_tiles = {}
-        for tile_id in tile_ids:
-            available_tiles[tile_id] = self.isTileAvailable(tile_id)
+        for tile_id, lzxy in tile_id_lzxys:
+            available = stored_tiles[lzxy]
+            if not available:
+                self._addTileDownloadRequest(lzxy, tile_id)
+            available_tiles[tile_id] = available
         return available_tiles
 
     def isTileAvailable(self, tileId):
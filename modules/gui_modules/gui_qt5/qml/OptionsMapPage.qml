@@ -57,6 +57,10 @@ BasePage {
                     text : QT_TRANSLATE_NOOP("TileStorageComboBox", "Sqlite")
                     value : "sqlite"
                 }
+                ListElement {
+                    text : QT_TRANSLATE_NOOP("TileStorageComboBox", "Pack files")
+                    value : "pack"
+                }
                 }
             Component.onCompleted : {
                 key = "tileStorageType"
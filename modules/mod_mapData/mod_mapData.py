@@ -55,6 +55,8 @@ class MapData(RanaModule):
 
         self._checkPool = BatchSizeCheckPool()
         self._downloadPool = BatchTileDownloadPool()
+        # download size estimated from stored tiles, -1 if unknown
+        self._estimatedDownloadSize = -1
 
         self.notificateOnce = True
         self.scroll = 0
@@ -86,6 +88,7 @@ class MapData(RanaModule):
         """Clear the download request set"""
         with self._tileDownloadRequestsLock:
             self._tileDownloadRequests.clear()
+        self._estimatedDownloadSize = -1
 
     @property
     def requestCount(self):
@@ -344,6 +347,49 @@ class MapData(RanaModule):
         else:
             return -1
 
+    @property
+    def estimatedDownloadSize(self):
+        """Download size of the batch estimated from stored tiles once size check was started
+
+        :return int: approximate download size or -1 if unknown
+        """
+        return self._estimatedDownloadSize
+
+    def estimateDownloadSize(self, layer):
+        """Return approximate download size of the requested tiles without any network requests
+
+        Tiles already stored are skipped, as they will not be downloaded.
+        The size of the rest is estimated from average size of tiles of the same layer already stored
+        on the same zoom level (or on all zoom levels if there are no tiles on the zoom level).
+
+        :param layer: layer of the requested tiles
+        :return int: approximate download size or -1 if there are no stored tiles to estimate from
+        """
+        storeTiles = self.m.get("storeTiles", None)
+        with self._tileDownloadRequestsLock:
+            requests = list(self._tileDownloadRequests)
+        if storeTiles is None or layer is None or not requests:
+            return -1
+        # download requests are (x, y, z) tuples
+        lzxys = [(layer, z, x, y) for x, y, z in requests]
+        storedTiles = storeTiles.tiles_are_stored(lzxys)
+        missingZoomlevels = [lzxy[1] for lzxy in lzxys if not storedTiles.get(lzxy)]
+        if not missingZoomlevels:
+            return 0
+        zoomStats = storeTiles.get_layer_zoom_stats(layer)
+        totalTileCount = sum(zStats["tile_count"] for zStats in zoomStats.values())
+        if not totalTileCount:
+            return -1
+        averageTileSize = sum(zStats["size"] for zStats in zoomStats.values()) / totalTileCount
+        estimatedSize = 0
+        for z in missingZoomlevels:
+            stats = zoomStats.get(z)
+            if stats and stats["tile_count"]:
+                estimatedSize += stats["size"] / stats["tile_count"]
+            else:
+                estimatedSize += averageTileSize
+        return int(estimatedSize)
+
     def getFreeSpaceString(self):
         """Return a string describing the space available on the filesystem
         where the tile-folder is located
@@ -577,6 +623,15 @@ class MapData(RanaModule):
             self.log.error("can't check size - no requests")
             return
 
+        # the zoom level statistics of the tile stores give us an initial estimate
+        # at once, long before the size check finishes querying the tile server
+        self._estimatedDownloadSize = self.estimateDownloadSize(self._checkPool.layer)
+        if self._estimatedDownloadSize >= 0:
+            self.set("sizeStatus", 'estimated')
+            prettySize = utils.bytes_to_pretty_unit_string(self._estimatedDownloadSize)
+            self.log.info("estimated batch download size from stored tiles: %s", prettySize)
+            self.notify("Estimated download size: %s" % prettySize, 3000)
+
         if self._checkPool.running:
             self.log.error("size check already in progress")
             return
@@ -22,7 +22,8 @@ from modules.base_module import RanaModule
 import threading
 import time
 
-from queue import Queue
+from queue import Queue, Empty
+from collections import deque, OrderedDict
 
 import urllib3
 
@@ -31,8 +32,15 @@ from core import tiles
 from core import constants
 from core.signal import Signal
 from core import threads
+from core import geo
 
-from .tile_downloader import Downloader
+from .tile_downloader import Downloader, BACKGROUND_TAGS
+from .tile_cache import TileImageCache
+from .tile_retry import TileRetryScheduler
+from .tile_prefetch import getPredictedTiles, PREFETCH_TAG, PREFETCH_MIN_SPEED, \
+    PREFETCH_REPEAT_TIMEOUT, PREFETCH_LAYER_TIMEOUT
+from .route_prefetch import RoutePrefetch, ROUTE_PREFETCH_TAG, ROUTE_PREFETCH_DISTANCE, \
+    ROUTE_PREFETCH_BUFFER, ROUTE_PREFETCH_BYTE_BUDGET, ROUTE_PREFETCH_BANDWIDTH
 
 #import socket
 #timeout = 30 # this sets timeout for all sockets
@@ -67,19 +75,16 @@ class MapTiles(RanaModule):
 
     def __init__(self, *args, **kwargs):
         RanaModule.__init__(self, *args, **kwargs)
-        self.images = [{}, {}] # the first dict contains normal image data, the second contains special tiles
-        self.imagesLock = threading.RLock()
         # we need to limit the size of the tile cache to avoid a memory leak
+        # - least recently used tiles are evicted once the memory budget
+        #   or the maximum number of tiles is exceeded
         memoryTileCacheSize = int(self.get("memoryTileCacheSize", constants.DEFAULT_MEMORY_TILE_CACHE_SIZE))
-        self.log.info("in memory tile cache size: %d", memoryTileCacheSize)
+        memoryTileCacheBudget = int(self.get("memoryTileCacheBudget", constants.DEFAULT_MEMORY_TILE_CACHE_BUDGET))
+        self.log.info("in memory tile cache size: %d tiles, %d MiB", memoryTileCacheSize, memoryTileCacheBudget)
         self.maxImagesInMemory = memoryTileCacheSize
-        self.imagesTrimmingAmount = constants.DEFAULT_MEMORY_TILE_CACHE_TRIM_SIZE
-        # how many tiles to remove once the maximum is reached
-        # so that trim does not run always run after adding a tile
-        # TODO: analyse memory usage,
-        #       set appropriate value,
-        #       platform dependent value,
-        #       user configurable
+        # the first cache contains normal image data, the second contains special tiles
+        self.images = [TileImageCache(memoryTileCacheBudget * 1024 * 1024, maxItems=memoryTileCacheSize), {}]
+        self.imagesLock = threading.RLock()
         self.tileSide = 256 # by default, the tiles are squares, side=256
         self.scalingInfo = (1, 15, 256)
         self.downloadRequestTimeout = 30 # in seconds
@@ -111,6 +116,24 @@ class MapTiles(RanaModule):
 
         self._dlRequestQueue = Queue()
         self._downloader = None
+        # failed tile downloads are retried with exponential backoff,
+        # an empty request wakes up the tile loading manager once
+        # a retry that is due sooner than all the others is scheduled
+        self._retryScheduler = TileRetryScheduler(wakeupCallback=lambda: self._dlRequestQueue.put([]))
+
+        # motion-predictive tile prefetching
+        self._prefetchLock = threading.Lock()
+        # tiles predicted to come into view soon, soonest first
+        self._prefetchTiles = deque()
+        # lzxy -> when the tile was last queued for prefetch
+        self._prefetchedTiles = OrderedDict()
+        # layer -> (zoom level of the tile last requested for the layer, request timestamp)
+        self._requestedLayers = {}
+        self._lastPosition = None
+        # route corridor prefetching during turn by turn navigation
+        self._routePrefetch = None
+        # tiles along the route ahead, in the order they will be reached
+        self._routePrefetchTiles = deque()
 
     @property
     def tileDownloaded(self):
@@ -136,8 +159,16 @@ class MapTiles(RanaModule):
                                      constants.DEFAULT_AUTOMATIC_TILE_DOWNLOAD_QUEUE_SIZE))
         self.log.debug("automatic tile download queue size: %d", taskQueueSize)
         self._downloader = Downloader(maxThreads,
-                                      taskBufferSize=taskQueueSize)
+                                      taskBufferSize=taskQueueSize,
+                                      retryScheduler=self._retryScheduler)
         self._startTileLoadingManager()
+        # predict tiles that will come into view on position updates
+        self.modrana.watch('locationUpdated', self._locationUpdatedCB)
+        # prefetch tiles along the route during navigation
+        tbt = self.m.get('turnByTurn', None)
+        if tbt:
+            tbt.navigation_started.connect(self._navigationStartedCB)
+            tbt.navigation_stopped.connect(self._navigationStoppedCB)
 
     def getTile(self, lzxy, asynchronous=False, tag=None, download=True):
         """Return a tile specified by layerID, z, x & y
@@ -151,7 +182,7 @@ class MapTiles(RanaModule):
         """
         # check if the tile is in the recently-downloaded cache
         cacheItem = self.images[0].get(lzxy, None)
-        if cacheItem:
+        if cacheItem and not self._isExpired(cacheItem):
         #      self.log.debug("got tile FROM memory CACHE")
             return cacheItem[0]
 
@@ -273,6 +304,15 @@ class MapTiles(RanaModule):
         """
         return self._storeTiles.tile_is_stored(lzxy)
 
+    def tilesInStorage(self, lzxys):
+        """Report if tiles are available from local persistent storage
+
+        :param list lzxys: list of tile description tuples
+        :returns: dictionary with True for tiles in storage and False otherwise under lzxy keys
+        :rtype: dict
+        """
+        return self._storeTiles.tiles_are_stored(lzxys)
+
     def _updateScalingCB(self, key='mapScale', oldValue=1, newValue=1):
         """as this only needs to be updated once on startup and then only
         when scaling settings change this callback driven method is used"""
@@ -306,11 +346,35 @@ class MapTiles(RanaModule):
         and submitting download requests for tiles that were not found locally.
         """
         while True:
-            request = self._dlRequestQueue.get(block=True)
+            # wait for new requests, but only until the next retry of a failed download is due
+            # or until route prefetch can continue
+            timeout = self._retryScheduler.getTimeToNextRetry()
+            routePrefetchTimeout = self._getRoutePrefetchTimeout()
+            if routePrefetchTimeout is not None and (timeout is None or routePrefetchTimeout < timeout):
+                timeout = routePrefetchTimeout
+            try:
+                request = self._dlRequestQueue.get(block=True, timeout=timeout)
+            except Empty:
+                request = []
             if request == TERMINATOR:
                 self.log.info("automatic tile download management thread shutting down")
                 break
             try:
+                # remember which layers and zoom levels are in view for prefetching,
+                # retries and background requests (eg. from the tile storage
+                # sweeper) are not in view, so they are skipped
+                now = time.time()
+                with self._prefetchLock:
+                    for lzxy, tag in request:
+                        if tag is not None and tag not in BACKGROUND_TAGS:
+                            self._requestedLayers[lzxy[0]] = (lzxy[1], now)
+                dueRetries = self._retryScheduler.popDueRetries()
+                if dueRetries:
+                    self.log.debug("retrying download of %d tiles", len(dueRetries))
+                    for lzxy, _tag in dueRetries:
+                        self._removeExpiredImageFromMemory(lzxy)
+                    # retries go first, as they have been waiting the longest
+                    request = dueRetries + request
                 for item in request:
                     lzxy, tag = item
                     # first check if the tile is locally available and load it
@@ -330,38 +394,230 @@ class MapTiles(RanaModule):
                         # tile not found locally and needs to be downloaded from network
                         # Are we allowed to download it ? (network=='full')
                         if self.get('network', 'full') == 'full':
+                            # a background request must not take over the retry
+                            # of a tile somebody is waiting for
+                            retryTag = None if tag in BACKGROUND_TAGS else tag
+                            if self._retryScheduler.isBackingOff(lzxy, retryTag):
+                                # the download recently failed, the retry will be
+                                # reported to the listener once it is done
+                                sprint("download of %s is backing off after a failure", lzxy)
+                                continue
                             sprint("auto tile dl enabled - adding dl request for %s", lzxy)
                             # switch the status tile to "Waiting for download slot"
                             if self.cacheImageSurfaces:
                                 with self.imagesLock:
                                     self.images[0][lzxy] = self.waitingTile
-                            droppedRequest = self._downloader.downloadTile(lzxy, tag)
-                            if droppedRequest:
-                                # this tile download request has been dropped from
-                                # the bottom of the request stack, remove its
-                                #  "Waiting..." tile from image cache
-                                # - if it is not in view, this makes place for new tiles in cache,
-                                # - if it is in view, new download request will be added
-                                lzxy, tag = droppedRequest
-                                sprint("old download request dropped from work request stack: %s", lzxy)
-                                self.removeImageFromMemory(lzxy)
-                                # also notify any listener that tha tile has been processed
-                                self.tileDownloaded(constants.TILE_DOWNLOAD_QUEUE_FULL, droppedRequest[0], droppedRequest[1])
+                            droppedLzxy = self._downloader.downloadTile(lzxy, tag)
+                            if droppedLzxy:
+                                # an old tile download request has been dropped from
+                                # the bottom of the request stack, the downloader has
+                                # already notified all the requests waiting for the tile
+                                sprint("old download request dropped from work request stack: %s", droppedLzxy)
                         else:
                             sprint("auto tile dl disabled - not adding dl request for %s", lzxy)
                     else:
                         # tile found locally and not downloaded, trigger the downloaded signal
                         sprint("%s found locally", lzxy)
-                        self.tileDownloaded(constants.TILE_DOWNLOAD_SUCCESS, lzxy, tag)
+                        self._retryScheduler.cancelRetry(lzxy)
+                        if tag not in BACKGROUND_TAGS:
+                            self.tileDownloaded(constants.TILE_DOWNLOAD_SUCCESS, lzxy, tag)
                         # and cache it in memory
                         if self.cacheImageSurfaces:
                             # if we are using image surfaces, convert the raw image data
                             # into an image surface
                             tileData = self._data2cairoImageSurface(tileData)
                         self.storeInMemory(tileData, lzxy)
+                # prefetch tiles predicted to come into view, but only
+                # while there are no requests for tiles that are in view
+                while self._dlRequestQueue.empty():
+                    with self._prefetchLock:
+                        if not self._prefetchTiles:
+                            break
+                        lzxy = self._prefetchTiles.popleft()
+                    self._prefetchTile(lzxy)
+                # then prefetch tiles along the route, as long as the budgets allow
+                while self._dlRequestQueue.empty() and self._routePrefetchTile():
+                    pass
             except Exception:
                 self.log.exception("exception in tile download manager thread")
 
+    def _locationUpdatedCB(self, key, oldValue, newValue):
+        """Predict tiles that will come into view when moving on and queue them for prefetching"""
+        pos = self.get('pos', None)
+        if pos is None:
+            return
+        lastPosition = self._lastPosition
+        self._lastPosition = pos
+        self._updateRoutePrefetch(pos)
+        if not self.get('tilePrefetch', True):
+            return
+        speed = self.get('metersPerSecSpeed', None)
+        # prefetch only when moving fast enough in follow-position mode
+        if speed is None or speed < PREFETCH_MIN_SPEED or not self.get('centred', True):
+            return
+        lat, lon = pos
+        bearing = self.get('bearing', None)
+        if bearing is None:
+            # not all position sources report bearing, use the direction of the last move instead
+            if lastPosition is None or lastPosition == pos:
+                return
+            bearing = geo.bearing(lastPosition[0], lastPosition[1], lat, lon)
+        viewport = self.get('viewport', None)
+        if viewport:
+            width, height = viewport[2], viewport[3]
+        else:
+            width, height = 800, 480
+        tileSide = self.scalingInfo[2]
+        viewportSize = (float(width) / tileSide, float(height) / tileSide)
+
+        predictedTiles = []
+        for layer, z in self._getRequestedLayerZooms():
+            for x, y in getPredictedTiles(lat, lon, bearing, speed, z, viewportSize):
+                predictedTiles.append((layer, z, x, y))
+        now = time.time()
+        with self._prefetchLock:
+            prefetchTiles = deque()
+            for lzxy in predictedTiles:
+                prefetchTimestamp = self._prefetchedTiles.get(lzxy)
+                if prefetchTimestamp is not None and now - prefetchTimestamp < PREFETCH_REPEAT_TIMEOUT:
+                    continue
+                self._prefetchedTiles[lzxy] = now
+                self._prefetchedTiles.move_to_end(lzxy)
+                prefetchTiles.append(lzxy)
+            while self._prefetchedTiles:
+                oldestLzxy, prefetchTimestamp = next(iter(self._prefetchedTiles.items()))
+                if now - prefetchTimestamp < PREFETCH_REPEAT_TIMEOUT:
+                    break
+                del self._prefetchedTiles[oldestLzxy]
+            # older predictions are outdated, so they are replaced
+            self._prefetchTiles = prefetchTiles
+        if prefetchTiles:
+            # wake up the tile loading manager
+            self._dlRequestQueue.put([])
+
+    def _getRequestedLayerZooms(self):
+        """Return (layer, zoom level) tuples recently requested by the GUI"""
+        now = time.time()
+        with self._prefetchLock:
+            return [(layer, z) for layer, (z, timestamp) in self._requestedLayers.items()
+                    if now - timestamp < PREFETCH_LAYER_TIMEOUT]
+
+    def _navigationStartedCB(self):
+        """Start prefetching tiles along the route"""
+        self._navigationStoppedCB()
+        if not self.get('routePrefetch', True):
+            return
+        route = self.m.get('route', None)
+        directions = route.get_current_directions() if route else None
+        if not directions or not directions.points_lle:
+            return
+        routePrefetch = RoutePrefetch(directions.points_lle,
+                                      distance=float(self.get('routePrefetchDistance', ROUTE_PREFETCH_DISTANCE)),
+                                      bufferMeters=float(self.get('routePrefetchBuffer', ROUTE_PREFETCH_BUFFER)),
+                                      byteBudget=float(self.get('routePrefetchBudget', ROUTE_PREFETCH_BYTE_BUDGET)),
+                                      bandwidth=float(self.get('routePrefetchBandwidth', ROUTE_PREFETCH_BANDWIDTH)))
+        self.log.info("prefetching tiles along a %1.1f km route", routePrefetch.routeLength)
+        with self._prefetchLock:
+            self._routePrefetch = routePrefetch
+        pos = self.get('pos', None)
+        if pos:
+            self._updateRoutePrefetch(pos)
+
+    def _navigationStoppedCB(self):
+        """Stop prefetching tiles along the route"""
+        with self._prefetchLock:
+            routePrefetch = self._routePrefetch
+            self._routePrefetch = None
+            self._routePrefetchTiles = deque()
+        if routePrefetch:
+            self.log.info("route prefetch stopped, %d kB downloaded", routePrefetch.downloadedBytes // 1024)
+
+    def _updateRoutePrefetch(self, pos):
+        """Queue tiles of the route section ahead for prefetching as the position advances"""
+        if self._routePrefetch is None:
+            return
+        # the zoom level in use and the adjacent zoom levels
+        layerZooms = []
+        for layer, z in self._getRequestedLayerZooms():
+            for prefetchZ in (z, z + 1, z - 1):
+                if layer.min_zoom <= prefetchZ <= layer.max_zoom:
+                    layerZooms.append((layer, prefetchZ))
+        with self._prefetchLock:
+            if self._routePrefetch is None:
+                return
+            newTiles = self._routePrefetch.update(pos[0], pos[1], layerZooms)
+            self._routePrefetchTiles.extend(newTiles)
+        if newTiles:
+            # wake up the tile loading manager
+            self._dlRequestQueue.put([])
+
+    def _getRoutePrefetchTimeout(self):
+        """Return how long to wait before route prefetch can continue or None if there is nothing to prefetch"""
+        with self._prefetchLock:
+            if self._routePrefetch is None or not self._routePrefetchTiles:
+                return None
+            delay = self._routePrefetch.getDownloadDelay()
+        # the download pool might be busy, so check again in a while even if the budget allows a download
+        return max(delay, 1.0)
+
+    def _routePrefetchTile(self):
+        """Prefetch the next tile along the route
+
+        :returns: True if a tile has been handled, False if route prefetch needs to wait
+        :rtype: bool
+        """
+        with self._prefetchLock:
+            if self._routePrefetch is None or not self._routePrefetchTiles:
+                return False
+            if self._routePrefetch.budgetExhausted:
+                self.log.info("route prefetch byte budget exhausted")
+                self._routePrefetchTiles = deque()
+                return False
+            lzxy = self._routePrefetchTiles.popleft()
+        if self._storeTiles.tile_is_stored(lzxy):
+            return True
+        with self._prefetchLock:
+            canDownload = self._routePrefetch is not None and self._routePrefetch.canDownload()
+        if canDownload and self.get('network', 'full') == 'full' and self._downloadPoolHasSpareCapacity():
+            if not self._retryScheduler.isBackingOff(lzxy):
+                self._downloader.downloadTile(lzxy, ROUTE_PREFETCH_TAG)
+            return True
+        else:
+            # try again later
+            with self._prefetchLock:
+                if self._routePrefetch is not None:
+                    self._routePrefetchTiles.appendleft(lzxy)
+            return False
+
+    def routePrefetchTileDownloaded(self, size):
+        """Account a tile downloaded by route prefetch to the route prefetch budgets
+
+        :param int size: tile size in bytes
+        """
+        with self._prefetchLock:
+            if self._routePrefetch is not None:
+                self._routePrefetch.tileDownloaded(size)
+
+    def _prefetchTile(self, lzxy):
+        """Load a tile to the in memory tile cache or download it in advance"""
+        if lzxy in self.images[0]:
+            return
+        tileData = self._storeTiles.get_tile_data(lzxy)
+        if tileData:
+            if self.cacheImageSurfaces:
+                tileData = self._data2cairoImageSurface(tileData)
+            self.storeInMemory(tileData, lzxy)
+        elif self.get('network', 'full') == 'full' and not self._retryScheduler.isBackingOff(lzxy):
+            if self._downloadPoolHasSpareCapacity():
+                self._downloader.downloadTile(lzxy, PREFETCH_TAG)
+
+    def _downloadPoolHasSpareCapacity(self):
+        """Report if the download pool can take a prefetch download
+
+        Prefetch downloads should not crowd out downloads of tiles that are in view.
+        """
+        return self._downloader.qsize < self._downloader.maxThreads
+
     def removeImageFromMemory(self, name, dictIndex=0):
         """Remove a tile from the in memory tile cache"""
 
@@ -374,6 +630,19 @@ class MapTiles(RanaModule):
                 else:
                     self.log.debug("can't remove unknown %s from memory tile cache", name)
 
+    @staticmethod
+    def _isExpired(cacheItem):
+        """Report if an in memory tile cache item (eg. an error tile) has expired"""
+        expireTimestamp = cacheItem[1].get('expireTimestamp')
+        return expireTimestamp is not None and expireTimestamp <= time.time()
+
+    def _removeExpiredImageFromMemory(self, name):
+        """Remove a tile from the in memory tile cache if it has expired"""
+        with self.imagesLock:
+            cacheItem = self.images[0].get(name)
+            if cacheItem and self._isExpired(cacheItem):
+                del self.images[0][name]
+
     def _fakeDebugLog(self, *argv):
         """Log function that does nothing"""
         pass
@@ -394,13 +663,10 @@ class MapTiles(RanaModule):
         if expireTimestamp:
             metadata['expireTimestamp'] = expireTimestamp
         with self.imagesLock: #make sure no one fiddles with the cache while we are working with it
-            self.images[dictIndex][name] = (surface, metadata) # store the image in memory
-
-            # check cache size,
-            # if there are too many images, delete them
-            if len(self.images[0]) > self.maxImagesInMemory:
-                self._trimCache()
-                # new tile available, make redraw request TODO: what overhead does this create ?
+            # store the image in memory, the tile cache evicts least
+            # recently used tiles by itself once it becomes full
+            self.images[dictIndex][name] = (surface, metadata)
+            # new tile available, make redraw request TODO: what overhead does this create ?
             self._tileLoadedNotify(imageType)
 
     def _tileLoadedNotify(self, imageType):
@@ -410,35 +676,11 @@ class MapTiles(RanaModule):
         # TODO: is this still needed ?
         pass
 
-    def _trimCache(self):
-        """To avoid a memory leak, the maximum size of the image cache is fixed
-           when we reach the maximum size, we start removing images,
-           starting from the oldest ones with an amount of images specified
-           in imagesTrimmingAmount, so that trim does not run every time
-           an image is added to a full cache
-           -> only the normal image cache needs trimming (images[0]),
-           as the special image cache (images[1]) is just created once and not updated dynamically
-           NOTE: the storeInMemory method which is calling this function
-                 already locked images, so we don't have to"""
-        trimmingAmount = self.imagesTrimmingAmount
-        imagesLength = len(self.images[0])
-        if trimmingAmount >= imagesLength:
-            # this means that the trimming amount was set higher,
-            # than current length of the cache
-            # the result is basically flushing the cache every time it fills back
-            # well, I don't have an idea why would someone want to do that
-            self.images[0] = {}
-        else:
-            oldestKeys = sorted(self.images[0], key=lambda image: self.images[0][image][1]['addedTimestamp'])[
-                         0:trimmingAmount]
-            for key in oldestKeys:
-                del self.images[0][key]
-
     def _clearTileCache(self):
         """completely clear the in memory image cache"""
         with self.imagesLock:
             self.log.info('fully clearing the in memory tile cache (%d tiles)', len(self.images[0]))
-            self.images[0] = {}
+            self.images[0].clear()
 
     def _removeTilesFromCache(self, imageTypes):
         """Remove tiles of the given types from the in memory tile cache.
@@ -448,12 +690,12 @@ class MapTiles(RanaModule):
         with self.imagesLock:
             self.log.info("removing %s from the tile cache", imageTypes)
             removedCounter = 0
-            keys = list(self.images[0].keys())
-            for key in keys:
-                if self.images[0][key][1]["type"] in imageTypes:
+            items = self.images[0].items()
+            for key, (_image, metadata) in items:
+                if metadata["type"] in imageTypes:
                     del self.images[0][key]
                     removedCounter += 1
-            self.log.debug("removed %d tiles from total of %d", removedCounter, len(keys))
+            self.log.debug("removed %d tiles from total of %d", removedCounter, len(items))
 
     def _updateTileFilteringCB(self, key='mapScale', oldValue=1, newValue=1):
         if key == 'invertMapTiles':
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# Route corridor tile prefetching
+#
+# During turn by turn navigation the whole route is known in advance,
+# so tiles along the route can be downloaded before they are needed,
+# while there is still network coverage:
+# * tiles within a buffer around the route are prefetched for the next
+#   couple of kilometers of the route, on the zoom levels in use and
+#   the adjacent zoom levels
+# * the prefetched section of the route is extended incrementally
+#   as the position advances along the route
+# * tiles that are already stored are skipped and downloads are limited
+#   by a total byte budget and by a bandwidth budget (a token bucket),
+#   so that prefetching does not eat all the data plan or all the bandwidth
+#   needed for tiles that are actually in view
+#   (the budgets can be exceeded by the size of the downloads in progress,
+#   as the size of a tile is only known once it is downloaded)
+import time
+from math import cos, radians, floor, ceil, hypot
+
+from core import geo
+from core import tilenames
+
+from .tile_prefetch import EARTH_CIRCUMFERENCE
+
+# tag used for route prefetch requests, tiles loaded for prefetch are not reported to listeners
+ROUTE_PREFETCH_TAG = "routePrefetch"
+# how far ahead along the route to prefetch tiles
+ROUTE_PREFETCH_DISTANCE = 5  # in km
+# prefetch tiles within this distance from the route
+ROUTE_PREFETCH_BUFFER = 150  # in meters
+# how many tiles can be downloaded per route
+ROUTE_PREFETCH_BYTE_BUDGET = 20  # in MiB
+# how fast can tiles be downloaded
+ROUTE_PREFETCH_BANDWIDTH = 64  # in KiB/s
+# how many seconds worth of bandwidth can be used at once
+ROUTE_PREFETCH_BURST = 4  # in seconds
+# the next route section is prefetched once the position is
+# closer than this to the end of the prefetched section
+ROUTE_PREFETCH_EXTEND_DISTANCE = 1  # in km
+# look for the closest route point at most this far ahead
+# of the last known position on the route
+ROUTE_PROGRESS_SEARCH_DISTANCE = 2  # in km
+# the route is sampled in steps of this size
+ROUTE_SAMPLING_STEP = 0.5  # in tiles
+
+def getRouteSectionTiles(pointsLL, z, bufferMeters):
+    """Return tiles within a buffer around a route section
+
+    :param list pointsLL: route section as (lat, lon, ...) tuples
+    :param int z: zoom level
+    :param float bufferMeters: buffer size in meters
+    :returns: list of (x, y) tuples in the order they are reached along the route
+    :rtype: list
+    """
+    tileCount = 2 ** z
+    seen = set()
+    sectionTiles = []
+    if not pointsLL:
+        return sectionTiles
+    # the buffer is converted to tiles at the latitude of the start of the route section,
+    # which is good enough for the couple of km long sections prefetched at once
+    metersPerTile = EARTH_CIRCUMFERENCE * max(cos(radians(pointsLL[0][0])), 0.01) / tileCount
+    bufferTiles = bufferMeters / metersPerTile
+    points = [tilenames.ll2xy(point[0], point[1], z) for point in pointsLL]
+    # a section with a single point still has its tiles prefetched
+    segments = list(zip(points[:-1], points[1:])) or [(points[0], points[0])]
+    for (x1, y1), (x2, y2) in segments:
+        stepCount = max(int(ceil(hypot(x2 - x1, y2 - y1) / ROUTE_SAMPLING_STEP)), 1)
+        for step in range(stepCount + 1):
+            x = x1 + (x2 - x1) * step / stepCount
+            y = y1 + (y2 - y1) * step / stepCount
+            for tileX in range(int(floor(x - bufferTiles)), int(floor(x + bufferTiles)) + 1):
+                for tileY in range(int(floor(y - bufferTiles)), int(floor(y + bufferTiles)) + 1):
+                    tile = (tileX, tileY)
+                    if tile not in seen and 0 <= tileX < tileCount and 0 <= tileY < tileCount:
+                        seen.add(tile)
+                        sectionTiles.append(tile)
+    return sectionTiles
+
+
+class RoutePrefetch(object):
+    """Prefetch state for a single route
+
+    :param list pointsLL: route points as (lat, lon, ...) tuples
+    :param float distance: how far ahead to prefetch in km
+    :param float bufferMeters: buffer around the route in meters
+    :param float byteBudget: how much can be downloaded for the route in MiB
+    :param float bandwidth: how fast can tiles be downloaded in KiB/s
+    """
+
+    def __init__(self, pointsLL, distance=ROUTE_PREFETCH_DISTANCE, bufferMeters=ROUTE_PREFETCH_BUFFER,
+                 byteBudget=ROUTE_PREFETCH_BYTE_BUDGET, bandwidth=ROUTE_PREFETCH_BANDWIDTH):
+        self._points = pointsLL
+        self._distance = distance
+        self._bufferMeters = bufferMeters
+        self._byteBudget = byteBudget * 1024 * 1024
+        self._bandwidth = max(bandwidth * 1024, 1)
+        # distance of route points from the route start in km
+        self._pointDistances = [0.0]
+        for (lat1, lon1), (lat2, lon2) in zip(((p[0], p[1]) for p in pointsLL[:-1]),
+                                              ((p[0], p[1]) for p in pointsLL[1:])):
+            self._pointDistances.append(self._pointDistances[-1] + geo.distance(lat1, lon1, lat2, lon2))
+        self._pointIndex = 0
+        # (layer, z) -> index of the route point up to which tiles have been prefetched
+        self._prefetchedUpTo = {}
+        self._queuedTiles = set()
+        self.downloadedBytes = 0
+        self._tokens = self._bandwidth * ROUTE_PREFETCH_BURST
+        self._tokensTimestamp = time.time()
+
+    @property
+    def routeLength(self):
+        """Route length in km"""
+        return self._pointDistances[-1]
+
+    @property
+    def budgetExhausted(self):
+        return self.downloadedBytes >= self._byteBudget
+
+    def _updateProgress(self, lat, lon):
+        """Find the route point closest to the current position, searching only ahead
+        of the last known position on the route, so that the progress never goes back
+        (a new route is computed when rerouting anyway)
+        """
+        index = self._pointIndex
+        searchLimit = self._pointDistances[index] + ROUTE_PROGRESS_SEARCH_DISTANCE
+        closestIndex = index
+        closestDistance = None
+        while index < len(self._points) and self._pointDistances[index] <= searchLimit:
+            point = self._points[index]
+            distance = geo.distance(lat, lon, point[0], point[1])
+            if closestDistance is None or distance < closestDistance:
+                closestIndex = index
+                closestDistance = distance
+            index += 1
+        self._pointIndex = closestIndex
+
+    def _getPointIndexAhead(self, distance):
+        """Return index of the last route point within the given distance from the current route point"""
+        limit = self._pointDistances[self._pointIndex] + distance
+        index = self._pointIndex
+        while index + 1 < len(self._points) and self._pointDistances[index + 1] <= limit:
+            index += 1
+        return index
+
+    def update(self, lat, lon, layerZooms):
+        """Update progress along the route & return tiles of the route section ahead
+        that have not been queued for prefetch yet
+
+        :param float lat: current latitude
+        :param float lon: current longitude
+        :param list layerZooms: (layer, zoom level) tuples to prefetch tiles for
+        :returns: list of lzxy tuples in the order they are reached along the route
+        :rtype: list
+        """
+        if self.budgetExhausted:
+            return []
+        self._updateProgress(lat, lon)
+        extendIndex = self._getPointIndexAhead(self._distance - ROUTE_PREFETCH_EXTEND_DISTANCE)
+        endIndex = self._getPointIndexAhead(self._distance)
+        newTiles = []
+        for layer, z in layerZooms:
+            prefetchedUpTo = self._prefetchedUpTo.get((layer, z))
+            if prefetchedUpTo is not None and prefetchedUpTo >= max(extendIndex, self._pointIndex + 1):
+                # enough of the route ahead is already prefetched on this zoom level
+                continue
+            startIndex = self._pointIndex
+            if prefetchedUpTo is not None:
+                startIndex = max(startIndex, prefetchedUpTo)
+            # include the next point, so that the segment leading out of the section is covered
+            section = self._points[startIndex:endIndex + 2]
+            for x, y in getRouteSectionTiles(section, z, self._bufferMeters):
+                lzxy = (layer, z, x, y)
+                if lzxy not in self._queuedTiles:
+                    self._queuedTiles.add(lzxy)
+                    newTiles.append(lzxy)
+            self._prefetchedUpTo[(layer, z)] = endIndex + 1
+        return newTiles
+
+    def _refillTokens(self):
+        now = time.time()
+        self._tokens = min(self._tokens + (now - self._tokensTimestamp) * self._bandwidth,
+                           self._bandwidth * ROUTE_PREFETCH_BURST)
+        self._tokensTimestamp = now
+
+    def canDownload(self):
+        """Report if the byte & bandwidth budgets allow another tile download"""
+        if self.budgetExhausted:
+            return False
+        self._refillTokens()
+        return self._tokens > 0
+
+    def getDownloadDelay(self):
+        """Return seconds until the bandwidth budget allows another tile download"""
+        self._refillTokens()
+        if self._tokens > 0:
+            return 0
+        return -self._tokens / self._bandwidth
+
+    def tileDownloaded(self, size):
+        """Account a downloaded tile to the budgets
+
+        :param int size: tile size in bytes
+        """
+        self._refillTokens()
+        self._tokens -= size
+        self.downloadedBytes += size
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# In memory tile image cache
+#
+# A least recently used cache of tile images with a memory budget:
+# * tiles are kept in an ordered dict in least recently used first order,
+#   so both cache hits (moving a tile to the end) and eviction (popping
+#   from the front) take constant time
+# * memory used by every tile is recorded once the tile is added, so that
+#   the cache size is limited in bytes and not just in tiles - this keeps
+#   memory usage predictable with big (high DPI, scaled) tiles
+# * cache items are (image, metadata) tuples, same as for the special tile cache
+import threading
+from collections import OrderedDict
+
+import logging
+log = logging.getLogger("mod.mapTiles.tile_cache")
+
+# used for images whose memory usage can't be found out
+DEFAULT_IMAGE_SIZE = 256 * 256 * 4  # a 256x256 tile with 32 bits per pixel
+
+def getImageSize(image):
+    """Return the approximate memory usage of a tile image in bytes
+
+    :param image: raw tile image data or an image surface
+    :returns: memory usage in bytes
+    :rtype: int
+    """
+    if isinstance(image, (bytes, bytearray)):
+        return len(image)
+    try:
+        # Cairo image surface
+        return image.get_stride() * image.get_height()
+    except AttributeError:
+        return DEFAULT_IMAGE_SIZE
+
+
+class TileImageCache(object):
+    """Least recently used tile image cache limited by memory usage
+
+    :param int maxSize: memory budget in bytes
+    :param int maxItems: maximum number of cached tiles, None means no limit
+    """
+
+    def __init__(self, maxSize, maxItems=None):
+        self._maxSize = maxSize
+        self._maxItems = maxItems
+        # name -> (item, size in bytes), least recently used first
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        """Memory used by the cached tiles in bytes"""
+        return self._size
+
+    def get(self, name, default=None):
+        """Return the cached item & mark it as recently used"""
+        with self._lock:
+            cached = self._items.get(name)
+            if cached is None:
+                return default
+            self._items.move_to_end(name)
+            return cached[0]
+
+    def __contains__(self, name):
+        return name in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def __setitem__(self, name, item):
+        itemSize = getImageSize(item[0])
+        with self._lock:
+            replaced = self._items.pop(name, None)
+            if replaced is not None:
+                self._size -= replaced[1]
+            self._items[name] = (item, itemSize)
+            self._size += itemSize
+            # evict least recently used tiles, but never the tile that has just been added
+            while len(self._items) > 1 and (self._size > self._maxSize or
+                                            (self._maxItems is not None and len(self._items) > self._maxItems)):
+                _evictedName, (_evictedItem, evictedSize) = self._items.popitem(last=False)
+                self._size -= evictedSize
+
+    def __delitem__(self, name):
+        with self._lock:
+            _item, itemSize = self._items.pop(name)
+            self._size -= itemSize
+
+    def items(self):
+        """Return a list of (name, item) tuples, least recently used first"""
+        with self._lock:
+            return [(name, item) for name, (item, _itemSize) in self._items.items()]
+
+    def keys(self):
+        with self._lock:
+            return list(self._items.keys())
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._size = 0
@@ -21,14 +21,22 @@ from core.singleton import modrana
 from core import tiles
 from core import constants
 
+from .tile_prefetch import PREFETCH_TAG
+from .route_prefetch import ROUTE_PREFETCH_TAG
+
+# tags of background requests, nobody is waiting for these tiles
+BACKGROUND_TAGS = (PREFETCH_TAG, ROUTE_PREFETCH_TAG, constants.TILE_STORAGE_REVALIDATION_TAG)
+
 import logging
 log = logging.getLogger("mod.mapTiles.tile_downloader")
 
 class Downloader(object):
     def __init__(self, maxThreads, taskBufferSize=0,
-                 taskTimeout=0):
+                 taskTimeout=0, retryScheduler=None):
         self._mapTiles = modrana.m.get("mapTiles")
         self._storeTiles = modrana.m.get("storeTiles")
+        # schedules retries of failed downloads with exponential backoff
+        self._retryScheduler = retryScheduler
         # if task buffer size is set, start leaking
         # old tile download requests from the bottom of the
         # request stack once it becomes full, as we don't want
@@ -41,11 +49,12 @@ class Downloader(object):
                                     leak=leak)
         # in seconds, 0 == no task timeout
         self._taskTimeout = taskTimeout
-        self._running = set()
-        self._runningLock = threading.RLock()
-        # due to GIL, we don't have a lock
-        # for the set of tile downloads
-        # in progress (hopefully)
+        # tiles that are being downloaded or waiting for download,
+        # lzxy -> list of (tag, callback) tuples of the requests for the tile,
+        # so that each tile is downloaded only once, no matter how many times
+        # it is requested in the meantime
+        self._inFlight = {}
+        self._inFlightLock = threading.Lock()
         self._imageSurface = self._mapTiles.cacheImageSurfaces
 
     def shutdown(self):
@@ -53,102 +62,125 @@ class Downloader(object):
 
     def _tileDownloaded(self, error, lzxy, tag):
         #log.debug("DOWNLOADER: CALLING SIGNAL: %s %s" % (tag, success))
-        self._mapTiles.tileDownloaded(error, lzxy, tag)
+        # nobody is waiting for prefetched & revalidated tiles
+        if tag not in BACKGROUND_TAGS:
+            self._mapTiles.tileDownloaded(error, lzxy, tag)
+
+    def downloadTile(self, lzxy, tag=None, overwrite=False, callback=None):
+        """Add a tile download request
 
-    def downloadTile(self, lzxy, tag=None, overwrite=False):
-        """Add a tile download request, if this download
-        request replaces another not yet handled request
-        from the bottom of the work stack, the old
-        lzxy will be returned
+        If the tile is already being downloaded or waiting for download,
+        the request joins the pending download instead of downloading the tile
+        again and all requests are notified once the download is finished.
+
+        If this download request replaces another not yet handled request
+        from the bottom of the work stack, all requests waiting for the
+        replaced download are notified and its lzxy is returned.
 
         :param tuple lzxy: tile to download represented by a tuple
         :param str tag: tracking tag for the download request
         :param bool overwrite: download tile even if locally available
-        :returns: None or a tuple that was removed because of the new one
+        :param callback: called with error code, lzxy and tag once the download is finished
+        :returns: None or lzxy of the tile that was removed because of the new request
         :rtype: None or tuple
         """
-        discardedRequest = None
-        discardedTile = None
-        with self._runningLock:
-            if lzxy not in self._running:
-                # drop download requests for tiles that are already
-                # being downloaded
-                discardedRequest = self._pool.submit(
-                    self._handleDownload, lzxy, tag, time.time(), overwrite
-                )
-        # return lzxy & tag for any discarded request or return None
-        # if no request was discarded
+        with self._inFlightLock:
+            requests = self._inFlight.get(lzxy)
+            if requests is not None:
+                # the tile is already being downloaded, join the pending download
+                if (tag, callback) not in requests:
+                    requests.append((tag, callback))
+                return None
+            self._inFlight[lzxy] = [(tag, callback)]
+        discardedRequest = self._pool.submit(
+            self._handleDownload, lzxy, time.time(), overwrite
+        )
         if discardedRequest:
-            discardedTile = discardedRequest[1][0], discardedRequest[1][1]
-        return discardedTile
+            discardedLzxy = discardedRequest[1][0]
+            # remove any "Waiting..." tile of the dropped download from the image cache
+            # - if it is not in view, this makes place for new tiles in cache,
+            # - if it is in view, new download request will be added
+            self._mapTiles.removeImageFromMemory(discardedLzxy)
+            self._downloadFinished(constants.TILE_DOWNLOAD_QUEUE_FULL, discardedLzxy)
+            return discardedLzxy
+        else:
+            return None
+
+    def _getRequestTags(self, lzxy):
+        """Return tags of requests waiting for the tile, in the order they were made"""
+        with self._inFlightLock:
+            return [tag for tag, _callback in self._inFlight.get(lzxy, [])]
 
-    def _handleDownload(self, lzxy, tag, timestamp, overwrite):
+    def _downloadFinished(self, error, lzxy):
+        """Notify all requests waiting for the tile"""
+        with self._inFlightLock:
+            requests = self._inFlight.pop(lzxy, [])
+        for tag, callback in requests:
+            # a failing listener must not keep the other requests waiting
+            try:
+                self._tileDownloaded(error, lzxy, tag)
+                if callback:
+                    callback(error, lzxy, tag)
+            except Exception:
+                log.exception("notifying request %s for tile %s failed", tag, lzxy)
+
+    def _handleDownload(self, lzxy, timestamp, overwrite):
         download = True
         error = constants.TILE_DOWNLOAD_ERROR
-        with self._runningLock:
-            if (lzxy, tag) in self._running:
-                # tile is already being downloaded
-                download = False
+        try:
+            if self._taskTimeout:
+                dt = time.time() - timestamp
+                if dt >= self._taskTimeout:
+                    # download request timed out
+                    download = False
+
+            if not download and not overwrite:
+                # check if the tile has been already downloaded
+                download = not self._storeTiles.tile_is_stored(lzxy)
+                if not download:
+                    error = constants.TILE_DOWNLOAD_SUCCESS
+
+            if download:
+                # download tile
+                try:
+                    content = self._downloadTile(lzxy)
+                    error = constants.TILE_DOWNLOAD_SUCCESS
+                    if ROUTE_PREFETCH_TAG in self._getRequestTags(lzxy):
+                        # route prefetch downloads are limited by a byte & bandwidth budget
+                        self._mapTiles.routePrefetchTileDownloaded(len(content))
+                    if self._retryScheduler:
+                        self._retryScheduler.downloadSucceeded(lzxy)
+                except urllib3.exceptions.HTTPError:
+                    # server returned a HTTP error, this means we got
+                    # to the server but it didn't like us for some reason,
+                    error = self._fatalDownloadError(lzxy, self._getRequestTags(lzxy))
+                except URLError:
+                    # this is most probably caused by a loss of network connectivity
+                    error = self._temporaryDownloadError(lzxy, self._getRequestTags(lzxy))
             else:
-                # tile is not yet being downloaded
-                # so register we are handling it
-                self._running.add((lzxy, tag))
-
-        if self._taskTimeout:
-            dt = time.time() - timestamp
-            if dt >= self._taskTimeout:
-                # download request timed out
-                download = False
-
-        if not download and not overwrite:
-            # check if the tile has been already downloaded
-            download = not self._storeTiles.tile_is_stored(lzxy)
-
-        if download:
-            # download tile
-            try:
-                self._downloadTile(lzxy)
-                error = constants.TILE_DOWNLOAD_SUCCESS
-            except urllib3.exceptions.HTTPError:
-                # server returned a HTTP error, this means we got
-                # to the server but it didn't like us for some reason,
-                error = self._fatalDownloadError(lzxy)
-            except URLError:
-                # this is most probably caused by a loss of network connectivity
-                error = self._temporaryDownloadError(lzxy)
-
-            # something other is wrong (most probably a corrupt tile)
-            except Exception:
-                import sys
-                e = sys.exc_info()[1]
-                self._printErrorMessage(e, lzxy)
-                # remove the status tile
+                # don't download tile and remove
+                # any "downloading" tiles that might
+                # be in the image cache
                 self._mapTiles.removeImageFromMemory(lzxy)
-                error = constants.TILE_DOWNLOAD_ERROR
-            finally:
-                # done, unregister the tile from the tracking set
-                with self._runningLock:
-                    try:
-                        self._running.remove((lzxy, tag))
-                    except KeyError:
-                        pass
-                        # TODO: find why this happens (well, it appears to be harmless)
-                        #       and maybe forward it to debug log once we have one ?
-                        #print("auto tile dl pool: warning, tuple already removed from tracking!")
-                        #print(lzxy)
-                # report that tha tile has or has not bee successfully downloaded
-                self._tileDownloaded(error, lzxy, tag)
-        else:
-            # don't download tile and remove
-            # any "downloading" tiles that might
-            # be in the image cache
+        # something other is wrong (most probably a corrupt tile)
+        except Exception:
+            import sys
+            e = sys.exc_info()[1]
+            self._printErrorMessage(e, lzxy)
+            # remove the status tile
             self._mapTiles.removeImageFromMemory(lzxy)
-            # report the tile as not been downloaded
-            self._tileDownloaded(error, lzxy, tag)
+            error = constants.TILE_DOWNLOAD_ERROR
+        finally:
+            # done, report to all requests waiting for the tile
+            # that it has or has not been successfully downloaded
+            self._downloadFinished(error, lzxy)
 
 
     def _downloadTile(self, lzxy):
-            """Downloads a tile image image from network"""
+            """Downloads a tile image image from network
+
+            :returns: tile data
+            """
             self._downloadInProgress(lzxy)
             content = self._mapTiles._downloadTile(lzxy)
             if content is None:
@@ -157,27 +189,44 @@ class Downloader(object):
             # cache the raw data
             self._mapTiles.storeInMemory(content, lzxy)
             self._storeTiles.store_tile_data(lzxy, content)
+            return content
 
     def _downloadInProgress(self, lzxy):
         if self._imageSurface:
             # change the status tile to "Downloading..."
             self._mapTiles.storeInMemory(self._mapTiles.downloadingTile[0], lzxy, imageType="downloading")
 
-    def _temporaryDownloadError(self, lzxy):
+    def _scheduleRetry(self, lzxy, tags, fatal):
+        """Schedule a retry of a failed download
+
+        :param list tags: tags of the requests waiting for the tile
+        :returns: timestamp of the retry or None if the tile will not be retried
+        """
+        # prefetched & revalidated tiles are not retried, they will be
+        # predicted or found to be expired again if still needed
+        tags = [tag for tag in tags if tag not in BACKGROUND_TAGS]
+        if self._retryScheduler and tags:
+            # the retry is reported to the most recent request
+            return self._retryScheduler.downloadFailed(lzxy, tags[-1], fatal=fatal)
+        else:
+            return None
+
+    def _temporaryDownloadError(self, lzxy, tags):
+        # as not to DOS the system when we temporarily loose internet connection or other such error
+        # occurs, the download is retried later with exponential backoff
+        expireTimestamp = self._scheduleRetry(lzxy, tags, fatal=False)
         if self._imageSurface:
+            # a temporary error tile is shown in place of the tile image until the retry
             tileNetworkErrorSurface = self._mapTiles.images[1]['tileNetworkError'][0]
-            expireTimestamp = time.time() + 10
             self._mapTiles.storeInMemory(tileNetworkErrorSurface, lzxy, 'error',
-                                         expireTimestamp) # retry after 10 seconds
-            # as not to DOS the system when we temporarily loose internet connection or other such error
-            # occurs, we load a temporary error tile with expiration timestamp instead of the tile image
-            # TODO: actually remove tiles according to expiration timestamp :)
+                                         expireTimestamp)
         return constants.TILE_DOWNLOAD_TEMPORARY_ERROR
 
-    def _fatalDownloadError(self, lzxy):
+    def _fatalDownloadError(self, lzxy, tags):
+        # the server did not like us, so wait longer before trying again
+        expireTimestamp = self._scheduleRetry(lzxy, tags, fatal=True)
         if self._imageSurface:
             tileDownloadFailedSurface = self._mapTiles.images[1]['tileDownloadFailed'][0]
-            expireTimestamp = time.time() + 10
             self._mapTiles.storeInMemory(tileDownloadFailedSurface, lzxy, 'semiPermanentError',
                                          expireTimestamp)
             # like this, when tile download fails due to a http error,
@@ -185,8 +234,9 @@ class Downloader(object):
             # like this:
             #  - modRana does not immediately try to download a tile that errors out
             #  - the error tile is shown without modifying the pipeline too much
-            #  - modRana will eventually try to download the tile again,
-            #    after it is flushed with old tiles from the memory
+            #  - modRana will try to download the tile again once the error tile expires,
+            #    or once it is flushed with old tiles from the memory if
+            #    the tile is no longer retried
         return constants.TILE_DOWNLOAD_ERROR
 
     def _printErrorMessage(self, e, lzxy):
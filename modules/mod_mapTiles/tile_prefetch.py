@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Motion-predictive tile prefetching
+#
+# When moving fast (eg. when driving in follow-position mode) tiles are
+# requested by the GUI only once they scroll into view, so they often
+# arrive too late and blank tiles are shown for a while.
+# To prevent that, the viewport is projected some time ahead along the
+# current bearing and with the current speed and the tiles that will come
+# into view are loaded in advance:
+# * the lookahead time is constant, so the lookahead distance grows with speed
+# * the distance is converted to tiles of the current zoom level, so it
+#   grows with zoom as well, within limits
+# * tiles are returned in the order they are expected to come into view
+from math import sin, cos, radians, floor, ceil, hypot
+
+from core import tilenames
+
+# tag used for prefetch requests, tiles loaded for prefetch are not reported to listeners
+PREFETCH_TAG = "prefetch"
+# how far ahead to project the viewport
+PREFETCH_LOOKAHEAD = 10  # in seconds
+# don't prefetch when moving slower than this
+PREFETCH_MIN_SPEED = 3  # in m/s, ~11 km/h
+# project the viewport at least this many tiles ahead, so that the tiles
+# just beyond the viewport edge are loaded even at low zoom levels
+PREFETCH_MIN_DISTANCE = 1  # in tiles
+# project the viewport at most this many tiles ahead
+PREFETCH_MAX_DISTANCE = 8  # in tiles
+# prefetch at most this many tiles per position update
+PREFETCH_MAX_TILES = 48
+# don't prefetch a tile again for this long
+PREFETCH_REPEAT_TIMEOUT = 60  # in seconds
+# prefetch only for layers that have been requested by the GUI this recently
+PREFETCH_LAYER_TIMEOUT = 30  # in seconds
+# the viewport is projected ahead in steps of this size
+PREFETCH_STEP = 0.5  # in tiles
+
+EARTH_CIRCUMFERENCE = 40075016.686  # in meters, at the equator
+
+def _getViewportTiles(cx, cy, halfWidth, halfHeight):
+    """Return tiles covered by a viewport centered on the given fractional tile coordinates"""
+    for x in range(int(floor(cx - halfWidth)), int(floor(cx + halfWidth)) + 1):
+        for y in range(int(floor(cy - halfHeight)), int(floor(cy + halfHeight)) + 1):
+            yield x, y
+
+def getPredictedTiles(lat, lon, bearing, speed, z, viewportSize,
+                      lookahead=PREFETCH_LOOKAHEAD, maxDistance=PREFETCH_MAX_DISTANCE,
+                      maxTiles=PREFETCH_MAX_TILES):
+    """Return tiles that will come into view when moving on with the given speed and bearing
+
+    :param float lat: current latitude
+    :param float lon: current longitude
+    :param float bearing: direction of motion in degrees, clockwise from north
+    :param float speed: speed in m/s
+    :param int z: zoom level
+    :param tuple viewportSize: viewport (width, height) in tiles
+    :param float lookahead: how far ahead to project the viewport in seconds
+    :param float maxDistance: how far ahead to project the viewport at most in tiles
+    :param int maxTiles: maximum number of tiles to return
+    :returns: list of (x, y) tuples in the order the tiles are expected to come into view,
+              tiles in the current viewport are not included
+    :rtype: list
+    """
+    tileCount = 2 ** z
+    x, y = tilenames.ll2xy(lat, lon, z)
+    metersPerTile = EARTH_CIRCUMFERENCE * cos(radians(lat)) / tileCount
+    if metersPerTile <= 0 or speed <= 0:
+        return []
+    distance = min(max(speed * lookahead / metersPerTile, PREFETCH_MIN_DISTANCE), maxDistance)
+    # tile y coordinates grow southwards
+    dx = sin(radians(bearing))
+    dy = -cos(radians(bearing))
+    halfWidth = viewportSize[0] / 2.0
+    halfHeight = viewportSize[1] / 2.0
+
+    seen = set(_getViewportTiles(x, y, halfWidth, halfHeight))
+    predictedTiles = []
+    stepCount = int(ceil(distance / PREFETCH_STEP))
+    for step in range(1, stepCount + 1):
+        stepDistance = distance * step / stepCount
+        cx = x + dx * stepDistance
+        cy = y + dy * stepDistance
+        newTiles = []
+        for tile in _getViewportTiles(cx, cy, halfWidth, halfHeight):
+            if tile not in seen and 0 <= tile[0] < tileCount and 0 <= tile[1] < tileCount:
+                seen.add(tile)
+                newTiles.append(tile)
+        # tiles closer to the projected viewport center are needed sooner
+        newTiles.sort(key=lambda t: hypot(t[0] + 0.5 - cx, t[1] + 0.5 - cy))
+        predictedTiles.extend(newTiles)
+        if len(predictedTiles) >= maxTiles:
+            break
+    return predictedTiles[:maxTiles]
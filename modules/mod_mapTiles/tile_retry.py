@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Retry scheduling for failed tile downloads
+#
+# Tiles that fail to download are retried automatically with exponential backoff:
+# * each failed tile gets a retry time, retry times are kept in a min-heap
+#   so that the tile loading manager can cheaply find out when the next
+#   retry is due and wait for it
+# * the backoff grows with the number of failures of the tile, but also with
+#   the number of failures of the whole layer, so that when a tile server is down
+#   or the network is gone tiles of the layer back off together instead of
+#   each tile hammering the server on its own
+# * requests for tiles that are backing off don't reach the network,
+#   the scheduled retry reports the result once it is done
+# * a successful download resets the backoff of both the tile and its layer
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import logging
+log = logging.getLogger("mod.mapTiles.tile_retry")
+
+# delay before the first retry after a temporary (network) error
+RETRY_BASE_DELAY = 10  # in seconds
+# delay before the first retry after a fatal (HTTP) error
+RETRY_FATAL_BASE_DELAY = 60  # in seconds
+# the delay doubles with every failure up to this limit
+RETRY_MAX_DELAY = 30 * 60  # in seconds
+# give up retrying a tile after this many failures in a row,
+# the tile is downloaded again only once it is requested again
+RETRY_MAX_ATTEMPTS = 8
+# retry delays are spread by up to this fraction, so that tiles
+# that failed together are not all retried at exactly the same time
+RETRY_JITTER = 0.1
+# at most this many tiles can wait for a retry
+MAX_SCHEDULED_RETRIES = 1000
+
+
+def getBackoffDelay(failureCount, baseDelay, maxDelay=RETRY_MAX_DELAY):
+    """Return the delay before the next retry after the given number of failures
+
+    :param int failureCount: number of failures in a row, at least 1
+    :param float baseDelay: delay after the first failure in seconds
+    :param float maxDelay: upper limit for the delay in seconds
+    :returns: delay in seconds
+    :rtype: float
+    """
+    # limit the exponent, as there is no point in computing huge powers of two
+    return min(baseDelay * 2 ** min(failureCount - 1, 32), maxDelay)
+
+
+class TileRetryScheduler(object):
+    """Schedule retries of failed tile downloads
+
+    :param wakeupCallback: called once a retry becomes the earliest scheduled one,
+                           so that a thread waiting for retries can wait for less time
+    """
+
+    def __init__(self, wakeupCallback=None, baseDelay=RETRY_BASE_DELAY,
+                 fatalBaseDelay=RETRY_FATAL_BASE_DELAY, maxDelay=RETRY_MAX_DELAY,
+                 maxAttempts=RETRY_MAX_ATTEMPTS, maxScheduledRetries=MAX_SCHEDULED_RETRIES):
+        self._wakeupCallback = wakeupCallback
+        self._baseDelay = baseDelay
+        self._fatalBaseDelay = fatalBaseDelay
+        self._maxDelay = maxDelay
+        self._maxAttempts = maxAttempts
+        self._maxScheduledRetries = maxScheduledRetries
+        # (retry timestamp, sequence number, lzxy) min-heap, entries superseded
+        # by a later failure or a successful download are skipped once popped
+        self._heap = []
+        self._sequence = itertools.count()
+        # lzxy -> [retry timestamp, failure count, tag]
+        self._retries = {}
+        # layer -> [failure count, timestamp until which the layer is backing off]
+        self._layerBackoff = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._retries)
+
+    def downloadFailed(self, lzxy, tag=None, fatal=False):
+        """Schedule a retry of a failed tile download
+
+        :param tuple lzxy: the tile that failed to download
+        :param tag: tracking tag of the download request
+        :param bool fatal: the server refused the tile (HTTP error), as opposed to a network error
+        :returns: timestamp of the retry or None if the tile will not be retried
+        :rtype: float or None
+        """
+        now = time.time()
+        baseDelay = self._fatalBaseDelay if fatal else self._baseDelay
+        wakeup = False
+        with self._lock:
+            layer = lzxy[0]
+            # tiles of a layer often fail together (when the server or the network is down),
+            # so only failures once the layer backoff is over increase the layer backoff
+            layerBackoff = self._layerBackoff.get(layer)
+            if layerBackoff is None:
+                layerBackoff = [0, 0]
+                self._layerBackoff[layer] = layerBackoff
+            if now >= layerBackoff[1]:
+                layerBackoff[0] += 1
+                layerBackoff[1] = now + getBackoffDelay(layerBackoff[0], self._baseDelay, self._maxDelay)
+
+            retry = self._retries.get(lzxy)
+            failureCount = retry[1] + 1 if retry else 1
+            if failureCount > self._maxAttempts:
+                log.debug("giving up on %s after %d failed downloads", lzxy, failureCount)
+                del self._retries[lzxy]
+                return None
+            if retry is None and len(self._retries) >= self._maxScheduledRetries:
+                # drop tiles whose retry is already over (and was not reported
+                # as successful, eg. because the tile was not downloaded at all)
+                for overLzxy in [k for k, v in self._retries.items() if v[0] <= now]:
+                    del self._retries[overLzxy]
+            if retry is None and len(self._retries) >= self._maxScheduledRetries:
+                log.debug("too many tiles waiting for a retry, not retrying %s", lzxy)
+                return None
+            delay = getBackoffDelay(failureCount, baseDelay, self._maxDelay)
+            delay *= 1 + random.uniform(0, RETRY_JITTER)
+            retryTimestamp = max(now + delay, layerBackoff[1])
+            self._retries[lzxy] = [retryTimestamp, failureCount, tag]
+            wakeup = not self._heap or retryTimestamp < self._heap[0][0]
+            heapq.heappush(self._heap, (retryTimestamp, next(self._sequence), lzxy))
+        if wakeup and self._wakeupCallback:
+            self._wakeupCallback()
+        return retryTimestamp
+
+    def downloadSucceeded(self, lzxy):
+        """Reset the backoff of the tile and its layer after a successful download"""
+        with self._lock:
+            self._retries.pop(lzxy, None)
+            self._layerBackoff.pop(lzxy[0], None)
+
+    def cancelRetry(self, lzxy):
+        """Don't retry the tile, eg. because it has been found in tile storage"""
+        with self._lock:
+            self._retries.pop(lzxy, None)
+
+    def isBackingOff(self, lzxy, tag=None):
+        """Report if the tile is waiting for a retry
+
+        The tag of the scheduled retry is replaced with the given tag (if any),
+        so that the retry is reported to the most recent requester.
+
+        :returns: True if the tile should not be downloaded before the retry, else False
+        :rtype: bool
+        """
+        with self._lock:
+            retry = self._retries.get(lzxy)
+            if retry is None or retry[0] <= time.time():
+                return False
+            if tag is not None:
+                retry[2] = tag
+            return True
+
+    def getTimeToNextRetry(self):
+        """Return seconds until the earliest retry is due or None if no retries are scheduled"""
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(self._heap[0][0] - time.time(), 0)
+
+    def popDueRetries(self):
+        """Return tiles whose retry is due
+
+        The failure count of the tiles is kept until they are successfully downloaded,
+        so that failing retries back off more.
+
+        :returns: list of (lzxy, tag) tuples
+        :rtype: list
+        """
+        dueRetries = []
+        now = time.time()
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                retryTimestamp, _sequenceNumber, lzxy = heapq.heappop(self._heap)
+                retry = self._retries.get(lzxy)
+                if retry is None or retry[0] != retryTimestamp:
+                    # superseded heap entry
+                    continue
+                dueRetries.append((lzxy, retry[2]))
+        return dueRetries
+
+    def clear(self):
+        with self._lock:
+            self._heap = []
+            self._retries.clear()
+            self._layerBackoff.clear()
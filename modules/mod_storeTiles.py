@@ -33,14 +33,20 @@ except Exception:
 import os
 import time
 from collections import defaultdict
-from threading import RLock
+from types import MappingProxyType
+from threading import Lock, RLock, Event
 
 from collections import OrderedDict
 
 from core import constants
 from core import utils
+from core import threads
 from core.tile_storage.files_store import FileBasedTileStore
 from core.tile_storage.sqlite_store import SqliteTileStore
+from core.tile_storage.pack_store import PackFileTileStore
+from core.tile_storage.mbtiles_store import MBTilesTileStore, export_to_mbtiles, import_from_mbtiles
+from core.tile_storage.presence_index import TilePresenceIndex
+from core.tile_storage.store_routing import StoreRoutingCache
 
 def getModule(*args, **kwargs):
     return StoreTiles(*args, **kwargs)
@@ -71,10 +77,56 @@ class StoreTiles(RanaModule):
         # - we have a watch on the store type key, so this variable will
         #   be automatically updated if store type changes at runtime
         self._primary_tile_storage_type = constants.DEFAULT_TILE_STORAGE_TYPE
-        self._stores = FlexibleDefaultDict(factory=self._get_existing_stores_for_layer)
+        # layer -> read only ordered mapping of store type -> store
+        # - tile reads & writes don't take the management lock, they just use
+        #   the current snapshot of the layer stores
+        # - the snapshot is never modified, any change (a store being added or reordered)
+        #   publishes a new one under the management lock, so only store
+        #   creation and teardown are serialized
+        # - existing stores of a layer are looked for & opened the first time the layer
+        #   is used with just a per layer lock held, so that opening stores of one layer
+        #   does not hold up the first use of other layers
+        self._stores = {}
+        self._layer_locks = {}
+        # guards publishing of the snapshots & creation of the per layer locks,
+        # it is only held briefly and no other lock is taken while holding it
+        self._stores_lock = Lock()
 
         self._prevent_media_indexing = self.dmod.device_id == "android"
 
+        # per layer tile presence indexes make it possible to find out that
+        # a tile is not stored without querying the tile stores
+        self._presence_indexes = FlexibleDefaultDict(factory=self._get_presence_index_for_layer)
+        self._use_presence_index = False
+        self.modrana.watch('tilePresenceIndex', self._presence_index_changed_cb, runNow=True)
+
+        # for layers with more than one store the per layer store routing caches
+        # remember which store has tiles from a region & which stores recently
+        # did not have a tile, so that not all the stores are probed for every tile
+        self._store_routing = FlexibleDefaultDict(factory=lambda layer: StoreRoutingCache())
+
+        # Tile storage quotas (global and per layer, in MiB) are enforced by a background
+        # thread that evicts least recently used tiles once a quota is exceeded.
+        self._quota_manager_thread = None
+        self._quota_check_event = Event()
+        self._quota_manager_shutdown = False
+
+        # SQLite tile stores can be compacted by a background thread
+        self._compaction_thread = None
+        self._compaction_shutdown = False
+
+        # Tile stores can be checked for damaged tiles (and repaired) by a background thread,
+        # the last integrity report is kept for each layer and store type.
+        self._integrity_check_thread = None
+        self._integrity_check_shutdown = False
+        self._integrity_reports = {}
+
+        # Tiles older than the layer timeout can be periodically deleted or
+        # downloaded again by a background sweeper thread.
+        self._sweeper_thread = None
+        self._sweep_event = Event()
+        self._sweeper_shutdown = False
+
         # the tile loading debug log function is no-op by default, but can be
         # redirected to the normal debug log by setting the "tileLoadingDebug"
         # key to True
@@ -84,6 +136,14 @@ class StoreTiles(RanaModule):
         # device modules are loaded and initialized and configs are parsed before "normal"
         # modRana modules are initialized, so we can cache the map folder path in init
 
+    def firstTime(self):
+        # the quota manager needs the map layers module, so start it only
+        # once all modules are loaded
+        self.modrana.watch('tileStorageQuota', self._quota_changed_cb, runNow=True)
+        self.modrana.watch('tileStorageLayerQuota', self._quota_changed_cb, runNow=True)
+        # the sweeper needs the map layers & map tiles modules
+        self.modrana.watch('tileStorageExpiredTiles', self._expired_tiles_mode_changed_cb, runNow=True)
+
     def _get_existing_stores_for_layer(self, layer):
         """Check for any existing stores for the given layer in persistent storage
            and return a dictionary with the found stores under file storage type keys.
@@ -98,14 +158,24 @@ class StoreTiles(RanaModule):
             # we need to prevent tiles from being indexed to the gallery
             # - this basically dumps a .nomedia file to the root of the
             #   file based tile store folder
-            store_tuple = (constants.TILE_STORAGE_FILES, FileBasedTileStore(
-                layer_folder_path, prevent_media_indexing=self._prevent_media_indexing
-            ))
+            store_tuple = (constants.TILE_STORAGE_FILES, self._get_files_store(layer_folder_path))
             store_tuples.append(store_tuple)
         # check if the path contains a sqlite tile store
         if SqliteTileStore.is_store(layer_folder_path):
             self._llog("sqlite tile store has been found for layer %s" % layer)
-            store_tuple = (constants.TILE_STORAGE_SQLITE, SqliteTileStore(layer_folder_path))
+            store_tuple = (constants.TILE_STORAGE_SQLITE, self._get_sqlite_store(layer_folder_path))
+            store_tuples.append(store_tuple)
+        # check if the path contains a pack file tile store
+        if PackFileTileStore.is_store(layer_folder_path):
+            self._llog("pack file tile store has been found for layer %s" % layer)
+            store_tuple = (constants.TILE_STORAGE_PACK, PackFileTileStore(
+                layer_folder_path, prevent_media_indexing=self._prevent_media_indexing
+            ))
+            store_tuples.append(store_tuple)
+        # check if the path contains any MBTiles tile packs
+        if MBTilesTileStore.is_store(layer_folder_path):
+            self._llog("MBTiles tile store has been found for layer %s" % layer)
+            store_tuple = (constants.TILE_STORAGE_MBTILES, MBTilesTileStore(layer_folder_path))
             store_tuples.append(store_tuple)
 
         self._llog("%d existing stores have been found for layer %s" % (len(store_tuples), layer), start)
@@ -113,34 +183,187 @@ class StoreTiles(RanaModule):
         store_tuples.sort(key=self._sort_store_tuples)
         return OrderedDict(store_tuples)
 
+    def _get_files_store(self, store_path):
+        """Return a file based tile store for the given path configured according to current settings"""
+        # in durable mode tile files are synced to permanent storage before being renamed in place,
+        # with syncs of many tiles coalesced so that batch downloads don't wait for every tile
+        durable = bool(self.get('filesTileStorageDurable', False))
+        return FileBasedTileStore(store_path,
+                                  prevent_media_indexing=self._prevent_media_indexing,
+                                  durable=durable)
+
+    def _get_sqlite_store(self, store_path):
+        """Return a sqlite tile store for the given path configured according to current settings"""
+        # in write-behind mode tiles are written to the database in batches
+        # by a writer thread instead of committing every tile separately
+        write_behind = bool(self.get('sqliteTileStorageWriteBehind', False))
+        # in WAL mode tile reads (map rendering) don't need to wait for
+        # tile writes (batch download) to finish
+        wal_mode = bool(self.get('sqliteTileStorageWAL', False))
+        # with attached stores tile data is read with a single query
+        # instead of querying lookup & storage databases separately
+        attach_stores = bool(self.get('sqliteTileStorageAttachStores', False))
+        # with deduplication byte identical tiles (sea, empty land, etc.) are stored only once
+        deduplicate = bool(self.get('sqliteTileStorageDeduplicate', False))
+        return SqliteTileStore(store_path,
+                               write_behind=write_behind,
+                               commit_interval=constants.DEFAULT_SQLITE_TILE_DATABASE_COMMIT_INTERVAL,
+                               wal_mode=wal_mode,
+                               attach_stores=attach_stores,
+                               deduplicate=deduplicate)
+
+    def _get_presence_index_for_layer(self, layer):
+        """Return a tile presence index for the given layer"""
+        persistence_folder = None
+        if self.get('tilePresenceIndexPersist', False):
+            persistence_folder = os.path.join(self.modrana.paths.map_folder_path, layer.folder_name)
+        return TilePresenceIndex(stores_getter=lambda: self._get_stores_for_reading(layer),
+                                 persistence_folder=persistence_folder)
+
+    def _presence_index_changed_cb(self, key, oldValue, newValue):
+        with self._tile_storage_management_lock:
+            self._use_presence_index = bool(newValue)
+            if not self._use_presence_index:
+                self._presence_indexes.clear()
+
+    def _tile_might_be_stored(self, lzxy):
+        """Check the tile presence index of the corresponding layer (if enabled)
+
+        :returns: False if the tile is definitely not stored, else True
+        :rtype: bool
+        """
+        if not self._use_presence_index:
+            return True
+        return self._get_presence_index(lzxy[0]).might_be_stored(lzxy[1], lzxy[2], lzxy[3])
+
+    def _get_presence_index(self, layer):
+        """Return the tile presence index for the given layer, creating it if needed"""
+        presence_index = self._presence_indexes.get(layer)
+        if presence_index is None:
+            with self._tile_storage_management_lock:
+                presence_index = self._presence_indexes[layer]
+        return presence_index
+
+    def invalidate_presence_index(self, layer):
+        """Drop the tile presence index for the given layer
+
+        Needs to be called if tiles are added to the layer stores
+        by other means than by calling store_tile_data().
+        """
+        presence_index = self._presence_indexes.get(layer)
+        if presence_index is not None:
+            presence_index.invalidate()
+
+    def invalidate_store_routing(self, layer):
+        """Drop the store routing information for the given layer
+
+        Needs to be called if tiles are added to the layer stores
+        by other means than by calling store_tile_data().
+        """
+        store_routing = self._store_routing.get(layer)
+        if store_routing is not None:
+            store_routing.invalidate()
+
+    def _get_store_routing(self, layer, store_items):
+        """Return the store routing cache for the given layer or None if the layer has just a single store"""
+        if len(store_items) < 2:
+            return None
+        store_routing = self._store_routing.get(layer)
+        if store_routing is None:
+            with self._tile_storage_management_lock:
+                store_routing = self._store_routing[layer]
+        return store_routing
+
+    def _get_routed_stores_for_reading(self, lzxy):
+        """Get stores to probe for the given tile, in order
+
+        :returns: list of (store type, store) tuples & the store routing cache for
+                  the tile layer (None if the layer has just a single store)
+        :rtype: tuple
+        """
+        layer = lzxy[0]
+        store_items = list(self._get_layer_stores(layer).items())
+        store_routing = self._get_store_routing(layer, store_items)
+        if store_routing is not None:
+            store_items = store_routing.route(lzxy, store_items)
+        return store_items, store_routing
+
+    def _get_layer_stores(self, layer):
+        """Get the current snapshot of stores for the given layer
+
+        Existing stores are looked for (with the lock of the layer held)
+        only the first time the layer is used.
+
+        :returns: read only ordered mapping of store type -> store
+        """
+        layer_stores = self._stores.get(layer)
+        if layer_stores is None:
+            with self._get_layer_lock(layer):
+                layer_stores = self._stores.get(layer)
+                if layer_stores is None:
+                    layer_stores = self._publish_layer_stores(
+                        layer, self._get_existing_stores_for_layer(layer).items()
+                    )
+        return layer_stores
+
+    def _get_layer_lock(self, layer):
+        """Return the lock held while existing stores of the given layer are looked for"""
+        with self._stores_lock:
+            return self._layer_locks.setdefault(layer, Lock())
+
+    def _publish_layer_stores(self, layer, store_tuples):
+        """Publish a new snapshot of stores for the given layer
+
+        The stores are ordered according to the current primary tile storage type.
+        NOTE: changes of already published stores need to be made with the management lock held
+
+        :returns: the new snapshot
+        """
+        with self._stores_lock:
+            store_tuples = sorted(store_tuples, key=self._sort_store_tuples)
+            layer_stores = MappingProxyType(OrderedDict(store_tuples))
+            # copy on write, so that the layer -> stores mapping can be
+            # used & iterated over without locking
+            stores = dict(self._stores)
+            stores[layer] = layer_stores
+            self._stores = stores
+        return layer_stores
+
     def _get_stores_for_reading(self, layer):
         """Get an iterable of stores for the given layer
            - store corresponding to primary storage type is always first (if any)
            - there might not by any stores (eq. no tiles) for the given layer
         """
-        with self._tile_storage_management_lock:
-            return self._stores[layer].values()
+        return self._get_layer_stores(layer).values()
 
     def _get_store_for_writing(self, layer):
         """Get a store for writing tiles corresponding to the given layer
            and current primary tile storage type.
         """
+        store = self._get_layer_stores(layer).get(self._primary_tile_storage_type)
+        if store is not None:
+            return store
         with self._tile_storage_management_lock:
-            store = self._stores[layer].get(self._primary_tile_storage_type)
+            # the store might have been added while waiting for the lock
+            store = self._get_layer_stores(layer).get(self._primary_tile_storage_type)
             if store is None:
                 start = time.perf_counter()
                 self._llog("store type %s not found for layer %s" % (self._primary_tile_storage_type, layer))
                 layer_folder_path = os.path.join(self.modrana.paths.map_folder_path, layer.folder_name)
                 if self._primary_tile_storage_type == constants.TILE_STORAGE_FILES:
                     store_type = constants.TILE_STORAGE_FILES
-                    store = FileBasedTileStore(
+                    store = self._get_files_store(layer_folder_path)
+                    self._llog("adding file based store for layer %s" % layer)
+                elif self._primary_tile_storage_type == constants.TILE_STORAGE_PACK:
+                    store_type = constants.TILE_STORAGE_PACK
+                    store = PackFileTileStore(
                         layer_folder_path, prevent_media_indexing=self._prevent_media_indexing
                     )
-                    self._llog("adding file based store for layer %s" % layer)
+                    self._llog("adding pack file store for layer %s" % layer)
                 else:  # sqlite tile store
                     store_type = constants.TILE_STORAGE_SQLITE
-                    store = SqliteTileStore(layer_folder_path)
-                    self._llog("adding file based store for layer %s" % layer)
+                    store = self._get_sqlite_store(layer_folder_path)
+                    self._llog("adding sqlite store for layer %s" % layer)
                 # add the store to the stores dict while keeping the primary-storage-type first ordering
                 self._add_store_for_layer(layer, (store_type, store))
                 self._llog("added store type %s for layer %s" % (self._primary_tile_storage_type, layer), start)
@@ -158,18 +381,15 @@ class StoreTiles(RanaModule):
            current primary tile storage type.
         """
         with self._tile_storage_management_lock:
-            store_tuples = list(self._stores[layer].items())
-            store_tuples.sort(key=self._sort_store_tuples)
-            self._stores[layer] = OrderedDict(store_tuples)
+            self._publish_layer_stores(layer, self._get_layer_stores(layer).items())
 
     def _add_store_for_layer(self, layer, store_tuple):
         """Add a store for the given layer while keeping the ordering
            according to the current primary tile storage type."""
         with self._tile_storage_management_lock:
-            store_tuples = list(self._stores[layer].items())
+            store_tuples = list(self._get_layer_stores(layer).items())
             store_tuples.append(store_tuple)
-            store_tuples.sort(key=self._sort_store_tuples)
-            self._stores[layer] = OrderedDict(store_tuples)
+            self._publish_layer_stores(layer, store_tuples)
 
     def _primary_tile_storage_type_changed_cb(self, key, oldValue, newValue):
         start = time.perf_counter()
@@ -183,7 +403,10 @@ class StoreTiles(RanaModule):
             # reorder the ordered dicts storing already initialized tile stores
             # so that the primary tile storage method is first
             self._llog("resorting ordered dicts for the new primary storage type")
-            for layer in self._stores.keys():
+            # layers published from now on are sorted according to the new type already
+            with self._stores_lock:
+                layers = list(self._stores.keys())
+            for layer in layers:
                 self._sort_layer_odict(layer)
             self._llog("ordered dicts resorted", start)
 
@@ -207,12 +430,19 @@ class StoreTiles(RanaModule):
         start = time.perf_counter()
         layer = lzxy[0]
         self._llog("tile requested: %s" % str(lzxy))
-        with self._tile_storage_management_lock:
-            stores = self._get_stores_for_reading(layer)
-            self._llog("tile %s got stores: %s" % (str(lzxy), list(stores)))
+        if not self._tile_might_be_stored(lzxy):
+            self._llog("tile not in presence index: %s" % str(lzxy), start)
+            return None
+        store_items, store_routing = self._get_routed_stores_for_reading(lzxy)
+        self._llog("tile %s got stores: %s" % (str(lzxy), [store for _store_type, store in store_items]))
 
-        for store in stores:
+        for store_type, store in store_items:
             tile_tuple = store.get_tile(lzxy)
+            if store_routing is not None:
+                if tile_tuple is None:
+                    store_routing.record_miss(store_type, lzxy)
+                else:
+                    store_routing.record_hit(store_type, lzxy)
             if tile_tuple is not None:
                 self._llog("tile %s found in %s" % (str(lzxy), store))
                 tile_data, timestamp = tile_tuple
@@ -241,11 +471,18 @@ class StoreTiles(RanaModule):
     def tile_is_stored(self, lzxy):
         start = time.perf_counter()
         self._llog("do we have tile: %s ?" % str(lzxy))
+        if not self._tile_might_be_stored(lzxy):
+            self._llog("tile not in presence index: %s" % str(lzxy), start)
+            return False
         layer = lzxy[0]
-        with self._tile_storage_management_lock:
-            stores = self._get_stores_for_reading(layer)
-        for store in stores:
+        store_items, store_routing = self._get_routed_stores_for_reading(lzxy)
+        for store_type, store in store_items:
             tile_tuple = store.tile_is_stored(lzxy)
+            if store_routing is not None:
+                if tile_tuple is False:
+                    store_routing.record_miss(store_type, lzxy)
+                else:
+                    store_routing.record_hit(store_type, lzxy)
             if tile_tuple is not False:
                 self._llog("we have tile %s in %s" % (str(lzxy), store))
                 _true, timestamp = tile_tuple
@@ -272,16 +509,552 @@ class StoreTiles(RanaModule):
         self._llog("we have not found tile: %s" % str(lzxy), start)
         return False
 
+    def _tile_timed_out(self, layer, timestamp):
+        """Report if a tile with the given timestamp is too old for the given layer
+
+        :param layer: layer the tile belongs to
+        :param timestamp: tile timestamp
+        :returns: True if the tile is too old, False otherwise
+        :rtype: bool
+        """
+        if layer.timeout is None:  # the tile is always fresh
+            return False
+        # layer.timeout is in hours, convert to seconds
+        return timestamp < time.time() - layer.timeout*60*60
+
+    def get_tiles_data(self, lzxys):
+        """Get data for multiple tiles at once
+
+        Each store is asked only for tiles not found in the previous stores,
+        using a single bulk request.
+
+        :param list lzxys: list of lzxy tuples
+        :returns: dictionary with tile data or None (for tiles that have not been found
+                  or have timed out) under lzxy keys
+        :rtype: dict
+        """
+        start = time.perf_counter()
+        results = dict.fromkeys(lzxys)
+        remaining = [lzxy for lzxy in results.keys() if self._tile_might_be_stored(lzxy)]
+        self._llog("%d tiles requested" % len(remaining))
+        # group tiles by layer as every layer has its own stores
+        layer_tiles = OrderedDict()
+        for lzxy in remaining:
+            layer_tiles.setdefault(lzxy[0], []).append(lzxy)
+        for layer, layer_lzxys in layer_tiles.items():
+            store_items = list(self._get_layer_stores(layer).items())
+            store_routing = self._get_store_routing(layer, store_items)
+            for store_type, store in store_items:
+                if not layer_lzxys:
+                    break
+                not_found = []
+                if store_routing is not None:
+                    # tiles known to be missing from this store are looked for in the next store
+                    layer_lzxys, not_found = store_routing.split_known_misses(store_type, layer_lzxys)
+                    if not layer_lzxys:
+                        layer_lzxys = not_found
+                        continue
+                for lzxy, tile_tuple in store.get_tiles(layer_lzxys).items():
+                    if tile_tuple is None:
+                        not_found.append(lzxy)
+                        if store_routing is not None:
+                            store_routing.record_miss(store_type, lzxy)
+                    else:
+                        if store_routing is not None:
+                            store_routing.record_hit(store_type, lzxy)
+                        tile_data, timestamp = tile_tuple
+                        if self._tile_timed_out(layer, timestamp):
+                            self.log.debug("not loading timed-out tile: %s" % str(lzxy))
+                        else:
+                            results[lzxy] = tile_data
+                layer_lzxys = not_found
+        self._llog("%d tiles requested in bulk" % len(results), start)
+        return results
+
+    def tiles_are_stored(self, lzxys):
+        """Report if multiple tiles are stored at once
+
+        :param list lzxys: list of lzxy tuples
+        :returns: dictionary with True for stored tiles and False for tiles that
+                  are not stored or have timed out under lzxy keys
+        :rtype: dict
+        """
+        start = time.perf_counter()
+        results = dict.fromkeys(lzxys, False)
+        layer_tiles = OrderedDict()
+        for lzxy in results.keys():
+            if self._tile_might_be_stored(lzxy):
+                layer_tiles.setdefault(lzxy[0], []).append(lzxy)
+        for layer, layer_lzxys in layer_tiles.items():
+            store_items = list(self._get_layer_stores(layer).items())
+            store_routing = self._get_store_routing(layer, store_items)
+            for store_type, store in store_items:
+                if not layer_lzxys:
+                    break
+                not_found = []
+                if store_routing is not None:
+                    # tiles known to be missing from this store are looked for in the next store
+                    layer_lzxys, not_found = store_routing.split_known_misses(store_type, layer_lzxys)
+                    if not layer_lzxys:
+                        layer_lzxys = not_found
+                        continue
+                for lzxy, tile_tuple in store.tiles_are_stored(layer_lzxys).items():
+                    if tile_tuple is False:
+                        not_found.append(lzxy)
+                        if store_routing is not None:
+                            store_routing.record_miss(store_type, lzxy)
+                    else:
+                        if store_routing is not None:
+                            store_routing.record_hit(store_type, lzxy)
+                        results[lzxy] = not self._tile_timed_out(layer, tile_tuple[1])
+                layer_lzxys = not_found
+        self._llog("%d tiles checked in bulk" % len(results), start)
+        return results
+
     def store_tile_data(self, lzxy, tile_data):
         start = time.perf_counter()
         self._llog("store tile data for: %s" % str(lzxy))
         store = self._get_store_for_writing(lzxy[0])
         self._llog("store tile data for: %s into %s" % (str(lzxy), store))
         store.store_tile_data(lzxy, tile_data)
+        store_routing = self._store_routing.get(lzxy[0])
+        if store_routing is not None:
+            store_routing.record_write(self._primary_tile_storage_type, lzxy)
+        if self._use_presence_index:
+            # the tile needs to be added to the index only once it is stored,
+            # so that an index being built in the meantime does not miss it
+            self._get_presence_index(lzxy[0]).add(lzxy[1], lzxy[2], lzxy[3])
         self._llog("stored tile data for: %s" % str(lzxy), start)
 
+    def _get_quotas(self):
+        """Return the global and per layer tile storage quotas in bytes
+
+        :returns: (global quota, layer quota) tuple, None means no quota
+        """
+        quotas = []
+        for key in ('tileStorageQuota', 'tileStorageLayerQuota'):
+            quota = self.get(key, 0)
+            quotas.append(int(float(quota) * 2**20) if quota else None)
+        return tuple(quotas)
+
+    def _quota_changed_cb(self, key, oldValue, newValue):
+        if self._get_quotas() == (None, None):
+            return
+        if self._quota_manager_thread is None:
+            self._quota_manager_thread = threads.ModRanaThread(name=constants.THREAD_TILE_STORAGE_QUOTA_MANAGER,
+                                                               target=self._quota_manager)
+            threads.threadMgr.add(self._quota_manager_thread)
+        # check the new quota right away
+        self._quota_check_event.set()
+
+    def _quota_manager(self):
+        """Periodically check tile storage quotas and evict tiles if they are exceeded
+
+        This method is run by the quota manager thread.
+        """
+        while True:
+            self._quota_check_event.wait(constants.DEFAULT_TILE_STORAGE_QUOTA_CHECK_INTERVAL)
+            self._quota_check_event.clear()
+            if self._quota_manager_shutdown:
+                break
+            try:
+                self._enforce_quotas()
+            except Exception:
+                self.log.exception("tile storage quota enforcement failed")
+        self.log.debug("tile storage quota manager shutting down")
+
+    def _get_layers_with_storage(self):
+        """Return a list of layers that have a folder for their tile stores"""
+        layers = []
+        map_layers = self.m.get('mapLayers', None)
+        if map_layers:
+            for layer in map_layers.getLayerList():
+                layer_folder_path = os.path.join(self.modrana.paths.map_folder_path, layer.folder_name)
+                if os.path.isdir(layer_folder_path):
+                    layers.append(layer)
+        return layers
+
+    def _get_writable_stores(self, layer):
+        """Return stores of the given layer tiles can be deleted from (eq. not read only tile packs)"""
+        return [store for store_type, store in self._get_layer_stores(layer).items()
+                if store_type != constants.TILE_STORAGE_MBTILES]
+
+    def _get_evictable_stores(self, layer):
+        """Return stores of the given layer least recently used tiles can be evicted from
+
+        Pack stores don't support eviction (deleted tiles still take space in the pack files),
+        so they don't count towards the quotas either, as they could never get under quota.
+        """
+        return [store for store_type, store in self._get_layer_stores(layer).items()
+                if store_type not in (constants.TILE_STORAGE_MBTILES, constants.TILE_STORAGE_PACK)]
+
+    def _evict_from_layer(self, layer, layer_stores, size_in_bytes):
+        """Evict least recently used tiles from stores of the given layer
+
+        The amount of data to evict is split between the stores according to their size.
+
+        :param layer: layer to evict tiles from
+        :param list layer_stores: list of (store, used size) tuples
+        :param int size_in_bytes: how much tile data to evict
+        :returns: size of evicted tile data in bytes
+        """
+        layer_size = sum(size for _store, size in layer_stores)
+        evicted_bytes = 0
+        if not layer_size:
+            return evicted_bytes
+        for store, store_size in layer_stores:
+            store_share = int(size_in_bytes * store_size / layer_size) + 1
+            evicted_bytes += store.evict_tiles(store_share,
+                                               should_continue=lambda: not self._quota_manager_shutdown)
+        self.log.info("%s evicted from layer %s", utils.bytes_to_pretty_unit_string(evicted_bytes), layer.label)
+        self.invalidate_presence_index(layer)
+        return evicted_bytes
+
+    def _enforce_quotas(self):
+        """Evict least recently used tiles from layers that are over quota
+
+        Per layer quota is enforced first, then if all layers together are
+        over the global quota, tiles are evicted from all layers proportionally
+        to their size.
+        """
+        global_quota, layer_quota = self._get_quotas()
+        if global_quota is None and layer_quota is None:
+            return
+        start = time.perf_counter()
+        layers = self._get_layers_with_storage()
+        layer_sizes = []
+        total_size = 0
+        for layer in layers:
+            if self._quota_manager_shutdown:
+                return
+            layer_stores = []
+            for store in self._get_evictable_stores(layer):
+                store_size = store.get_used_size()
+                if store_size:
+                    layer_stores.append((store, store_size))
+            layer_size = sum(size for _store, size in layer_stores)
+            if layer_quota is not None and layer_size > layer_quota:
+                self.log.info("layer %s is over quota (%s)", layer.label,
+                              utils.bytes_to_pretty_unit_string(layer_size))
+                evict_bytes = layer_size - int(layer_quota * constants.TILE_STORAGE_QUOTA_EVICTION_TARGET)
+                layer_size -= self._evict_from_layer(layer, layer_stores, evict_bytes)
+                layer_stores = [(store, store.get_used_size() or 0) for store, _size in layer_stores]
+            layer_sizes.append((layer, layer_stores, layer_size))
+            total_size += layer_size
+        if global_quota is not None and total_size > global_quota:
+            self.log.info("tile storage is over quota (%s)", utils.bytes_to_pretty_unit_string(total_size))
+            evict_bytes = total_size - int(global_quota * constants.TILE_STORAGE_QUOTA_EVICTION_TARGET)
+            for layer, layer_stores, layer_size in layer_sizes:
+                if self._quota_manager_shutdown:
+                    return
+                layer_share = int(evict_bytes * layer_size / total_size) + 1
+                self._evict_from_layer(layer, layer_stores, layer_share)
+        self._llog("tile storage quotas checked", start)
+
+    def _expired_tiles_mode_changed_cb(self, key, oldValue, newValue):
+        if (newValue or constants.DEFAULT_TILE_STORAGE_EXPIRED_TILES) == constants.TILE_STORAGE_EXPIRED_KEEP:
+            return
+        if self._sweeper_thread is None:
+            self._sweeper_thread = threads.ModRanaThread(name=constants.THREAD_TILE_STORAGE_SWEEPER,
+                                                         target=self._sweeper)
+            threads.threadMgr.add(self._sweeper_thread)
+        # sweep with the new mode right away
+        self._sweep_event.set()
+
+    def _sweeper(self):
+        """Periodically look for tiles older than the layer timeout and delete or revalidate them
+
+        This method is run by the sweeper thread.
+        """
+        while True:
+            self._sweep_event.wait(constants.DEFAULT_TILE_STORAGE_SWEEP_INTERVAL)
+            self._sweep_event.clear()
+            if self._sweeper_shutdown:
+                break
+            try:
+                self._sweep_expired_tiles()
+            except Exception:
+                self.log.exception("expired tile sweep failed")
+        self.log.debug("tile storage sweeper shutting down")
+
+    def _sweep_expired_tiles(self):
+        """Delete or revalidate stored tiles older than the timeout of their layer
+
+        Stores find the expired tiles in bulk (by an index on the tile timestamp
+        for SQLite stores and by file modification time for file based stores),
+        so that tile freshness does not have to be dealt with only when tiles are read.
+        """
+        mode = self.get('tileStorageExpiredTiles', constants.DEFAULT_TILE_STORAGE_EXPIRED_TILES)
+        if mode not in (constants.TILE_STORAGE_EXPIRED_DELETE, constants.TILE_STORAGE_EXPIRED_REVALIDATE):
+            return
+        start = time.perf_counter()
+        map_tiles = self.m.get('mapTiles', None)
+        for layer in self._get_layers_with_storage():
+            if layer.timeout is None:  # tiles of this layer never expire
+                continue
+            # layer.timeout is in hours, convert to seconds
+            expired_before = int(time.time() - layer.timeout*60*60)
+            for store in self._get_writable_stores(layer):
+                if self._sweeper_shutdown:
+                    return
+                if mode == constants.TILE_STORAGE_EXPIRED_DELETE:
+                    deleted_count = store.delete_expired_tiles(expired_before,
+                                                               should_continue=lambda: not self._sweeper_shutdown)
+                    if deleted_count:
+                        self.log.info("%d expired tiles deleted from %s", deleted_count, store)
+                elif map_tiles is not None and self.get('network', 'full') == 'full':
+                    # the expired tiles are reported as not stored, so they will be downloaded again
+                    expired_tiles = store.get_expired_tiles(expired_before,
+                                                            limit=constants.TILE_STORAGE_REVALIDATION_LIMIT)
+                    for z, x, y in expired_tiles:
+                        map_tiles.addTileDownloadRequest((layer, z, x, y),
+                                                         constants.TILE_STORAGE_REVALIDATION_TAG)
+                    if expired_tiles:
+                        self.log.info("%d expired tiles from %s queued for download", len(expired_tiles), store)
+        self._llog("expired tiles swept", start)
+
+    def compact_tile_storage(self, layers=None):
+        """Compact SQLite tile stores in a background thread
+
+        Free space left after deleted & replaced tiles is released, sparsely used
+        storage databases are consolidated and storage databases left empty are deleted.
+        Progress is reported through status & progress of the compaction thread
+        and compaction pauses while tiles are being read heavily.
+
+        :param list layers: layers to compact, all layers with stored tiles if None
+        :returns: the compaction thread
+        """
+        with self._tile_storage_management_lock:
+            if self._compaction_thread is not None and self._compaction_thread.is_alive():
+                self.log.info("tile storage compaction is already running")
+                return self._compaction_thread
+            if layers is None:
+                layers = self._get_layers_with_storage()
+            self._compaction_thread = threads.ModRanaThread(name=constants.THREAD_TILE_STORAGE_COMPACTION,
+                                                            target=lambda: self._compact_stores(layers))
+            threads.threadMgr.add(self._compaction_thread)
+            return self._compaction_thread
+
+    def _compact_stores(self, layers):
+        """Compact SQLite tile stores of the given layers
+
+        This method is run by the compaction thread.
+        """
+        start = time.perf_counter()
+        thread = self._compaction_thread
+        layer_stores = []
+        for layer in layers:
+            store = self._get_layer_stores(layer).get(constants.TILE_STORAGE_SQLITE)
+            if store is not None:
+                layer_stores.append((layer, store))
+        shrunk_by = 0
+        for index, (layer, store) in enumerate(layer_stores):
+            if self._compaction_shutdown:
+                break
+
+            def progress_cb(message, progress, layer=layer, index=index):
+                thread.status = "%s: %s" % (layer.label, message)
+                thread.progress = (index + progress) / len(layer_stores)
+
+            try:
+                shrunk_by += store.compact(should_continue=lambda: not self._compaction_shutdown,
+                                           progress_callback=progress_cb)
+            except Exception:
+                self.log.exception("compacting tile storage for layer %s failed", layer.label)
+        thread.status = "done"
+        thread.progress = 1.0
+        self.log.info("tile storage compacted, %s released (%s)", utils.bytes_to_pretty_unit_string(shrunk_by),
+                      utils.get_elapsed_time_string(start))
+
+    def check_tile_storage(self, layers=None, repair=False):
+        """Check tile stores for damaged tiles & inconsistencies in a background thread
+
+        Progress is reported through status & progress of the integrity check thread,
+        results can be retrieved with get_integrity_reports() once the check is done.
+
+        :param list layers: layers to check, all layers with stored tiles if None
+        :param bool repair: repair or quarantine damaged tiles & inconsistencies found
+        :returns: the integrity check thread
+        """
+        with self._tile_storage_management_lock:
+            if self._integrity_check_thread is not None and self._integrity_check_thread.is_alive():
+                self.log.info("tile storage integrity check is already running")
+                return self._integrity_check_thread
+            if layers is None:
+                layers = self._get_layers_with_storage()
+            self._integrity_check_thread = threads.ModRanaThread(
+                name=constants.THREAD_TILE_STORAGE_INTEGRITY_CHECK,
+                target=lambda: self._check_stores(layers, repair)
+            )
+            threads.threadMgr.add(self._integrity_check_thread)
+            return self._integrity_check_thread
+
+    def _check_stores(self, layers, repair):
+        """Check integrity of tile stores of the given layers
+
+        This method is run by the integrity check thread.
+        """
+        start = time.perf_counter()
+        thread = self._integrity_check_thread
+        layer_stores = []
+        for layer in layers:
+            store_items = list(self._get_layer_stores(layer).items())
+            layer_stores.extend((layer, store_type, store) for store_type, store in store_items
+                                if store_type != constants.TILE_STORAGE_MBTILES)
+        damaged_tile_count = 0
+        for index, (layer, store_type, store) in enumerate(layer_stores):
+            if self._integrity_check_shutdown:
+                break
+
+            def progress_cb(message, progress, layer=layer, index=index):
+                thread.status = "%s: %s" % (layer.label, message)
+                thread.progress = (index + progress) / len(layer_stores)
+
+            try:
+                report = store.check_integrity(repair=repair,
+                                               should_continue=lambda: not self._integrity_check_shutdown,
+                                               progress_callback=progress_cb)
+            except Exception:
+                self.log.exception("checking tile storage integrity for layer %s failed", layer.label)
+                continue
+            if report is None:  # the store can't be checked
+                continue
+            with self._tile_storage_management_lock:
+                self._integrity_reports.setdefault(layer, {})[store_type] = report
+            damaged_tile_count += report["invalid_tiles"] + report["missing_tiles"] + report["orphaned_tiles"]
+            if report["repaired_tiles"]:
+                # orphaned tiles might have been added back to the store
+                self.invalidate_presence_index(layer)
+                self.invalidate_store_routing(layer)
+        thread.status = "done"
+        thread.progress = 1.0
+        self.log.info("tile storage integrity checked, %d damaged tiles found (%s)",
+                      damaged_tile_count, utils.get_elapsed_time_string(start))
+
+    def get_integrity_reports(self):
+        """Return integrity reports of the last tile storage integrity checks
+
+        :returns: dictionary with integrity reports under store type keys
+                  under layer keys, see core.tile_storage.utils.get_integrity_report()
+        :rtype: dict
+        """
+        with self._tile_storage_management_lock:
+            return {layer: dict(reports) for layer, reports in self._integrity_reports.items()}
+
+    def get_layer_stats(self, layer):
+        """Return storage statistics for all stores of the given layer
+
+        :returns: dictionary with store statistics under store type keys
+        :rtype: dict
+        """
+        store_items = list(self._get_layer_stores(layer).items())
+        return {store_type: store.stats() for store_type, store in store_items}
+
+    def get_layer_zoom_stats(self, layer):
+        """Return statistics of tiles of the given layer stored on each zoom level
+
+        The statistics are maintained by the stores as tiles are stored and deleted,
+        so this is cheap enough to be used by the GUI & batch download planning.
+        Only stores keeping zoom level statistics (SQLite) are included.
+
+        :returns: dictionary with tile count, tile data size in bytes, min/max x & y coordinates
+                  and oldest/newest tile timestamp under zoom level keys,
+                  see BaseTileStore.get_zoom_stats()
+        :rtype: dict
+        """
+        stores = list(self._get_layer_stores(layer).values())
+        layer_zoom_stats = {}
+        for store in stores:
+            store_zoom_stats = store.get_zoom_stats()
+            if not store_zoom_stats:
+                continue
+            for z, stats in store_zoom_stats.items():
+                merged_stats = layer_zoom_stats.get(z)
+                if merged_stats is None:
+                    layer_zoom_stats[z] = dict(stats)
+                    continue
+                merged_stats["tile_count"] += stats["tile_count"]
+                merged_stats["size"] += stats["size"]
+                for key in ("min_x", "min_y", "oldest_timestamp"):
+                    merged_stats[key] = min(merged_stats[key], stats[key])
+                for key in ("max_x", "max_y", "newest_timestamp"):
+                    merged_stats[key] = max(merged_stats[key], stats[key])
+        return layer_zoom_stats
+
+    def export_layer_to_mbtiles(self, layer, mbtiles_path):
+        """Export tiles of the given layer from its SQLite store to a MBTiles file
+
+        :returns: number of exported tiles or None if the layer has no SQLite store
+        """
+        store = self._get_layer_stores(layer).get(constants.TILE_STORAGE_SQLITE)
+        if store is None:
+            self.log.error("can't export layer %s to MBTiles - no SQLite tile store", layer)
+            return None
+        return export_to_mbtiles(store, mbtiles_path, name=layer.label, tile_format=layer.type)
+
+    def export_layer_delta(self, layer, mbtiles_path, modified_since):
+        """Export tiles of the given layer modified since the given timestamp to a MBTiles delta pack
+
+        The newest timestamp of the exported tiles is recorded in the pack metadata
+        and should be used as modified_since for the next delta export.
+
+        :param int modified_since: Unix timestamp
+        :returns: number of exported tiles or None if the layer has no SQLite store
+        """
+        store = self._get_layer_stores(layer).get(constants.TILE_STORAGE_SQLITE)
+        if store is None:
+            self.log.error("can't export delta of layer %s - no SQLite tile store", layer)
+            return None
+        return export_to_mbtiles(store, mbtiles_path, name=layer.label, tile_format=layer.type,
+                                 modified_since=modified_since)
+
+    def import_layer_from_mbtiles(self, layer, mbtiles_path):
+        """Import tiles from a MBTiles file to the SQLite store of the given layer
+
+        The SQLite store is created if the layer does not have one yet.
+        Tiles from a delta pack only replace older stored tiles.
+
+        :returns: number of imported tiles
+        """
+        with self._tile_storage_management_lock:
+            store = self._get_layer_stores(layer).get(constants.TILE_STORAGE_SQLITE)
+            if store is None:
+                layer_folder_path = os.path.join(self.modrana.paths.map_folder_path, layer.folder_name)
+                store = self._get_sqlite_store(layer_folder_path)
+                self._add_store_for_layer(layer, (constants.TILE_STORAGE_SQLITE, store))
+        tile_count = import_from_mbtiles(mbtiles_path, store, extension=layer.type)
+        self.invalidate_presence_index(layer)
+        self.invalidate_store_routing(layer)
+        return tile_count
+
+    def flush(self):
+        """Flush any tiles "in flight" in all stores to permanent storage"""
+        # the current snapshot can be iterated over without holding the lock,
+        # so tile reads & writes are not blocked while the stores are flushed
+        for store_odicts in self._stores.values():
+            for store in store_odicts.values():
+                store.flush()
+
     def shutdown(self):
         start = time.perf_counter()
+        # stop the quota manager
+        self._quota_manager_shutdown = True
+        self._quota_check_event.set()
+        if self._quota_manager_thread is not None:
+            self._quota_manager_thread.join()
+        # stop compaction
+        self._compaction_shutdown = True
+        if self._compaction_thread is not None:
+            self._compaction_thread.join()
+        # stop the integrity check
+        self._integrity_check_shutdown = True
+        if self._integrity_check_thread is not None:
+            self._integrity_check_thread.join()
+        # stop the sweeper
+        self._sweeper_shutdown = True
+        self._sweep_event.set()
+        if self._sweeper_thread is not None:
+            self._sweeper_thread.join()
         # close all stores
         self.log.debug("closing tile stores")
         layer_count = 0
@@ -292,5 +1065,9 @@ class StoreTiles(RanaModule):
                     store.close()
                     store_count+=1
             layer_count+=1
+            # persist the presence indexes once the stores are closed and
+            # all tiles have been written
+            for presence_index in self._presence_indexes.values():
+                presence_index.save()
         self.log.debug("closed all tile stores (for %d layers, %d stores in total in %s)"
                        % (layer_count, store_count, utils.get_elapsed_time_string(start)))
\ No newline at end of file
@@ -0,0 +1,62 @@
+import unittest
+from unittest.mock import MagicMock
+
+from modules.mod_mapData.mod_mapData import MapData
+
+class MapDataTests(unittest.TestCase):
+
+    def setUp(self):
+        self.modules = {}
+        self.modrana = MagicMock()
+        self.modrana.m = self.modules
+        self.map_data = MapData(self.modrana, "mapData", "mod_mapData")
+        self.layer = MagicMock()
+        self.store_tiles = MagicMock()
+        self.store_tiles.tiles_are_stored.side_effect = lambda lzxys: dict.fromkeys(lzxys, False)
+        self.store_tiles.get_layer_zoom_stats.return_value = {
+            14: {"tile_count": 10, "size": 10000},
+            15: {"tile_count": 2, "size": 6000},
+        }
+        self.modules["storeTiles"] = self.store_tiles
+
+    def estimate_download_size_test(self):
+        """Check the download size is estimated from zoom level statistics of stored tiles"""
+        # (x, y, z) download requests, there are no stored tiles on zoom level 16
+        self.map_data.addDownloadRequests([(1, 1, 14), (2, 1, 14), (1, 1, 15), (1, 1, 16)])
+        # 1000 B average on z14, 3000 B on z15 & 16000/12 B average over all zoom levels
+        self.assertEqual(self.map_data.estimateDownloadSize(self.layer), int(2*1000 + 3000 + 16000/12))
+        self.store_tiles.get_layer_zoom_stats.assert_called_once_with(self.layer)
+
+    def estimate_skips_stored_tiles_test(self):
+        """Check tiles that are already stored are not counted towards the download size"""
+        self.map_data.addDownloadRequests([(1, 1, 14), (2, 1, 14), (1, 1, 15)])
+        stored = {(self.layer, 14, 1, 1), (self.layer, 15, 1, 1)}
+        self.store_tiles.tiles_are_stored.side_effect = \
+            lambda lzxys: {lzxy: (True, 0) if lzxy in stored else False for lzxy in lzxys}
+        self.assertEqual(self.map_data.estimateDownloadSize(self.layer), 1000)
+        # nothing needs to be downloaded once all the tiles are stored
+        stored.add((self.layer, 14, 2, 1))
+        self.assertEqual(self.map_data.estimateDownloadSize(self.layer), 0)
+
+    def estimate_unknown_test(self):
+        """Check the download size is reported as unknown without stored tiles to estimate from"""
+        self.assertEqual(self.map_data.estimateDownloadSize(self.layer), -1)
+        self.map_data.addDownloadRequests([(1, 1, 14)])
+        self.store_tiles.get_layer_zoom_stats.return_value = {}
+        self.assertEqual(self.map_data.estimateDownloadSize(self.layer), -1)
+        del self.modules["storeTiles"]
+        self.assertEqual(self.map_data.estimateDownloadSize(self.layer), -1)
+
+    def size_check_notification_test(self):
+        """Check the estimated download size is shown once the size check is started"""
+        self.map_data._checkPool = MagicMock()
+        self.map_data._downloadPool = MagicMock()
+        self.map_data._checkPool.running = False
+        self.map_data._downloadPool.running = False
+        self.modules["mapLayers"] = MagicMock()
+        self.modules["mapLayers"].getLayerById.return_value = self.layer
+        self.map_data.addDownloadRequests([(1, 1, 14), (2, 1, 14)])
+        self.map_data.startBatchSizeEstimation()
+        self.assertEqual(self.map_data.estimatedDownloadSize, 2000)
+        self.map_data._checkPool.startBatch.assert_called_once()
+        self.modrana.notify.assert_called_once_with("Estimated download size: 1.95KB", 3000, "")
@@ -0,0 +1,434 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from core import constants
+from core import tilenames
+from modules.mod_mapTiles.tile_cache import TileImageCache
+from modules.mod_mapTiles.tile_retry import TileRetryScheduler, getBackoffDelay
+from modules.mod_mapTiles.tile_prefetch import getPredictedTiles, _getViewportTiles
+from modules.mod_mapTiles.route_prefetch import RoutePrefetch, getRouteSectionTiles
+from modules.mod_mapTiles.tile_downloader import Downloader
+
+class TileImageCacheTests(unittest.TestCase):
+
+    def eviction_by_size_test(self):
+        """Check least recently used tiles are evicted once the byte budget is exceeded"""
+        cache = TileImageCache(maxSize=250)
+        cache["a"] = (b"a" * 100, None)
+        cache["b"] = (b"b" * 100, None)
+        self.assertEqual(cache.size, 200)
+        cache["c"] = (b"c" * 100, None)
+        self.assertEqual(cache.keys(), ["b", "c"])
+        self.assertEqual(cache.size, 200)
+        self.assertIsNone(cache.get("a"))
+
+    def eviction_by_count_test(self):
+        """Check least recently used tiles are evicted once there are too many tiles"""
+        cache = TileImageCache(maxSize=10000, maxItems=2)
+        cache["a"] = (b"a", None)
+        cache["b"] = (b"b", None)
+        cache["c"] = (b"c", None)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.keys(), ["b", "c"])
+        self.assertEqual(cache.size, 2)
+
+    def hit_refreshes_recency_test(self):
+        """Check a cache hit protects the tile from eviction"""
+        cache = TileImageCache(maxSize=250)
+        cache["a"] = (b"a" * 100, "metadata a")
+        cache["b"] = (b"b" * 100, "metadata b")
+        self.assertEqual(cache.get("a"), (b"a" * 100, "metadata a"))
+        cache["c"] = (b"c" * 100, None)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.keys(), ["a", "c"])
+
+    def replacement_test(self):
+        """Check replacing a tile accounts only for the new image"""
+        cache = TileImageCache(maxSize=1000)
+        cache["a"] = (b"a" * 100, None)
+        cache["b"] = (b"b" * 100, None)
+        cache["a"] = (b"A" * 300, None)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.size, 400)
+        # the replaced tile is now the most recently used one
+        self.assertEqual(cache.keys(), ["b", "a"])
+        del cache["a"]
+        self.assertEqual(cache.size, 100)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def new_item_not_evicted_test(self):
+        """Check a tile bigger than the whole budget is still cached"""
+        cache = TileImageCache(maxSize=100)
+        cache["a"] = (b"a" * 50, None)
+        cache["big"] = (b"b" * 500, None)
+        self.assertEqual(cache.keys(), ["big"])
+        self.assertEqual(cache.size, 500)
+        self.assertEqual(cache.get("big"), (b"b" * 500, None))
+
+class TileRetrySchedulerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        time_patcher = patch("modules.mod_mapTiles.tile_retry.time")
+        mock_time = time_patcher.start()
+        mock_time.time.side_effect = lambda: self.now
+        self.addCleanup(time_patcher.stop)
+        # no jitter, so that retry times are predictable
+        random_patcher = patch("modules.mod_mapTiles.tile_retry.random")
+        mock_random = random_patcher.start()
+        mock_random.uniform.return_value = 0
+        self.addCleanup(random_patcher.stop)
+        self.tile = ("layer", 15, 1, 2)
+        self.other_tile = ("layer", 15, 1, 3)
+
+    def backoff_delay_test(self):
+        """Check the backoff delay doubles with every failure up to the limit"""
+        self.assertEqual(getBackoffDelay(1, 10, 1800), 10)
+        self.assertEqual(getBackoffDelay(2, 10, 1800), 20)
+        self.assertEqual(getBackoffDelay(3, 10, 1800), 40)
+        self.assertEqual(getBackoffDelay(8, 10, 1800), 1280)
+        self.assertEqual(getBackoffDelay(9, 10, 1800), 1800)
+        self.assertEqual(getBackoffDelay(1000, 10, 1800), 1800)
+
+    def retry_backoff_test(self):
+        """Check the retries of a failing tile back off"""
+        scheduler = TileRetryScheduler(maxDelay=30)
+        self.assertEqual(scheduler.downloadFailed(self.tile), 1010)
+        self.now = 1010
+        self.assertEqual(scheduler.downloadFailed(self.tile), 1030)
+        self.now = 1030
+        # capped by the maximum delay
+        self.assertEqual(scheduler.downloadFailed(self.tile), 1060)
+        self.now = 1060
+        self.assertEqual(scheduler.downloadFailed(self.tile), 1090)
+        # fatal errors start with a longer delay
+        self.assertEqual(scheduler.downloadFailed(("other layer", 15, 1, 2), fatal=True), 1090)
+        scheduler = TileRetryScheduler()
+        self.assertEqual(scheduler.downloadFailed(self.tile, fatal=True), 1120)
+
+    def layer_backoff_test(self):
+        """Check tiles of a failing layer are not retried before the layer backoff is over"""
+        scheduler = TileRetryScheduler()
+        self.assertEqual(scheduler.downloadFailed(self.tile), 1010)
+        self.now = 1010
+        self.assertEqual(scheduler.downloadFailed(self.tile), 1030)
+        self.now = 1030
+        self.assertEqual(scheduler.downloadFailed(self.tile), 1070)
+        # the first failure of another tile of the layer is retried
+        # only once the layer backoff is over
+        self.assertEqual(scheduler.downloadFailed(self.other_tile), 1070)
+        # but tiles of other layers are not affected
+        self.assertEqual(scheduler.downloadFailed(("other layer", 15, 1, 2)), 1040)
+
+    def max_attempts_test(self):
+        """Check retrying a tile is given up after too many failures"""
+        scheduler = TileRetryScheduler(maxAttempts=2)
+        self.assertIsNotNone(scheduler.downloadFailed(self.tile))
+        self.now = 1010
+        self.assertIsNotNone(scheduler.downloadFailed(self.tile))
+        self.assertEqual(len(scheduler), 1)
+        self.now = 1030
+        self.assertIsNone(scheduler.downloadFailed(self.tile))
+        self.assertEqual(len(scheduler), 0)
+        self.assertFalse(scheduler.isBackingOff(self.tile))
+        self.assertEqual(scheduler.popDueRetries(), [])
+
+    def due_retries_test(self):
+        """Check due retries are returned once with the most recent tag"""
+        wakeup_callback = MagicMock()
+        scheduler = TileRetryScheduler(wakeupCallback=wakeup_callback)
+        scheduler.downloadFailed(self.tile, tag="first")
+        wakeup_callback.assert_called_once_with()
+        self.assertEqual(scheduler.getTimeToNextRetry(), 10)
+        self.assertTrue(scheduler.isBackingOff(self.tile, tag="second"))
+        self.assertEqual(scheduler.popDueRetries(), [])
+        self.now = 1010
+        self.assertFalse(scheduler.isBackingOff(self.tile))
+        self.assertEqual(scheduler.popDueRetries(), [(self.tile, "second")])
+        self.assertEqual(scheduler.popDueRetries(), [])
+        self.assertIsNone(scheduler.getTimeToNextRetry())
+
+    def superseded_retries_test(self):
+        """Check heap entries superseded by a later failure or a cancellation are skipped"""
+        scheduler = TileRetryScheduler()
+        scheduler.downloadFailed(self.tile)
+        scheduler.downloadFailed(self.other_tile)
+        self.now = 1005
+        # the tile failed again before its retry, so it is retried later
+        self.assertEqual(scheduler.downloadFailed(self.tile), 1025)
+        scheduler.cancelRetry(self.other_tile)
+        self.now = 1010
+        self.assertEqual(scheduler.popDueRetries(), [])
+        self.now = 1025
+        self.assertEqual(scheduler.popDueRetries(), [(self.tile, None)])
+        self.assertEqual(scheduler.popDueRetries(), [])
+
+    def download_succeeded_test(self):
+        """Check a successful download resets the backoff of the tile and its layer"""
+        scheduler = TileRetryScheduler()
+        scheduler.downloadFailed(self.tile)
+        self.now = 1010
+        scheduler.downloadFailed(self.tile)
+        self.now = 1030
+        scheduler.downloadFailed(self.tile)
+        scheduler.downloadSucceeded(self.tile)
+        self.assertEqual(len(scheduler), 0)
+        self.assertFalse(scheduler.isBackingOff(self.tile))
+        # both the tile and the layer start from the base delay again
+        self.assertEqual(scheduler.downloadFailed(self.other_tile), 1040)
+        self.assertEqual(scheduler.downloadFailed(self.tile), 1040)
+
+class PredictedTilesTests(unittest.TestCase):
+
+    def setUp(self):
+        # the position is in tile (17894, 11225) on zoom level 15
+        self.lat = 49.2
+        self.lon = 16.6
+        self.viewport_size = (3.1, 1.9)
+
+    def predicted_tiles_test(self):
+        """Check tiles ahead of the motion are predicted in the order they come into view"""
+        tiles = getPredictedTiles(self.lat, self.lon, 90, 30, 15, self.viewport_size)
+        self.assertEqual(tiles, [(17897, 11225), (17897, 11224), (17897, 11226)])
+
+    def no_motion_test(self):
+        """Check nothing is predicted when not moving"""
+        self.assertEqual(getPredictedTiles(self.lat, self.lon, 90, 0, 15, self.viewport_size), [])
+
+    def predicted_tiles_direction_test(self):
+        """Check the predicted tiles are ahead of the motion and not in view already"""
+        x, y = tilenames.ll2xy(self.lat, self.lon, 15)
+        in_view = set(_getViewportTiles(x, y, 1.55, 0.95))
+        for bearing in (0, 90, 180, 270):
+            tiles = getPredictedTiles(self.lat, self.lon, bearing, 30, 15, self.viewport_size)
+            self.assertTrue(tiles)
+            self.assertEqual(len(tiles), len(set(tiles)))
+            for x, y in tiles:
+                self.assertNotIn((x, y), in_view)
+                if bearing == 0:
+                    self.assertLess(y, 11225)
+                elif bearing == 90:
+                    self.assertGreater(x, 17894)
+                elif bearing == 180:
+                    self.assertGreater(y, 11225)
+                else:
+                    self.assertLess(x, 17894)
+
+    def lookahead_limits_test(self):
+        """Check the lookahead grows with speed within the distance & tile count limits"""
+        slow = getPredictedTiles(self.lat, self.lon, 90, 30, 15, self.viewport_size)
+        fast = getPredictedTiles(self.lat, self.lon, 90, 300, 15, self.viewport_size)
+        self.assertLess(len(slow), len(fast))
+        # the viewport is projected at most 8 tiles ahead
+        fastest = getPredictedTiles(self.lat, self.lon, 90, 1000, 15, self.viewport_size)
+        self.assertEqual(max(x for x, _y in fastest), 17904)
+        self.assertEqual(getPredictedTiles(self.lat, self.lon, 90, 5000, 15, self.viewport_size), fastest)
+        limited = getPredictedTiles(self.lat, self.lon, 90, 300, 15, self.viewport_size, maxTiles=5)
+        self.assertEqual(limited, fast[:5])
+        # the minimum distance still covers the tiles just beyond the viewport edge
+        crawling = getPredictedTiles(self.lat, self.lon, 90, 0.1, 15, self.viewport_size)
+        self.assertEqual(crawling, slow)
+
+class RoutePrefetchTests(unittest.TestCase):
+
+    def setUp(self):
+        # a ~20 km long route going east
+        self.route = [(49.2, 16.6 + i * 0.00137) for i in range(200)]
+        self.layer_zooms = [("layer", 15), ("layer", 16)]
+
+    def route_section_tiles_test(self):
+        """Check tiles around a route section are returned in route order"""
+        self.assertEqual(getRouteSectionTiles([], 15, 150), [])
+        # a single point still has its tiles
+        self.assertEqual(getRouteSectionTiles(self.route[:1], 15, 0), [(17894, 11225)])
+        tiles = getRouteSectionTiles(self.route[:10], 15, 0)
+        self.assertEqual(tiles, [(17894, 11225), (17895, 11225), (17896, 11225)])
+        # the buffer adds the neighbouring tiles
+        tiles = getRouteSectionTiles(self.route[:10], 15, 500)
+        self.assertEqual(len(tiles), len(set(tiles)))
+        self.assertEqual(set(tiles), {(x, y) for x in (17894, 17895, 17896) for y in (11224, 11225, 11226)})
+        # tiles are ordered along the route
+        xs = [x for x, _y in getRouteSectionTiles(self.route, 15, 150)]
+        self.assertEqual(xs, sorted(xs))
+
+    def route_section_tiles_bounds_test(self):
+        """Check no tiles outside of the map are returned"""
+        tiles = getRouteSectionTiles([(0.01, -179.99), (0.01, -179.9)], 2, 1000000)
+        self.assertTrue(tiles)
+        for x, y in tiles:
+            self.assertTrue(0 <= x < 4)
+            self.assertTrue(0 <= y < 4)
+
+    def progress_test(self):
+        """Check the route section ahead is prefetched & extended as the position advances"""
+        prefetch = RoutePrefetch(self.route)
+        self.assertAlmostEqual(prefetch.routeLength, 19.8, places=1)
+        tiles = prefetch.update(49.2, 16.6, self.layer_zooms)
+        self.assertEqual(len(tiles), 38)
+        self.assertEqual(len(tiles), len(set(tiles)))
+        self.assertEqual({lzxy[:2] for lzxy in tiles}, set(self.layer_zooms))
+        self.assertEqual(tiles[0], ("layer", 15, 17894, 11225))
+        # the section ahead is already prefetched
+        self.assertEqual(prefetch.update(49.2, 16.6 + 5 * 0.00137, self.layer_zooms), [])
+        # extend the section once its end gets close
+        lat, lon = self.route[45]
+        new_tiles = prefetch.update(lat, lon, self.layer_zooms)
+        self.assertEqual(len(new_tiles), 15)
+        self.assertFalse(set(tiles) & set(new_tiles))
+        # progress along the route never goes back
+        self.assertEqual(prefetch.update(49.2, 16.6, self.layer_zooms), [])
+
+    def new_zoom_level_test(self):
+        """Check a newly used zoom level gets its tiles prefetched"""
+        prefetch = RoutePrefetch(self.route)
+        prefetch.update(49.2, 16.6, [("layer", 15)])
+        tiles = prefetch.update(49.2, 16.6, self.layer_zooms)
+        self.assertTrue(tiles)
+        self.assertEqual({lzxy[1] for lzxy in tiles}, {16})
+
+    def byte_budget_test(self):
+        """Check prefetch stops once the byte budget is exhausted"""
+        prefetch = RoutePrefetch(self.route, byteBudget=0.01)
+        self.assertTrue(prefetch.canDownload())
+        prefetch.tileDownloaded(5000)
+        self.assertFalse(prefetch.budgetExhausted)
+        prefetch.tileDownloaded(6000)
+        self.assertEqual(prefetch.downloadedBytes, 11000)
+        self.assertTrue(prefetch.budgetExhausted)
+        self.assertFalse(prefetch.canDownload())
+        self.assertEqual(prefetch.update(49.2, 16.6, self.layer_zooms), [])
+
+    @patch("modules.mod_mapTiles.route_prefetch.time")
+    def bandwidth_budget_test(self, mock_time):
+        """Check the token bucket limits the download bandwidth"""
+        now = [1000.0]
+        mock_time.time.side_effect = lambda: now[0]
+        prefetch = RoutePrefetch(self.route, bandwidth=1)
+        # a burst is allowed
+        self.assertTrue(prefetch.canDownload())
+        self.assertEqual(prefetch.getDownloadDelay(), 0)
+        prefetch.tileDownloaded(4000)
+        self.assertTrue(prefetch.canDownload())
+        prefetch.tileDownloaded(6000)
+        self.assertFalse(prefetch.canDownload())
+        self.assertAlmostEqual(prefetch.getDownloadDelay(), (10000 - 4096) / 1024.0)
+        now[0] += 5
+        self.assertFalse(prefetch.canDownload())
+        now[0] += 1
+        self.assertTrue(prefetch.canDownload())
+        # unused bandwidth is only accumulated up to the burst size
+        now[0] += 3600
+        prefetch.tileDownloaded(4096)
+        self.assertFalse(prefetch.canDownload())
+
+class DownloaderTests(unittest.TestCase):
+
+    def setUp(self):
+        self.map_tiles = MagicMock()
+        self.map_tiles.cacheImageSurfaces = False
+        self.map_tiles._downloadTile.return_value = b"tile data"
+        self.store_tiles = MagicMock()
+        modrana_patcher = patch("modules.mod_mapTiles.tile_downloader.modrana")
+        mock_modrana = modrana_patcher.start()
+        mock_modrana.m.get.side_effect = {"mapTiles": self.map_tiles,
+                                          "storeTiles": self.store_tiles}.get
+        self.addCleanup(modrana_patcher.stop)
+        pool_patcher = patch("modules.mod_mapTiles.tile_downloader.LifoThreadPool")
+        self.pool = pool_patcher.start().return_value
+        self.pool.submit.return_value = None
+        self.addCleanup(pool_patcher.stop)
+        self.retry_scheduler = MagicMock()
+        self.downloader = Downloader(maxThreads=2, taskBufferSize=10, retryScheduler=self.retry_scheduler)
+        self.tile = ("layer", 15, 1, 2)
+        self.other_tile = ("layer", 15, 1, 3)
+
+    def _run_download(self, lzxy):
+        """Run the download submitted to the mocked pool for the given tile"""
+        for submit_call in self.pool.submit.call_args_list:
+            function, *args = submit_call[0]
+            if args[0] == lzxy:
+                function(*args)
+                return
+        self.fail("download of %s has not been submitted" % (lzxy,))
+
+    def coalescing_test(self):
+        """Check concurrent requests for a tile download it only once and are all notified once"""
+        first_callback = MagicMock()
+        second_callback = MagicMock()
+        self.assertIsNone(self.downloader.downloadTile(self.tile, "first", callback=first_callback))
+        self.assertIsNone(self.downloader.downloadTile(self.tile, "second", callback=second_callback))
+        # a repeated request is notified only once
+        self.assertIsNone(self.downloader.downloadTile(self.tile, "second", callback=second_callback))
+        self.assertIsNone(self.downloader.downloadTile(self.tile, "prefetch"))
+        self.assertEqual(self.pool.submit.call_count, 1)
+
+        self._run_download(self.tile)
+        self.map_tiles._downloadTile.assert_called_once_with(self.tile)
+        self.store_tiles.store_tile_data.assert_called_once_with(self.tile, b"tile data")
+        self.retry_scheduler.downloadSucceeded.assert_called_once_with(self.tile)
+        # nobody is waiting for prefetched tiles
+        self.assertEqual(self.map_tiles.tileDownloaded.call_args_list,
+                         [((constants.TILE_DOWNLOAD_SUCCESS, self.tile, "first"),),
+                          ((constants.TILE_DOWNLOAD_SUCCESS, self.tile, "second"),)])
+        first_callback.assert_called_once_with(constants.TILE_DOWNLOAD_SUCCESS, self.tile, "first")
+        second_callback.assert_called_once_with(constants.TILE_DOWNLOAD_SUCCESS, self.tile, "second")
+
+        # once the download is finished the tile can be downloaded again
+        self.downloader.downloadTile(self.tile, "third")
+        self.assertEqual(self.pool.submit.call_count, 2)
+
+    def failed_download_test(self):
+        """Check all requests are notified of a failed download & the retry goes to the latest one"""
+        self.map_tiles._downloadTile.return_value = None
+        self.downloader.downloadTile(self.tile, "first")
+        self.downloader.downloadTile(self.tile, "second")
+        self.downloader.downloadTile(self.tile, "prefetch")
+        self._run_download(self.tile)
+        self.retry_scheduler.downloadFailed.assert_called_once_with(self.tile, "second", fatal=True)
+        self.assertEqual(self.map_tiles.tileDownloaded.call_args_list,
+                         [((constants.TILE_DOWNLOAD_ERROR, self.tile, "first"),),
+                          ((constants.TILE_DOWNLOAD_ERROR, self.tile, "second"),)])
+
+    def revalidation_download_test(self):
+        """Check nobody is notified of and no retry is scheduled for a revalidated tile"""
+        self.map_tiles._downloadTile.return_value = None
+        self.downloader.downloadTile(self.tile, constants.TILE_STORAGE_REVALIDATION_TAG)
+        self._run_download(self.tile)
+        self.map_tiles.tileDownloaded.assert_not_called()
+        self.retry_scheduler.downloadFailed.assert_not_called()
+
+    def failing_listener_test(self):
+        """Check a failing listener does not keep other requests waiting for the tile"""
+        callback = MagicMock()
+        self.map_tiles.tileDownloaded.side_effect = [AttributeError, None]
+        self.downloader.downloadTile(self.tile, "first")
+        self.downloader.downloadTile(self.tile, "second", callback=callback)
+        self._run_download(self.tile)
+        self.assertEqual(self.map_tiles.tileDownloaded.call_count, 2)
+        callback.assert_called_once_with(constants.TILE_DOWNLOAD_SUCCESS, self.tile, "second")
+        # the tile is no longer in flight
+        self.downloader.downloadTile(self.tile, "third")
+        self.assertEqual(self.pool.submit.call_count, 2)
+
+    def dropped_download_test(self):
+        """Check all requests waiting for a dropped download are notified"""
+        first_callback = MagicMock()
+        second_callback = MagicMock()
+        self.downloader.downloadTile(self.tile, "first", callback=first_callback)
+        self.downloader.downloadTile(self.tile, "second", callback=second_callback)
+        # the download of the first tile is dropped from the bottom of the work stack
+        self.pool.submit.return_value = (self.downloader._handleDownload, (self.tile, 0, False), {})
+        self.assertEqual(self.downloader.downloadTile(self.other_tile, "third"), self.tile)
+        self.map_tiles.removeImageFromMemory.assert_called_once_with(self.tile)
+        self.assertEqual(self.map_tiles.tileDownloaded.call_args_list,
+                         [((constants.TILE_DOWNLOAD_QUEUE_FULL, self.tile, "first"),),
+                          ((constants.TILE_DOWNLOAD_QUEUE_FULL, self.tile, "second"),)])
+        first_callback.assert_called_once_with(constants.TILE_DOWNLOAD_QUEUE_FULL, self.tile, "first")
+        second_callback.assert_called_once_with(constants.TILE_DOWNLOAD_QUEUE_FULL, self.tile, "second")
+        # the dropped tile can be requested again
+        self.pool.submit.return_value = None
+        self.downloader.downloadTile(self.tile, "fourth")
+        self.assertEqual(self.pool.submit.call_count, 3)
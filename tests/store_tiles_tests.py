@@ -0,0 +1,154 @@
+import threading
+import unittest
+from collections import OrderedDict
+from unittest.mock import MagicMock, patch
+
+from core import constants
+from modules.mod_storeTiles import StoreTiles
+
+class StoreTilesTests(unittest.TestCase):
+
+    def setUp(self):
+        self.options = {}
+        self.modules = {}
+        self.modrana = MagicMock()
+        self.modrana.get.side_effect = lambda key, default=None: self.options.get(key, default)
+        self.modrana.m = self.modules
+        self.store_tiles = StoreTiles(self.modrana, "storeTiles", "mod_storeTiles")
+        self.layer = MagicMock()
+        self.layer.timeout = 24
+
+    def revalidate_expired_tiles_test(self):
+        """Check expired tiles are queued for download as background requests"""
+        self.options["tileStorageExpiredTiles"] = constants.TILE_STORAGE_EXPIRED_REVALIDATE
+        map_tiles = MagicMock()
+        self.modules["mapTiles"] = map_tiles
+        store = MagicMock()
+        store.get_expired_tiles.return_value = [(15, 1, 2), (15, 1, 3)]
+        with patch.object(self.store_tiles, "_get_layers_with_storage", return_value=[self.layer]), \
+                patch.object(self.store_tiles, "_get_writable_stores", return_value=[store]):
+            self.store_tiles._sweep_expired_tiles()
+        store.get_expired_tiles.assert_called_once()
+        self.assertEqual(map_tiles.addTileDownloadRequest.call_args_list,
+                         [(((self.layer, 15, 1, 2), constants.TILE_STORAGE_REVALIDATION_TAG),),
+                          (((self.layer, 15, 1, 3), constants.TILE_STORAGE_REVALIDATION_TAG),)])
+        store.delete_expired_tiles.assert_not_called()
+
+    def delete_expired_tiles_test(self):
+        """Check expired tiles are deleted in the delete mode"""
+        self.options["tileStorageExpiredTiles"] = constants.TILE_STORAGE_EXPIRED_DELETE
+        map_tiles = MagicMock()
+        self.modules["mapTiles"] = map_tiles
+        store = MagicMock()
+        store.delete_expired_tiles.return_value = 2
+        with patch.object(self.store_tiles, "_get_layers_with_storage", return_value=[self.layer]), \
+                patch.object(self.store_tiles, "_get_writable_stores", return_value=[store]):
+            self.store_tiles._sweep_expired_tiles()
+        store.delete_expired_tiles.assert_called_once()
+        map_tiles.addTileDownloadRequest.assert_not_called()
+
+    def _get_store(self, used_size):
+        store = MagicMock()
+        store.get_used_size.return_value = used_size
+        store.evict_tiles.return_value = 0
+        return store
+
+    def quota_skips_pack_stores_test(self):
+        """Check pack stores are neither evicted from nor counted towards the quotas"""
+        mib = 1024 * 1024
+        self.options["tileStorageLayerQuota"] = 10
+        files_store = self._get_store(8 * mib)
+        pack_store = self._get_store(100 * mib)
+        layer_stores = OrderedDict([(constants.TILE_STORAGE_FILES, files_store),
+                                    (constants.TILE_STORAGE_PACK, pack_store)])
+        with patch.object(self.store_tiles, "_get_layers_with_storage", return_value=[self.layer]), \
+                patch.object(self.store_tiles, "_get_layer_stores", return_value=layer_stores):
+            self.store_tiles._enforce_quotas()
+            # the layer is under quota without the pack store
+            files_store.evict_tiles.assert_not_called()
+            files_store.get_used_size.return_value = 12 * mib
+            self.store_tiles._enforce_quotas()
+            files_store.evict_tiles.assert_called_once()
+            self.assertEqual(files_store.evict_tiles.call_args[0][0], 12 * mib - 9 * mib + 1)
+            pack_store.get_used_size.assert_not_called()
+            pack_store.evict_tiles.assert_not_called()
+            # expired tiles can still be deleted from pack stores
+            self.assertEqual(self.store_tiles._get_writable_stores(self.layer), [files_store, pack_store])
+
+    def layer_stores_snapshot_test(self):
+        """Check a new read only snapshot is published when stores of a layer change"""
+        files_store = MagicMock()
+        sqlite_store = MagicMock()
+        existing_stores = OrderedDict([(constants.TILE_STORAGE_FILES, files_store)])
+        with patch.object(self.store_tiles, "_get_existing_stores_for_layer",
+                          return_value=existing_stores) as get_existing_stores:
+            layer_stores = self.store_tiles._get_layer_stores(self.layer)
+            self.assertEqual(list(layer_stores.items()), [(constants.TILE_STORAGE_FILES, files_store)])
+            # existing stores are looked for only the first time
+            self.assertIs(self.store_tiles._get_layer_stores(self.layer), layer_stores)
+            get_existing_stores.assert_called_once_with(self.layer)
+        with self.assertRaises(TypeError):
+            layer_stores[constants.TILE_STORAGE_SQLITE] = sqlite_store
+        stores = self.store_tiles._stores
+        self.store_tiles._add_store_for_layer(self.layer, (constants.TILE_STORAGE_SQLITE, sqlite_store))
+        new_layer_stores = self.store_tiles._get_layer_stores(self.layer)
+        self.assertEqual(list(new_layer_stores.values()), [files_store, sqlite_store])
+        # the previous snapshots are left as they were
+        self.assertEqual(list(layer_stores.values()), [files_store])
+        self.assertIs(stores[self.layer], layer_stores)
+
+    def primary_store_type_change_test(self):
+        """Check stores are reordered once the primary tile storage type changes"""
+        files_store = MagicMock()
+        sqlite_store = MagicMock()
+        existing_stores = OrderedDict([(constants.TILE_STORAGE_SQLITE, sqlite_store),
+                                       (constants.TILE_STORAGE_FILES, files_store)])
+        with patch.object(self.store_tiles, "_get_existing_stores_for_layer", return_value=existing_stores):
+            layer_stores = self.store_tiles._get_layer_stores(self.layer)
+        # the primary store type goes first
+        self.assertEqual(list(layer_stores.values()), [files_store, sqlite_store])
+        self.store_tiles._primary_tile_storage_type_changed_cb("tileStorageType", constants.TILE_STORAGE_FILES,
+                                                               constants.TILE_STORAGE_SQLITE)
+        self.assertEqual(list(self.store_tiles._get_stores_for_reading(self.layer)), [sqlite_store, files_store])
+        self.assertEqual(list(layer_stores.values()), [files_store, sqlite_store])
+        self.store_tiles._primary_tile_storage_type_changed_cb("tileStorageType", constants.TILE_STORAGE_SQLITE,
+                                                               "invalid")
+        self.assertEqual(self.store_tiles._primary_tile_storage_type, constants.TILE_STORAGE_SQLITE)
+
+    def concurrent_first_use_test(self):
+        """Check looking for stores of one layer does not hold up the first use of other layers"""
+        slow_layer = MagicMock()
+        slow_layer_store = MagicMock()
+        fast_layer_store = MagicMock()
+        discovery_started = threading.Event()
+        discovery_can_finish = threading.Event()
+        discovered_layers = []
+
+        def get_existing_stores(layer):
+            discovered_layers.append(layer)
+            if layer is slow_layer:
+                discovery_started.set()
+                discovery_can_finish.wait(5)
+                return OrderedDict([(constants.TILE_STORAGE_SQLITE, slow_layer_store)])
+            return OrderedDict([(constants.TILE_STORAGE_FILES, fast_layer_store)])
+
+        results = []
+        with patch.object(self.store_tiles, "_get_existing_stores_for_layer", side_effect=get_existing_stores):
+            threads = [threading.Thread(target=lambda: results.append(
+                self.store_tiles._get_layer_stores(slow_layer))) for _i in range(2)]
+            threads[0].start()
+            self.assertTrue(discovery_started.wait(5))
+            threads[1].start()
+            # the other layer can be used while the stores of the slow layer are being opened
+            fast_layer_stores = self.store_tiles._get_layer_stores(self.layer)
+            self.assertEqual(list(fast_layer_stores.values()), [fast_layer_store])
+            self.assertEqual(results, [])
+            discovery_can_finish.set()
+            for thread in threads:
+                thread.join(5)
+        # both requests for the slow layer got the same stores, which were looked for just once
+        self.assertEqual(len(results), 2)
+        self.assertIs(results[0], results[1])
+        self.assertEqual(list(results[0].values()), [slow_layer_store])
+        self.assertEqual(discovered_layers, [slow_layer, self.layer])
+        self.assertEqual(set(self.store_tiles._stores.keys()), {slow_layer, self.layer})
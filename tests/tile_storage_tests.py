@@ -0,0 +1,969 @@
+import os
+import unittest
+import sqlite3
+import tempfile
+import shutil
+import threading
+import time
+from unittest.mock import MagicMock, patch
+
+from core.tile_storage.sqlite_store import SqliteTileStore
+from core.tile_storage.files_store import FileBasedTileStore
+from core.tile_storage.pack_store import PackFileTileStore
+from core.tile_storage import pack_store
+from core.tile_storage.migration import FilesToSqliteMigration, MIGRATION_STATE_FILE_NAME
+from core.tile_storage.mbtiles_store import MBTilesTileStore, export_to_mbtiles, import_from_mbtiles
+from core.tile_storage import utils
+from core.tile_storage.presence_index import ScalableBloomFilter, TilePresenceIndex
+from core.tile_storage.store_routing import StoreRoutingCache
+
+PNG_TILE = b"\211PNG\r\n\032\n" + b"png tile data"
+PNG_TILE_2 = b"\211PNG\r\n\032\n" + b"another png tile data"
+COMPLETE_PNG_TILE = PNG_TILE + utils.PNG_END
+
+def get_layer(tile_type="png"):
+    layer = MagicMock()
+    layer.type = tile_type
+    return layer
+
+class SqliteTileStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.layer = get_layer()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def store_and_get_test(self):
+        """Check basic tile storage operations"""
+        store = SqliteTileStore(self.store_path)
+        lzxy = (self.layer, 1, 2, 3)
+        self.assertIsNone(store.get_tile(lzxy))
+        self.assertFalse(store.tile_is_stored(lzxy))
+        store.store_tile_data(lzxy, PNG_TILE)
+        self.assertEqual(store.get_tile(lzxy)[0], PNG_TILE)
+        self.assertTrue(store.tile_is_stored(lzxy)[0])
+        # replace the tile
+        store.store_tile_data(lzxy, PNG_TILE_2)
+        self.assertEqual(store.get_tile(lzxy)[0], PNG_TILE_2)
+        store.delete_tile(lzxy)
+        self.assertIsNone(store.get_tile(lzxy))
+        # deleting a tile that is not stored should not fail
+        store.delete_tile(lzxy)
+        store.close()
+
+    def write_behind_test(self):
+        """Check that queued tiles are readable and written on flush & close"""
+        store = SqliteTileStore(self.store_path, write_behind=True, queue_size=10, commit_interval=60)
+        for y in range(25):
+            store.store_tile_data((self.layer, 1, 2, y), PNG_TILE)
+        # queued tiles should be visible right away
+        for y in range(25):
+            self.assertEqual(store.get_tile((self.layer, 1, 2, y))[0], PNG_TILE)
+            self.assertTrue(store.tile_is_stored((self.layer, 1, 2, y))[0])
+        store.delete_tile((self.layer, 1, 2, 24))
+        self.assertFalse(store.tile_is_stored((self.layer, 1, 2, 24)))
+        store.flush()
+        self.assertEqual(len(store._write_queue), 0)
+        store.store_tile_data((self.layer, 1, 3, 0), PNG_TILE_2)
+        store.close()
+
+        # check the tiles made it to the database
+        store = SqliteTileStore(self.store_path)
+        for y in range(24):
+            self.assertEqual(store.get_tile((self.layer, 1, 2, y))[0], PNG_TILE)
+        self.assertIsNone(store.get_tile((self.layer, 1, 2, 24)))
+        self.assertEqual(store.get_tile((self.layer, 1, 3, 0))[0], PNG_TILE_2)
+        store.close()
+
+    def wal_mode_test(self):
+        """Check that readers can run in parallel with a writer in WAL mode"""
+        store = SqliteTileStore(self.store_path, wal_mode=True, read_connection_pool_size=2)
+        errors = []
+
+        def write():
+            try:
+                for y in range(200):
+                    store.store_tile_data((self.layer, 2, 1, y), PNG_TILE)
+            except Exception as e:
+                errors.append(e)
+
+        def read():
+            try:
+                for y in range(200):
+                    tile = store.get_tile((self.layer, 2, 1, y))
+                    if tile is not None:
+                        self.assertEqual(tile[0], PNG_TILE)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write)]
+        threads.extend(threading.Thread(target=read) for i in range(4))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        for y in range(200):
+            self.assertEqual(store.get_tile((self.layer, 2, 1, y))[0], PNG_TILE)
+        self.assertEqual(store._lookup_db_connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        store.close()
+
+    def size_accounting_test(self):
+        """Check storage database sizes are tracked without checking the disk on every write"""
+        store = SqliteTileStore(self.store_path)
+        store_name = store.store_names[0]
+        store_path = os.path.join(self.store_path, store_name)
+        self.assertEqual(store.stats()["store_sizes"][store_name], os.path.getsize(store_path))
+        for y in range(10):
+            store.store_tile_data((self.layer, 1, 1, y), PNG_TILE)
+        stats = store.stats()
+        self.assertGreaterEqual(stats["store_sizes"][store_name], 10 * len(PNG_TILE))
+        self.assertEqual(stats["size"], stats["lookup_size"] + stats["store_sizes"][store_name])
+        # the size is re-checked on disk once enough data has been written
+        store._add_to_storage_db_size(store_name, 1024**3)
+        self.assertEqual(store.stats()["store_sizes"][store_name], os.path.getsize(store_path))
+        store.close()
+
+    def eviction_test(self):
+        """Check least recently used tiles are evicted first"""
+        store = SqliteTileStore(self.store_path)
+        lzxys = [(self.layer, 4, 1, y) for y in range(16)]
+        for lzxy in lzxys:
+            store.store_tile_data(lzxy, PNG_TILE)
+        # pretend the tiles have been stored a day ago
+        store._lookup_db_connection.execute("update tiles set last_access=last_access-86400")
+        store._lookup_db_connection.commit()
+        # access the first half of the tiles
+        for lzxy in lzxys[:8]:
+            store.get_tile(lzxy)
+        store.get_tiles(lzxys[:4])
+        evicted_bytes = store.evict_tiles(len(PNG_TILE) * 8, batch_size=4)
+        self.assertGreaterEqual(evicted_bytes, len(PNG_TILE) * 8)
+        stored = store.tiles_are_stored(lzxys)
+        for lzxy in lzxys[:8]:
+            self.assertTrue(stored[lzxy])
+        for lzxy in lzxys[8:]:
+            self.assertFalse(stored[lzxy])
+        store.close()
+
+    def compaction_test(self):
+        """Check sparse storage databases are consolidated and free space is released"""
+        big_tile = PNG_TILE + b"x" * 4000
+        for wal_mode in (False, True):
+            store = SqliteTileStore(self.store_path, wal_mode=wal_mode, attach_stores=True)
+            first_store_name = store.store_names[0]
+            lzxys = [(self.layer, 9, 1, y) for y in range(40)]
+            for lzxy in lzxys:
+                store.store_tile_data(lzxy, big_tile)
+            for lzxy in lzxys[10:]:
+                store.delete_tile(lzxy)
+            # store more tiles to a second storage database
+            second_store_name, second_store_connection = store._add_store()
+            store._storage_databases[second_store_name] = second_store_connection
+            store._new_tiles_store_name = second_store_name
+            store._new_tiles_store_connection = second_store_connection
+            second_lzxys = [(self.layer, 9, 2, y) for y in range(20)]
+            for lzxy in second_lzxys:
+                store.store_tile_data(lzxy, big_tile)
+            # populate the read connection pool in WAL mode
+            self.assertEqual(store.get_tile(lzxys[0])[0], big_tile)
+            progress = []
+            store.compact(progress_callback=lambda message, value: progress.append(value))
+            self.assertEqual(progress[-1], 1.0)
+            # the sparser storage database has been drained & deleted
+            self.assertEqual(store.store_names, [second_store_name])
+            self.assertFalse(os.path.exists(os.path.join(self.store_path, first_store_name)))
+            self.assertEqual(second_store_connection.execute("pragma freelist_count").fetchone()[0], 0)
+            tiles = store.get_tiles(lzxys + second_lzxys)
+            for lzxy in lzxys[:10] + second_lzxys:
+                self.assertEqual(tiles[lzxy][0], big_tile)
+                self.assertEqual(store.get_tile(lzxy)[0], big_tile)
+            for lzxy in lzxys[10:]:
+                self.assertIsNone(tiles[lzxy])
+            # new tiles are stored to the remaining storage database
+            store.store_tile_data(lzxys[-1], big_tile)
+            self.assertEqual(store.get_tile(lzxys[-1])[0], big_tile)
+            store.clear()
+
+    def expired_tiles_test(self):
+        """Check tiles older than a timestamp are found and deleted in bulk"""
+        store = SqliteTileStore(self.store_path)
+        lzxys = [(self.layer, 5, 1, y) for y in range(10)]
+        for lzxy in lzxys:
+            store.store_tile_data(lzxy, PNG_TILE)
+        # make the first half of the tiles a day old, the oldest first
+        for y in range(5):
+            store._lookup_db_connection.execute("update tiles set unix_epoch_timestamp=unix_epoch_timestamp-86400-? "
+                                                "where z=5 and x=1 and y=?", (5 - y, y))
+        store._lookup_db_connection.commit()
+        expired_before = int(time.time()) - 3600
+        self.assertEqual(store.get_expired_tiles(expired_before), [(5, 1, y) for y in range(5)])
+        self.assertEqual(store.get_expired_tiles(expired_before, limit=2), [(5, 1, 0), (5, 1, 1)])
+        self.assertEqual(store.delete_expired_tiles(expired_before, batch_size=2), 5)
+        stored = store.tiles_are_stored(lzxys)
+        for lzxy in lzxys:
+            self.assertEqual(bool(stored[lzxy]), lzxy[3] >= 5)
+        self.assertEqual(store.get_expired_tiles(expired_before), [])
+        # the timestamp index is added to lookup databases created before it existed
+        store._lookup_db_connection.execute("drop index tiles_timestamp")
+        store._lookup_db_connection.commit()
+        store.close()
+        store = SqliteTileStore(self.store_path)
+        index_count = store._lookup_db_connection.execute(
+            "select count(*) from sqlite_master where type='index' and name='tiles_timestamp'").fetchone()[0]
+        self.assertEqual(index_count, 1)
+        store.close()
+
+    def last_access_upgrade_test(self):
+        """Check the last access column is added to existing lookup databases"""
+        store = SqliteTileStore(self.store_path)
+        store.store_tile_data((self.layer, 1, 1, 1), PNG_TILE)
+        store.close()
+        connection = sqlite3.connect(os.path.join(self.store_path, "lookup.sqlite"))
+        connection.execute("drop index tiles_last_access")
+        connection.execute("alter table tiles drop column last_access")
+        connection.commit()
+        connection.close()
+        store = SqliteTileStore(self.store_path)
+        last_access, timestamp = store._lookup_db_connection.execute(
+            "select last_access, unix_epoch_timestamp from tiles").fetchone()
+        self.assertEqual(last_access, timestamp)
+        self.assertEqual(store.get_tile((self.layer, 1, 1, 1))[0], PNG_TILE)
+        store.close()
+
+    def bulk_operations_test(self):
+        """Check getting & checking multiple tiles at once"""
+        store = SqliteTileStore(self.store_path, write_behind=True, commit_interval=60)
+        stored = [(self.layer, z, 1, y) for z in (3, 4) for y in range(400)]
+        missing = [(self.layer, 5, 1, y) for y in range(10)]
+        for lzxy in stored:
+            store.store_tile_data(lzxy, PNG_TILE)
+        store.flush()
+        # one more tile only in the write queue
+        queued = (self.layer, 6, 1, 1)
+        store.store_tile_data(queued, PNG_TILE_2)
+        tiles = store.get_tiles(stored + missing + [queued])
+        self.assertEqual(len(tiles), len(stored) + len(missing) + 1)
+        for lzxy in stored:
+            self.assertEqual(tiles[lzxy][0], PNG_TILE)
+        for lzxy in missing:
+            self.assertIsNone(tiles[lzxy])
+        self.assertEqual(tiles[queued][0], PNG_TILE_2)
+        stored_tiles = store.tiles_are_stored(stored + missing + [queued])
+        for lzxy in stored + [queued]:
+            self.assertTrue(stored_tiles[lzxy][0])
+        for lzxy in missing:
+            self.assertFalse(stored_tiles[lzxy])
+        store.close()
+
+    def attached_stores_test(self):
+        """Check reading tiles over storage databases attached to the lookup database"""
+        for wal_mode in (False, True):
+            store = SqliteTileStore(self.store_path, wal_mode=wal_mode, attach_stores=True)
+            lzxys = [(self.layer, 7, 1, y) for y in range(20)]
+            for lzxy in lzxys:
+                store.store_tile_data(lzxy, PNG_TILE)
+            self.assertEqual(store.get_tile(lzxys[0])[0], PNG_TILE)
+            self.assertIsNone(store.get_tile((self.layer, 7, 2, 0)))
+            # add a new storage database and move a tile to it
+            store_name, store_connection = store._add_store()
+            store._storage_databases[store_name] = store_connection
+            store_connection.execute("insert into tiles (z, x, y, tile, extension, unix_epoch_timestamp) "
+                                     "values (7, 1, 0, ?, 'png', 1)", (PNG_TILE_2,))
+            store_connection.commit()
+            store._lookup_db_connection.execute("update tiles set store_filename=? where z=7 and x=1 and y=0",
+                                                (store_name,))
+            store._lookup_db_connection.commit()
+            self.assertEqual(store.get_tile(lzxys[0]), (PNG_TILE_2, 1))
+            tiles = store.get_tiles(lzxys + [(self.layer, 7, 2, 0)])
+            self.assertEqual(tiles[lzxys[0]][0], PNG_TILE_2)
+            for lzxy in lzxys[1:]:
+                self.assertEqual(tiles[lzxy][0], PNG_TILE)
+            self.assertIsNone(tiles[(self.layer, 7, 2, 0)])
+            store.clear()
+
+    def deduplication_test(self):
+        """Check identical tiles are stored only once when deduplication is enabled"""
+        store = SqliteTileStore(self.store_path, deduplicate=True)
+        lzxys = [(self.layer, 8, 1, y) for y in range(10)]
+        for lzxy in lzxys:
+            store.store_tile_data(lzxy, PNG_TILE)
+        store.store_tile_data((self.layer, 8, 2, 0), PNG_TILE_2)
+        store_connection = list(store._storage_databases.values())[0]
+
+        def get_blobs():
+            return store_connection.execute("select tile, refcount from blobs order by id").fetchall()
+
+        self.assertEqual(get_blobs(), [(PNG_TILE, 10), (PNG_TILE_2, 1)])
+        self.assertEqual(store.get_tile(lzxys[0])[0], PNG_TILE)
+        tiles = store.get_tiles(lzxys)
+        for lzxy in lzxys:
+            self.assertEqual(tiles[lzxy][0], PNG_TILE)
+        # replacing & deleting tiles decreases the reference count
+        store.store_tile_data(lzxys[0], PNG_TILE_2)
+        store.delete_tile(lzxys[1])
+        self.assertEqual(get_blobs(), [(PNG_TILE, 8), (PNG_TILE_2, 2)])
+        # unused tile data is deleted
+        store.store_tile_data((self.layer, 8, 2, 0), PNG_TILE)
+        store.delete_tile(lzxys[0])
+        self.assertEqual(get_blobs(), [(PNG_TILE, 9)])
+        store.close()
+        # deduplicated tiles can be read over attached storage databases
+        store = SqliteTileStore(self.store_path, attach_stores=True)
+        self.assertEqual(store.get_tile(lzxys[2])[0], PNG_TILE)
+        self.assertEqual(store.get_tiles(lzxys[2:4])[lzxys[3]][0], PNG_TILE)
+        # and tile data is deleted once all tiles using it are evicted
+        store.evict_tiles(1)
+        store_connection = list(store._storage_databases.values())[0]
+        self.assertEqual(store_connection.execute("select count(*) from blobs").fetchone()[0], 0)
+        store.close()
+
+    def deduplicated_eviction_test(self):
+        """Check tiles sharing their data are evicted by their size before deduplication"""
+        store = SqliteTileStore(self.store_path, deduplicate=True)
+        lzxys = [(self.layer, 8, 1, y) for y in range(8)]
+        for lzxy in lzxys:
+            store.store_tile_data(lzxy, PNG_TILE)
+        store.store_tile_data((self.layer, 8, 2, 0), PNG_TILE_2)
+        self.assertEqual(store.get_used_size(), len(PNG_TILE) * 8 + len(PNG_TILE_2))
+        # the shared tiles are the least recently used ones
+        store._lookup_db_connection.execute("update tiles set last_access=last_access-86400 where x=1")
+        store._lookup_db_connection.commit()
+        evicted_bytes = store.evict_tiles(len(PNG_TILE) * 3, batch_size=2)
+        self.assertEqual(evicted_bytes, len(PNG_TILE) * 4)
+        stored = store.tiles_are_stored(lzxys + [(self.layer, 8, 2, 0)])
+        self.assertEqual(len([lzxy for lzxy in lzxys if stored[lzxy]]), 4)
+        self.assertTrue(stored[(self.layer, 8, 2, 0)])
+        self.assertEqual(store.get_used_size(), len(PNG_TILE) * 4 + len(PNG_TILE_2))
+        store.close()
+
+    def files_migration_test(self):
+        """Check tiles stored as files are migrated, resuming an interrupted migration"""
+        files_store = FileBasedTileStore(self.store_path)
+        lzxys = [(self.layer, z, x, y) for z in (3, 4) for x in range(3) for y in range(4)]
+        for lzxy in lzxys:
+            files_store.store_tile_data(lzxy, PNG_TILE)
+        with open(os.path.join(self.store_path, "3", "0", "9.png"), "wb") as f:
+            f.write(b"not an image")
+        # pretend a previous run has migrated a folder
+        with open(os.path.join(self.store_path, MIGRATION_STATE_FILE_NAME), "w") as f:
+            f.write("4/2\n4/")
+        store = SqliteTileStore(self.store_path)
+        progress = []
+        migration = FilesToSqliteMigration(self.store_path, store, thread_count=3, transaction_size=10,
+                                           delete_source=True)
+        self.assertTrue(migration.run(progress_callback=lambda done, total: progress.append((done, total))))
+        self.assertEqual(migration.migrated_tile_count, len(lzxys) - 4)
+        self.assertEqual(migration.invalid_tile_count, 1)
+        self.assertEqual(progress[-1], (6, 6))
+        for lzxy in lzxys:
+            self.assertEqual(bool(store.tile_is_stored(lzxy)), lzxy[1:3] != (4, 2))
+        self.assertEqual(store.get_tile((self.layer, 3, 1, 1))[0], PNG_TILE)
+        self.assertIsNone(store.get_tile((self.layer, 3, 0, 9)))
+        self.assertFalse(os.path.exists(os.path.join(self.store_path, MIGRATION_STATE_FILE_NAME)))
+        # migrated tile files are deleted, the invalid tile & the skipped folder are kept
+        self.assertEqual(sorted(os.listdir(os.path.join(self.store_path, "3"))), ["0"])
+        self.assertEqual(len(os.listdir(os.path.join(self.store_path, "4", "2"))), 4)
+        # an interrupted migration reports it has not finished
+        migration = FilesToSqliteMigration(self.store_path, store)
+        self.assertFalse(migration.run(should_continue=lambda: False))
+        self.assertTrue(os.path.exists(os.path.join(self.store_path, MIGRATION_STATE_FILE_NAME)))
+        store.close()
+
+    def zoom_stats_test(self):
+        """Check zoom level statistics are maintained and added to older lookup databases"""
+        store = SqliteTileStore(self.store_path, deduplicate=True)
+        with patch("core.tile_storage.sqlite_store.time.time", return_value=1000):
+            for x, y in [(1, 2), (3, 5), (2, 7)]:
+                store.store_tile_data((self.layer, 4, x, y), PNG_TILE)
+        store.store_tile_data((self.layer, 5, 9, 9), PNG_TILE_2)
+        zoom_stats = store.get_zoom_stats()
+        self.assertEqual(sorted(zoom_stats.keys()), [4, 5])
+        self.assertEqual(zoom_stats[4]["tile_count"], 3)
+        self.assertEqual(zoom_stats[4]["size"], 3 * len(PNG_TILE))
+        self.assertEqual((zoom_stats[4]["min_x"], zoom_stats[4]["max_x"]), (1, 3))
+        self.assertEqual((zoom_stats[4]["min_y"], zoom_stats[4]["max_y"]), (2, 7))
+        self.assertEqual((zoom_stats[4]["oldest_timestamp"], zoom_stats[4]["newest_timestamp"]), (1000, 1000))
+        # replace a tile & delete tiles
+        store.store_tile_data((self.layer, 4, 3, 5), PNG_TILE_2)
+        store.delete_tile((self.layer, 4, 2, 7))
+        store.delete_tile((self.layer, 5, 9, 9))
+        zoom_stats = store.get_zoom_stats()
+        self.assertEqual(list(zoom_stats.keys()), [4])
+        self.assertEqual(zoom_stats[4]["tile_count"], 2)
+        self.assertEqual(zoom_stats[4]["size"], len(PNG_TILE) + len(PNG_TILE_2))
+        self.assertGreater(zoom_stats[4]["newest_timestamp"], 1000)
+        # bounds are narrowed by compaction
+        self.assertEqual(zoom_stats[4]["max_y"], 7)
+        store.compact()
+        self.assertEqual(store.get_zoom_stats()[4]["max_y"], 5)
+        store.close()
+
+        # a lookup database created before the statistics existed
+        with sqlite3.connect(os.path.join(self.store_path, "lookup.sqlite")) as connection:
+            for trigger in ("zoom_stats_insert", "zoom_stats_update", "zoom_stats_delete"):
+                connection.execute("drop trigger %s" % trigger)
+            connection.execute("drop table zoom_stats")
+            connection.execute("alter table tiles drop column size")
+        store = SqliteTileStore(self.store_path)
+        zoom_stats = store.get_zoom_stats()
+        self.assertEqual(zoom_stats[4]["tile_count"], 2)
+        self.assertEqual(zoom_stats[4]["size"], len(PNG_TILE) + len(PNG_TILE_2))
+        store.store_tile_data((self.layer, 4, 0, 0), PNG_TILE)
+        self.assertEqual(store.get_zoom_stats()[4]["tile_count"], 3)
+        store.close()
+
+    def integrity_check_test(self):
+        """Check damaged, missing & orphaned tiles are found and repaired"""
+        store = SqliteTileStore(self.store_path)
+        lzxys = [(self.layer, 4, x, 1) for x in range(6)]
+        for lzxy in lzxys:
+            store.store_tile_data(lzxy, COMPLETE_PNG_TILE)
+        store.store_tile_data((self.layer, 4, 0, 2), b"<html>not a tile</html>")
+        store.store_tile_data((self.layer, 4, 1, 2), PNG_TILE)  # truncated
+        store_db_path = os.path.join(self.store_path, store.store_names[0])
+        with sqlite3.connect(store_db_path) as connection:
+            # tile data missing for a tile in the lookup database
+            connection.execute("delete from tiles where z=4 and x=0 and y=1")
+            # tile data the lookup database does not point to
+            connection.execute("insert into tiles (z, x, y, tile, extension, unix_epoch_timestamp) "
+                               "values (4, 7, 7, ?, 'png', 1)", (COMPLETE_PNG_TILE,))
+        progress = []
+        report = store.check_integrity(thread_count=2,
+                                       progress_callback=lambda message, value: progress.append(value))
+        self.assertEqual(report["checked_tiles"], 8)
+        self.assertEqual(report["invalid_tiles"], 2)
+        self.assertEqual(report["missing_tiles"], 1)
+        self.assertEqual(report["orphaned_tiles"], 1)
+        self.assertEqual(report["damaged_databases"], [])
+        self.assertEqual(report["repaired_tiles"], 0)
+        self.assertEqual(progress[-1], 1.0)
+
+        report = store.check_integrity(repair=True)
+        self.assertEqual(report["repaired_tiles"], 4)
+        self.assertEqual(report["quarantined_tiles"], 2)
+        self.assertIsNone(store.get_tile((self.layer, 4, 0, 2)))
+        self.assertIsNone(store.get_tile((self.layer, 4, 1, 2)))
+        self.assertFalse(store.tile_is_stored((self.layer, 4, 0, 1)))
+        self.assertEqual(store.get_tile((self.layer, 4, 7, 7))[0], COMPLETE_PNG_TILE)
+        with open(os.path.join(self.store_path, "quarantine", "4", "0", "2.png"), "rb") as f:
+            self.assertEqual(f.read(), b"<html>not a tile</html>")
+        report = store.check_integrity()
+        self.assertEqual(report["invalid_tiles"] + report["missing_tiles"] + report["orphaned_tiles"], 0)
+        self.assertEqual(report["checked_tiles"], 6)
+        store.close()
+
+
+class FileBasedTileStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.layer = get_layer()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def eviction_test(self):
+        """Check least recently used tile files are evicted first"""
+        store = FileBasedTileStore(self.store_path)
+        lzxys = [(self.layer, 4, x, 1) for x in range(6)]
+        for lzxy in lzxys:
+            store.store_tile_data(lzxy, PNG_TILE)
+            # pretend the tiles have been stored & accessed a day ago
+            tile_path = store._get_tile_file_path(lzxy)
+            old_time = time.time() - 86400
+            os.utime(tile_path, (old_time, old_time))
+        for lzxy in lzxys[:3]:
+            store.get_tile(lzxy)
+        self.assertEqual(store.get_used_size(), len(PNG_TILE) * len(lzxys))
+        self.assertEqual(store.evict_tiles(len(PNG_TILE) * 3), len(PNG_TILE) * 3)
+        for lzxy in lzxys[:3]:
+            self.assertTrue(store.tile_is_stored(lzxy)[0])
+        for lzxy in lzxys[3:]:
+            self.assertFalse(store.tile_is_stored(lzxy))
+            # empty folders should be removed
+            self.assertFalse(os.path.exists(os.path.join(self.store_path, "4", str(lzxy[2]))))
+
+    def eviction_order_test(self):
+        """Check tile files of different sizes are evicted in least recently used order"""
+        store = FileBasedTileStore(self.store_path)
+        now = time.time()
+        for x in range(10):
+            lzxy = (self.layer, 4, x, 1)
+            store.store_tile_data(lzxy, PNG_TILE + b"x" * (x * 10))
+            access_time = now - 86400 - (x % 5) * 3600 - x
+            os.utime(store._get_tile_file_path(lzxy), (access_time, access_time))
+        # x = 9, 4, 8, 3, 7, ... from the least recently used
+        evicted_bytes = store.evict_tiles(2 * len(PNG_TILE) + 100)
+        self.assertEqual(evicted_bytes, 2 * len(PNG_TILE) + 130)
+        # check the tile files directly, as tile lookups count as tile accesses
+        stored = [x for x in range(10) if os.path.exists(store._get_tile_file_path((self.layer, 4, x, 1)))]
+        self.assertEqual(stored, [0, 1, 2, 3, 5, 6, 7, 8])
+        evicted_bytes = store.evict_tiles(2 * len(PNG_TILE) + 100)
+        self.assertEqual(evicted_bytes, 2 * len(PNG_TILE) + 110)
+        stored = [x for x in range(10) if os.path.exists(store._get_tile_file_path((self.layer, 4, x, 1)))]
+        self.assertEqual(stored, [0, 1, 2, 5, 6, 7])
+        self.assertEqual(store.evict_tiles(0), 0)
+
+    def used_size_test(self):
+        """Check the used size is kept up to date without walking the store"""
+        store = FileBasedTileStore(self.store_path)
+        store.store_tile_data((self.layer, 3, 1, 1), PNG_TILE)
+        self.assertEqual(store.get_used_size(), len(PNG_TILE))
+
+        def get_actual_size():
+            return sum(os.path.getsize(os.path.join(path, name))
+                       for path, _folders, names in os.walk(self.store_path) for name in names
+                       if name[0].isdigit())
+
+        with patch.object(store, "_iter_tile_files", side_effect=AssertionError("the store has been walked")):
+            store.store_tile_data((self.layer, 3, 1, 2), PNG_TILE)
+            store.store_tile_data((self.layer, 3, 1, 1), PNG_TILE_2)
+            store.store_tile_data((self.layer, 3, 2, 1), PNG_TILE)
+            store.delete_tile((self.layer, 3, 2, 1))
+            self.assertEqual(store.get_used_size(), len(PNG_TILE) + len(PNG_TILE_2))
+            self.assertEqual(store.get_used_size(), get_actual_size())
+        store.delete_expired_tiles(time.time() + 60)
+        self.assertEqual(store.get_used_size(), 0)
+        # tiles renamed in place by the syncer are counted as well
+        durable_store = FileBasedTileStore(self.store_path, durable=True)
+        self.assertEqual(durable_store.get_used_size(), 0)
+        durable_store.store_tile_data((self.layer, 3, 1, 1), PNG_TILE)
+        durable_store.store_tile_data((self.layer, 3, 1, 2), PNG_TILE_2)
+        durable_store.flush()
+        with patch.object(durable_store, "_iter_tile_files", side_effect=AssertionError("the store has been walked")):
+            self.assertEqual(durable_store.get_used_size(), len(PNG_TILE) + len(PNG_TILE_2))
+        durable_store.close()
+        # tile files changed by others are found once the store is walked again
+        self.assertEqual(store.get_used_size(), 0)
+        with patch("core.tile_storage.files_store.FILES_USED_SIZE_RECOUNT_INTERVAL", 0):
+            self.assertEqual(store.get_used_size(), len(PNG_TILE) + len(PNG_TILE_2))
+
+
+    def expired_tiles_test(self):
+        """Check tile files modified before a timestamp are found and deleted"""
+        store = FileBasedTileStore(self.store_path)
+        lzxys = [(self.layer, 3, x, 2) for x in range(4)]
+        now = time.time()
+        for lzxy in lzxys:
+            store.store_tile_data(lzxy, PNG_TILE)
+        for lzxy in lzxys[:2]:
+            file_path = store._get_tile_file_path(lzxy)
+            os.utime(file_path, (now, now - 86400 + lzxy[2]))
+        expired_before = int(now) - 3600
+        self.assertEqual(store.get_expired_tiles(expired_before), [(3, 0, 2), (3, 1, 2)])
+        self.assertEqual(store.get_expired_tiles(expired_before, limit=1), [(3, 0, 2)])
+        self.assertEqual(store.delete_expired_tiles(expired_before), 2)
+        for lzxy in lzxys:
+            self.assertEqual(bool(store.tile_is_stored(lzxy)), lzxy[2] >= 2)
+        self.assertFalse(os.path.exists(os.path.join(self.store_path, "3", "0")))
+
+    def integrity_check_test(self):
+        """Check damaged tile files are quarantined and leftover partial files deleted"""
+        store = FileBasedTileStore(self.store_path)
+        for x in range(3):
+            store.store_tile_data((self.layer, 2, x, 1), COMPLETE_PNG_TILE)
+        store.store_tile_data((self.layer, 2, 3, 1), b"<html>not a tile</html>")
+        partial_file_path = os.path.join(self.store_path, "2", "0", "5.png.part")
+        with open(partial_file_path, "wb") as f:
+            f.write(PNG_TILE)
+        os.utime(partial_file_path, (time.time() - 86400, time.time() - 86400))
+        report = store.check_integrity(thread_count=2)
+        self.assertEqual(report["checked_tiles"], 4)
+        self.assertEqual(report["invalid_tiles"], 1)
+        self.assertEqual(report["orphaned_tiles"], 1)
+        report = store.check_integrity(repair=True)
+        self.assertEqual(report["repaired_tiles"], 2)
+        self.assertEqual(report["quarantined_tiles"], 1)
+        self.assertFalse(os.path.exists(partial_file_path))
+        self.assertFalse(os.path.exists(os.path.join(self.store_path, "2", "3")))
+        self.assertTrue(os.path.isfile(os.path.join(self.store_path, "quarantine", "2", "3", "1.png")))
+        self.assertEqual(sorted(store.get_tile_coordinates(2)), [(0, 1), (1, 1), (2, 1)])
+        self.assertEqual(store.check_integrity()["invalid_tiles"], 0)
+
+    def fuzzy_lookup_cache_test(self):
+        """Check fuzzy matching misses and folder listings are cached and invalidated"""
+        store = FileBasedTileStore(self.store_path)
+        jpg_layer = get_layer("jpg")
+        store.store_tile_data((self.layer, 2, 1, 1), PNG_TILE)
+        # found by fuzzy matching under a different extension
+        self.assertEqual(store.get_tile((jpg_layer, 2, 1, 1))[0], PNG_TILE)
+        self.assertIsNone(store.get_tile((jpg_layer, 2, 1, 2)))
+        # a tile added by someone else is not looked for until the miss times out
+        with open(os.path.join(self.store_path, "2", "1", "2.png"), "wb") as f:
+            f.write(PNG_TILE_2)
+        with patch("os.stat") as stat:
+            self.assertIsNone(store.get_tile((jpg_layer, 2, 1, 2)))
+            self.assertFalse(store.tile_is_stored((jpg_layer, 2, 1, 2)))
+            stat.assert_not_called()
+        with patch("core.tile_storage.files_store.FILES_NEGATIVE_CACHE_TIMEOUT", -1):
+            self.assertEqual(store.get_tile((jpg_layer, 2, 1, 2))[0], PNG_TILE_2)
+        # tiles stored by the store are found right away
+        self.assertIsNone(store.get_tile((jpg_layer, 2, 1, 3)))
+        store.store_tile_data((self.layer, 2, 1, 3), PNG_TILE)
+        self.assertEqual(store.get_tile((jpg_layer, 2, 1, 3))[0], PNG_TILE)
+        store.delete_tile((self.layer, 2, 1, 3))
+        self.assertIsNone(store.get_tile((jpg_layer, 2, 1, 3)))
+
+    def fuzzy_lookup_during_store_test(self):
+        """Check a lookup running while a tile is being stored does not hide the tile"""
+        store = FileBasedTileStore(self.store_path)
+        jpg_layer = get_layer("jpg")
+        rename = os.rename
+        lookup_results = []
+
+        def rename_with_lookup(source, destination):
+            # the tile has been written but it is not in place yet
+            lookup_results.append(store.get_tile((jpg_layer, 2, 1, 4)))
+            rename(source, destination)
+
+        with patch("os.rename", rename_with_lookup):
+            store.store_tile_data((self.layer, 2, 1, 4), PNG_TILE)
+        self.assertEqual(lookup_results, [None])
+        self.assertEqual(store.get_tile((jpg_layer, 2, 1, 4))[0], PNG_TILE)
+        self.assertTrue(store.tile_is_stored((jpg_layer, 2, 1, 4)))
+
+
+    def durable_mode_test(self):
+        """Check tiles are synced in batches before being renamed in place"""
+        syncfs = MagicMock(return_value=0)
+        with patch("core.tile_storage.files_store._syncfs", syncfs):
+            store = FileBasedTileStore(self.store_path, durable=True, sync_batch_size=20, sync_interval=60)
+            for y in range(10):
+                store.store_tile_data((self.layer, 3, 1, y), PNG_TILE)
+            store.store_tile_data((self.layer, 3, 1, 0), PNG_TILE_2)
+            store.store_tile_data((self.layer, 3, 2, 0), PNG_TILE)
+            # unsynced tiles are readable but not in place yet
+            self.assertEqual(store.get_tile((self.layer, 3, 1, 0))[0], PNG_TILE_2)
+            self.assertFalse(store.tile_is_stored((get_layer("jpg"), 3, 1, 5), fuzzy_matching=False))
+            self.assertTrue(store.tile_is_stored((self.layer, 3, 1, 5))[0])
+            self.assertFalse(os.path.exists(os.path.join(self.store_path, "3", "1", "5.png")))
+            store.delete_tile((self.layer, 3, 2, 0))
+            syncfs.assert_not_called()
+            store.flush()
+            # tile data and renames are synced once for the whole batch
+            self.assertEqual(syncfs.call_count, 2)
+            self.assertEqual(sorted(os.listdir(os.path.join(self.store_path, "3", "1"))),
+                             sorted("%d.png" % y for y in range(10)))
+            self.assertEqual(store.get_tile((self.layer, 3, 1, 0))[0], PNG_TILE_2)
+            self.assertIsNone(store.get_tile((self.layer, 3, 2, 0)))
+            # the sync interval is respected
+            store._sync_interval = 0.05
+            store.store_tile_data((self.layer, 3, 1, 10), PNG_TILE)
+            for _i in range(100):
+                if os.path.exists(os.path.join(self.store_path, "3", "1", "10.png")):
+                    break
+                time.sleep(0.01)
+            self.assertTrue(os.path.exists(os.path.join(self.store_path, "3", "1", "10.png")))
+            store.store_tile_data((self.layer, 3, 1, 11), PNG_TILE)
+            store.close()
+            self.assertTrue(os.path.exists(os.path.join(self.store_path, "3", "1", "11.png")))
+
+    def durable_mode_delete_during_sync_test(self):
+        """Check a tile deleted while being synced does not reappear once synced"""
+        store = FileBasedTileStore(self.store_path, durable=True, sync_batch_size=20, sync_interval=60)
+        sync_filesystem = store._sync_filesystem
+        deleted_tiles = []
+
+        def sync_filesystem_with_delete(paths):
+            # the tiles have been taken from the sync queue but not renamed in place yet
+            if not deleted_tiles:
+                deleted_tiles.append((self.layer, 3, 1, 0))
+                store.delete_tile((self.layer, 3, 1, 0))
+            sync_filesystem(paths)
+
+        store._sync_filesystem = sync_filesystem_with_delete
+        store.store_tile_data((self.layer, 3, 1, 0), PNG_TILE)
+        store.store_tile_data((self.layer, 3, 1, 1), PNG_TILE)
+        store.flush()
+        self.assertEqual(deleted_tiles, [(self.layer, 3, 1, 0)])
+        self.assertIsNone(store.get_tile((self.layer, 3, 1, 0)))
+        self.assertEqual(store.get_tile((self.layer, 3, 1, 1))[0], PNG_TILE)
+        # no partial files are left behind
+        self.assertEqual(os.listdir(os.path.join(self.store_path, "3", "1")), ["1.png"])
+        # the deleted tile can be stored again
+        store.store_tile_data((self.layer, 3, 1, 0), PNG_TILE_2)
+        store.close()
+        self.assertEqual(store.get_tile((self.layer, 3, 1, 0))[0], PNG_TILE_2)
+
+
+class PackFileTileStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.layer = get_layer()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def store_and_get_test(self):
+        """Check basic tile storage operations, both from the journal and the index"""
+        store = PackFileTileStore(self.store_path)
+        lzxy = (self.layer, 1, 2, 3)
+        self.assertFalse(PackFileTileStore.is_store(self.store_path))
+        self.assertIsNone(store.get_tile(lzxy))
+        self.assertFalse(store.tile_is_stored(lzxy))
+        store.store_tile_data(lzxy, PNG_TILE)
+        self.assertEqual(store.get_tile(lzxy)[0], PNG_TILE)
+        self.assertTrue(store.tile_is_stored(lzxy)[0])
+        self.assertTrue(PackFileTileStore.is_store(self.store_path))
+        # merge the journal to the index
+        store.flush()
+        self.assertEqual(store.get_tile(lzxy)[0], PNG_TILE)
+        # replace the tile
+        store.store_tile_data(lzxy, PNG_TILE_2)
+        self.assertEqual(store.get_tile(lzxy)[0], PNG_TILE_2)
+        store.flush()
+        self.assertEqual(store.get_tile(lzxy)[0], PNG_TILE_2)
+        store.delete_tile(lzxy)
+        self.assertIsNone(store.get_tile(lzxy))
+        store.flush()
+        self.assertIsNone(store.get_tile(lzxy))
+        # deleting a tile that is not stored should not fail
+        store.delete_tile(lzxy)
+        store.close()
+
+    def reopen_test(self):
+        """Check tiles are found after the store is reopened and pack files roll over"""
+        store = PackFileTileStore(self.store_path)
+        lzxys = [(self.layer, 5, x, y) for x in range(10) for y in range(10)]
+        with patch.object(pack_store, "MAX_PACK_FILE_SIZE", 1000 / pack_store.GIBI_BYTE):
+            for lzxy in lzxys:
+                store.store_tile_data(lzxy, PNG_TILE)
+            store.store_tile_data((self.layer, 4, 1, 1), PNG_TILE_2)
+        self.assertGreater(len(store.stats()["pack_sizes"]), 1)
+        signature = store.get_modification_signature(5)
+        store.close()
+
+        store = PackFileTileStore(self.store_path)
+        self.assertEqual(store.get_modification_signature(5), signature)
+        for lzxy in lzxys:
+            self.assertEqual(store.get_tile(lzxy)[0], PNG_TILE)
+        self.assertEqual(store.get_tile((self.layer, 4, 1, 1))[0], PNG_TILE_2)
+        self.assertEqual(sorted(store.get_tile_coordinates(5)), [(x, y) for x in range(10) for y in range(10)])
+        self.assertEqual(store.get_tile_coordinates(4), [(1, 1)])
+        self.assertEqual(store.get_tile_coordinates(6), [])
+        store.close()
+
+    def crash_recovery_test(self):
+        """Check records not covered by the index are replayed and a torn record is truncated"""
+        store = PackFileTileStore(self.store_path)
+        indexed_lzxy = (self.layer, 3, 1, 1)
+        store.store_tile_data(indexed_lzxy, PNG_TILE)
+        store.flush()
+        lzxys = [(self.layer, 3, x, 2) for x in range(5)]
+        for lzxy in lzxys:
+            store.store_tile_data(lzxy, PNG_TILE)
+        store.delete_tile(indexed_lzxy)
+        # simulate a crash - the records are written but the index is not
+        store._write_file.flush()
+        pack_path = store._get_pack_path(0)
+        pack_size = os.path.getsize(pack_path)
+        with open(pack_path, "ab") as f:
+            f.write(pack_store.RECORD_HEADER.pack(pack_store.RECORD_MAGIC, 3, 9, 9, 0, 100, 0) + b"torn")
+
+        store = PackFileTileStore(self.store_path)
+        self.assertEqual(os.path.getsize(pack_path), pack_size)
+        for lzxy in lzxys:
+            self.assertEqual(store.get_tile(lzxy)[0], PNG_TILE)
+        self.assertIsNone(store.get_tile(indexed_lzxy))
+        self.assertIsNone(store.get_tile((self.layer, 3, 9, 9)))
+        # a damaged index is rebuilt from the pack files
+        store.close()
+        with open(os.path.join(self.store_path, pack_store.PACK_INDEX_NAME), "ab") as f:
+            f.write(b"garbage")
+        store = PackFileTileStore(self.store_path)
+        self.assertEqual(sorted(store.get_tile_coordinates(3)), [(x, 2) for x in range(5)])
+        store.clear()
+        self.assertFalse(PackFileTileStore.is_store(self.store_path))
+
+    def expired_tiles_test(self):
+        """Check tiles stored before a timestamp are found and deleted"""
+        store = PackFileTileStore(self.store_path)
+        lzxys = [(self.layer, 3, x, 2) for x in range(4)]
+        now = int(time.time())
+        with patch.object(pack_store.time, "time", side_effect=[now - 86400 + 1, now - 86400, now, now]):
+            for lzxy in lzxys:
+                store.store_tile_data(lzxy, PNG_TILE)
+        store.flush()
+        expired_before = now - 3600
+        self.assertEqual(store.get_expired_tiles(expired_before), [(3, 1, 2), (3, 0, 2)])
+        self.assertEqual(store.get_expired_tiles(expired_before, limit=1), [(3, 1, 2)])
+        self.assertEqual(store.delete_expired_tiles(expired_before), 2)
+        for lzxy in lzxys:
+            self.assertEqual(bool(store.tile_is_stored(lzxy)), lzxy[2] >= 2)
+        store.close()
+
+
+class MBTilesTileStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.layer = get_layer()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def export_mount_import_test(self):
+        """Check exporting tiles to a MBTiles pack, reading from it and importing it back"""
+        sqlite_store = SqliteTileStore(os.path.join(self.store_path, "sqlite"))
+        lzxys = [(self.layer, 3, x, y) for x in range(8) for y in range(8)]
+        for lzxy in lzxys:
+            sqlite_store.store_tile_data(lzxy, PNG_TILE)
+        sqlite_store.store_tile_data((self.layer, 10, 1, 2), PNG_TILE_2)
+        pack_folder = os.path.join(self.store_path, "pack")
+        os.mkdir(pack_folder)
+        self.assertFalse(MBTilesTileStore.is_store(pack_folder))
+        pack_path = os.path.join(pack_folder, "pack.mbtiles")
+        self.assertEqual(export_to_mbtiles(sqlite_store, pack_path), len(lzxys) + 1)
+        sqlite_store.close()
+
+        self.assertTrue(MBTilesTileStore.is_store(pack_folder))
+        mbtiles_store = MBTilesTileStore(pack_folder)
+        self.assertEqual(mbtiles_store.get_tile((self.layer, 10, 1, 2))[0], PNG_TILE_2)
+        self.assertIsNone(mbtiles_store.get_tile((self.layer, 10, 1, 3)))
+        self.assertTrue(mbtiles_store.tile_is_stored((self.layer, 3, 0, 0))[0])
+        self.assertFalse(mbtiles_store.tile_is_stored((self.layer, 3, 8, 0)))
+        # the tile rows are stored flipped according to the TMS scheme
+        connection = sqlite3.connect(pack_path)
+        self.assertEqual(connection.execute("select tile_row from tiles where zoom_level=10").fetchone()[0], 1021)
+        self.assertEqual(dict(connection.execute("select name, value from metadata"))["format"], "png")
+        connection.close()
+        tiles = mbtiles_store.get_tiles(lzxys + [(self.layer, 4, 0, 0)])
+        for lzxy in lzxys:
+            self.assertEqual(tiles[lzxy][0], PNG_TILE)
+        self.assertIsNone(tiles[(self.layer, 4, 0, 0)])
+        self.assertEqual(sorted(mbtiles_store.get_tile_coordinates(10)), [(1, 2)])
+        mbtiles_store.close()
+
+        # import the pack to a store already containing some tiles
+        import_store = SqliteTileStore(os.path.join(self.store_path, "import"))
+        import_store.store_tile_data((self.layer, 10, 1, 2), PNG_TILE)
+        import_store.store_tile_data((self.layer, 11, 1, 2), PNG_TILE)
+        self.assertEqual(import_from_mbtiles(pack_path, import_store), len(lzxys) + 1)
+        self.assertEqual(import_store.get_tile((self.layer, 10, 1, 2))[0], PNG_TILE_2)
+        self.assertEqual(import_store.get_tile((self.layer, 11, 1, 2))[0], PNG_TILE)
+        tiles = import_store.get_tiles(lzxys)
+        for lzxy in lzxys:
+            self.assertEqual(tiles[lzxy][0], PNG_TILE)
+        lookup_connection = import_store._lookup_db_connection
+        self.assertEqual(lookup_connection.execute("select count(*) from tiles").fetchone()[0], len(lzxys) + 2)
+        import_store.close()
+
+    def delta_export_import_test(self):
+        """Check exporting only modified tiles & importing them with last writer wins"""
+        master_store = SqliteTileStore(os.path.join(self.store_path, "master"))
+        master_store.store_tiles([(3, x, 0, "png", PNG_TILE, 1000) for x in range(8)])
+        master_store.store_tiles([(3, 1, 1, "png", PNG_TILE_2, 2000), (3, 2, 1, "png", PNG_TILE_2, 3000)])
+        pack_path = os.path.join(self.store_path, "delta.mbtiles")
+        self.assertEqual(export_to_mbtiles(master_store, pack_path, modified_since=2000), 2)
+        empty_pack_path = os.path.join(self.store_path, "empty.mbtiles")
+        self.assertEqual(export_to_mbtiles(master_store, empty_pack_path, modified_since=3001), 0)
+        master_store.close()
+        connection = sqlite3.connect(pack_path)
+        metadata = dict(connection.execute("select name, value from metadata"))
+        self.assertEqual(metadata["modrana_modified_since"], "2000")
+        self.assertEqual(metadata["modrana_newest_timestamp"], "3000")
+        connection.close()
+
+        device_store = SqliteTileStore(os.path.join(self.store_path, "device"))
+        # 3/1/1 is older than the delta, 3/2/1 newer
+        device_store.store_tiles([(3, 1, 1, "png", PNG_TILE, 1500), (3, 2, 1, "png", PNG_TILE, 4000)])
+        self.assertEqual(import_from_mbtiles(pack_path, device_store), 1)
+        self.assertEqual(device_store.get_tile((self.layer, 3, 1, 1)), (PNG_TILE_2, 2000))
+        self.assertEqual(device_store.get_tile((self.layer, 3, 2, 1)), (PNG_TILE, 4000))
+        # importing the same delta again does nothing
+        self.assertEqual(import_from_mbtiles(pack_path, device_store), 0)
+        self.assertEqual(import_from_mbtiles(empty_pack_path, device_store), 0)
+        self.assertEqual(sorted(device_store.get_tile_coordinates(3)), [(1, 1), (2, 1)])
+        device_store.close()
+
+
+class TilePresenceIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.layer = get_layer()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def wait_for_index(self, index, z):
+        """Query the index until the zoom level index has been built"""
+        index.might_be_stored(z, 0, 0)
+        for i in range(100):
+            if z in index._ready or z in index._unsupported:
+                return
+            time.sleep(0.05)
+        self.fail("presence index for zoom level %d has not been built" % z)
+
+    def bloom_filter_test(self):
+        """Check the Bloom filter has no false negatives and grows when full"""
+        bloom_filter = ScalableBloomFilter(initial_capacity=100)
+        for key in range(5000):
+            bloom_filter.add(key)
+        self.assertGreater(len(bloom_filter.filters), 1)
+        for key in range(5000):
+            self.assertIn(key, bloom_filter)
+        false_positives = sum(1 for key in range(5000, 15000) if key in bloom_filter)
+        self.assertLess(false_positives, 500)
+
+    def presence_index_test(self):
+        """Check the presence index built from sqlite & files stores and its persistence"""
+        sqlite_store = SqliteTileStore(self.store_path)
+        files_store = FileBasedTileStore(self.store_path)
+        sqlite_store.store_tile_data((self.layer, 5, 1, 1), PNG_TILE)
+        files_store.store_tile_data((self.layer, 5, 2, 2), PNG_TILE)
+        stores = [sqlite_store, files_store]
+        index = TilePresenceIndex(lambda: stores, persistence_folder=self.store_path)
+        self.wait_for_index(index, 5)
+        self.assertTrue(index.might_be_stored(5, 1, 1))
+        self.assertTrue(index.might_be_stored(5, 2, 2))
+        self.assertFalse(index.might_be_stored(5, 3, 3))
+        sqlite_store.store_tile_data((self.layer, 5, 3, 3), PNG_TILE)
+        index.add(5, 3, 3)
+        self.assertTrue(index.might_be_stored(5, 3, 3))
+        sqlite_store.close()
+        index.save()
+
+        # the persisted index should be used if the stores have not changed
+        index = TilePresenceIndex(lambda: stores, persistence_folder=self.store_path)
+        self.assertIsNotNone(index._load(5, stores))
+        self.wait_for_index(index, 5)
+        self.assertTrue(index.might_be_stored(5, 3, 3))
+        self.assertFalse(index.might_be_stored(5, 4, 4))
+        # but not once they have been modified
+        files_store.store_tile_data((self.layer, 5, 4, 4), PNG_TILE)
+        self.assertIsNone(index._load(5, stores))
+
+
+class StoreRoutingCacheTests(unittest.TestCase):
+
+    def routing_test(self):
+        """Check the store that served a region goes first and known misses are skipped"""
+        layer = get_layer()
+        routing = StoreRoutingCache()
+        store_items = [("files", "files store"), ("sqlite", "sqlite store"), ("mbtiles", "mbtiles store")]
+        self.assertEqual(routing.route((layer, 5, 1, 1), store_items), store_items)
+        routing.record_miss("files", (layer, 5, 1, 1))
+        routing.record_hit("mbtiles", (layer, 5, 1, 1))
+        # the mbtiles store served the region, the files store does not have the tile
+        self.assertEqual(routing.route((layer, 5, 1, 1), store_items),
+                         [("mbtiles", "mbtiles store"), ("sqlite", "sqlite store")])
+        # a neighbouring tile from the same region
+        self.assertEqual(routing.route((layer, 5, 2, 3), store_items),
+                         [("mbtiles", "mbtiles store"), ("files", "files store"), ("sqlite", "sqlite store")])
+        self.assertEqual(routing.split_known_misses("files", [(layer, 5, 1, 1), (layer, 5, 2, 3)]),
+                         ([(layer, 5, 2, 3)], [(layer, 5, 1, 1)]))
+        # writing the tile drops the miss
+        routing.record_write("files", (layer, 5, 1, 1))
+        self.assertEqual(routing.route((layer, 5, 1, 1), store_items)[0], ("files", "files store"))
+        routing.record_miss("sqlite", (layer, 5, 1, 1))
+        routing.invalidate()
+        self.assertEqual(routing.route((layer, 5, 1, 1), store_items), store_items)
+        # misses time out
+        routing = StoreRoutingCache(miss_timeout=-1)
+        routing.record_miss("files", (layer, 5, 1, 1))
+        self.assertEqual(routing.route((layer, 5, 1, 1), store_items), store_items)